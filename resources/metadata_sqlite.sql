@@ -336,6 +336,7 @@ CREATE INDEX custom_columns_idx ON custom_columns (label);
 CREATE INDEX data_idx ON data (book);
 CREATE INDEX lrp_idx ON last_read_positions (book);
 CREATE INDEX annot_idx ON annotations (book);
+CREATE INDEX annot_timestamp_idx ON annotations (timestamp);
 CREATE INDEX formats_idx ON data (format);
 CREATE INDEX languages_idx ON languages (lang_code COLLATE NOCASE);
 CREATE INDEX publishers_idx ON publishers (name COLLATE NOCASE);
@@ -638,4 +639,4 @@ CREATE TRIGGER series_update_trg
         BEGIN
           UPDATE series SET sort=title_sort(NEW.name) WHERE id=NEW.id;
         END;
-pragma user_version=26;
+pragma user_version=27;
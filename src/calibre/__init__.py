@@ -10,6 +10,9 @@
 
 if not hasenv('CALIBRE_SHOW_DEPRECATION_WARNINGS'):
     warnings.simplefilter('ignore', DeprecationWarning)
+if hasenv('CALIBRE_PROFILE_IMPORTS'):
+    from calibre.utils.import_profiler import install_import_profiler
+    install_import_profiler(os.environ['CALIBRE_PROFILE_IMPORTS'])
 try:
     os.getcwd()
 except OSError:
@@ -598,11 +598,10 @@ def initialize(self):
         Tab will be dynamically generated and added to the Catalog Options dialog in
         calibre.gui2.dialogs.catalog.py:Catalog
         '''
-        from calibre.customize.builtins import plugins as builtin_plugins
         from calibre.customize.ui import config
         from calibre.ptempfile import PersistentTemporaryDirectory
 
-        if type(self) not in builtin_plugins and self.name not in config['disabled_plugins']:
+        if self.plugin_path is not None and self.name not in config['disabled_plugins']:
             files_to_copy = [f"{self.name.lower()}.{ext}" for ext in ["ui","py"]]
             resources = zipfile.ZipFile(self.plugin_path,'r')
 
@@ -588,99 +588,63 @@ def set_metadata(self, stream, mi, type):
 # }}}
 
 # Conversion plugins {{{
-from calibre.ebooks.conversion.plugins.comic_input import ComicInput
-from calibre.ebooks.conversion.plugins.djvu_input import DJVUInput
-from calibre.ebooks.conversion.plugins.epub_input import EPUBInput
-from calibre.ebooks.conversion.plugins.fb2_input import FB2Input
-from calibre.ebooks.conversion.plugins.html_input import HTMLInput
-from calibre.ebooks.conversion.plugins.htmlz_input import HTMLZInput
-from calibre.ebooks.conversion.plugins.lit_input import LITInput
-from calibre.ebooks.conversion.plugins.mobi_input import MOBIInput
-from calibre.ebooks.conversion.plugins.odt_input import ODTInput
-from calibre.ebooks.conversion.plugins.pdb_input import PDBInput
-from calibre.ebooks.conversion.plugins.azw4_input import AZW4Input
-from calibre.ebooks.conversion.plugins.pdf_input import PDFInput
-from calibre.ebooks.conversion.plugins.pml_input import PMLInput
-from calibre.ebooks.conversion.plugins.rb_input import RBInput
-from calibre.ebooks.conversion.plugins.recipe_input import RecipeInput
-from calibre.ebooks.conversion.plugins.rtf_input import RTFInput
-from calibre.ebooks.conversion.plugins.tcr_input import TCRInput
-from calibre.ebooks.conversion.plugins.txt_input import TXTInput
-from calibre.ebooks.conversion.plugins.lrf_input import LRFInput
-from calibre.ebooks.conversion.plugins.chm_input import CHMInput
-from calibre.ebooks.conversion.plugins.snb_input import SNBInput
-from calibre.ebooks.conversion.plugins.docx_input import DOCXInput
-
-from calibre.ebooks.conversion.plugins.epub_output import EPUBOutput
-from calibre.ebooks.conversion.plugins.fb2_output import FB2Output
-from calibre.ebooks.conversion.plugins.lit_output import LITOutput
-from calibre.ebooks.conversion.plugins.lrf_output import LRFOutput
-from calibre.ebooks.conversion.plugins.mobi_output import (MOBIOutput,
-        AZW3Output)
-from calibre.ebooks.conversion.plugins.oeb_output import OEBOutput
-from calibre.ebooks.conversion.plugins.pdb_output import PDBOutput
-from calibre.ebooks.conversion.plugins.pdf_output import PDFOutput
-from calibre.ebooks.conversion.plugins.pml_output import PMLOutput
-from calibre.ebooks.conversion.plugins.rb_output import RBOutput
-from calibre.ebooks.conversion.plugins.rtf_output import RTFOutput
-from calibre.ebooks.conversion.plugins.tcr_output import TCROutput
-from calibre.ebooks.conversion.plugins.txt_output import TXTOutput, TXTZOutput
-from calibre.ebooks.conversion.plugins.html_output import HTMLOutput
-from calibre.ebooks.conversion.plugins.htmlz_output import HTMLZOutput
-from calibre.ebooks.conversion.plugins.snb_output import SNBOutput
-from calibre.ebooks.conversion.plugins.docx_output import DOCXOutput
 
-plugins += [
-    ComicInput,
-    DJVUInput,
-    EPUBInput,
-    FB2Input,
-    HTMLInput,
-    HTMLZInput,
-    LITInput,
-    MOBIInput,
-    ODTInput,
-    PDBInput,
-    AZW4Input,
-    PDFInput,
-    PMLInput,
-    RBInput,
-    RecipeInput,
-    RTFInput,
-    TCRInput,
-    TXTInput,
-    LRFInput,
-    CHMInput,
-    SNBInput,
-    DOCXInput,
-]
-plugins += [
-    EPUBOutput,
-    DOCXOutput,
-    FB2Output,
-    LITOutput,
-    LRFOutput,
-    MOBIOutput, AZW3Output,
-    OEBOutput,
-    PDBOutput,
-    PDFOutput,
-    PMLOutput,
-    RBOutput,
-    RTFOutput,
-    TCROutput,
-    TXTOutput,
-    TXTZOutput,
-    HTMLOutput,
-    HTMLZOutput,
-    SNBOutput,
-]
+# The plugins below are only imported and initialized when they are first
+# needed, see load_lazy_plugins() in calibre/customize/ui.py. Each entry is
+# the name of the plugin and the location of its class.
+lazy_plugins = {}
+
+lazy_plugins['conversion'] = (
+    ('Comic Input', 'calibre.ebooks.conversion.plugins.comic_input:ComicInput'),
+    ('DJVU Input', 'calibre.ebooks.conversion.plugins.djvu_input:DJVUInput'),
+    ('EPUB Input', 'calibre.ebooks.conversion.plugins.epub_input:EPUBInput'),
+    ('FB2 Input', 'calibre.ebooks.conversion.plugins.fb2_input:FB2Input'),
+    ('HTML Input', 'calibre.ebooks.conversion.plugins.html_input:HTMLInput'),
+    ('HTLZ Input', 'calibre.ebooks.conversion.plugins.htmlz_input:HTMLZInput'),
+    ('LIT Input', 'calibre.ebooks.conversion.plugins.lit_input:LITInput'),
+    ('MOBI Input', 'calibre.ebooks.conversion.plugins.mobi_input:MOBIInput'),
+    ('ODT Input', 'calibre.ebooks.conversion.plugins.odt_input:ODTInput'),
+    ('PDB Input', 'calibre.ebooks.conversion.plugins.pdb_input:PDBInput'),
+    ('AZW4 Input', 'calibre.ebooks.conversion.plugins.azw4_input:AZW4Input'),
+    ('PDF Input', 'calibre.ebooks.conversion.plugins.pdf_input:PDFInput'),
+    ('PML Input', 'calibre.ebooks.conversion.plugins.pml_input:PMLInput'),
+    ('RB Input', 'calibre.ebooks.conversion.plugins.rb_input:RBInput'),
+    ('Recipe Input', 'calibre.ebooks.conversion.plugins.recipe_input:RecipeInput'),
+    ('RTF Input', 'calibre.ebooks.conversion.plugins.rtf_input:RTFInput'),
+    ('TCR Input', 'calibre.ebooks.conversion.plugins.tcr_input:TCRInput'),
+    ('TXT Input', 'calibre.ebooks.conversion.plugins.txt_input:TXTInput'),
+    ('LRF Input', 'calibre.ebooks.conversion.plugins.lrf_input:LRFInput'),
+    ('CHM Input', 'calibre.ebooks.conversion.plugins.chm_input:CHMInput'),
+    ('SNB Input', 'calibre.ebooks.conversion.plugins.snb_input:SNBInput'),
+    ('DOCX Input', 'calibre.ebooks.conversion.plugins.docx_input:DOCXInput'),
+    ('EPUB Output', 'calibre.ebooks.conversion.plugins.epub_output:EPUBOutput'),
+    ('DOCX Output', 'calibre.ebooks.conversion.plugins.docx_output:DOCXOutput'),
+    ('FB2 Output', 'calibre.ebooks.conversion.plugins.fb2_output:FB2Output'),
+    ('LIT Output', 'calibre.ebooks.conversion.plugins.lit_output:LITOutput'),
+    ('LRF Output', 'calibre.ebooks.conversion.plugins.lrf_output:LRFOutput'),
+    ('MOBI Output', 'calibre.ebooks.conversion.plugins.mobi_output:MOBIOutput'),
+    ('AZW3 Output', 'calibre.ebooks.conversion.plugins.mobi_output:AZW3Output'),
+    ('OEB Output', 'calibre.ebooks.conversion.plugins.oeb_output:OEBOutput'),
+    ('PDB Output', 'calibre.ebooks.conversion.plugins.pdb_output:PDBOutput'),
+    ('PDF Output', 'calibre.ebooks.conversion.plugins.pdf_output:PDFOutput'),
+    ('PML Output', 'calibre.ebooks.conversion.plugins.pml_output:PMLOutput'),
+    ('RB Output', 'calibre.ebooks.conversion.plugins.rb_output:RBOutput'),
+    ('RTF Output', 'calibre.ebooks.conversion.plugins.rtf_output:RTFOutput'),
+    ('TCR Output', 'calibre.ebooks.conversion.plugins.tcr_output:TCROutput'),
+    ('TXT Output', 'calibre.ebooks.conversion.plugins.txt_output:TXTOutput'),
+    ('TXTZ Output', 'calibre.ebooks.conversion.plugins.txt_output:TXTZOutput'),
+    ('HTML Output', 'calibre.ebooks.conversion.plugins.html_output:HTMLOutput'),
+    ('HTMLZ Output', 'calibre.ebooks.conversion.plugins.htmlz_output:HTMLZOutput'),
+    ('SNB Output', 'calibre.ebooks.conversion.plugins.snb_output:SNBOutput'),
+)
 # }}}
 
 # Catalog plugins {{{
-from calibre.library.catalogs.csv_xml import CSV_XML
-from calibre.library.catalogs.bibtex import BIBTEX
-from calibre.library.catalogs.epub_mobi import EPUB_MOBI
-plugins += [CSV_XML, BIBTEX, EPUB_MOBI]
+lazy_plugins['catalog'] = (
+    ('Catalog_CSV_XML', 'calibre.library.catalogs.csv_xml:CSV_XML'),
+    ('Catalog_BIBTEX', 'calibre.library.catalogs.bibtex:BIBTEX'),
+    ('Catalog_EPUB_MOBI', 'calibre.library.catalogs.epub_mobi:EPUB_MOBI'),
+)
 # }}}
 
 # Profiles {{{
@@ -689,130 +653,129 @@ def set_metadata(self, stream, mi, type):
 # }}}
 
 # Device driver plugins {{{
-from calibre.devices.hanlin.driver import HANLINV3, HANLINV5, BOOX, SPECTRA
-from calibre.devices.blackberry.driver import BLACKBERRY, PLAYBOOK
-from calibre.devices.cybook.driver import CYBOOK, ORIZON, MUSE, DIVA
-from calibre.devices.eb600.driver import (EB600, COOL_ER, SHINEBOOK, TOLINO,
-                POCKETBOOK360, GER2, ITALICA, ECLICTO, DBOOK, INVESBOOK,
-                BOOQ, ELONEX, POCKETBOOK301, MENTOR, POCKETBOOK602,
-                POCKETBOOK701, POCKETBOOK740, POCKETBOOK360P, PI2, POCKETBOOK622,
-                POCKETBOOKHD)
-from calibre.devices.iliad.driver import ILIAD
-from calibre.devices.irexdr.driver import IREXDR1000, IREXDR800
-from calibre.devices.jetbook.driver import (JETBOOK, MIBUK, JETBOOK_MINI,
-        JETBOOK_COLOR)
-from calibre.devices.kindle.driver import (KINDLE, KINDLE2, KINDLE_DX,
-        KINDLE_FIRE)
-from calibre.devices.nook.driver import NOOK, NOOK_COLOR
-from calibre.devices.prs505.driver import PRS505
-from calibre.devices.prst1.driver import PRST1
-from calibre.devices.user_defined.driver import USER_DEFINED
-from calibre.devices.android.driver import ANDROID, S60, WEBOS
-from calibre.devices.nokia.driver import N770, N810, E71X, E52
-from calibre.devices.eslick.driver import ESLICK, EBK52
-from calibre.devices.nuut2.driver import NUUT2
-from calibre.devices.iriver.driver import IRIVER_STORY
-from calibre.devices.binatone.driver import README
-from calibre.devices.hanvon.driver import (N516, EB511, ALEX, AZBOOKA, THEBOOK,
-        LIBREAIR, ODYSSEY, KIBANO)
-from calibre.devices.edge.driver import EDGE
-from calibre.devices.teclast.driver import (TECLAST_K3, NEWSMY, IPAPYRUS,
-        SOVOS, PICO, SUNSTECH_EB700, ARCHOS7O, STASH, WEXLER)
-from calibre.devices.sne.driver import SNE
-from calibre.devices.misc import (
-    PALMPRE, AVANT, SWEEX, PDNOVEL, GEMEI, VELOCITYMICRO, PDNOVEL_KOBO,
-    LUMIREAD, ALURATEK_COLOR, TREKSTOR, EEEREADER, NEXTBOOK, ADAM, MOOVYBOOK,
-    COBY, EX124G, WAYTEQ, WOXTER, POCKETBOOK626, SONYDPTS1, CERVANTES)
-from calibre.devices.folder_device.driver import FOLDER_DEVICE_FOR_CONFIG
-from calibre.devices.kobo.driver import KOBO, KOBOTOUCH
-from calibre.devices.boeye.driver import BOEYE_BEX, BOEYE_BDX
-from calibre.devices.smart_device_app.driver import SMART_DEVICE_APP
-from calibre.devices.mtp.driver import MTP_DEVICE
 
 # Order here matters. The first matched device is the one used.
-plugins += [
-    HANLINV3,
-    HANLINV5,
-    BLACKBERRY, PLAYBOOK,
-    CYBOOK, ORIZON, MUSE, DIVA,
-    ILIAD,
-    IREXDR1000,
-    IREXDR800,
-    JETBOOK, JETBOOK_MINI, MIBUK, JETBOOK_COLOR,
-    SHINEBOOK,
-    POCKETBOOK360, POCKETBOOK301, POCKETBOOK602, POCKETBOOK701, POCKETBOOK360P,
-    POCKETBOOK622, PI2, POCKETBOOKHD, POCKETBOOK740,
-    KINDLE, KINDLE2, KINDLE_DX, KINDLE_FIRE,
-    NOOK, NOOK_COLOR,
-    PRS505, PRST1,
-    ANDROID, S60, WEBOS,
-    N770,
-    E71X,
-    E52,
-    N810,
-    COOL_ER,
-    ESLICK,
-    EBK52,
-    NUUT2,
-    IRIVER_STORY,
-    GER2,
-    ITALICA,
-    ECLICTO,
-    DBOOK,
-    INVESBOOK,
-    BOOX,
-    BOOQ,
-    EB600, TOLINO,
-    README,
-    N516, KIBANO,
-    THEBOOK, LIBREAIR,
-    EB511,
-    ELONEX,
-    TECLAST_K3,
-    NEWSMY,
-    PICO, SUNSTECH_EB700, ARCHOS7O, SOVOS, STASH, WEXLER,
-    IPAPYRUS,
-    EDGE,
-    SNE,
-    ALEX, ODYSSEY,
-    PALMPRE,
-    KOBO, KOBOTOUCH,
-    AZBOOKA,
-    FOLDER_DEVICE_FOR_CONFIG,
-    AVANT, CERVANTES,
-    MENTOR,
-    SWEEX,
-    PDNOVEL,
-    SPECTRA,
-    GEMEI,
-    VELOCITYMICRO,
-    PDNOVEL_KOBO,
-    LUMIREAD,
-    ALURATEK_COLOR,
-    TREKSTOR,
-    EEEREADER,
-    NEXTBOOK,
-    ADAM,
-    MOOVYBOOK, COBY, EX124G, WAYTEQ, WOXTER, POCKETBOOK626, SONYDPTS1,
-    BOEYE_BEX,
-    BOEYE_BDX,
-    MTP_DEVICE,
-    SMART_DEVICE_APP,
-    USER_DEFINED,
-]
-
+lazy_plugins['device'] = (
+    ('Hanlin V3 driver', 'calibre.devices.hanlin.driver:HANLINV3'),
+    ('Hanlin V5 driver', 'calibre.devices.hanlin.driver:HANLINV5'),
+    ('Blackberry Device Interface', 'calibre.devices.blackberry.driver:BLACKBERRY'),
+    ('Blackberry Playbook Interface', 'calibre.devices.blackberry.driver:PLAYBOOK'),
+    ('Cybook Gen 3 / Opus Device Interface', 'calibre.devices.cybook.driver:CYBOOK'),
+    ('Cybook Orizon Device Interface', 'calibre.devices.cybook.driver:ORIZON'),
+    ('Cybook Muse Device Interface', 'calibre.devices.cybook.driver:MUSE'),
+    ('Bookeen Diva HD Device Interface', 'calibre.devices.cybook.driver:DIVA'),
+    ('IRex Iliad Device Interface', 'calibre.devices.iliad.driver:ILIAD'),
+    ('IRex Digital Reader 1000 Device Interface', 'calibre.devices.irexdr.driver:IREXDR1000'),
+    ('IRex Digital Reader 800 Device Interface', 'calibre.devices.irexdr.driver:IREXDR800'),
+    ('Ectaco JetBook Device Interface', 'calibre.devices.jetbook.driver:JETBOOK'),
+    ('JetBook Mini Device Interface', 'calibre.devices.jetbook.driver:JETBOOK_MINI'),
+    ('MiBuk Wolder Device Interface', 'calibre.devices.jetbook.driver:MIBUK'),
+    ('JetBook Color Device Interface', 'calibre.devices.jetbook.driver:JETBOOK_COLOR'),
+    ('ShineBook device Interface', 'calibre.devices.eb600.driver:SHINEBOOK'),
+    ('PocketBook 360 Device Interface', 'calibre.devices.eb600.driver:POCKETBOOK360'),
+    ('PocketBook 301 Device Interface', 'calibre.devices.eb600.driver:POCKETBOOK301'),
+    ('PocketBook Pro 602/902 Device Interface', 'calibre.devices.eb600.driver:POCKETBOOK602'),
+    ('PocketBook 701 Device Interface', 'calibre.devices.eb600.driver:POCKETBOOK701'),
+    ('PocketBook 360+ Device Interface', 'calibre.devices.eb600.driver:POCKETBOOK360P'),
+    ('PocketBook 622 Device Interface', 'calibre.devices.eb600.driver:POCKETBOOK622'),
+    ('Infibeam Pi2 Device Interface', 'calibre.devices.eb600.driver:PI2'),
+    ('Pocket Touch HD Device Interface', 'calibre.devices.eb600.driver:POCKETBOOKHD'),
+    ('PocketBook 701 Device Interface', 'calibre.devices.eb600.driver:POCKETBOOK740'),
+    ('Kindle Device Interface', 'calibre.devices.kindle.driver:KINDLE'),
+    ('Kindle 2/3/4/Touch/PaperWhite/Voyage Device Interface', 'calibre.devices.kindle.driver:KINDLE2'),
+    ('Kindle DX Device Interface', 'calibre.devices.kindle.driver:KINDLE_DX'),
+    ('Kindle Fire Device Interface', 'calibre.devices.kindle.driver:KINDLE_FIRE'),
+    ('Nook Device Interface', 'calibre.devices.nook.driver:NOOK'),
+    ('Nook Color Device Interface', 'calibre.devices.nook.driver:NOOK_COLOR'),
+    ('SONY Device Interface', 'calibre.devices.prs505.driver:PRS505'),
+    ('SONY PRST1 and newer Device Interface', 'calibre.devices.prst1.driver:PRST1'),
+    ('Android driver', 'calibre.devices.android.driver:ANDROID'),
+    ('S60 driver', 'calibre.devices.android.driver:S60'),
+    ('WebOS driver', 'calibre.devices.android.driver:WEBOS'),
+    ('Nokia 770 Device Interface', 'calibre.devices.nokia.driver:N770'),
+    ('Nokia E71X device interface', 'calibre.devices.nokia.driver:E71X'),
+    ('Nokia E52 device interface', 'calibre.devices.nokia.driver:E52'),
+    ('Nokia N800/N810/N900/N950/N9 Device Interface', 'calibre.devices.nokia.driver:N810'),
+    ('Cool-er device interface', 'calibre.devices.eb600.driver:COOL_ER'),
+    ('ESlick Device Interface', 'calibre.devices.eslick.driver:ESLICK'),
+    ('EBK-52 Device Interface', 'calibre.devices.eslick.driver:EBK52'),
+    ('Nuut2 Device Interface', 'calibre.devices.nuut2.driver:NUUT2'),
+    ('Iriver Story Device Interface', 'calibre.devices.iriver.driver:IRIVER_STORY'),
+    ('Ganaxa GeR2 Device Interface', 'calibre.devices.eb600.driver:GER2'),
+    ('Italica Device Interface', 'calibre.devices.eb600.driver:ITALICA'),
+    ('eClicto Device Interface', 'calibre.devices.eb600.driver:ECLICTO'),
+    ('Airis Dbook Device Interface', 'calibre.devices.eb600.driver:DBOOK'),
+    ('Inves Book Device Interface', 'calibre.devices.eb600.driver:INVESBOOK'),
+    ('BOOX driver', 'calibre.devices.hanlin.driver:BOOX'),
+    ('Booq Device Interface', 'calibre.devices.eb600.driver:BOOQ'),
+    ('Netronix EB600 Device Interface', 'calibre.devices.eb600.driver:EB600'),
+    ('Tolino Shine Device Interface', 'calibre.devices.eb600.driver:TOLINO'),
+    ('Binatone Readme Device Interface', 'calibre.devices.binatone.driver:README'),
+    ('N516 driver', 'calibre.devices.hanvon.driver:N516'),
+    ('Kibano driver', 'calibre.devices.hanvon.driver:KIBANO'),
+    ('The Book driver', 'calibre.devices.hanvon.driver:THEBOOK'),
+    ('Libre Air Driver', 'calibre.devices.hanvon.driver:LIBREAIR'),
+    ('Elonex EB 511 driver', 'calibre.devices.hanvon.driver:EB511'),
+    ('Elonex 600EB', 'calibre.devices.eb600.driver:ELONEX'),
+    ('Teclast K3/K5 Device Interface', 'calibre.devices.teclast.driver:TECLAST_K3'),
+    ('Newsmy device interface', 'calibre.devices.teclast.driver:NEWSMY'),
+    ('Pico device interface', 'calibre.devices.teclast.driver:PICO'),
+    ('Sunstech EB700 device interface', 'calibre.devices.teclast.driver:SUNSTECH_EB700'),
+    ('Archos 7O device interface', 'calibre.devices.teclast.driver:ARCHOS7O'),
+    ('Sovos device interface', 'calibre.devices.teclast.driver:SOVOS'),
+    ('Stash device interface', 'calibre.devices.teclast.driver:STASH'),
+    ('Wexler device interface', 'calibre.devices.teclast.driver:WEXLER'),
+    ('iPapyrus device interface', 'calibre.devices.teclast.driver:IPAPYRUS'),
+    ('Edge Device Interface', 'calibre.devices.edge.driver:EDGE'),
+    ('Samsung SNE Device Interface', 'calibre.devices.sne.driver:SNE'),
+    ('Alex driver', 'calibre.devices.hanvon.driver:ALEX'),
+    ('Cybook Odyssey driver', 'calibre.devices.hanvon.driver:ODYSSEY'),
+    ('Palm Pre Device Interface', 'calibre.devices.misc:PALMPRE'),
+    ('Kobo Reader Device Interface', 'calibre.devices.kobo.driver:KOBO'),
+    ('KoboTouch', 'calibre.devices.kobo.driver:KOBOTOUCH'),
+    ('Azbooka driver', 'calibre.devices.hanvon.driver:AZBOOKA'),
+    ('Folder Device Interface', 'calibre.devices.folder_device.driver:FOLDER_DEVICE_FOR_CONFIG'),
+    ('Booq Avant Device Interface', 'calibre.devices.misc:AVANT'),
+    ('Bq Cervantes Device Interface', 'calibre.devices.misc:CERVANTES'),
+    ('Astak Mentor EB600', 'calibre.devices.eb600.driver:MENTOR'),
+    ('Sweex Device Interface', 'calibre.devices.misc:SWEEX'),
+    ('Pandigital Novel device interface', 'calibre.devices.misc:PDNOVEL'),
+    ('Spectra', 'calibre.devices.hanlin.driver:SPECTRA'),
+    ('Gemei Device Interface', 'calibre.devices.misc:GEMEI'),
+    ('VelocityMicro device interface', 'calibre.devices.misc:VELOCITYMICRO'),
+    ('Pandigital Kobo device interface', 'calibre.devices.misc:PDNOVEL_KOBO'),
+    ('Acer Lumiread Device Interface', 'calibre.devices.misc:LUMIREAD'),
+    ('Aluratek Color Device Interface', 'calibre.devices.misc:ALURATEK_COLOR'),
+    ('Trekstor E-book player device interface', 'calibre.devices.misc:TREKSTOR'),
+    ('Asus EEE Reader device interface', 'calibre.devices.misc:EEEREADER'),
+    ('Nextbook device interface', 'calibre.devices.misc:NEXTBOOK'),
+    ('Notion Ink Adam device interface', 'calibre.devices.misc:ADAM'),
+    ('Moovybook device interface', 'calibre.devices.misc:MOOVYBOOK'),
+    ('COBY MP977 device interface', 'calibre.devices.misc:COBY'),
+    ('Motorola Ex124G device interface', 'calibre.devices.misc:EX124G'),
+    ('WayteQ device interface', 'calibre.devices.misc:WAYTEQ'),
+    ('Woxter Scriba device interface', 'calibre.devices.misc:WOXTER'),
+    ('PocketBook Touch Lux 2', 'calibre.devices.misc:POCKETBOOK626'),
+    ('SONY DPT-S1', 'calibre.devices.misc:SONYDPTS1'),
+    ('BOEYE BEX reader driver', 'calibre.devices.boeye.driver:BOEYE_BEX'),
+    ('BOEYE BDX reader driver', 'calibre.devices.boeye.driver:BOEYE_BDX'),
+    ('MTP Device Interface', 'calibre.devices.mtp.driver:MTP_DEVICE'),
+    ('SmartDevice App Interface', 'calibre.devices.smart_device_app.driver:SMART_DEVICE_APP'),
+    ('User Defined USB driver', 'calibre.devices.user_defined.driver:USER_DEFINED'),
+)
 
 # }}}
 
 # New metadata download plugins {{{
-from calibre.ebooks.metadata.sources.google import GoogleBooks
-from calibre.ebooks.metadata.sources.amazon import Amazon
-from calibre.ebooks.metadata.sources.edelweiss import Edelweiss
-from calibre.ebooks.metadata.sources.openlibrary import OpenLibrary
-from calibre.ebooks.metadata.sources.google_images import GoogleImages
-from calibre.ebooks.metadata.sources.big_book_search import BigBookSearch
-
-plugins += [GoogleBooks, GoogleImages, Amazon, Edelweiss, OpenLibrary, BigBookSearch]
+
+lazy_plugins['metadata_source'] = (
+    ('Google', 'calibre.ebooks.metadata.sources.google:GoogleBooks'),
+    ('Google Images', 'calibre.ebooks.metadata.sources.google_images:GoogleImages'),
+    ('Amazon.com', 'calibre.ebooks.metadata.sources.amazon:Amazon'),
+    ('Edelweiss', 'calibre.ebooks.metadata.sources.edelweiss:Edelweiss'),
+    ('Open Library', 'calibre.ebooks.metadata.sources.openlibrary:OpenLibrary'),
+    ('Big Book Search', 'calibre.ebooks.metadata.sources.big_book_search:BigBookSearch'),
+)
 
 # }}}
 
@@ -1,9 +1,11 @@
 __license__   = 'GPL v3'
 __copyright__ = '2008, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import os, shutil, traceback, functools, sys
+import os, shutil, traceback, functools, sys, importlib
 from collections import defaultdict
+from contextlib import nullcontext
 from itertools import chain, repeat
+from threading import Lock, RLock
 
 from calibre.customize import (CatalogPlugin, FileTypePlugin, PluginNotFound,
                               MetadataReaderPlugin, MetadataWriterPlugin,
@@ -14,7 +16,7 @@
 from calibre.customize.conversion import InputFormatPlugin, OutputFormatPlugin
 from calibre.customize.zipplugin import loader
 from calibre.customize.profiles import InputProfile, OutputProfile
-from calibre.customize.builtins import plugins as builtin_plugins
+from calibre.customize.builtins import plugins as builtin_plugins, lazy_plugins as lazy_builtin_plugins
 from calibre.devices.interface import DevicePlugin
 from calibre.ebooks.metadata import MetaInformation
 from calibre.utils.config import (make_config_dir, Config, ConfigProxy,
@@ -23,7 +25,8 @@
 from calibre.constants import DEBUG, numeric_version, system_plugins_loc, ismacos
 from polyglot.builtins import iteritems, itervalues
 
-builtin_names = frozenset(p.name for p in builtin_plugins)
+lazy_builtin_groups = {name: group for group, entries in iteritems(lazy_builtin_plugins) for name, location in entries}
+builtin_names = frozenset(p.name for p in builtin_plugins) | frozenset(lazy_builtin_groups)
 BLACKLISTED_PLUGINS = frozenset({'Marvin XD', 'iOS reader applications'})
 
 
@@ -50,6 +53,9 @@ def _config():
 
 
 def find_plugin(name):
+    group = lazy_builtin_groups.get(name)
+    if group is not None:
+        load_lazy_plugins(group)
     for plugin in _initialized_plugins:
         if plugin.name == name:
             return plugin
@@ -411,14 +417,24 @@ def metadata_writers():
 
 class QuickMetadata:
 
+    # Re-entrant so that metadata can be read in several threads at once
+    # without the first thread to finish turning off quick mode for the others
+
     def __init__(self):
-        self.quick = False
+        self.lock = Lock()
+        self.depth = 0
+
+    @property
+    def quick(self):
+        return self.depth > 0
 
     def __enter__(self):
-        self.quick = True
+        with self.lock:
+            self.depth += 1
 
     def __exit__(self, *args):
-        self.quick = False
+        with self.lock:
+            self.depth -= 1
 
 
 quick_metadata = QuickMetadata()
@@ -454,6 +470,21 @@ def __exit__(self, *args):
 force_identifiers = ForceIdentifiers()
 
 
+_plugin_usage_locks = defaultdict(Lock)
+_plugin_usage_locks_lock = Lock()
+
+
+def plugin_usage_lock(plugin):
+    # Plugins loaded from ZIP files change sys.path and their own state when
+    # entered as context managers, so each must only be used by one thread at
+    # a time. Builtin plugins have no such state, so they are not serialized
+    # and metadata can be read in several threads at once.
+    if plugin.plugin_path is None:
+        return nullcontext()
+    with _plugin_usage_locks_lock:
+        return _plugin_usage_locks[plugin.name]
+
+
 def get_file_type_metadata(stream, ftype):
     mi = MetaInformation(None, None)
 
@@ -461,7 +492,7 @@ def get_file_type_metadata(stream, ftype):
     if ftype in _metadata_readers:
         for plugin in _metadata_readers[ftype]:
             if not is_disabled(plugin):
-                with plugin:
+                with plugin_usage_lock(plugin), plugin:
                     try:
                         plugin.quick = quick_metadata.quick
                         if hasattr(stream, 'seek'):
@@ -480,7 +511,7 @@ def set_file_type_metadata(stream, mi, ftype, report_error=None):
         customization = config['plugin_customization']
         for plugin in _metadata_writers[ftype]:
             if not is_disabled(plugin):
-                with plugin:
+                with plugin_usage_lock(plugin), plugin:
                     try:
                         plugin.apply_null = apply_null_metadata.apply_null
                         plugin.force_identifiers = force_identifiers.force_identifiers
@@ -555,6 +586,7 @@ def remove_plugin(plugin_or_name):
 
 
 def input_format_plugins():
+    load_lazy_plugins('conversion')
     for plugin in _initialized_plugins:
         if isinstance(plugin, InputFormatPlugin):
             yield plugin
@@ -587,6 +619,7 @@ def available_input_formats():
 
 
 def output_format_plugins():
+    load_lazy_plugins('conversion')
     for plugin in _initialized_plugins:
         if isinstance(plugin, OutputFormatPlugin):
             yield plugin
@@ -613,6 +646,7 @@ def available_output_formats():
 
 
 def catalog_plugins():
+    load_lazy_plugins('catalog')
     for plugin in _initialized_plugins:
         if isinstance(plugin, CatalogPlugin):
             yield plugin
@@ -638,6 +672,7 @@ def plugin_for_catalog_format(fmt):
 
 
 def device_plugins(include_disabled=False):
+    load_lazy_plugins('device')
     for plugin in _initialized_plugins:
         if isinstance(plugin, DevicePlugin):
             if include_disabled or not is_disabled(plugin):
@@ -649,6 +684,7 @@ def device_plugins(include_disabled=False):
 
 
 def disabled_device_plugins():
+    load_lazy_plugins('device')
     for plugin in _initialized_plugins:
         if isinstance(plugin, DevicePlugin):
             if is_disabled(plugin):
@@ -668,12 +704,14 @@ def metadata_plugins(capabilities):
 
 
 def all_metadata_plugins():
+    load_lazy_plugins('metadata_source')
     for plugin in _initialized_plugins:
         if isinstance(plugin, Source):
             yield plugin
 
 
 def patch_metadata_plugins(possibly_updated_plugins):
+    load_lazy_plugins('metadata_source')
     patches = {}
     for i, plugin in enumerate(_initialized_plugins):
         if isinstance(plugin, Source) and plugin.name in builtin_names:
@@ -701,6 +739,9 @@ def all_edit_book_tool_plugins():
 
 
 _initialized_plugins = []
+_pending_lazy_groups = set()
+_loading_lazy_groups = set()
+_lazy_plugins_lock = RLock()
 
 
 def initialize_plugin(plugin, path_to_zip_file, installation_type):
@@ -739,9 +780,51 @@ def get_system_plugins():
     return dict(ans)
 
 
+def load_lazy_plugins(*groups):
+    '''
+    Import and initialize the builtin plugins in the specified groups from
+    calibre.customize.builtins.lazy_plugins, if they have not been already.
+    With no arguments, all groups are loaded. This means that commands that
+    only need, for example, the metadata reader plugins do not have to import
+    all the conversion plugins and device drivers.
+    '''
+    global _initialized_plugins
+    groups = groups or tuple(lazy_builtin_plugins)
+    if _pending_lazy_groups.isdisjoint(groups):
+        return
+    with _lazy_plugins_lock:
+        # Groups are only removed from the pending set once they are loaded,
+        # so that other threads wait for them. A plugin that uses these
+        # functions while it is being initialized sees only the plugins
+        # loaded so far.
+        groups = [g for g in groups if g in _pending_lazy_groups and g not in _loading_lazy_groups]
+        _loading_lazy_groups.update(groups)
+        try:
+            loaded = []
+            for group in groups:
+                for name, location in lazy_builtin_plugins[group]:
+                    module, cls = location.partition(':')[::2]
+                    try:
+                        plugin = getattr(importlib.import_module(module), cls)
+                        loaded.append(initialize_plugin(plugin, None, PluginInstallationType.BUILTIN))
+                    except Exception:
+                        print('Failed to initialize plugin:', repr(name), file=sys.stderr)
+                        if DEBUG:
+                            traceback.print_exc()
+            if loaded:
+                # Replace the list rather than changing it in place so that
+                # threads that are iterating over it are not affected
+                _initialized_plugins = sorted(_initialized_plugins + loaded, key=lambda x: x.priority, reverse=True)
+            _pending_lazy_groups.difference_update(groups)
+        finally:
+            _loading_lazy_groups.difference_update(groups)
+
+
 def initialize_plugins(perf=False):
     global _initialized_plugins
     _initialized_plugins = []
+    _pending_lazy_groups.clear()
+    _pending_lazy_groups.update(lazy_builtin_plugins)
     system_plugins = get_system_plugins().copy()
     conflicts = {name for name in config['plugins'] if name in
             builtin_names or name in system_plugins}
@@ -805,6 +888,7 @@ def initialize_plugins(perf=False):
 
 
 def initialized_plugins():
+    load_lazy_plugins()
     yield from _initialized_plugins
 
 # }}}
@@ -906,6 +990,51 @@ def main(args=sys.argv):
     return 0
 
 
+def find_tests():
+    import json
+    import subprocess
+    import unittest
+
+    group_types = {
+        'conversion': (InputFormatPlugin, OutputFormatPlugin), 'catalog': CatalogPlugin,
+        'device': DevicePlugin, 'metadata_source': Source,
+    }
+
+    class TestLazyPlugins(unittest.TestCase):
+
+        def test_lazy_plugin_declarations(self):
+            self.assertEqual(set(group_types), set(lazy_builtin_plugins))
+            for group, entries in iteritems(lazy_builtin_plugins):
+                for name, location in entries:
+                    module, cls = location.partition(':')[::2]
+                    plugin = getattr(importlib.import_module(module), cls)
+                    self.assertEqual(plugin.name, name, location)
+                    self.assertTrue(issubclass(plugin, group_types[group]), location)
+            names = {p.name for p in initialized_plugins()}
+            self.assertEqual(names & builtin_names, builtin_names)
+
+        def test_lazy_plugins_not_imported(self):
+            # Regression test for the start up cost of commands that only
+            # need the metadata plugins, such as ebook-meta
+            from calibre.debug import run_calibre_debug
+            p = run_calibre_debug('-c', '''
+import json, sys
+from calibre.customize.ui import find_plugin, input_format_plugins, lazy_builtin_plugins, metadata_readers
+list(metadata_readers())
+modules = {loc.partition(':')[0] for entries in lazy_builtin_plugins.values() for name, loc in entries}
+imported = sorted(modules & set(sys.modules))
+print(json.dumps([imported, len(list(input_format_plugins())), find_plugin('Kobo Reader Device Interface').name]))
+''', stdout=subprocess.PIPE)
+            raw = p.communicate()[0]
+            self.assertEqual(p.returncode, 0)
+            imported, num_input_plugins, kobo = json.loads(raw.decode('utf-8').splitlines()[-1])
+            self.assertFalse(imported, 'Lazily loaded plugins imported at startup')
+            self.assertGreaterEqual(num_input_plugins, len([x for x in lazy_builtin_plugins['conversion'] if x[0].endswith(' Input')]))
+            self.assertEqual(kobo, 'Kobo Reader Device Interface')
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestLazyPlugins)
+
+
 if __name__ == '__main__':
     sys.exit(main())
 # }}}
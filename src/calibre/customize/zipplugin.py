@@ -5,7 +5,9 @@
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import hashlib
 import importlib
+import marshal
 import os
 import posixpath
 import re
@@ -15,9 +17,10 @@
 from collections import OrderedDict
 from functools import partial
 from importlib.machinery import ModuleSpec
-from importlib.util import decode_source
+from importlib.util import MAGIC_NUMBER, decode_source
 
 from calibre import as_unicode
+from calibre.constants import cache_dir
 from calibre.customize import (
     InvalidPlugin, Plugin, PluginNotFound, numeric_version, platform
 )
@@ -137,14 +140,93 @@ def load_translations(namespace, zfp):
     namespace['ngettext'] = trans.ngettext
 
 
+def plugin_code_cache_dir():
+    return os.path.join(cache_dir(), 'plugin-code')
+
+
+class PluginCodeCache:
+
+    '''
+    The compiled code of the modules in a plugin zip file and the list of
+    modules in it, stored in a single file in the calibre cache directory, so
+    that the code is not compiled again in every process that imports the
+    plugin and the zip file is not read at all when the code is in the cache.
+    The cache is discarded when the modification time or size of the zip
+    file, or the Python bytecode version change.
+    '''
+
+    def __init__(self, zip_file_path, base_dir=None):
+        zip_file_path = os.path.abspath(zip_file_path)
+        self.path = os.path.join(base_dir or plugin_code_cache_dir(), hashlib.sha1(zip_file_path.encode('utf-8')).hexdigest())
+        self.lock = threading.Lock()
+        try:
+            st = os.stat(zip_file_path)
+        except OSError:
+            self.key = None
+        else:
+            self.key = (zip_file_path, st.st_mtime_ns, st.st_size, MAGIC_NUMBER, sys.flags.optimize)
+        self.data = self.read()
+
+    def read(self):
+        data = None
+        if self.key is not None:
+            try:
+                with open(self.path, 'rb') as f:
+                    data = marshal.loads(f.read())
+            except Exception:
+                pass
+        if not isinstance(data, dict) or data.get('key') != self.key:
+            data = {'key': self.key, 'manifest': None, 'code': {}}
+        return data
+
+    def save(self):
+        if self.key is None:
+            return
+        # Merge in code cached by other processes since this cache was read
+        on_disk = self.read()
+        on_disk['code'].update(self.data['code'])
+        self.data['code'] = on_disk['code']
+        tpath = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tpath, 'wb') as f:
+                f.write(marshal.dumps(self.data))
+            os.replace(tpath, self.path)
+        except OSError:
+            pass
+
+    @property
+    def manifest(self):
+        return self.data['manifest']
+
+    def set_manifest(self, manifest):
+        with self.lock:
+            self.data['manifest'] = manifest
+            self.save()
+
+    def get_code(self, name):
+        with self.lock:
+            raw = self.data['code'].get(name)
+        if raw is not None:
+            try:
+                return marshal.loads(raw)
+            except Exception:
+                pass
+
+    def set_code(self, name, code):
+        with self.lock:
+            self.data['code'][name] = marshal.dumps(code)
+            self.save()
+
+
 class CalibrePluginLoader:
 
     __slots__ = (
         'plugin_name', 'fullname_in_plugin', 'zip_file_path', '_is_package', 'names',
-        'filename', 'all_names'
+        'filename', 'all_names', 'code_cache'
     )
 
-    def __init__(self, plugin_name, fullname_in_plugin, zip_file_path, names, filename, is_package, all_names):
+    def __init__(self, plugin_name, fullname_in_plugin, zip_file_path, names, filename, is_package, all_names, code_cache=None):
         self.plugin_name = plugin_name
         self.fullname_in_plugin = fullname_in_plugin
         self.zip_file_path = zip_file_path
@@ -152,6 +234,7 @@ def __init__(self, plugin_name, fullname_in_plugin, zip_file_path, names, filena
         self.filename = filename
         self._is_package = is_package
         self.all_names = all_names
+        self.code_cache = code_cache
 
     def __eq__(self, other):
         return (
@@ -175,14 +258,10 @@ def is_package(self, fullname):
     def get_source_as_bytes(self, fullname=None):
         src = b''
         if self.plugin_name and self.fullname_in_plugin and self.zip_file_path:
-            zinfo = self.names.get(self.fullname_in_plugin)
-            if zinfo is not None:
+            name = self.names.get(self.fullname_in_plugin)
+            if name is not None:
                 with zipfile.ZipFile(self.zip_file_path) as zf:
-                    try:
-                        src = zf.read(zinfo)
-                    except Exception:
-                        # Maybe the zip file changed from under us
-                        src = zf.read(zinfo.filename)
+                    src = zf.read(name)
         return src
 
     def get_source(self, fullname=None):
@@ -193,8 +272,13 @@ def get_filename(self, fullname):
         return self.filename
 
     def get_code(self, fullname=None):
-        return compile(self.get_source_as_bytes(fullname), f'calibre_plugins.{self.plugin_name}.{self.fullname_in_plugin}',
-            'exec', dont_inherit=True)
+        filename = f'calibre_plugins.{self.plugin_name}.{self.fullname_in_plugin}'
+        code = None if self.code_cache is None else self.code_cache.get_code(filename)
+        if code is None:
+            code = compile(self.get_source_as_bytes(fullname), filename, 'exec', dont_inherit=True)
+            if self.code_cache is not None:
+                self.code_cache.set_code(filename, code)
+        return code
 
     def exec_module(self, module):
         compiled = self.get_code()
@@ -213,10 +297,10 @@ def resource_path(self, name):
     def contents(self):
         if not self._is_package:
             return ()
-        zinfo = self.names.get(self.fullname_in_plugin)
-        if zinfo is None:
+        name = self.names.get(self.fullname_in_plugin)
+        if name is None:
             return ()
-        base = posixpath.dirname(zinfo.filename)
+        base = posixpath.dirname(name)
         if base:
             base += '/'
 
@@ -229,18 +313,18 @@ def is_ok(x):
         return tuple(filter(is_ok, self.all_names))
 
     def is_resource(self, name):
-        zinfo = self.names.get(self.fullname_in_plugin)
-        if zinfo is None:
+        zname = self.names.get(self.fullname_in_plugin)
+        if zname is None:
             return False
-        base = posixpath.dirname(zinfo.filename)
+        base = posixpath.dirname(zname)
         q = posixpath.join(base, name)
         return q in self.all_names
 
     def open_resource(self, name):
-        zinfo = self.names.get(self.fullname_in_plugin)
-        if zinfo is None:
+        zname = self.names.get(self.fullname_in_plugin)
+        if zname is None:
             raise FileNotFoundError(f'{self.fullname_in_plugin} not in plugin zip file')
-        base = posixpath.dirname(zinfo.filename)
+        base = posixpath.dirname(zname)
         q = posixpath.join(base, name)
         with zipfile.ZipFile(self.zip_file_path) as zf:
             return zf.open(q)
@@ -259,14 +343,14 @@ def find_spec(self, fullname, path, target=None):
         parts = fullname.split('.')
         if parts[0] != 'calibre_plugins':
             return
-        plugin_name = fullname_in_plugin = zip_file_path = filename = None
+        plugin_name = fullname_in_plugin = zip_file_path = filename = code_cache = None
         all_names = frozenset()
         names = OrderedDict()
 
         if len(parts) > 1:
             plugin_name = parts[1]
             with self._lock:
-                zip_file_path, names, all_names = self.loaded_plugins.get(plugin_name, (None, None, None))
+                zip_file_path, names, all_names, code_cache = self.loaded_plugins.get(plugin_name, (None, None, None, None))
             if zip_file_path is None:
                 return
             fullname_in_plugin = '.'.join(parts[2:])
@@ -287,7 +371,7 @@ def find_spec(self, fullname, path, target=None):
 
         return ModuleSpec(
             fullname,
-            CalibrePluginLoader(plugin_name, fullname_in_plugin, zip_file_path, names, filename, is_package, all_names),
+            CalibrePluginLoader(plugin_name, fullname_in_plugin, zip_file_path, names, filename, is_package, all_names, code_cache),
             is_package=is_package, origin=filename
         )
 
@@ -295,8 +379,7 @@ def load(self, path_to_zip_file):
         if not os.access(path_to_zip_file, os.R_OK):
             raise PluginNotFound('Cannot access %r'%path_to_zip_file)
 
-        with zipfile.ZipFile(path_to_zip_file) as zf:
-            plugin_name = self._locate_code(zf, path_to_zip_file)
+        plugin_name = self._locate_code(path_to_zip_file)
 
         try:
             ans = None
@@ -336,7 +419,31 @@ def load(self, path_to_zip_file):
                 del self.loaded_plugins[plugin_name]
             raise
 
-    def _locate_code(self, zf, path_to_zip_file):
+    def _locate_code(self, path_to_zip_file):
+        code_cache = PluginCodeCache(path_to_zip_file)
+        manifest = code_cache.manifest
+        if manifest is None:
+            with zipfile.ZipFile(path_to_zip_file) as zf:
+                manifest = self._read_manifest(zf, path_to_zip_file)
+            code_cache.set_manifest(manifest)
+        plugin_name, names, all_names = manifest
+
+        if plugin_name is None:
+            c = 0
+            while True:
+                c += 1
+                plugin_name = 'dummy%d'%c
+                if plugin_name not in self.loaded_plugins:
+                    break
+
+        with self._lock:
+            self.loaded_plugins[plugin_name] = path_to_zip_file, names, all_names, code_cache
+
+        return plugin_name
+
+    def _read_manifest(self, zf, path_to_zip_file):
+        # Return the import name of the plugin, a mapping of module names to
+        # the names of the files they are in and the names of all files in the zip file
         all_names = frozenset(zf.namelist())
         names = [x[1:] if x[0] == '/' else x for x in all_names]
 
@@ -346,18 +453,10 @@ def _locate_code(self, zf, path_to_zip_file):
             if name.startswith('plugin-import-name-') and ext == '.txt':
                 plugin_name = name.rpartition('-')[-1]
 
-        if plugin_name is None:
-            c = 0
-            while True:
-                c += 1
-                plugin_name = 'dummy%d'%c
-                if plugin_name not in self.loaded_plugins:
-                    break
-        else:
-            if self._identifier_pat.match(plugin_name) is None:
-                raise InvalidPlugin(
-                    'The plugin at %r uses an invalid import name: %r' %
-                    (path_to_zip_file, plugin_name))
+        if plugin_name is not None and self._identifier_pat.match(plugin_name) is None:
+            raise InvalidPlugin(
+                'The plugin at %r uses an invalid import name: %r' %
+                (path_to_zip_file, plugin_name))
 
         pynames = [x for x in names if x.endswith('.py')]
 
@@ -373,7 +472,7 @@ def _locate_code(self, zf, path_to_zip_file):
                 continue
             valid_packages.add('.'.join(parts))
 
-        names = OrderedDict()
+        names = {}
 
         for candidate in pynames:
             parts = posixpath.splitext(candidate)[0].split('/')
@@ -381,7 +480,7 @@ def _locate_code(self, zf, path_to_zip_file):
             if package and package not in valid_packages:
                 continue
             name = '.'.join(parts)
-            names[name] = zf.getinfo(candidate)
+            names[name] = zf.getinfo(candidate).filename
 
         # Legacy plugins
         if '__init__' not in names:
@@ -395,16 +494,90 @@ def _locate_code(self, zf, path_to_zip_file):
                     'contain a top-level __init__.py file')
                     % path_to_zip_file)
 
-        with self._lock:
-            self.loaded_plugins[plugin_name] = path_to_zip_file, names, tuple(all_names)
-
-        return plugin_name
+        return plugin_name, names, tuple(all_names)
 
 
 loader = CalibrePluginFinder()
 sys.meta_path.append(loader)
 
 
+def find_tests():
+    import shutil
+    import tempfile
+    import time
+    import unittest
+    from unittest.mock import patch
+
+    class TestPluginCodeCache(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+            self.zip_path = os.path.join(self.tdir, 'plugin.zip')
+            self.cache_dir = os.path.join(self.tdir, 'cache')
+            self.create_plugin('VALUE = 1')
+
+        def tearDown(self):
+            shutil.rmtree(self.tdir)
+
+        def create_plugin(self, module_source):
+            with zipfile.ZipFile(self.zip_path, 'w') as zf:
+                zf.writestr('plugin-import-name-code_cache_test.txt', b'')
+                zf.writestr('__init__.py', 'from calibre_plugins.code_cache_test.sub.mod import VALUE')
+                zf.writestr('sub/__init__.py', '')
+                zf.writestr('sub/mod.py', module_source)
+                zf.writestr('sub/data.txt', b'some data')
+                zf.writestr('notpackage/mod.py', '')
+
+        def get_code(self, finder, fullname):
+            spec = finder.find_spec(fullname, None)
+            self.assertIsNotNone(spec, fullname)
+            return spec.loader.get_code()
+
+        def test_plugin_code_cache(self):
+            with patch(__name__ + '.plugin_code_cache_dir', return_value=self.cache_dir):
+                finder = CalibrePluginFinder()
+                self.assertEqual(finder._locate_code(self.zip_path), 'code_cache_test')
+                names = finder.loaded_plugins['code_cache_test'][1]
+                self.assertEqual(set(names), {'__init__', 'sub.__init__', 'sub.mod'})
+                ns = {}
+                exec(self.get_code(finder, 'calibre_plugins.code_cache_test.sub.mod'), ns)
+                self.assertEqual(ns['VALUE'], 1)
+
+                cache = PluginCodeCache(self.zip_path)
+                self.assertEqual(cache.manifest[1], names)
+                self.assertIn('calibre_plugins.code_cache_test.sub.mod', cache.data['code'])
+
+                finder = CalibrePluginFinder()
+                with patch.object(zipfile, 'ZipFile', side_effect=AssertionError('zip file should not be read')):
+                    finder._locate_code(self.zip_path)
+                    ns = {}
+                    exec(self.get_code(finder, 'calibre_plugins.code_cache_test.sub.mod'), ns)
+                    self.assertEqual(ns['VALUE'], 1)
+
+                time.sleep(0.01)
+                self.create_plugin('VALUE = 22')
+                self.assertIsNone(PluginCodeCache(self.zip_path).manifest)
+                finder = CalibrePluginFinder()
+                finder._locate_code(self.zip_path)
+                ns = {}
+                exec(self.get_code(finder, 'calibre_plugins.code_cache_test.sub.mod'), ns)
+                self.assertEqual(ns['VALUE'], 22)
+
+        def test_plugin_resources(self):
+            with patch(__name__ + '.plugin_code_cache_dir', return_value=self.cache_dir):
+                finder = CalibrePluginFinder()
+                finder._locate_code(self.zip_path)
+                reader = finder.find_spec('calibre_plugins.code_cache_test.sub', None).loader
+                self.assertTrue(reader.is_resource('data.txt'))
+                self.assertFalse(reader.is_resource('missing.txt'))
+                self.assertFalse(reader.is_resource('sub/data.txt'))
+                with reader.open_resource('data.txt') as f:
+                    self.assertEqual(f.read(), b'some data')
+                self.assertIn('sub/data.txt', reader.contents())
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestPluginCodeCache)
+
+
 if __name__ == '__main__':
     from tempfile import NamedTemporaryFile
 
@@ -7,7 +7,7 @@
 import os
 import re
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from contextlib import contextmanager
 from functools import partial
 
@@ -213,9 +213,119 @@ def import_book_directory(db, dirpath, callback=None, added_ids=None, compiled_r
         callback(mi.title)
 
 
+def read_metadata_in_workers(groups, tdir, max_workers=None):
+    '''
+    Run the import plugins on and read metadata from groups of files, each
+    group being the files of a single book, using a pool of worker processes.
+    Yields ``(paths, mi, tb)`` for every group, in order. ``paths`` are the
+    files after the import plugins have run and ``mi.cover`` is the path to
+    the cover extracted from the files, if any. If reading the metadata failed,
+    mi is None and tb is the traceback. Temporary files are created in tdir.
+    '''
+    from io import BytesIO
+
+    from calibre.ebooks.metadata.opf2 import OPF
+    from calibre.utils.ipc.pool import Failure, Pool
+    from polyglot.queue import Empty
+
+    pool = Pool(max_workers=max_workers, name='ReadMetadata')
+    # Limit how far ahead of the consumer the workers can get, so that results
+    # for huge imports do not pile up in memory
+    lookahead = 4 * pool.max_workers
+    groups = enumerate(groups)
+    pending, results, exhausted = deque(), {}, False
+    try:
+        while True:
+            while not exhausted and len(pending) < lookahead:
+                try:
+                    group_id, paths = next(groups)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((group_id, list(paths)))
+                pool(group_id, 'calibre.ebooks.metadata.worker', 'read_metadata', pending[-1][1], group_id, tdir)
+            if not pending:
+                break
+            group_id, paths = pending.popleft()
+            while group_id not in results:
+                if pool.failed:
+                    raise Failure(pool.terminal_failure)
+                try:
+                    wr = pool.results.get(timeout=0.1)
+                except Empty:
+                    continue
+                results[wr.id] = wr
+            wr = results.pop(group_id)
+            if wr.is_terminal_failure:
+                raise Failure(pool.terminal_failure)
+            if wr.result.err is not None:
+                yield paths, None, wr.result.err + '\n' + wr.result.traceback
+                continue
+            paths, opf, has_cover, duplicate_info, file_hashes = wr.result.value
+            mi = OPF(BytesIO(opf), basedir=tdir, populate_spine=False, try_to_guess_cover=False).to_book_metadata()
+            if mi.application_id == '__calibre_dummy__':
+                mi.application_id = None
+            if mi.is_null('title') and paths:
+                mi.title = os.path.splitext(os.path.basename(paths[0]))[0]
+            mi.cover = os.path.join(tdir, '%s.cdata' % group_id) if has_cover else None
+            yield paths, mi, None
+    finally:
+        pool.shutdown()
+
+
+def recursive_import_in_workers(
+    db, root, single_book_per_directory, callback, added_ids, compiled_rules, add_duplicates, max_workers, batch_size=32
+):
+    from calibre.ptempfile import TemporaryDirectory
+
+    def groups():
+        for dirpath in os.walk(root):
+            for formats in find_books_in_directory(dirpath[0], single_book_per_directory, compiled_rules=compiled_rules):
+                yield formats
+                if single_book_per_directory:
+                    break
+
+    duplicates, batch = [], []
+
+    def add_batch():
+        # Books are added in batches, in the order in which they were found
+        ids, dups = db.new_api.add_books([(mi, create_format_map(formats)) for mi, formats in batch], add_duplicates=add_duplicates)
+        dups = {id(mi) for mi, format_map in dups}
+        added = [(mi, formats) for mi, formats in batch if id(mi) not in dups]
+        duplicates.extend((mi, formats) for mi, formats in batch if id(mi) in dups)
+        del batch[:]
+        for book_id, (mi, formats) in zip(ids, added):
+            if added_ids is not None:
+                added_ids.add(book_id)
+            if callable(callback) and callback(mi.title):
+                return True
+
+    with TemporaryDirectory('_recursive_import') as tdir:
+        for formats, mi, tb in read_metadata_in_workers(groups(), tdir, max_workers):
+            if mi is None:
+                prints('Failed to read metadata from:', ', '.join(formats))
+                prints(tb)
+                continue
+            batch.append((mi, formats))
+            if len(batch) >= batch_size and add_batch():
+                return duplicates
+        if batch:
+            add_batch()
+    return duplicates
+
+
 def recursive_import(db, root, single_book_per_directory=True,
-        callback=None, added_ids=None, compiled_rules=(), add_duplicates=False):
+        callback=None, added_ids=None, compiled_rules=(), add_duplicates=False, max_workers=0):
+    '''
+    Add all the books found in the folder root and its sub-folders. If
+    max_workers is not zero, the metadata is read by a pool of that many worker
+    processes (all CPU cores if it is None), with the books being added in
+    batches.
+    '''
     root = os.path.abspath(root)
+    if max_workers != 0:
+        return recursive_import_in_workers(
+            db, root, single_book_per_directory, callback, added_ids, compiled_rules, add_duplicates, max_workers)
     duplicates  = []
     for dirpath in os.walk(root):
         func = import_book_directory if single_book_per_directory else import_book_directory_multiple
@@ -10,15 +10,19 @@
 import errno
 import hashlib
 import json
+import mmap
 import os
 import shutil
 import stat
 import sys
 import time
 import uuid
+from collections import Counter
 from contextlib import closing, suppress
 from typing import Optional
 from functools import partial
+from io import BytesIO
+from threading import Lock
 
 from calibre import as_unicode, force_unicode, isbytestring, prints
 from calibre.constants import (
@@ -324,6 +328,64 @@ def save_annotations_for_book(cursor, book_id, fmt, annots_list, user_type='loca
     cursor.executemany(
         'INSERT OR REPLACE INTO annotations (book, format, user_type, user, timestamp, annot_id, annot_type, annot_data, searchable_text)'
         ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', data)
+
+
+def merge_annotations_for_book(cursor, book_id, fmt, annots_list, user_type='local', user='viewer'):
+    '''
+    Merge annots_list, a list of (annotation, timestamp in seconds) pairs, into
+    the stored annotations. Only annotations that are newer than the stored
+    annotation with the same type and id are written, the rest of the stored
+    annotations are left untouched. Returns True if anything was changed.
+    '''
+    fmt = fmt.upper()
+    newest = {}
+    for annot, timestamp_in_secs in annots_list:
+        atype = annot['type'].lower()
+        aid, text = annot_db_data(annot)
+        if aid is None:
+            continue
+        key = atype, aid
+        q = newest.get(key)
+        if q is None or timestamp_in_secs > q[0]:
+            newest[key] = timestamp_in_secs, annot, text
+    if not newest:
+        return False
+    stored = {(atype, aid): timestamp for atype, aid, timestamp in cursor.execute(
+        'SELECT annot_type, annot_id, timestamp FROM annotations WHERE book=? AND format=? AND user_type=? AND user=?',
+        (book_id, fmt, user_type, user))}
+    data = []
+    for key, (timestamp_in_secs, annot, text) in newest.items():
+        timestamp = stored.get(key)
+        if timestamp is None or timestamp_in_secs > timestamp:
+            data.append((book_id, fmt, user_type, user, timestamp_in_secs, key[1], key[0], json.dumps(annot), text))
+    if not data:
+        return False
+    cursor.execute('INSERT OR IGNORE INTO annotations_dirtied (book) VALUES (?)', (book_id,))
+    # Update rows in place so that their ids, and hence any cursors
+    # pointing at them, remain valid
+    cursor.executemany(
+        'INSERT INTO annotations (book, format, user_type, user, timestamp, annot_id, annot_type, annot_data, searchable_text)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (book, user_type, user, format, annot_type, annot_id) DO UPDATE'
+        ' SET timestamp=excluded.timestamp, annot_data=excluded.annot_data, searchable_text=excluded.searchable_text', data)
+    return True
+
+
+def annotation_filters(restrict_to_user=None, annotation_type=None, ignore_removed=False, restrict_to_book_ids=None):
+    clauses, data = [], []
+    if restrict_to_user:
+        clauses.append('annotations.user_type = ? AND annotations.user = ?')
+        data.extend(restrict_to_user)
+    if annotation_type:
+        clauses.append('annotations.annot_type = ?')
+        data.append(annotation_type)
+    if ignore_removed:
+        # Match the truthiness test used for annotations in Python, so that
+        # annotations with "removed": false are not ignored
+        clauses.append("IFNULL(json_extract(annotations.annot_data, '$.removed'), 0) = 0")
+    if restrict_to_book_ids is not None:
+        clauses.append('annotations.book IN (SELECT value FROM json_each(?))')
+        data.append(json.dumps(tuple(restrict_to_book_ids)))
+    return clauses, data
 # }}}
 
 
@@ -331,11 +393,11 @@ class Connection(apsw.Connection):  # {{{
 
     BUSY_TIMEOUT = 10000  # milliseconds
 
-    def __init__(self, path):
+    def __init__(self, path, flags=apsw.SQLITE_OPEN_READWRITE | apsw.SQLITE_OPEN_CREATE):
         from calibre.utils.localization import get_lang
         from calibre_extensions.sqlite_extension import set_ui_language
         set_ui_language(get_lang())
-        super().__init__(path)
+        super().__init__(path, flags=flags)
         plugins.load_apsw_extension(self, 'sqlite_extension')
         self.fts_dbpath = self.notes_dbpath = None
 
@@ -421,6 +483,69 @@ def rmtree_with_retry(path, sleep_time=1):
         shutil.rmtree(path)
 
 
+class FormatLease:  # {{{
+
+    '''
+    A read-only view of a format file, memory mapped so that no copy of the
+    file is made. Use it as a context manager or call :meth:`release` when
+    done. The data is available as the buffer ``data``, for example
+    ``data[:4]`` or ``hashlib.sha1(data)`` and as the seekable file like
+    object ``stream``. While the lease is held, the library replaces the
+    file with a new one instead of overwriting it in place, so the data
+    never changes. On Windows, where files that are in use cannot be
+    replaced, a private copy of the file is mapped instead.
+
+    Elsewhere, writes from outside the library are not prevented. If another
+    program truncates the file in place while it is mapped, reading the data
+    past the new end of the file raises SIGBUS and kills the process.
+    '''
+
+    def __init__(self, path, release_callback=None):
+        self.path = path
+        self.key = self.copy_path = None
+        self.release_callback = release_callback
+        self.mmap = None
+        with open(make_long_path_useable(path), 'rb') as f:
+            st = os.fstat(f.fileno())
+            if not st.st_size:
+                self.data = b''
+            elif iswindows:
+                with PersistentTemporaryFile('_format_lease') as pt:
+                    shutil.copyfileobj(f, pt)
+                    pt.flush()
+                    self.copy_path = pt.name
+                    self.data = self.mmap = mmap.mmap(pt.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.key = st.st_dev, st.st_ino
+                self.data = self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.data)
+        self.stream = self.mmap if self.mmap is not None else BytesIO(self.data)
+
+    def release(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.data = b''
+        if self.copy_path is not None:
+            with suppress(OSError):
+                os.remove(self.copy_path)
+            self.copy_path = None
+        if self.key is not None and self.release_callback is not None:
+            self.release_callback(self.key)
+        self.key = self.release_callback = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.release()
+
+    def __del__(self):
+        with suppress(Exception):
+            self.release()
+# }}}
+
+
 class DB:
 
     PATH_LIMIT = 40 if iswindows else 100
@@ -432,6 +557,8 @@ def __init__(self, library_path, default_prefs=None, read_only=False,
                  restore_all_prefs=False, progress_callback=lambda x, y:True,
                  load_user_formatter_functions=True):
         self.is_closed = False
+        self.format_leases = Counter()
+        self.format_leases_lock = Lock()
         if isbytestring(library_path):
             library_path = library_path.decode(filesystem_encoding)
         self.field_metadata = FieldMetadata()
@@ -995,6 +1122,12 @@ def add_notes_resource(self, path_or_stream, name, mtime=None) -> int:
     def get_notes_resource(self, resource_hash) -> Optional[dict]:
         return self.notes.get_resource_data(self.conn, resource_hash)
 
+    def notes_resources_to_verify(self, after, limit):
+        return self.notes.resources_to_verify(self.conn, after, limit)
+
+    def bad_notes_resources(self, hashes, check_exists=False):
+        return self.notes.bad_resources(hashes, self.conn if check_exists else None)
+
     def notes_resources_used_by(self, field, item_id):
         conn = self.conn
         note_id = self.notes.note_id_for(conn, field, item_id)
@@ -1077,6 +1210,8 @@ def get_next_fts_job(self):
         return self.fts.get_next_fts_job()
 
     def reindex_fts(self):
+        if self.fts is not None:
+            self.fts.close_read_connections()
         if self.conn.fts_dbpath:
             self.conn.execute('DETACH fts_db')
             os.remove(self.conn.fts_dbpath)
@@ -1608,9 +1743,48 @@ def apply_to_format(self, book_id, path, fname, fmt, func, missing_value=None):
         path = self.format_abspath(book_id, fmt, fname, path)
         if path is None:
             return missing_value
+        if self.is_format_leased(path):
+            # Modify a copy so that the data seen by the readers holding
+            # leases on the file does not change
+            tpath = path + '.tmp'
+            shutil.copy2(path, tpath)
+            try:
+                with open(tpath, 'r+b') as f:
+                    ans = func(f)
+                os.replace(tpath, path)
+            finally:
+                with suppress(FileNotFoundError):
+                    os.remove(tpath)
+            return ans
         with open(path, 'r+b') as f:
             return func(f)
 
+    def map_format(self, book_id, fmt, fname, path):
+        path = self.format_abspath(book_id, fmt, fname, path)
+        if path is None:
+            raise NoSuchFormat('Record %d has no fmt: %s'%(book_id, fmt))
+        ans = FormatLease(path, self.release_format_lease)
+        if ans.key is not None:
+            with self.format_leases_lock:
+                self.format_leases[ans.key] += 1
+        return ans
+
+    def release_format_lease(self, key):
+        with self.format_leases_lock:
+            self.format_leases[key] -= 1
+            if self.format_leases[key] < 1:
+                del self.format_leases[key]
+
+    def is_format_leased(self, path):
+        if not self.format_leases:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        with self.format_leases_lock:
+            return (st.st_dev, st.st_ino) in self.format_leases
+
     def format_hash(self, book_id, fmt, fname, path):
         path = self.format_abspath(book_id, fmt, fname, path)
         if path is None:
@@ -1873,11 +2047,17 @@ def add_format(self, book_id, fmt, stream, title, author, path, current_name, mt
                     raise
             size = os.path.getsize(dest)
         elif (not getattr(stream, 'name', False) or not samefile(dest, stream.name)):
-            with open(dest, 'wb') as f:
+            # A file that readers hold leases on is replaced rather than
+            # overwritten in place
+            leased = self.is_format_leased(dest)
+            tdest = dest + '.tmp' if leased else dest
+            with open(tdest, 'wb') as f:
                 shutil.copyfileobj(stream, f)
                 size = f.tell()
             if mtime is not None:
-                os.utime(dest, (mtime, mtime))
+                os.utime(tdest, (mtime, mtime))
+            if leased:
+                os.replace(tdest, dest)
         elif os.path.exists(dest):
             size = os.path.getsize(dest)
             if mtime is not None:
@@ -2341,8 +2521,13 @@ def annotations_for_book(self, book_id, fmt, user_type, user):
 
     def search_annotations(self,
         fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, annotation_type,
-        restrict_to_book_ids, restrict_to_user, ignore_removed=False
+        restrict_to_book_ids, restrict_to_user, ignore_removed=False, after=None, limit=None
     ):
+        '''
+        Yield the annotations matching fts_engine_query, best matches first.
+        Results are ordered by (rank, id) so that a search can be continued
+        from the last result seen by passing its 'cursor' as after.
+        '''
         fts_engine_query = unicode_normalize(fts_engine_query)
         fts_table = 'annotations_fts_stemmed' if use_stemming else 'annotations_fts'
         text = 'annotations.searchable_text'
@@ -2353,29 +2538,26 @@ def search_annotations(self,
                         snippet_size=max(1, min(snippet_size, 64)))
             else:
                 text = f"highlight({fts_table}, 0, '{highlight_start}', '{highlight_end}')"
-        query = 'SELECT {0}.id, {0}.book, {0}.format, {0}.user_type, {0}.user, {0}.annot_data, {1} FROM {0} '
-        query = query.format('annotations', text)
+        query = 'SELECT {0}.id, {0}.book, {0}.format, {0}.user_type, {0}.user, {0}.annot_data, {1}, {2}.rank FROM {0} '
+        query = query.format('annotations', text, fts_table)
         query += ' JOIN {fts_table} ON annotations.id = {fts_table}.rowid'.format(fts_table=fts_table)
         query += f' WHERE {fts_table} MATCH ?'
-        data = [fts_engine_query]
-        if restrict_to_user:
-            query += ' AND annotations.user_type = ? AND annotations.user = ?'
-            data += list(restrict_to_user)
-        if annotation_type:
-            query += ' AND annotations.annot_type = ? '
-            data.append(annotation_type)
-        query += f' ORDER BY {fts_table}.rank '
+        clauses, data = annotation_filters(restrict_to_user, annotation_type, ignore_removed, restrict_to_book_ids)
+        if after is not None:
+            clauses.append(f'({fts_table}.rank > ? OR ({fts_table}.rank = ? AND annotations.id > ?))')
+            data.extend((after[0], after[0], after[1]))
+        for clause in clauses:
+            query += ' AND ' + clause
+        query += f' ORDER BY {fts_table}.rank, annotations.id'
+        if limit is not None:
+            query += f' LIMIT {int(limit)}'
         ls = json.loads
         try:
-            for (rowid, book_id, fmt, user_type, user, annot_data, text) in self.execute(query, tuple(data)):
-                if restrict_to_book_ids is not None and book_id not in restrict_to_book_ids:
-                    continue
+            for (rowid, book_id, fmt, user_type, user, annot_data, text, rank) in self.execute(query, (fts_engine_query,) + tuple(data)):
                 try:
                     parsed_annot = ls(annot_data)
                 except Exception:
                     continue
-                if ignore_removed and parsed_annot.get('removed'):
-                    continue
                 yield {
                     'id': rowid,
                     'book_id': book_id,
@@ -2384,6 +2566,7 @@ def search_annotations(self,
                     'user': user,
                     'text': text,
                     'annotation': parsed_annot,
+                    'cursor': (rank, rowid),
                 }
         except apsw.SQLError as e:
             raise FTSQueryError(fts_engine_query, query, e)
@@ -2440,31 +2623,29 @@ def update_annotations(self, annot_id_map):
                     self.execute('UPDATE annotations SET annot_data=?, timestamp=?, annot_type=?, searchable_text=?, annot_id=? WHERE id=?',
                         (json.dumps(annot), timestamp, atype, text, aid, annot_id))
 
-    def all_annotations(self, restrict_to_user=None, limit=None, annotation_type=None, ignore_removed=False, restrict_to_book_ids=None):
+    def all_annotations(self, restrict_to_user=None, limit=None, annotation_type=None, ignore_removed=False, restrict_to_book_ids=None, after=None):
+        '''
+        Yield annotations, newest first. Results are ordered by (timestamp, id)
+        so that a listing can be continued from the last result seen by passing
+        its 'cursor' as after.
+        '''
         ls = json.loads
-        q = 'SELECT id, book, format, user_type, user, annot_data FROM annotations'
-        data = []
-        restrict_clauses = []
-        if restrict_to_user is not None:
-            data.extend(restrict_to_user)
-            restrict_clauses.append(' user_type = ? AND user = ?')
-        if annotation_type:
-            data.append(annotation_type)
-            restrict_clauses.append(' annot_type = ? ')
-        if restrict_clauses:
-            q += ' WHERE ' + ' AND '.join(restrict_clauses)
-        q += ' ORDER BY timestamp DESC '
-        count = 0
-        for (rowid, book_id, fmt, user_type, user, annot_data) in self.execute(q, tuple(data)):
-            if restrict_to_book_ids is not None and book_id not in restrict_to_book_ids:
-                continue
+        q = 'SELECT id, book, format, user_type, user, annot_data, timestamp FROM annotations'
+        clauses, data = annotation_filters(restrict_to_user, annotation_type, ignore_removed, restrict_to_book_ids)
+        if after is not None:
+            clauses.append('(timestamp < ? OR (timestamp = ? AND id < ?))')
+            data.extend((after[0], after[0], after[1]))
+        if clauses:
+            q += ' WHERE ' + ' AND '.join(clauses)
+        q += ' ORDER BY timestamp DESC, id DESC'
+        if limit is not None:
+            q += f' LIMIT {int(limit)}'
+        for (rowid, book_id, fmt, user_type, user, annot_data, timestamp) in self.execute(q, tuple(data)):
             try:
                 annot = ls(annot_data)
                 atype = annot['type']
             except Exception:
                 continue
-            if ignore_removed and annot.get('removed'):
-                continue
             text = ''
             if atype == 'bookmark':
                 text = annot['title']
@@ -2478,10 +2659,8 @@ def all_annotations(self, restrict_to_user=None, limit=None, annotation_type=Non
                 'user': user,
                 'text': text,
                 'annotation': annot,
+                'cursor': (timestamp, rowid),
             }
-            count += 1
-            if limit is not None and count >= limit:
-                break
 
     def all_annotation_users(self):
         return self.execute('SELECT DISTINCT user_type, user FROM annotations')
@@ -2503,6 +2682,10 @@ def set_annotations_for_book(self, book_id, fmt, annots_list, user_type='local',
             with self.conn:  # Disable autocommit mode, for performance
                 save_annotations_for_book(self.conn.cursor(), book_id, fmt, annots_list, user_type, user)
 
+    def merge_annotations_for_book(self, book_id, fmt, annots_list, user_type='local', user='viewer'):
+        with self.conn:
+            return merge_annotations_for_book(self.conn.cursor(), book_id, fmt, annots_list, user_type, user)
+
     def dirty_books_with_dirtied_annotations(self):
         with self.conn:
             self.execute('INSERT or IGNORE INTO metadata_dirtied(book) SELECT book FROM annotations_dirtied;')
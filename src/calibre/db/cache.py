@@ -15,10 +15,11 @@
 import weakref
 from collections import defaultdict
 from collections.abc import MutableSet, Set
-from contextlib import closing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing, suppress
 from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
-from queue import Queue
+from queue import Empty, Queue
 from threading import Lock
 from time import mktime, monotonic, sleep, time
 from typing import NamedTuple, Optional, Tuple
@@ -30,8 +31,9 @@
     run_plugins_on_postimport,
 )
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
-from calibre.db.annotations import merge_annotations
+from calibre.db.annotations import annot_db_data, safe_timestamp_sort_key
 from calibre.db.categories import get_categories
+from calibre.db.composite_values import CompositeValues
 from calibre.db.constants import NOTES_DIR_NAME
 from calibre.db.errors import NoSuchBook, NoSuchFormat
 from calibre.db.fields import IDENTITY, InvalidLinkTable, create_field
@@ -43,7 +45,8 @@
 from calibre.db.notes.connect import copy_marked_up_text
 from calibre.db.search import Search
 from calibre.db.tables import VirtualTable
-from calibre.db.utils import type_safe_sort_key_function
+from calibre.db.format_hashes import FormatHashes, hash_stream
+from calibre.db.utils import DeviceMatchIndex, FuzzyTitleIndex, type_safe_sort_key_function
 from calibre.db.write import get_series_values, uniq
 from calibre.ebooks import check_ebook_format
 from calibre.ebooks.metadata import author_to_author_sort, string_to_authors
@@ -161,6 +164,7 @@ def __init__(self, backend, library_database_instance=None):
         self.event_dispatcher = EventDispatcher()
         self.fields = {}
         self.composites = {}
+        self.composite_values = CompositeValues(self)
         self.read_lock, self.write_lock = create_locks()
         self.format_metadata_cache = defaultdict(dict)
         self.formatter_template_cache = {}
@@ -173,6 +177,15 @@ def __init__(self, backend, library_database_instance=None):
         self.dirtied_sequence = 0
         self.cover_caches = set()
         self.clear_search_cache_count = 0
+        self.device_match_index_cache = None
+        self.device_match_dirtied = set()
+        self.event_dispatcher.synchronous_listeners.append(self.update_device_match_dirtied)
+        self.fuzzy_title_index_cache = None
+        self.fuzzy_title_dirtied = set()
+        self.fuzzy_title_index_lock = Lock()
+        self.event_dispatcher.synchronous_listeners.append(self.update_fuzzy_title_dirtied)
+        self.format_hashes = FormatHashes(self)
+        self.event_dispatcher.synchronous_listeners.append(self.invalidate_format_hashes)
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -307,8 +320,13 @@ def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
         if book_ids:
             for book_id in book_ids:
                 self.format_metadata_cache.pop(book_id, None)
+            if self.device_match_index_cache is not None:
+                self.device_match_dirtied |= set(book_ids)
+            if self.fuzzy_title_index_cache is not None:
+                self.fuzzy_title_dirtied |= set(book_ids)
         else:
             self.format_metadata_cache.clear()
+            self.device_match_index_cache = self.fuzzy_title_index_cache = None
         if search_cache:
             self._clear_search_caches(book_ids)
         self._clear_link_map_cache(book_ids)
@@ -331,6 +349,8 @@ def reload_from_db(self, clear_caches=True):
             for field in itervalues(self.fields):
                 if hasattr(field, 'table'):
                     field.table.read(self.backend)  # Reread data from metadata.db
+        # The indices were built from the data that was just replaced
+        self.device_match_index_cache = self.fuzzy_title_index_cache = None
 
     @property
     def field_metadata(self):
@@ -440,6 +460,7 @@ def init(self):
                                           self.backend.get_template_functions)
                 if table.metadata['datatype'] == 'composite':
                     self.composites[field] = self.fields[field]
+                    self.fields[field].value_store = self.composite_values
 
             self.fields['ondevice'] = create_field('ondevice',
                     VirtualTable('ondevice'), bools_are_tristate,
@@ -732,6 +753,26 @@ def get_notes_resource(self, resource_hash) -> Optional[dict]:
         ' Return a dict containing the resource data and name or None if no resource with the specified hash is found '
         return self.backend.get_notes_resource(resource_hash)
 
+    @api
+    def verify_notes_resources(self, after='', limit=256):
+        '''
+        Check a batch of at most limit notes resources for missing or corrupted
+        data. Returns the hashes of the bad resources and the value of after
+        with which to check the next batch, which is None when all resources
+        have been checked. The resources are hashed without holding the
+        database lock.
+        '''
+        with self.safe_read_lock:
+            hashes = self.backend.notes_resources_to_verify(after, limit)
+        bad = self.backend.bad_notes_resources(hashes)
+        if bad:
+            # Check the bad resources again with the lock held, so that
+            # resources changed or removed while they were being hashed are not
+            # reported
+            with self.safe_read_lock:
+                bad = self.backend.bad_notes_resources(bad, check_exists=True)
+        return bad, (hashes[-1] if len(hashes) >= limit else None)
+
     @read_api
     def notes_resources_used_by(self, field, item_id):
         ' Return the set of resource hashes of all resources used by the note for the specified item '
@@ -1229,6 +1270,36 @@ def copy_format_to(self, book_id, fmt, dest, use_hardlink=False, report_file_siz
         return self.backend.copy_format_to(book_id, fmt, name, path, dest,
                                                use_hardlink=use_hardlink, report_file_size=report_file_size)
 
+    @read_api
+    def map_format(self, book_id, fmt):
+        '''
+        Return a read-only view of the format ``fmt`` as a
+        :class:`calibre.db.backend.FormatLease`, for example::
+
+            with db.map_format(book_id, 'PDF') as lease:
+                zf = ZipFile(lease.stream)
+
+        The file is memory mapped, so unlike :meth:`format` and
+        :meth:`copy_format_to` no copy of it is made, and the data does not
+        change even if the format is replaced while the lease is held.
+        Release the lease as soon as possible. If the specified format does
+        not exist, raises :class:`NoSuchFormat` error.
+
+        Only the library itself replaces files instead of writing to them, so
+        if the file is truncated in place by another program while the lease
+        is held, accessing the missing part of the data crashes the process
+        with SIGBUS. Do not use this for formats that may be modified outside
+        of calibre while being read, use :meth:`format` with ``as_file=True``
+        instead.
+        '''
+        fmt = (fmt or '').upper()
+        try:
+            name = self.fields['formats'].format_fname(book_id, fmt)
+            path = self._field_for('path', book_id).replace('/', os.sep)
+        except (KeyError, AttributeError):
+            raise NoSuchFormat('Record %d has no %s file'%(book_id, fmt))
+        return self.backend.map_format(book_id, fmt, name, path)
+
     @read_api
     def format_abspath(self, book_id, fmt):
         '''
@@ -1446,6 +1517,12 @@ def skf(book_id):
 
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
+        if fields:
+            # Render composite columns for all books at once. Only the first
+            # field is needed for every book, the others break ties.
+            f = self.fields.get(fm.get(fields[0][0], fields[0][0]))
+            if f is not None and f.is_composite:
+                f.render_for_books(ids_to_sort, get_metadata)
 
         if len(fields) == 1:
             keyfunc = sort_key_func(fields[0][0])
@@ -2419,6 +2496,101 @@ def refresh_ondevice(self):
         self.clear_search_caches()
         self.clear_composite_caches()
 
+    def update_device_match_dirtied(self, event_type, args):
+        # Called synchronously from the write path for every event, records
+        # the books whose entries in the device match index are stale
+        if self.device_match_index_cache is None:
+            return
+        if event_type is EventType.metadata_changed:
+            if args[0] in ('title', 'authors', 'author_sort', 'uuid'):
+                self.device_match_dirtied |= args[1]
+        elif event_type is EventType.book_created:
+            self.device_match_dirtied.add(args[0])
+        elif event_type is EventType.books_removed:
+            self.device_match_dirtied |= set(args[0])
+        elif event_type in (EventType.items_renamed, EventType.items_removed):
+            if args[0] == 'authors':
+                self.device_match_dirtied |= args[1]
+
+    @write_api
+    def device_match_index(self, reset=False):
+        '''
+        Return a :class:`calibre.db.utils.DeviceMatchIndex` used to match
+        books on a device to books in the library. The index is built on first
+        use and thereafter updated only for the books that have changed, so
+        calling this is cheap. The returned object is owned by the database,
+        it must be used only by the thread that calls this method.
+
+        :param reset: If True the index is rebuilt from scratch
+        '''
+        idx = self.device_match_index_cache
+        if idx is None or reset:
+            idx = self.device_match_index_cache = DeviceMatchIndex()
+            book_ids = self._all_book_ids()
+        else:
+            book_ids = self.device_match_dirtied
+        self.device_match_dirtied = set()
+        if book_ids:
+            existing = self.fields['uuid'].table.book_col_map
+            ff = self._fast_field_for
+            tf, af, asf, uf = (self.fields[x] for x in ('title', 'authors', 'author_sort', 'uuid'))
+            for book_id in book_ids:
+                if book_id in existing:
+                    idx.add(book_id, ff(tf, book_id), ' & '.join(ff(af, book_id)), ff(asf, book_id), ff(uf, book_id))
+                else:
+                    idx.remove(book_id)
+        return idx
+
+    def update_fuzzy_title_dirtied(self, event_type, args):
+        # Called synchronously from the write path for every event, records
+        # the books whose entries in the fuzzy title index are stale
+        if self.fuzzy_title_index_cache is None:
+            return
+        if event_type is EventType.metadata_changed:
+            if args[0] == 'title':
+                self.fuzzy_title_dirtied |= args[1]
+        elif event_type is EventType.book_created:
+            self.fuzzy_title_dirtied.add(args[0])
+        elif event_type is EventType.books_removed:
+            self.fuzzy_title_dirtied |= set(args[0])
+
+    def invalidate_format_hashes(self, event_type, args):
+        # The stored hashes are checked against the size and mtime of the
+        # files, forget them anyway when formats are changed by us, in case
+        # the filesystem has a coarse mtime resolution
+        if event_type in (EventType.format_added, EventType.book_edited):
+            self.format_hashes.invalidate((args[0],))
+        elif event_type is EventType.formats_removed:
+            self.format_hashes.invalidate(args[0])
+        elif event_type is EventType.books_removed:
+            self.format_hashes.invalidate(args[0])
+
+    @read_api
+    def fuzzy_title_index(self):
+        '''
+        Return the :class:`calibre.db.utils.FuzzyTitleIndex` used to find
+        books with the same title as books being added. The index is built on
+        first use and thereafter updated only for the books whose titles have
+        changed. The returned object is owned by the database and must not be
+        modified.
+        '''
+        with self.fuzzy_title_index_lock:
+            idx = self.fuzzy_title_index_cache
+            if idx is None:
+                idx = FuzzyTitleIndex()
+                book_ids = self._all_book_ids()
+            else:
+                book_ids = self.fuzzy_title_dirtied
+            self.fuzzy_title_dirtied = set()
+            titles = self.fields['title'].table.book_col_map
+            for book_id in book_ids:
+                if book_id in titles:
+                    idx.add(book_id, titles[book_id])
+                else:
+                    idx.remove(book_id)
+            self.fuzzy_title_index_cache = idx
+        return idx
+
     @read_api
     def books_matching_device_book(self, lpath):
         ans = set()
@@ -2673,12 +2845,20 @@ def data_for_find_identical_books(self):
         author_map = defaultdict(set)
         for aid, author in iteritems(at.id_map):
             author_map[icu_lower(author)].add(aid)
-        return (author_map, at.col_book_map.copy(), self.fields['title'].table.book_col_map.copy(), self.fields['languages'].book_value_map.copy())
+        return (
+            author_map, at.col_book_map.copy(), self.fields['title'].table.book_col_map.copy(), self.fields['languages'].book_value_map.copy(),
+            self._fuzzy_title_index().copy_of_map())
 
     @read_api
     def update_data_for_find_identical_books(self, book_id, data):
-        author_map, author_book_map, title_map, lang_map = data
-        title_map[book_id] = self._field_for('title', book_id)
+        from calibre.db.utils import fuzzy_title
+        author_map, author_book_map, title_map, lang_map, fuzzy_title_map = data
+        old_title = title_map.get(book_id)
+        if old_title is not None:
+            # The book may have been retitled, for example by a merge
+            fuzzy_title_map.get(fuzzy_title(old_title), set()).discard(book_id)
+        title_map[book_id] = title = self._field_for('title', book_id)
+        fuzzy_title_map.setdefault(fuzzy_title(title or ''), set()).add(book_id)
         lang_map[book_id] = self._field_for('languages', book_id)
         at = self.fields['authors'].table
         for aid in at.book_col_map.get(book_id, ()):
@@ -2691,43 +2871,110 @@ def update_data_for_find_identical_books(self, book_id, data):
     @read_api
     def find_identical_books(self, mi, search_restriction='', book_ids=None):
         ''' Finds books that have a superset of the authors in mi and the same
-        title (title is fuzzy matched). See also :meth:`data_for_find_identical_books`. '''
-        from calibre.db.utils import fuzzy_title
+        title (title is fuzzy matched). See also :meth:`data_for_find_identical_books`
+        and :meth:`find_books_with_identical_files`. '''
         identical_book_ids = set()
-        langq = tuple(x for x in map(canonicalize_lang, mi.languages or ()) if x and x != 'und')
-        if mi.authors:
-            try:
-                quathors = mi.authors[:20]  # Too many authors causes parsing of the search expression to fail
-                query = ' and '.join('authors:"=%s"'%(a.replace('"', '')) for a in quathors)
-                qauthors = mi.authors[20:]
-            except ValueError:
-                return identical_book_ids
+        if not mi.authors:
+            return identical_book_ids
+        candidates = self._fuzzy_title_index().books_with_title(mi.title)
+        if not candidates:
+            return identical_book_ids
+        if search_restriction or book_ids is not None:
             try:
-                book_ids = self._search(query, restriction=search_restriction, book_ids=book_ids)
-            except:
+                candidates = self._search('', restriction=search_restriction, book_ids=candidates if book_ids is None else candidates & set(book_ids))
+            except Exception:
                 traceback.print_exc()
                 return identical_book_ids
-            if qauthors and book_ids:
-                matches = set()
-                qauthors = {icu_lower(x) for x in qauthors}
-                for book_id in book_ids:
-                    aut = self._field_for('authors', book_id)
-                    if aut:
-                        aut = {icu_lower(x) for x in aut}
-                        if aut.issuperset(qauthors):
-                            matches.add(book_id)
-                book_ids = matches
-
-            for book_id in book_ids:
-                fbook_title = self._field_for('title', book_id)
-                fbook_title = fuzzy_title(fbook_title)
-                mbook_title = fuzzy_title(mi.title)
-                if fbook_title == mbook_title:
-                    bl = self._field_for('languages', book_id)
-                    if not langq or not bl or bl == langq:
-                        identical_book_ids.add(book_id)
+        qauthors = {icu_lower(x) for x in mi.authors}
+        langq = tuple(x for x in map(canonicalize_lang, mi.languages or ()) if x and x != 'und')
+        for book_id in candidates:
+            aut = {icu_lower(x) for x in self._field_for('authors', book_id)}
+            if aut.issuperset(qauthors):
+                bl = self._field_for('languages', book_id)
+                if not langq or not bl or bl == langq:
+                    identical_book_ids.add(book_id)
         return identical_book_ids
 
+    @api
+    def find_books_with_identical_files(self, files):
+        '''
+        Return the ids of the books that have a format that is byte for byte
+        identical to one of the specified files, which can be paths or
+        seekable file like objects. Only formats that have the same size as
+        one of the files are compared and their hashes are stored on disk, so
+        this is fast even for very large libraries. See also
+        :meth:`find_books_with_identical_file_hashes`.
+        '''
+        ans = set()
+        for f in files:
+            if isinstance(f, str):
+                size = os.path.getsize(f)
+            else:
+                pos = f.tell()
+                size = f.seek(0, os.SEEK_END)
+                f.seek(pos)
+            if not size:
+                continue
+            known = self.hashes_of_formats_with_size(size)
+            if known:
+                if isinstance(f, str):
+                    with open(f, 'rb') as stream:
+                        fhash = hash_stream(stream)
+                else:
+                    pos = f.tell()
+                    f.seek(0)
+                    fhash = hash_stream(f)
+                    f.seek(pos)
+                ans |= {book_id for (book_id, fmt), h in known.items() if h == fhash}
+        return ans
+
+    @api
+    def find_books_with_identical_file_hashes(self, file_hashes):
+        '''
+        Same as :meth:`find_books_with_identical_files` for files that have
+        already been hashed, for example in a worker process. file_hashes is
+        an iterable of (size, hash) pairs, with the hashes computed by
+        :func:`calibre.db.format_hashes.hash_stream`.
+        '''
+        ans = set()
+        for size, fhash in file_hashes:
+            if size:
+                ans |= {book_id for (book_id, fmt), h in self.hashes_of_formats_with_size(size).items() if h == fhash}
+        return ans
+
+    @api
+    def hashes_of_formats_with_size(self, size):
+        '''
+        Return a map of (book_id, fmt) to the hash of the format for all
+        formats that are size bytes long. Formats whose hashes are not stored
+        are hashed without holding the lock.
+        '''
+        known, unknown = {}, []
+        with self.safe_read_lock:
+            for book_id, fmt in self.fields['formats'].table.formats_with_size(size):
+                mdata = self.format_metadata(book_id, fmt, allow_cache=False)
+                if mdata.get('size') != size:
+                    continue
+                mtime = mdata['mtime'].timestamp()
+                h = self.format_hashes.get(book_id, fmt, size, mtime)
+                if h is None:
+                    unknown.append((book_id, fmt, mtime, mdata['path']))
+                else:
+                    known[book_id, fmt] = h
+        # The files are read through ordinary file handles, not memory
+        # mapped, so that a file being changed while it is read cannot crash
+        # us. A hash computed from a changing file is stored against the
+        # mtime read above, so it is never used once the file has changed.
+        for book_id, fmt, mtime, path in unknown:
+            try:
+                with open(make_long_path_useable(path), 'rb') as f:
+                    h = hash_stream(f)
+            except OSError:
+                continue
+            known[book_id, fmt] = h
+            self.format_hashes.set(book_id, fmt, size, mtime, h)
+        return known
+
     @read_api
     def get_top_level_move_items(self):
         all_paths = {self._field_for('path', book_id).partition('/')[0] for book_id in self._all_book_ids()}
@@ -2832,6 +3079,8 @@ def close(self):
         self._shutdown_fts(stage=2)
         with self.write_lock:
             self.backend.close()
+            self.composite_values.close()
+            self.format_hashes.close()
 
     @property
     def is_closed(self):
@@ -3011,9 +3260,22 @@ def user_categories_for_books(self, book_ids, proxy_metadata_map=None):
                         res.append([name, cat])
         return ans
 
-    @write_api
-    def embed_metadata(self, book_ids, only_fmts=None, report_error=None, report_progress=None):
-        ''' Update metadata in all formats of the specified book_ids to current metadata in the database. '''
+    @api
+    def embed_metadata(self, book_ids, only_fmts=None, report_error=None, report_progress=None, max_workers=None):
+        '''
+        Update metadata in all formats of the specified book_ids to current
+        metadata in the database. When more than one book is specified, the
+        files are updated in parallel by up to max_workers worker processes
+        (defaults to the number of CPUs), without holding the database lock
+        while the files are being rewritten.
+        '''
+        if len(book_ids) > 1 and max_workers != 1:
+            return self.embed_metadata_in_workers(book_ids, only_fmts, report_error, report_progress, max_workers)
+        with self.write_lock:
+            return self.embed_metadata_in_process(book_ids, only_fmts, report_error, report_progress)
+
+    def embed_metadata_in_process(self, book_ids, only_fmts=None, report_error=None, report_progress=None):
+        # Must be called with the write lock held
         field = self.fields['formats']
         from calibre.customize.ui import apply_null_metadata
         from calibre.ebooks.metadata.meta import set_metadata
@@ -3077,6 +3339,152 @@ def doit(fmt, mi, stream):
             if report_progress is not None:
                 report_progress(i+1, len(book_ids), mi)
 
+    def embed_metadata_in_workers(self, book_ids, only_fmts=None, report_error=None, report_progress=None, max_workers=None, batch_size=64):
+        # The worker processes rewrite copies of the files in a temporary
+        # folder. The copies replace the contents of the files in the library
+        # with the write lock held, and only if the files have not changed since
+        # they were copied, otherwise the book is updated in process.
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.utils.ipc.pool import Failure, Pool
+        if only_fmts:
+            only_fmts = {f.lower() for f in only_fmts}
+        field = self.fields['formats']
+        snapshots = {}
+        num_done = 0
+
+        def file_stamp(fpath):
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                return None
+            return st.st_size, st.st_mtime_ns
+
+        def snapshot(book_id, tdir):
+            # Called with the read lock held. Books that are skipped are
+            # snapshotted with no formats, so that their progress is reported.
+            path = self._field_for('path', book_id)
+            fmts = field.table.book_col_map.get(book_id, ())
+            path = path.replace('/', os.sep) if path else path
+            mi = self._get_metadata(book_id)
+            snapshots[book_id] = mi, path, []
+            data = {'fmts': [], 'cover': self.backend.cover_abspath(book_id, path) if path and fmts else None}
+            if data['cover'] is None:
+                return data  # books without covers are skipped, as in embed_metadata_in_process()
+            for fmt in fmts:
+                if only_fmts is not None and fmt.lower() not in only_fmts:
+                    continue
+                try:
+                    name = field.format_fname(book_id, fmt)
+                except Exception:
+                    continue
+                fpath = self.backend.format_abspath(book_id, fmt, name, path, do_file_rename=False) if name else None
+                if fpath:
+                    tpath = os.path.join(tdir, f'{book_id}.{fmt.lower()}')
+                    data['fmts'].append((fmt, name, fpath, tpath, file_stamp(fpath)))
+            mi.cover, mi.cover_data = None, (None, None)
+            data['opf'] = metadata_to_opf(mi)
+            data['last_modified'] = mi.last_modified.isoformat()
+            snapshots[book_id] = mi, path, data['fmts']
+            return data
+
+        def copy_from(tpath, stream):
+            with open(tpath, 'rb') as src:
+                stream.seek(0)
+                shutil.copyfileobj(src, stream)
+                stream.truncate()
+                return stream.tell()
+
+        def is_unchanged(book_id, path, fmts):
+            # Called with the write lock held
+            if self._field_for('path', book_id, default_value='').replace('/', os.sep) != path:
+                return False
+            fname_map = field.table.fname_map.get(book_id, {})
+            return all(name == fname_map.get(fmt) and stamp is not None and file_stamp(fpath) == stamp for fmt, name, fpath, tpath, stamp in fmts)
+
+        def commit(results):
+            # Replace the contents of the rewritten files and update their
+            # sizes in a single transaction
+            nonlocal num_done
+            with self.write_lock, self.backend.conn:
+                for book_id, sizes in results:
+                    mi, path, fmts = snapshots[book_id]
+                    if not sizes:
+                        continue
+                    if not is_unchanged(book_id, path, fmts):
+                        self.embed_metadata_in_process((book_id,), only_fmts, report_error)
+                        continue
+                    for fmt, name, fpath, tpath, stamp in fmts:
+                        if sizes.get(fmt) is None:
+                            continue
+                        try:
+                            new_size = self.backend.apply_to_format(book_id, path, name, fmt, partial(copy_from, tpath))
+                        except Exception:
+                            if report_error is None:
+                                raise
+                            report_error(mi, fmt, traceback.format_exc())
+                            continue
+                        if new_size is not None:
+                            self.format_metadata_cache[book_id].get(fmt, {})['size'] = new_size
+                            max_size = field.table.update_fmt(book_id, fmt, name, new_size, self.backend)
+                            self.fields['size'].table.update_sizes({book_id: max_size})
+            for book_id, sizes in results:
+                mi, path, fmts = snapshots.pop(book_id)
+                for fmt, name, fpath, tpath, stamp in fmts:
+                    with suppress(OSError):
+                        os.remove(tpath)
+                num_done += 1
+                if report_progress is not None:
+                    report_progress(num_done, len(book_ids), mi)
+
+        def consume_results(pool, block=False):
+            results = []
+            while True:
+                if pool.failed:
+                    raise Failure(pool.terminal_failure)
+                try:
+                    wr = pool.results.get(block=block and not results, timeout=0.1)
+                except Empty:
+                    if block and not results:
+                        continue
+                    break
+                if wr.result.err is not None:
+                    errors = [('', wr.result.err + '\n' + wr.result.traceback)]
+                    sizes = {}
+                else:
+                    sizes, errors = wr.result.value
+                if report_error is not None:
+                    for fmt, tb in errors:
+                        report_error(snapshots[wr.id][0], fmt, tb)
+                results.append((wr.id, sizes))
+            if results:
+                commit(results)
+
+        book_ids = tuple(book_ids)
+        with TemporaryDirectory('_embed_metadata') as tdir:
+            pool = Pool(max_workers=max_workers, name='EmbedMetadata')
+            try:
+                for i in range(0, len(book_ids), batch_size):
+                    with self.safe_read_lock:
+                        batch = {book_id: snapshot(book_id, tdir) for book_id in book_ids[i:i+batch_size]}
+                    skipped = []
+                    for book_id, data in batch.items():
+                        if data['fmts']:
+                            data['fmts'] = [(fmt, fpath, tpath) for fmt, name, fpath, tpath, stamp in data['fmts']]
+                            pool(book_id, 'calibre.db.utils', 'embed_metadata_in_files', data)
+                        else:
+                            skipped.append((book_id, {}))
+                    if skipped:
+                        commit(skipped)
+                    # Do not let snapshots accumulate faster than the workers can
+                    # process them
+                    while len(snapshots) > 4 * batch_size:
+                        consume_results(pool, block=True)
+                    consume_results(pool)
+                while snapshots:
+                    consume_results(pool, block=True)
+            finally:
+                pool.shutdown()
+
     @read_api
     def get_last_read_positions(self, book_id, fmt, user):
         fmt = fmt.upper()
@@ -3102,7 +3510,7 @@ def set_last_read_position(self, book_id, fmt, user='_', device='_', cfi=None, e
                 (book_id, fmt, user, device, cfi, epoch or time(), pos_frac))
 
     @read_api
-    def export_library(self, library_key, exporter, progress=None, abort=None):
+    def export_library(self, library_key, exporter, progress=None, abort=None, num_threads=4):
         from polyglot.binary import as_hex_unicode
         key_prefix = as_hex_unicode(library_key)
         book_ids = self._all_book_ids()
@@ -3147,32 +3555,67 @@ def report_progress(fname):
         metadata = {'format_data':format_metadata, 'metadata.db':dbkey, 'notes.db': notesdbkey, 'total':total, 'extra_files': extra_files}
         if has_fts:
             metadata['full-text-search.db'] = ftsdbkey
-        for i, book_id in enumerate(book_ids):
-            if abort is not None and abort.is_set():
-                return
-            if progress is not None:
-                report_progress(self._field_for('title', book_id))
-            format_metadata[book_id] = fm = {}
-            for fmt in self._formats(book_id):
-                mdata = self.format_metadata(book_id, fmt)
+        fmt_field = self.fields['formats']
+
+        def export_book(book_id, path, formats):
+            # Runs in a worker thread, so only uses the backend and the data
+            # gathered by the thread holding the read lock
+            fm, ef = {}, {}
+            for fmt, name, mdata in formats:
                 key = f'{key_prefix}:{book_id}:{fmt}'
                 fm[fmt] = key
-                with exporter.start_file(key, mtime=mdata.get('mtime')) as dest:
-                    self._copy_format_to(book_id, fmt, dest, report_file_size=dest.ensure_space)
+                mtime = mdata['mtime'].timestamp() if mdata.get('mtime') else None
+                if not exporter.has_file(key, mtime, mdata.get('size')):
+                    with exporter.start_file(key, mtime=mtime) as dest:
+                        self.backend.copy_format_to(book_id, fmt, name, path, dest, report_file_size=dest.ensure_space)
+            if not path:
+                return fm, ef
             cover_key = '{}:{}:{}'.format(key_prefix, book_id, '.cover')
-            with exporter.start_file(cover_key) as dest:
-                if not self.copy_cover_to(book_id, dest, report_file_size=dest.ensure_space):
-                    dest.discard()
-                else:
-                    fm['.cover'] = cover_key
-            bp = self.field_for('path', book_id)
-            extra_files[book_id] = ef = {}
-            if bp:
-                for (relpath, fobj, stat_result) in self.backend.iter_extra_files(book_id, bp, self.fields['formats']):
-                    key = f'{key_prefix}:{book_id}:.|{relpath}'
+            cpath = self.backend.cover_abspath(book_id, path)
+            try:
+                mtime = os.stat(cpath).st_mtime if cpath else None
+            except OSError:
+                mtime = None
+            if mtime is not None and exporter.has_file(cover_key, mtime):
+                fm['.cover'] = cover_key
+            else:
+                with exporter.start_file(cover_key, mtime=mtime) as dest:
+                    if not self.backend.copy_cover_to(path, dest, report_file_size=dest.ensure_space):
+                        dest.discard()
+                    else:
+                        fm['.cover'] = cover_key
+            for (relpath, fobj, stat_result) in self.backend.iter_extra_files(book_id, path, fmt_field):
+                key = f'{key_prefix}:{book_id}:.|{relpath}'
+                if not exporter.has_file(key, stat_result.st_mtime, stat_result.st_size):
                     with exporter.start_file(key, mtime=stat_result.st_mtime) as dest:
                         shutil.copyfileobj(fobj, dest)
-                    ef[relpath] = key
+                ef[relpath] = key
+            return fm, ef
+
+        # Books are exported in parallel, each thread writing to its own
+        # export parts, with a bounded number of books in flight
+        pending = {}
+
+        def finish(futures):
+            for f in futures:
+                book_id, title = pending.pop(f)
+                format_metadata[book_id], extra_files[book_id] = f.result()
+                report_progress(title)
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for book_id in book_ids:
+                if abort is not None and abort.is_set():
+                    for f in pending:
+                        f.cancel()
+                    return
+                path = self._field_for('path', book_id)
+                path = path.replace('/', os.sep) if path else path
+                formats = tuple((fmt, fmt_field.format_fname(book_id, fmt), self.format_metadata(book_id, fmt)) for fmt in self._formats(book_id))
+                title = self._field_for('title', book_id) if progress is not None else ''
+                pending[executor.submit(export_book, book_id, path, formats)] = book_id, title
+                if len(pending) >= 2 * num_threads:
+                    finish(wait(pending, return_when=FIRST_COMPLETED).done)
+            finish(wait(pending).done)
         exporter.set_metadata(library_key, metadata)
         if progress is not None:
             progress(_('Completed'), total, total)
@@ -3223,6 +3666,52 @@ def search_annotations(
             ignore_removed
         ))
 
+    @read_api
+    def annotations_page(
+        self, after=None, page_size=100, restrict_to_user=None, annotation_type=None, ignore_removed=False, restrict_to_book_ids=None
+    ):
+        '''
+        Return a page of at most page_size annotations, newest first, and the
+        cursor to pass as after to get the next page, which is None when there
+        are no more annotations. Pages start from the position of the last
+        annotation seen, so every page is equally fast to fetch and annotations
+        added while paging do not shift the later pages.
+        '''
+        results = tuple(self.backend.all_annotations(
+            restrict_to_user, page_size + 1, annotation_type, ignore_removed, restrict_to_book_ids, after))
+        if len(results) > page_size:
+            return results[:page_size], results[page_size - 1]['cursor']
+        return results, None
+
+    @read_api
+    def search_annotations_page(
+        self,
+        fts_engine_query,
+        after=None,
+        page_size=100,
+        use_stemming=True,
+        highlight_start=None,
+        highlight_end=None,
+        snippet_size=None,
+        annotation_type=None,
+        restrict_to_book_ids=None,
+        restrict_to_user=None,
+        ignore_removed=False
+    ):
+        '''
+        Like :meth:`search_annotations` but returns a page of at most page_size
+        results and the cursor to pass as after to get the next page, as for
+        :meth:`annotations_page`.
+        '''
+        results = tuple(self.backend.search_annotations(
+            fts_engine_query, use_stemming, highlight_start, highlight_end,
+            snippet_size, annotation_type, restrict_to_book_ids, restrict_to_user,
+            ignore_removed, after, page_size + 1
+        ))
+        if len(results) > page_size:
+            return results[:page_size], results[page_size - 1]['cursor']
+        return results, None
+
     @write_api
     def delete_annotations(self, annot_ids):
         self.backend.delete_annotations(annot_ids)
@@ -3252,14 +3741,14 @@ def set_annotations_for_book(self, book_id, fmt, annots_list, user_type='local',
     def merge_annotations_for_book(self, book_id, fmt, annots_list, user_type='local', user='viewer'):
         from calibre.utils.date import EPOCH
         from calibre.utils.iso8601 import parse_iso8601
-        amap = self._annotations_map_for_book(book_id, fmt, user_type=user_type, user=user)
-        merge_annotations(annots_list, amap)
         alist = []
-        for val in itervalues(amap):
-            for annot in val:
-                ts = (parse_iso8601(annot['timestamp']) - EPOCH).total_seconds()
+        for annot in annots_list:
+            if annot_db_data(annot)[0] is not None:
+                ts = (parse_iso8601(safe_timestamp_sort_key(annot)) - EPOCH).total_seconds()
                 alist.append((annot, ts))
-        self._set_annotations_for_book(book_id, fmt, alist, user_type=user_type, user=user)
+        # Only the annotations that are newer than the stored ones are written,
+        # instead of reading, merging and rewriting every annotation of the book
+        return self.backend.merge_annotations_for_book(book_id, fmt, alist, user_type, user)
 
     @write_api
     def reindex_annotations(self):
@@ -3438,75 +3927,114 @@ def is_null_date(x):
                         dest_value.extend(src_value)
                     self._set_field(field, {dest_id: dest_value})
 
-def import_library(library_key, importer, library_path, progress=None, abort=None):
+def import_library(library_key, importer, library_path, progress=None, abort=None, num_threads=4, resume=False):
+    '''
+    Import the library exported with the key library_key into library_path.
+    The files of num_threads books are imported at a time. The progress of the
+    import is recorded in library_path, if it is interrupted, calling this
+    function again with resume=True skips the books that were imported.
+    '''
     from calibre.db.backend import DB
-    metadata = importer.metadata[library_key]
-    total = metadata['total']
-    poff = 0
-    def report_progress(fname):
-        nonlocal poff
-        if progress is not None:
-            progress(fname, poff, total)
-            poff += 1
-    report_progress('metadata.db')
-    if abort is not None and abort.is_set():
-        return
-    with open(os.path.join(library_path, 'metadata.db'), 'wb') as f:
-        src = importer.start_file(metadata['metadata.db'], 'metadata.db for ' + library_path)
-        shutil.copyfileobj(src, f)
-        src.close()
-    if 'full-text-search.db' in metadata:
-        if progress is not None:
-            progress('full-text-search.db', 1, total)
-        if abort is not None and abort.is_set():
-            return
-        poff += 1
-        with open(os.path.join(library_path, 'full-text-search.db'), 'wb') as f:
-            src = importer.start_file(metadata['full-text-search.db'], 'full-text-search.db for ' + library_path)
-            shutil.copyfileobj(src, f)
-            src.close()
-    if abort is not None and abort.is_set():
-        return
-    if 'notes.db' in metadata:
-        import zipfile
-        notes_dir = os.path.join(library_path, NOTES_DIR_NAME)
-        os.makedirs(notes_dir, exist_ok=True)
-        with closing(importer.start_file(metadata['notes.db'], 'notes.db for ' + library_path)) as stream:
-            stream.check_hash = False
-            with zipfile.ZipFile(stream) as zf:
-                for zi in zf.infolist():
-                    tpath = zf._extract_member(zi, notes_dir, None)
-                    date_time = mktime(zi.date_time + (0, 0, -1))
-                    os.utime(tpath, (date_time, date_time))
-    if abort is not None and abort.is_set():
-        return
-    cache = Cache(DB(library_path, load_user_formatter_functions=False))
-    cache.init()
-
-    format_data = {int(book_id):data for book_id, data in iteritems(metadata['format_data'])}
-    extra_files = {int(book_id):data for book_id, data in metadata.get('extra_files', {}).items()}
-    for i, (book_id, fmt_key_map) in enumerate(iteritems(format_data)):
-        if abort is not None and abort.is_set():
-            return
-        title = cache._field_for('title', book_id)
-        if progress is not None:
-            progress(title, i + poff, total)
-        cache._update_path((book_id,), mark_as_dirtied=False)
-        for fmt, fmtkey in iteritems(fmt_key_map):
-            if fmt == '.cover':
-                with closing(importer.start_file(fmtkey, _('Cover for %s') % title)) as stream:
-                    path = cache._field_for('path', book_id).replace('/', os.sep)
-                    cache.backend.set_cover(book_id, path, stream, no_processing=True)
-            else:
-                with closing(importer.start_file(fmtkey, _('{0} format for {1}').format(fmt.upper(), title))) as stream:
-                    size, fname = cache._do_add_format(book_id, fmt, stream, mtime=stream.mtime)
+    from calibre.utils.exim import ImportJournal
+    with ImportJournal(library_path, resume=resume) as journal:
+        metadata = importer.metadata[library_key]
+        total = metadata['total']
+        poff = 0
+        def report_progress(fname):
+            nonlocal poff
+            if progress is not None:
+                progress(fname, poff, total)
+                poff += 1
+        if 'databases' in journal:
+            poff += 1 + int('full-text-search.db' in metadata)
+        else:
+            report_progress('metadata.db')
+            if abort is not None and abort.is_set():
+                return
+            with open(os.path.join(library_path, 'metadata.db'), 'wb') as f:
+                src = importer.start_file(metadata['metadata.db'], 'metadata.db for ' + library_path)
+                shutil.copyfileobj(src, f)
+                src.close()
+            if 'full-text-search.db' in metadata:
+                if progress is not None:
+                    progress('full-text-search.db', 1, total)
+                if abort is not None and abort.is_set():
+                    return
+                poff += 1
+                with open(os.path.join(library_path, 'full-text-search.db'), 'wb') as f:
+                    src = importer.start_file(metadata['full-text-search.db'], 'full-text-search.db for ' + library_path)
+                    shutil.copyfileobj(src, f)
+                    src.close()
+            if abort is not None and abort.is_set():
+                return
+            if 'notes.db' in metadata:
+                import zipfile
+                notes_dir = os.path.join(library_path, NOTES_DIR_NAME)
+                os.makedirs(notes_dir, exist_ok=True)
+                with closing(importer.start_file(metadata['notes.db'], 'notes.db for ' + library_path)) as stream:
+                    stream.check_hash = False
+                    with zipfile.ZipFile(stream) as zf:
+                        for zi in zf.infolist():
+                            tpath = zf._extract_member(zi, notes_dir, None)
+                            date_time = mktime(zi.date_time + (0, 0, -1))
+                            os.utime(tpath, (date_time, date_time))
+            if abort is not None and abort.is_set():
+                return
+            journal.add('databases')
+        cache = Cache(DB(library_path, load_user_formatter_functions=False))
+        cache.init()
+
+        format_data = {int(book_id):data for book_id, data in iteritems(metadata['format_data'])}
+        extra_files = {int(book_id):data for book_id, data in metadata.get('extra_files', {}).items()}
+
+        def import_book(book_id, title, author, path, fmt_key_map):
+            # Runs in a worker thread, only writes files in the folder of the book,
+            # the database is updated by the calling thread
+            added_formats = []
+            for fmt, fmtkey in iteritems(fmt_key_map):
+                if fmt == '.cover':
+                    with closing(importer.start_file(fmtkey, _('Cover for %s') % title)) as stream:
+                        cache.backend.set_cover(book_id, path, stream, no_processing=True)
+                else:
+                    with closing(importer.start_file(fmtkey, _('{0} format for {1}').format(fmt.upper(), title))) as stream:
+                        size, fname = cache.backend.add_format(book_id, fmt, stream, title, author, path, None, mtime=stream.mtime)
+                        added_formats.append((fmt, fname, size))
+            for relpath, efkey in extra_files.get(book_id, {}).items():
+                with closing(importer.start_file(efkey, _('Extra file {0} for book {1}').format(relpath, title))) as stream:
+                    cache.backend.add_extra_file(relpath, stream, path)
+            return added_formats
+
+        pending = {}
+
+        def finish(futures):
+            for f in futures:
+                book_id = pending.pop(f)
+                for fmt, fname, size in f.result():
                     cache.fields['formats'].table.update_fmt(book_id, fmt, fname, size, cache.backend)
-        for relpath, efkey in extra_files.get(book_id, {}).items():
-            with closing(importer.start_file(efkey, _('Extra file {0} for book {1}').format(relpath, title))) as stream:
+                cache.dump_metadata({book_id})
+                journal.add(book_id)
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for i, (book_id, fmt_key_map) in enumerate(iteritems(format_data)):
+                if abort is not None and abort.is_set():
+                    for f in pending:
+                        f.cancel()
+                    return
+                if book_id in journal:
+                    continue
+                title = cache._field_for('title', book_id)
+                if progress is not None:
+                    progress(title, i + poff, total)
+                cache._update_path((book_id,), mark_as_dirtied=False)
                 path = cache._field_for('path', book_id).replace('/', os.sep)
-                cache.backend.add_extra_file(relpath, stream, path)
-        cache.dump_metadata({book_id})
-    if progress is not None:
-        progress(_('Completed'), total, total)
-    return cache
+                authors = cache._field_for('authors', book_id, default_value=(_('Unknown'),))
+                author = authors[0] if authors else _('Unknown')
+                pending[executor.submit(import_book, book_id, title, author, path, fmt_key_map)] = book_id
+                if len(pending) >= 2 * num_threads:
+                    finish(wait(pending, return_when=FIRST_COMPLETED).done)
+            finish(wait(pending).done)
+        journal.remove()
+        if progress is not None:
+            progress(_('Completed'), total, total)
+        return cache
 # }}}
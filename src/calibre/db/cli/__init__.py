@@ -2,7 +2,12 @@
 # License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import hashlib
 import importlib
+import os
+import re
+import shutil
+import time
 
 
 def module_for_cmd(cmd):
@@ -17,3 +22,58 @@ def integers_from_string(arg, include_last_inrange=False):
                 yield y
         else:
             yield y[0]
+
+
+def upload_key(path):
+    # The name under which a file uploaded by calibredb for use by a later
+    # command is stored on the server
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()
+
+
+def is_upload_token(x):
+    # Both the request id generated by calibredb and the upload key must be
+    # plain alphanumeric tokens, as they are used as file names on the server
+    return isinstance(x, str) and re.fullmatch(r'[0-9a-zA-Z]{1,64}', x) is not None
+
+
+def staged_uploads_dir():
+    from calibre.ptempfile import base_dir
+    return os.path.join(base_dir(), 'cdb-uploads')
+
+
+def staged_upload_path(request_id, key):
+    for x in (request_id, key):
+        if not is_upload_token(x):
+            raise ValueError(f'Invalid upload identifier: {x!r}')
+    return os.path.join(staged_uploads_dir(), request_id, key)
+
+
+def remove_staged_uploads(request_id, keys):
+    # Remove the specified staged files, if they were not used, and the folder
+    # of the request, once it is empty
+    if not is_upload_token(request_id):
+        return
+    for key in keys:
+        try:
+            os.remove(staged_upload_path(request_id, key))
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(os.path.join(staged_uploads_dir(), request_id))
+    except OSError:
+        pass
+
+
+def expire_staged_uploads(max_age=24 * 60 * 60):
+    # Remove files left behind by calibredb commands that did not complete
+    now = time.time()
+    try:
+        entries = tuple(os.scandir(staged_uploads_dir()))
+    except FileNotFoundError:
+        return
+    for x in entries:
+        try:
+            if now - x.stat().st_mtime > max_age:
+                shutil.rmtree(x.path)
+        except OSError:
+            pass
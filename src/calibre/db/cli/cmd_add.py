@@ -3,15 +3,19 @@
 
 
 import os
+import shutil
 import sys
 from contextlib import contextmanager
+from itertools import tee
 from optparse import OptionGroup, OptionValueError
 
 from calibre import prints
 from calibre.db.adding import (
     cdb_find_in_dir, cdb_recursive_find, compile_rule, create_format_map,
-    run_import_plugins, run_import_plugins_before_metadata
+    read_metadata_in_workers, run_import_plugins,
+    run_import_plugins_before_metadata
 )
+from calibre.db.cli import remove_staged_uploads, staged_upload_path, upload_key
 from calibre.db.utils import find_identical_books
 from calibre.ebooks.metadata import MetaInformation, string_to_authors
 from calibre.ebooks.metadata.book.serialize import read_cover, serialize_cover
@@ -22,7 +26,8 @@
 from calibre.utils.short_uuid import uuid4
 
 readonly = False
-version = 0  # change this if you change signature of implementation()
+upload_batch_size = 32
+version = 1  # change this if you change signature of implementation()
 
 
 def empty(db, notify_changes, is_remote, args):
@@ -61,6 +66,8 @@ def add_book():
     if oautomerge != 'disabled' or not add_duplicates:
         identical_books_data = cached_identical_book_data(db, request_id)
         identical_book_list = find_identical_books(mi, identical_books_data)
+        # Also catch copies of files already in the library whose metadata differs
+        identical_book_list |= db.find_books_with_identical_files(format_map.values())
 
     if oautomerge != 'disabled':
         if identical_book_list:
@@ -109,13 +116,54 @@ def add_book():
     return added_ids, updated_ids, duplicates
 
 
+def remote_file(data, dest, request_id):
+    # Write a file sent by a remote calibredb to dest. The file is either
+    # embedded in the command or was uploaded previously, see DBCtx.upload()
+    name, raw = data
+    if raw is None:
+        shutil.move(staged_upload_path(request_id, upload_key(name)), dest)
+    else:
+        with open(dest, 'wb') as f:
+            f.write(raw)
+    return dest
+
+
+@contextmanager
+def staged_uploads(is_remote, request_id, files):
+    # Remove the files uploaded for the command that were not used, even if it
+    # failed
+    try:
+        yield
+    finally:
+        if is_remote:
+            remove_staged_uploads(request_id, [upload_key(name) for name, raw in files if raw is None])
+
+
+def apply_overrides(mi, path, otitle, oauthors, oisbn, otags, oseries, oseries_index, ocover, oidentifiers, olanguages):
+    if not mi.title:
+        mi.title = os.path.splitext(os.path.basename(path))[0]
+    if not mi.authors:
+        mi.authors = [_('Unknown')]
+    if oidentifiers:
+        ids = mi.get_identifiers()
+        ids.update(oidentifiers)
+        mi.set_identifiers(ids)
+    for x in ('title', 'authors', 'isbn', 'tags', 'series', 'languages'):
+        val = locals()['o' + x]
+        if val:
+            setattr(mi, x, val)
+    if oseries:
+        mi.series_index = oseries_index
+    if ocover:
+        mi.cover = None
+        mi.cover_data = ocover
+
+
 def book(db, notify_changes, is_remote, args):
     data, fname, fmt, add_duplicates, otitle, oauthors, oisbn, otags, oseries, oseries_index, ocover, oidentifiers, olanguages, oautomerge, request_id = args
-    with add_ctx(), TemporaryDirectory('add-single') as tdir, run_import_plugins_before_metadata(tdir):
+    with add_ctx(), staged_uploads(is_remote, request_id, (data,)), TemporaryDirectory('add-single') as tdir, run_import_plugins_before_metadata(tdir):
         if is_remote:
-            with open(os.path.join(tdir, fname), 'wb') as f:
-                f.write(data[1])
-            path = f.name
+            path = remote_file(data, os.path.join(tdir, fname), request_id)
         else:
             path = data
         path = run_import_plugins([path])[0]
@@ -123,27 +171,7 @@ def book(db, notify_changes, is_remote, args):
         fmt = (fmt[1:] if fmt else None) or 'unknown'
         with open(path, 'rb') as stream:
             mi = get_metadata(stream, stream_type=fmt, use_libprs_metadata=True)
-        if not mi.title:
-            mi.title = os.path.splitext(os.path.basename(path))[0]
-        if not mi.authors:
-            mi.authors = [_('Unknown')]
-        if oidentifiers:
-            ids = mi.get_identifiers()
-            ids.update(oidentifiers)
-            mi.set_identifiers(ids)
-        for x in ('title', 'authors', 'isbn', 'tags', 'series', 'languages'):
-            val = locals()['o' + x]
-            if val:
-                setattr(mi, x, val)
-        if oseries:
-            mi.series_index = oseries_index
-        if ocover:
-            mi.cover = None
-            mi.cover_data = ocover
-
-        identical_book_list, added_ids, updated_ids = set(), set(), set()
-        duplicates = []
-        identical_books_data = None
+        apply_overrides(mi, path, otitle, oauthors, oisbn, otags, oseries, oseries_index, ocover, oidentifiers, olanguages)
         added_ids, updated_ids, duplicates = do_adding(
             db, request_id, notify_changes, is_remote, mi, {fmt: path}, add_duplicates, oautomerge)
 
@@ -152,14 +180,12 @@ def book(db, notify_changes, is_remote, args):
 
 def format_group(db, notify_changes, is_remote, args):
     formats, add_duplicates, oautomerge, request_id, cover_data = args
-    with add_ctx(), TemporaryDirectory('add-multiple') as tdir, run_import_plugins_before_metadata(tdir):
+    with add_ctx(), staged_uploads(is_remote, request_id, formats), TemporaryDirectory('add-multiple') as tdir, run_import_plugins_before_metadata(tdir):
         updated_ids = {}
         if is_remote:
             paths = []
             for name, data in formats:
-                with open(os.path.join(tdir, os.path.basename(name)), 'wb') as f:
-                    f.write(data)
-                paths.append(f.name)
+                paths.append(remote_file((name, data), os.path.join(tdir, os.path.basename(name)), request_id))
         else:
             paths = list(formats)
         paths = run_import_plugins(paths)
@@ -174,6 +200,39 @@ def format_group(db, notify_changes, is_remote, args):
         return mi.title, set(added_ids), set(updated_ids), bool(duplicates)
 
 
+def books(db, notify_changes, is_remote, args):
+    # Add many single file books in one command, to avoid a round trip per
+    # book when adding to remote libraries
+    return [book(db, notify_changes, is_remote, book_args) for book_args in args[0]]
+
+
+def add_in_workers(db, groups, max_workers, add_duplicates, oautomerge, request_id, overrides=None):
+    # Add books to a local library, reading their metadata in worker processes.
+    # groups is an iterable of (paths, cover_data), consumed lazily, and
+    # overrides, if specified, are applied to every book, as for book().
+    # Yields the group and (title, added_ids, updated_ids, has_duplicates) for
+    # every group, in order.
+    with add_ctx(), TemporaryDirectory('add-in-workers') as tdir:
+        # The workers read at most a few groups ahead, so tee() only ever
+        # holds those groups
+        groups, worker_groups = tee(groups)
+        results = read_metadata_in_workers((paths for paths, cover_data in worker_groups), tdir, max_workers)
+        for group, (paths, mi, tb) in zip(groups, results):
+            opaths, cover_data = group
+            if mi is None:
+                prints(_('Failed to read metadata from: {}').format(', '.join(opaths)), file=sys.stderr)
+                prints(tb, file=sys.stderr)
+                yield group, (None, set(), set(), False)
+                continue
+            if overrides is not None:
+                apply_overrides(mi, paths[0], *overrides)
+            elif cover_data and not mi.cover:
+                mi.cover_data = 'jpeg', cover_data
+            added_ids, updated_ids, duplicates = do_adding(
+                db, request_id, None, False, mi, create_format_map(paths), add_duplicates, oautomerge)
+            yield group, (mi.title, set(added_ids), set(updated_ids), bool(duplicates))
+
+
 def implementation(db, notify_changes, action, *args):
     is_remote = notify_changes is not None
     func = globals()[action]
@@ -212,10 +271,35 @@ def add_ctx():
     sys.stdout = orig
 
 
+def add_files(dbctx, files, upload_threads, workers, request_id, add_duplicates, overrides, oautomerge):
+    # Yields the path and result of adding each file as a separate book. For
+    # remote libraries, files are uploaded concurrently and added in batches.
+    def book_args(book, data):
+        fmt = os.path.splitext(book)[1][1:]
+        return (data, os.path.basename(book), fmt, add_duplicates) + overrides + (oautomerge, request_id)
+
+    files = [book for book in files if os.path.splitext(book)[1][1:]]
+    if not dbctx.is_remote:
+        if workers and files:
+            results = add_in_workers(
+                dbctx.db.new_api, (([book], None) for book in files), workers, add_duplicates, oautomerge, request_id, overrides)
+            for ([book], cover_data), (title, aids, mids, dups) in results:
+                yield book, (aids, mids, dups, title)
+            return
+        for book in files:
+            yield book, dbctx.run('add', 'book', *book_args(book, dbctx.path(book)))
+        return
+    for i in range(0, len(files), upload_batch_size):
+        batch = files[i:i+upload_batch_size]
+        dbctx.upload(request_id, batch, upload_threads)
+        results = dbctx.run('add', 'books', [book_args(book, (book, None)) for book in batch])
+        yield from zip(batch, results)
+
+
 def do_add(
     dbctx, paths, one_book_per_directory, recurse, add_duplicates, otitle, oauthors,
     oisbn, otags, oseries, oseries_index, ocover, oidentifiers, olanguages,
-    compiled_rules, oautomerge
+    compiled_rules, oautomerge, upload_threads=4, workers=0
 ):
     request_id = uuid4()
     with add_ctx():
@@ -231,47 +315,56 @@ def do_add(
                     prints(path, 'not found')
 
         file_duplicates, added_ids, merged_ids = [], set(), set()
-        for book in files:
-            fmt = os.path.splitext(book)[1]
-            fmt = fmt[1:] if fmt else None
-            if not fmt:
-                continue
-            aids, mids, dups, book_title = dbctx.run(
-                'add', 'book', dbctx.path(book), os.path.basename(book), fmt, add_duplicates,
-                otitle, oauthors, oisbn, otags, oseries, oseries_index, serialize_cover(ocover) if ocover else None,
-                oidentifiers, olanguages, oautomerge, request_id
-            )
+        overrides = (
+            otitle, oauthors, oisbn, otags, oseries, oseries_index, serialize_cover(ocover) if ocover else None,
+            oidentifiers, olanguages)
+        for book, (aids, mids, dups, book_title) in add_files(
+            dbctx, files, upload_threads, workers, request_id, add_duplicates, overrides, oautomerge
+        ):
             added_ids |= set(aids)
             merged_ids |= set(mids)
 
             if dups:
                 file_duplicates.append((book_title, book))
 
+        def dir_groups():
+            scanner = cdb_recursive_find if recurse else cdb_find_in_dir
+            for dpath in dirs:
+                for formats in scanner(dpath, one_book_per_directory, compiled_rules):
+                    cover_data = None
+                    for fmt in formats:
+                        if fmt.lower().endswith('.opf'):
+                            with open(fmt, 'rb') as f:
+                                mi = get_metadata(f, stream_type='opf')
+                                if mi.cover_data and mi.cover_data[1]:
+                                    cover_data = mi.cover_data[1]
+                                elif mi.cover:
+                                    try:
+                                        with open(mi.cover, 'rb') as f:
+                                            cover_data = f.read()
+                                    except OSError:
+                                        pass
+                    yield formats, cover_data
+
+        def add_group(formats, cover_data):
+            if dbctx.is_remote:
+                dbctx.upload(request_id, formats, upload_threads)
+                fdata = tuple((fmt, None) for fmt in formats)
+            else:
+                fdata = tuple(map(dbctx.path, formats))
+            return dbctx.run('add', 'format_group', fdata, add_duplicates, oautomerge, request_id, cover_data)
+
         dir_dups = []
-        scanner = cdb_recursive_find if recurse else cdb_find_in_dir
-        for dpath in dirs:
-            for formats in scanner(dpath, one_book_per_directory, compiled_rules):
-                cover_data = None
-                for fmt in formats:
-                    if fmt.lower().endswith('.opf'):
-                        with open(fmt, 'rb') as f:
-                            mi = get_metadata(f, stream_type='opf')
-                            if mi.cover_data and mi.cover_data[1]:
-                                cover_data = mi.cover_data[1]
-                            elif mi.cover:
-                                try:
-                                    with open(mi.cover, 'rb') as f:
-                                        cover_data = f.read()
-                                except OSError:
-                                    pass
-
-                book_title, ids, mids, dups = dbctx.run(
-                        'add', 'format_group', tuple(map(dbctx.path, formats)), add_duplicates, oautomerge, request_id, cover_data)
-                if book_title is not None:
-                    added_ids |= set(ids)
-                    merged_ids |= set(mids)
-                    if dups:
-                        dir_dups.append((book_title, formats))
+        if workers and not dbctx.is_remote:
+            results = add_in_workers(dbctx.db.new_api, dir_groups(), workers, add_duplicates, oautomerge, request_id)
+        else:
+            results = ((group, add_group(*group)) for group in dir_groups())
+        for (formats, cover_data), (book_title, ids, mids, dups) in results:
+            if book_title is not None:
+                added_ids |= set(ids)
+                merged_ids |= set(mids)
+                if dups:
+                    dir_dups.append((book_title, formats))
 
         sys.stdout = sys.__stdout__
 
@@ -390,6 +483,27 @@ def option_parser(get_parser, args):
         )
     )
 
+    parser.add_option(
+        '--upload-threads',
+        default=4,
+        type=int,
+        help=_(
+            'When adding to a library on a calibre Content server, the number of files to upload'
+            ' to the server at a time. Default: %default'
+        )
+    )
+
+    parser.add_option(
+        '--workers',
+        default=0,
+        type=int,
+        help=_(
+            'The number of worker processes to use for reading metadata from the files being added,'
+            ' when adding to a local library. Useful for adding large numbers of books. When zero,'
+            ' metadata is read by calibredb itself, one book at a time. Default: %default'
+        )
+    )
+
     g = OptionGroup(
         parser,
         _('ADDING FROM FOLDERS'),
@@ -474,6 +588,6 @@ def main(opts, args, dbctx):
     do_add(
         dbctx, args, opts.one_book_per_directory, opts.recurse, opts.duplicates,
         opts.title, aut, opts.isbn, tags, opts.series, opts.series_index, opts.cover,
-        identifiers, lcodes, opts.filters, opts.automerge
+        identifiers, lcodes, opts.filters, opts.automerge, upload_threads=opts.upload_threads, workers=opts.workers
     )
     return 0
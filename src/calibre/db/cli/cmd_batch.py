@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2024, Kovid Goyal <kovid at kovidgoyal.net>
+
+import io
+import shlex
+import sys
+from contextlib import redirect_stderr, redirect_stdout
+
+from calibre import prints
+
+readonly = False
+version = 0  # change this if you change signature of implementation()
+
+# Commands whose main() makes a single request to the library, as the last
+# thing it does with it. When connected to a server, consecutive commands from
+# this set are sent to it in a single request.
+SINGLE_REQUEST_COMMANDS = frozenset((
+    'list', 'remove', 'add_format', 'remove_format', 'show_metadata', 'saved_searches',
+    'custom_columns', 'set_custom', 'list_categories', 'search', 'fts_search',
+))
+
+
+# Commands such as add_format send the contents of files in their requests.
+# Batches are limited to about this many bytes of file data, so that large
+# files do not all have to be held in memory and sent in one huge request.
+MAX_BATCH_DATA_SIZE = 32 * 1024 * 1024
+
+
+def data_size(obj):
+    if isinstance(obj, bytes):
+        return len(obj)
+    if isinstance(obj, (list, tuple)):
+        return sum(map(data_size, obj))
+    return 0
+
+
+class Deferred(BaseException):
+    # Not an Exception, so that it is not caught by the commands
+    pass
+
+
+class BatchCtx:
+
+    # Stands in for the DBCtx while a command is run as part of a batch. The
+    # first time the command is run its request is recorded and the command is
+    # stopped. Once the answer to the request is available, the command is run
+    # again and gets the answer.
+
+    def __init__(self, dbctx):
+        self.dbctx = dbctx
+        self.request = self.answer = None
+
+    def __getattr__(self, name):
+        return getattr(self.dbctx, name)
+
+    def run(self, name, *args):
+        if self.answer is None:
+            self.request = (name,) + args
+            raise Deferred()
+        return self.dbctx.result_or_exit(self.answer)
+
+
+def option_parser(get_parser, args):
+    parser = get_parser(
+        _(
+            '''\
+%prog batch [options] [commands_file]
+
+Run many calibredb commands, one per line, read from commands_file or from
+standard input. Each line is a calibredb command line without the leading
+calibredb, for example:
+
+set_metadata 1 --field title:"A title"
+
+Blank lines and lines starting with # are ignored. Since the library is opened
+only once, this is much faster than running calibredb separately for every
+command. When connected to a calibre Content server, consecutive commands that
+need only a single request to the server, such as list, search, set_custom and
+remove, are sent to it together in one request. Global options, such as
+--with-library, apply to all the commands and are ignored if specified on
+individual lines.
+'''
+        )
+    )
+    parser.add_option(
+        '--stop-on-error',
+        default=False,
+        action='store_true',
+        help=_('Stop at the first command that fails, instead of continuing with the remaining commands')
+    )
+    return parser
+
+
+def parse_commands(lines):
+    for lnum, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            parts = shlex.split(line)
+        except ValueError as err:
+            raise SystemExit(_('Invalid command on line {0}: {1}').format(lnum, err))
+        yield lnum, parts[0], parts[1:]
+
+
+def run_command(cmd, cmd_args, dbctx):
+    # Run a command, returning its exit code
+    from calibre.db.cli.main import COMMANDS, option_parser_for, run_cmd
+    try:
+        if cmd not in COMMANDS or cmd == 'batch':
+            raise SystemExit(_('Unknown command: {}').format(cmd))
+        parser = option_parser_for(cmd, cmd_args)()
+        copts, cargs = parser.parse_args(['calibredb'] + cmd_args)
+        return run_cmd(cmd, copts, cargs[1:], dbctx)
+    except SystemExit as err:
+        ret = err.code
+        if ret is not None and not isinstance(ret, int):
+            prints(ret, file=sys.stderr)
+            ret = 1
+        return ret
+
+
+def run_batch(commands, dbctx):
+    # Run the commands, all from SINGLE_REQUEST_COMMANDS, sending their
+    # requests to the server in as few requests as MAX_BATCH_DATA_SIZE allows.
+    # Yields the exit code of every command, in order, after printing its
+    # output.
+    pending, size = [], 0
+
+    def flush():
+        answers = iter(dbctx.run_batch([bctx.request for lnum, cmd, cmd_args, bctx, done in pending if done is None]))
+        for lnum, cmd, cmd_args, bctx, done in pending:
+            if done is None:
+                bctx.answer = next(answers)
+                ret = run_command(cmd, cmd_args, bctx)
+            else:
+                ret, out, err = done
+                sys.stdout.write(out), sys.stderr.write(err)
+            yield lnum, cmd, ret
+        del pending[:]
+
+    for lnum, cmd, cmd_args in commands:
+        bctx = BatchCtx(dbctx)
+        out, err = io.StringIO(), io.StringIO()
+        try:
+            with redirect_stdout(out), redirect_stderr(err):
+                ret = run_command(cmd, cmd_args, bctx)
+        except Deferred:
+            rsize = data_size(bctx.request)
+            if pending and size + rsize > MAX_BATCH_DATA_SIZE:
+                yield from flush()
+                size = 0
+            pending.append((lnum, cmd, cmd_args, bctx, None))
+            size += rsize
+        else:
+            # The command failed or finished without making a request
+            pending.append((lnum, cmd, cmd_args, None, (ret, out.getvalue(), err.getvalue())))
+    if pending:
+        yield from flush()
+
+
+def main(opts, args, dbctx):
+    if args:
+        with open(args[0], encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    else:
+        lines = sys.stdin.read().splitlines()
+
+    def run_all():
+        if not dbctx.is_remote or opts.stop_on_error:
+            for lnum, cmd, cmd_args in parse_commands(lines):
+                yield lnum, cmd, run_command(cmd, cmd_args, dbctx)
+            return
+        # Consecutive commands that make a single request each are sent to the
+        # server together, other commands are run one by one, in order. Not
+        # done with --stop-on-error, as all the commands sent together are run.
+        group = []
+        for lnum, cmd, cmd_args in parse_commands(lines):
+            if cmd in SINGLE_REQUEST_COMMANDS:
+                group.append((lnum, cmd, cmd_args))
+                continue
+            if group:
+                yield from run_batch(group, dbctx)
+                del group[:]
+            yield lnum, cmd, run_command(cmd, cmd_args, dbctx)
+        if group:
+            yield from run_batch(group, dbctx)
+
+    failed = 0
+    for lnum, cmd, ret in run_all():
+        if ret:
+            failed += 1
+            prints(_('Command on line {0} failed: {1}').format(lnum, cmd), file=sys.stderr)
+            if opts.stop_on_error:
+                break
+    return 1 if failed else 0
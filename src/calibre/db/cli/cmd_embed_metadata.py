@@ -53,6 +53,23 @@ def main(opts, args, dbctx):
     def progress(i, title):
         prints(_('Processed {0} ({1} of {2})').format(title, i, len(ids)))
 
+    if not dbctx.is_remote:
+        # Update all the books in one call, so that the files are updated in
+        # parallel by worker processes
+        db = dbctx.db.new_api
+        for book_id in ids:
+            if not db.has_id(book_id):
+                prints(_('No book with id: {}').format(book_id))
+        ids = tuple(book_id for book_id in ids if db.has_id(book_id))
+
+        def report_error(mi, fmt, tb):
+            prints(_('Failed to update metadata in the {0} format of {1}').format((fmt or '').upper(), mi.title))
+            prints(tb)
+
+        db.embed_metadata(ids, only_fmts=only_fmts, report_error=report_error,
+                          report_progress=lambda i, total, mi: progress(i, mi.title))
+        return 0
+
     for i, book_id in enumerate(ids):
         title = dbctx.run('embed_metadata', book_id, only_fmts)
         progress(i+1, title or _('No book with id: {}').format(book_id))
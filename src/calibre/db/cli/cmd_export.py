@@ -3,14 +3,23 @@
 
 
 import os
+import shutil
+import sys
+import time
+import traceback
+from contextlib import nullcontext
+from threading import Lock, Thread
 
 from calibre.db.cli import integers_from_string
 from calibre.db.errors import NoSuchFormat
 from calibre.db.constants import DATA_FILE_PATTERN
 from calibre.library.save_to_disk import (
-    config, do_save_book_to_disk, get_formats, sanitize_args
+    config, do_save_book_to_disk, ensure_unique_components, find_plugboard,
+    get_formats, get_path_components, plugboard_save_to_disk_value, sanitize_args
 )
+from calibre.utils.date import as_local_time
 from calibre.utils.formatter_functions import load_user_template_functions
+from polyglot.queue import Empty, Queue
 
 readonly = True
 version = 0  # change this if you change signature of implementation()
@@ -111,6 +120,22 @@ def option_parser(get_parser, args):
         switch = '--' + pref.replace('_', '-')
         parser.add_option(switch, default=False, action='store_true', help=opt.help)
 
+    parser.add_option(
+        '--io-threads',
+        default=1,
+        type=int,
+        help=_('The number of books to copy at the same time. Increasing this'
+               ' can speed up exports to slow or network storage. Default: %default')
+    )
+    parser.add_option(
+        '--metadata-workers',
+        default=0,
+        type=int,
+        help=_('The number of worker processes to use for updating the metadata'
+               ' in the exported files. When zero, metadata is updated by calibredb'
+               ' itself, one file at a time. Default: %default')
+    )
+
     return parser
 
 
@@ -118,14 +143,20 @@ class DBProxy:
 
     # Proxy to allow do_save_book_to_disk() to work with remote database
 
-    def __init__(self, dbctx):
+    def __init__(self, dbctx, threaded=False):
         self.dbctx = dbctx
+        # Connections to remote libraries cannot be shared between threads
+        self.lock = Lock() if threaded and dbctx.is_remote else nullcontext()
+
+    def run(self, *args):
+        with self.lock:
+            return self.dbctx.run('export', *args)
 
     def cover(self, book_id):
-        return self.dbctx.run('export', 'cover', book_id)
+        return self.run('cover', book_id)
 
     def copy_format_to(self, book_id, fmt, path):
-        fdata = self.dbctx.run('export', 'fmt', book_id, fmt, path)
+        fdata = self.run('fmt', book_id, fmt, path)
         if self.dbctx.is_remote:
             if fdata is None:
                 raise NoSuchFormat(fmt)
@@ -133,7 +164,7 @@ def copy_format_to(self, book_id, fmt, path):
                 f.write(fdata)
 
     def copy_extra_file_to(self, book_id, relpath, path):
-        fdata = self.dbctx.run('export', 'extra_file', book_id, relpath, path)
+        fdata = self.run('extra_file', book_id, relpath, path)
         if self.dbctx.is_remote:
             if fdata is None:
                 raise FileNotFoundError(relpath)
@@ -153,6 +184,139 @@ def export(opts, dbctx, book_id, dest, dbproxy, length, first):
     )
 
 
+class MetadataUpdater:
+
+    # Update the metadata in exported files using a pool of worker processes
+
+    def __init__(self, num_workers, plugboards, formats, library_id, template_funcs):
+        from calibre.ptempfile import PersistentTemporaryDirectory
+        from calibre.utils.ipc.pool import Pool
+        self.tdir = PersistentTemporaryDirectory('_export')
+        self.pool = Pool(max_workers=num_workers, name='ExportMetadata')
+        self.pool.set_common_data({
+            'plugboard_cache': {fmt: find_plugboard(plugboard_save_to_disk_value, fmt, plugboards) for fmt in formats},
+            'template_functions': template_funcs, 'library_id': library_id})
+
+    def __call__(self, book_id, mi, cdata, fmt_paths):
+        from calibre.ebooks.metadata.opf2 import metadata_to_opf
+        d = {'last_modified': mi.last_modified.isoformat(), 'fmts': fmt_paths}
+        if cdata:
+            d['cover'] = os.path.join(self.tdir, '%d.jpg' % book_id)
+            with open(d['cover'], 'wb') as f:
+                f.write(cdata)
+        mi.cover, mi.cover_data = None, (None, None)
+        d['opf'] = os.path.join(self.tdir, '%d.opf' % book_id)
+        with open(d['opf'], 'wb') as f:
+            f.write(metadata_to_opf(mi))
+        self.pool(book_id, 'calibre.library.save_to_disk', 'update_serialized_metadata', d)
+
+    def consume_results(self, titles):
+        while True:
+            try:
+                worker_result = self.pool.results.get_nowait()
+            except Empty:
+                break
+            title = titles.get(worker_result.id, str(worker_result.id))
+            if worker_result.is_terminal_failure:
+                raise SystemExit(_('The update metadata worker process crashed while processing the book %s') % title)
+            result = worker_result.result
+            errors = list(result.value or ())
+            if result.err is not None:
+                errors.append((None, result.err + '\n' + result.traceback))
+            for fmt, tb in errors:
+                print('Failed to set metadata for the', fmt, 'format of', title, file=sys.stderr)
+                print(tb, file=sys.stderr)
+
+    def wait(self, titles):
+        from calibre.utils.ipc.pool import Failure
+        try:
+            self.pool.wait_for_tasks()
+        except Failure as err:
+            raise SystemExit(str(err.failure_message) + '\n' + str(err.details))
+        self.consume_results(titles)
+
+    def shutdown(self):
+        self.pool.shutdown()
+        shutil.rmtree(self.tdir, ignore_errors=True)
+
+
+def export_parallel(opts, dbctx, book_ids, dest, length):
+    # First read the metadata for all books and calculate their paths, making
+    # sure no two books are saved to the same location
+    dbproxy = DBProxy(dbctx, threaded=True)
+    setup_data, collected_data = {}, {}
+    for i, book_id in enumerate(book_ids):
+        mi, plugboards, formats, library_id, template_funcs = dbproxy.run('setup', book_id, opts.formats)
+        if dbctx.is_remote and i == 0:
+            load_user_template_functions(library_id, template_funcs)
+        extra_files = plugboards.pop('extra_files_for_export', ())
+        setup_data[book_id] = plugboards, extra_files, library_id, template_funcs
+        originals = mi.pubdate, mi.timestamp
+        if mi.pubdate:
+            mi.pubdate = as_local_time(mi.pubdate)
+        if mi.timestamp:
+            mi.timestamp = as_local_time(mi.timestamp)
+        components = get_path_components(opts, mi, book_id, length)
+        mi.pubdate, mi.timestamp = originals
+        collected_data[book_id] = mi, components, formats
+    ensure_unique_components(collected_data)
+    titles = {book_id: data[0].title for book_id, data in collected_data.items()}
+
+    metadata_updater = None
+    if opts.update_metadata and opts.metadata_workers > 0 and collected_data:
+        plugboards, extra_files, library_id, template_funcs = next(iter(setup_data.values()))
+        all_formats = {fmt for data in collected_data.values() for fmt in data[2]}
+        metadata_updater = MetadataUpdater(opts.metadata_workers, plugboards, all_formats, library_id, template_funcs)
+
+    # Now copy the books using a pool of threads
+    jobs, results = Queue(), Queue()
+    for book_id in collected_data:
+        jobs.put(book_id)
+
+    def run():
+        while True:
+            try:
+                book_id = jobs.get_nowait()
+            except Empty:
+                break
+            mi, components, formats = collected_data[book_id]
+            plugboards, extra_files = setup_data[book_id][:2]
+            try:
+                do_save_book_to_disk(
+                    dbproxy, book_id, mi, plugboards, formats, dest, opts, length, extra_files,
+                    components=components, metadata_updater=metadata_updater)
+            except Exception:
+                results.put((book_id, traceback.format_exc()))
+            else:
+                results.put((book_id, None))
+
+    start_time = time.monotonic()
+    for i in range(max(1, min(opts.io_threads, len(collected_data)))):
+        Thread(target=run, name='ExportBooks-%d' % i, daemon=True).start()
+    total = len(collected_data)
+    try:
+        for num in range(1, total + 1):
+            book_id, tb = results.get()
+            if tb is not None:
+                print(_('Failed to export {}').format(titles[book_id]), file=sys.stderr)
+                print(tb, file=sys.stderr)
+            if metadata_updater is not None:
+                metadata_updater.consume_results(titles)
+            if opts.progress:
+                print(f'\r  {num / total:.0%} [{num}/{total}]', end=' '*20)
+        if metadata_updater is not None:
+            metadata_updater.wait(titles)
+    finally:
+        if metadata_updater is not None:
+            metadata_updater.shutdown()
+    if opts.progress:
+        elapsed = time.monotonic() - start_time
+        print()
+        print(_('Exported {0} books in {1:.1f} seconds ({2:.1f} books per second)').format(
+            total, elapsed, total / max(elapsed, 0.001)))
+    return 0
+
+
 def main(opts, args, dbctx):
     if len(args) < 1 and not opts.all:
         raise SystemExit(_('You must specify some ids or the %s option') % '--all')
@@ -163,8 +327,10 @@ def main(opts, args, dbctx):
         for arg in args:
             book_ids |= set(integers_from_string(arg))
     dest = os.path.abspath(os.path.expanduser(opts.to_dir))
-    dbproxy = DBProxy(dbctx)
     dest, opts, length = sanitize_args(dest, opts)
+    if opts.io_threads > 1 or opts.metadata_workers > 0:
+        return export_parallel(opts, dbctx, book_ids, dest, length)
+    dbproxy = DBProxy(dbctx)
     total = len(book_ids)
     for i, book_id in enumerate(book_ids):
         export(opts, dbctx, book_id, dest, dbproxy, length, i == 0)
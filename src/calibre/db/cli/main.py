@@ -4,24 +4,26 @@
 import json
 import os
 import sys
+from threading import Thread
 
-from calibre import browser, prints
+from calibre import as_unicode, browser, prints
 from calibre.constants import __appname__, __version__, iswindows
-from calibre.db.cli import module_for_cmd
+from calibre.db.cli import is_upload_token, module_for_cmd, upload_key
 from calibre.db.legacy import LibraryDatabase
 from calibre.utils.config import OptionParser, prefs
 from calibre.utils.localization import localize_user_manual_link
 from calibre.utils.lock import singleinstance
 from calibre.utils.serialize import MSGPACK_MIME
 from polyglot import http_client
-from polyglot.urllib import urlencode, urlparse, urlunparse
+from polyglot.queue import Empty, Queue
+from polyglot.urllib import quote, urlencode, urlparse, urlunparse
 
 COMMANDS = (
     'list', 'add', 'remove', 'add_format', 'remove_format', 'show_metadata',
     'set_metadata', 'export', 'catalog', 'saved_searches', 'add_custom_column',
     'custom_columns', 'remove_custom_column', 'set_custom', 'restore_database',
     'check_library', 'list_categories', 'backup_metadata', 'clone', 'embed_metadata',
-    'search', 'fts_index', 'fts_search',
+    'search', 'fts_index', 'fts_search', 'batch',
 )
 
 
@@ -124,6 +126,28 @@ def read_credentials(opts):
     return username, pw
 
 
+class UploadBody:
+
+    # The contents of a file, read in chunks as it is sent. Can be iterated
+    # over more than once, as the request is resent if the server asks for
+    # authentication.
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+
+
 class DBCtx:
 
     def __init__(self, opts, option_parser):
@@ -194,25 +218,90 @@ def interpret_http_error(self, err):
             raise SystemExit(err.reason)
 
     def remote_run(self, name, m, *args):
+        url = self.url + '/cdb/cmd/{}/{}'.format(name, getattr(m, 'version', 0))
+        return self.result_or_exit(self.remote_request(url, args))
+
+    def run_batch(self, commands):
+        '''
+        Run many commands, each of which is a tuple of the form (name, *args),
+        as for :meth:`run`. When connected to a server, all the commands are
+        sent in a single request. Returns a list with one entry per command, of
+        the form {'result': ...} or, for commands that failed, {'err': ...,
+        'tb': ...}, which can be passed to :meth:`result_or_exit`. A failed
+        command does not stop the commands after it.
+        '''
+        if not self.is_remote:
+            ans = []
+            for cmd in commands:
+                try:
+                    ans.append({'result': self.run(*cmd)})
+                except Exception as err:
+                    import traceback
+                    ans.append({'err': as_unicode(err), 'tb': traceback.format_exc()})
+            return ans
+        payload = [(cmd[0], getattr(module_for_cmd(cmd[0]), 'version', 0), cmd[1:]) for cmd in commands]
+        return self.remote_request(self.url + '/cdb/batch', payload)['results']
+
+    def remote_request(self, url, payload):
         from mechanize import HTTPError, Request
         from calibre.utils.serialize import msgpack_loads, msgpack_dumps
-        url = self.url + '/cdb/cmd/{}/{}'.format(name, getattr(m, 'version', 0))
         if self.library_id:
             url += '?' + urlencode({'library_id':self.library_id})
-        rq = Request(url, data=msgpack_dumps(args),
+        rq = Request(url, data=msgpack_dumps(payload),
                      headers={'Accept': MSGPACK_MIME, 'Content-Type': MSGPACK_MIME})
         try:
             res = self.br.open_novisit(rq, timeout=self.timeout)
-            ans = msgpack_loads(res.read())
+            return msgpack_loads(res.read())
         except HTTPError as err:
             self.interpret_http_error(err)
             raise
+
+    def result_or_exit(self, ans):
         if 'err' in ans:
             if ans['tb']:
                 prints(ans['tb'])
             raise SystemExit(ans['err'])
         return ans['result']
 
+    def upload(self, request_id, paths, num_threads=4):
+        # Stream the specified files to the server using num_threads
+        # connections, for use by later commands with the same request_id
+        from mechanize import HTTPError, Request
+        if not is_upload_token(request_id):
+            raise ValueError(f'Invalid upload request id: {request_id!r}')
+        jobs, errors = Queue(), []
+        for path in paths:
+            jobs.put(path)
+
+        def run(br):
+            while True:
+                try:
+                    path = jobs.get_nowait()
+                except Empty:
+                    break
+                url = self.url + f'/cdb/upload/{request_id}/{upload_key(path)}'
+                if self.library_id:
+                    url += '/' + quote(self.library_id)
+                body = UploadBody(path)
+                rq = Request(url, data=body, headers={
+                    'Content-Type': 'application/octet-stream', 'Content-Length': str(len(body))})
+                try:
+                    br.open_novisit(rq, timeout=self.timeout).read()
+                except Exception as err:
+                    errors.append(err)
+                    break
+
+        threads = [Thread(target=run, args=(self.br.clone_browser(),), name=f'CDBUpload-{i}', daemon=True)
+                   for i in range(max(1, min(num_threads, len(paths))))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for err in errors:
+            if isinstance(err, HTTPError):
+                self.interpret_http_error(err)
+            raise err
+
     def list_libraries(self):
         from mechanize import HTTPError
         url = self.url + '/ajax/library-info'
@@ -8,8 +8,16 @@
 Test the CLI of the calibre database management tool
 '''
 import csv
+import io
+import os
+import shutil
+import tempfile
 import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from types import SimpleNamespace
 
+from calibre.db.cli import cmd_batch
+from calibre.db.cli.cmd_batch import parse_commands
 from calibre.db.cli.cmd_check_library import _print_check_library_results
 from polyglot.builtins import iteritems
 from polyglot.io import PolyglotBytesIO
@@ -90,5 +98,106 @@ def test_escaped_csv_output(self):
         self.assertEqual(parsed_result, [[self.check[1], data[0][0], data[0][1]]])
 
 
+class BatchTest(unittest.TestCase):
+
+    def test_parse_commands(self):
+        lines = [
+            '# A comment', '', 'set_metadata 1 --field "title:A title"',
+            '  list --fields title  ',
+        ]
+        self.assertEqual(list(parse_commands(lines)), [
+            (3, 'set_metadata', ['1', '--field', 'title:A title']),
+            (4, 'list', ['--fields', 'title']),
+        ])
+        self.assertRaises(SystemExit, list, parse_commands(['list "unterminated']))
+
+    def test_remote_batch(self):
+        from calibre.db.cli.main import DBCtx
+
+        class RemoteCtx:
+            is_remote = True
+            result_or_exit = DBCtx.result_or_exit
+
+            def __init__(self):
+                self.batches = []
+
+            def run(self, name, *args):
+                raise AssertionError('Commands must be sent in batches')
+
+            def run_batch(self, commands):
+                self.batches.append(commands)
+                answers = {
+                    ('saved_searches', 'add', 'x', 'title:x'): {'result': None},
+                    ('saved_searches', 'list'): {'result': {'x': 'title:x'}},
+                    ('search', 'title:y'): {'err': 'Invalid search', 'tb': ''},
+                    ('show_metadata', 1): {'result': None},
+                }
+                return [answers[cmd] for cmd in commands]
+
+        dbctx = RemoteCtx()
+        lines = [
+            'saved_searches add x title:x', 'saved_searches list', 'search title:y',
+            # Cannot be sent along with other commands
+            'check_library',
+            'show_metadata 1',
+        ]
+        out, err = io.StringIO(), io.StringIO()
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(lines))
+        try:
+            with redirect_stdout(out), redirect_stderr(err):
+                ret = cmd_batch.main(SimpleNamespace(stop_on_error=False), [f.name], dbctx)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(ret, 1)
+        self.assertEqual(dbctx.batches, [
+            [('saved_searches', 'add', 'x', 'title:x'), ('saved_searches', 'list'), ('search', 'title:y')],
+            [('show_metadata', 1)]])
+        out, err = out.getvalue(), err.getvalue()
+        self.assertLess(out.index('x added'), out.index('title:x'))
+        for lnum in (3, 4, 5):
+            self.assertIn(f'line {lnum} failed', err)
+        for lnum in (1, 2):
+            self.assertNotIn(f'line {lnum} failed', err)
+
+    def test_remote_batch_size(self):
+        from calibre.db.cli.main import DBCtx
+
+        class RemoteCtx:
+            is_remote = True
+            result_or_exit = DBCtx.result_or_exit
+            path = DBCtx.path
+
+            def __init__(self):
+                self.batches = []
+
+            def run_batch(self, commands):
+                self.batches.append([(cmd[0], cmd[1]) for cmd in commands])
+                return [{'result': True} for cmd in commands]
+
+        dbctx = RemoteCtx()
+        tdir = tempfile.mkdtemp()
+        lines = []
+        for i in range(5):
+            path = os.path.join(tdir, f'{i}.txt')
+            with open(path, 'wb') as f:
+                f.write(b'x' * 40)
+            lines.append('add_format {} "{}"'.format(i, path.replace(os.sep, '/')))
+        cfile = os.path.join(tdir, 'commands')
+        with open(cfile, 'w') as f:
+            f.write('\n'.join(lines))
+        orig = cmd_batch.MAX_BATCH_DATA_SIZE
+        cmd_batch.MAX_BATCH_DATA_SIZE = 100
+        try:
+            self.assertEqual(cmd_batch.main(SimpleNamespace(stop_on_error=False), [cfile], dbctx), 0)
+        finally:
+            cmd_batch.MAX_BATCH_DATA_SIZE = orig
+            shutil.rmtree(tdir)
+        # No more file data than the limit is sent in one request
+        self.assertEqual(dbctx.batches, [[('add_format', 0), ('add_format', 1)], [('add_format', 2), ('add_format', 3)], [('add_format', 4)]])
+
+
 def find_tests():
-    return unittest.defaultTestLoader.loadTestsFromTestCase(PrintCheckLibraryResultsTest)
+    ans = unittest.defaultTestLoader.loadTestsFromTestCase(PrintCheckLibraryResultsTest)
+    ans.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(BatchTest))
+    return ans
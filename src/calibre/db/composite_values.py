@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2024, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A persistent cache of the rendered values of composite columns, so that they
+do not all have to be rendered again every time a library is opened.
+
+Values are only cached for templates whose result is determined by the values
+of the fields they refer to, see TemplateFormatter.template_dependencies().
+Every value is stored along with a fingerprint of the values of those fields
+for the book and is only used if the fingerprint still matches, so a stale
+value can never be returned, even if the library is changed by some other
+program. The cache for a column is discarded when its template, the metadata
+of the fields it uses, the tweaks, the interface language or the calibre
+version change.
+'''
+
+import hashlib
+import json
+import os
+import weakref
+from threading import Lock
+
+import apsw
+
+from calibre.constants import __version__, cache_dir
+from calibre.db.lazy import db_fields
+from calibre.ebooks.metadata.book import TOP_LEVEL_IDENTIFIERS
+from calibre.utils.config_base import tweaks
+from calibre.utils.localization import get_lang
+
+# Fields that ProxyMetadata computes from the value of a database field
+derived_fields = {'language': 'languages', 'has_cover': 'cover', 'db_approx_formats': 'formats'}
+derived_fields.update({k: 'identifiers' for k in TOP_LEVEL_IDENTIFIERS})
+
+
+def hash_json(obj):
+    try:
+        data = json.dumps(obj, sort_keys=True, default=repr)
+    except TypeError:  # keys of different types cannot be sorted
+        data = repr(obj)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class CompositeValues:
+
+    def __init__(self, db, path=None):
+        self.dbref = weakref.ref(db)
+        self.path = path
+        self.lock = Lock()
+        self._conn = None
+        self.invalidated = set()
+        self.failed = False
+
+    @property
+    def conn(self):
+        if self._conn is None and not self.failed:
+            try:
+                path = self.path or os.path.join(cache_dir(), 'composite-values', self.dbref().library_id + '.sqlite')
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                conn = apsw.Connection(path)
+                conn.setbusytimeout(5000)
+                with conn:
+                    conn.cursor().execute('''
+                    CREATE TABLE IF NOT EXISTS columns(name TEXT PRIMARY KEY, key TEXT NOT NULL);
+                    CREATE TABLE IF NOT EXISTS composite_values(
+                        name TEXT NOT NULL, book INTEGER NOT NULL, fingerprint TEXT NOT NULL, val TEXT NOT NULL,
+                        PRIMARY KEY(name, book));
+                    CREATE INDEX IF NOT EXISTS composite_values_book_idx ON composite_values(book);
+                    ''')
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                self.failed = True
+            else:
+                self._conn = conn
+        return self._conn
+
+    def dependencies(self, field):
+        # The database fields whose values determine the value of the composite
+        # column, or None if it cannot be cached
+        from calibre.utils.formatter import TemplateFormatter
+        db = self.dbref()
+        fm = db.field_metadata
+        names = TemplateFormatter().template_dependencies(
+            field.metadata['display']['composite_template'], field.get_template_functions())
+        if names is None:
+            return None
+        ans = set()
+        for name in names:
+            if name in ('id', 'application_id'):
+                continue
+            if name not in fm:
+                name = fm.search_term_to_field_key(name)
+            spec = db_fields.get(name)
+            dbname = spec[0] if spec is not None else derived_fields.get(name, name)
+            f = db.fields.get(dbname)
+            if f is None or f.is_composite:
+                return None
+            ans.add(dbname)
+            index_field = getattr(f, 'index_field', None)
+            if index_field is not None:
+                ans.add(index_field.name)
+        return tuple(sorted(ans))
+
+    def column_key(self, field, dependencies):
+        fm = self.dbref().field_metadata
+        return hash_json((
+            __version__, get_lang(), field.metadata['display'], dependencies,
+            [fm.get(x) for x in dependencies], dict(tweaks)))
+
+    def fingerprints(self, dependencies, book_ids):
+        db = self.dbref()
+        vals = [db._all_field_for(x, book_ids) for x in dependencies]
+        return {book_id: hashlib.sha1(repr(tuple(v[book_id] for v in vals)).encode('utf-8')).hexdigest() for book_id in book_ids}
+
+    def get(self, field, book_ids):
+        '''
+        Return the cached values that are still valid for the specified books
+        and the information needed to store newly rendered values with
+        :meth:`set`. Must be called with the database read lock held.
+        '''
+        dependencies = self.dependencies(field)
+        if dependencies is None:
+            return {}, None
+        state = self.column_key(field, dependencies), self.fingerprints(dependencies, book_ids)
+        key, fingerprints = state
+        conn = self.conn
+        if conn is None:
+            return {}, None
+        name = field.name
+        ans = {}
+        with self.lock, conn:
+            c = conn.cursor()
+            stored = tuple(c.execute('SELECT key FROM columns WHERE name=?', (name,)))
+            if not stored or stored[0][0] != key:
+                c.execute('DELETE FROM composite_values WHERE name=?', (name,))
+                c.execute('INSERT OR REPLACE INTO columns(name, key) VALUES (?, ?)', (name, key))
+                return ans, state
+            if len(fingerprints) > 256:
+                rows = c.execute('SELECT book, fingerprint, val FROM composite_values WHERE name=?', (name,))
+            else:
+                rows = (r for book_id in fingerprints for r in c.execute(
+                    'SELECT book, fingerprint, val FROM composite_values WHERE name=? AND book=?', (name, book_id)))
+            for book_id, fingerprint, val in rows:
+                if fingerprints.get(book_id) == fingerprint:
+                    ans[book_id] = val
+        return ans, state
+
+    def set(self, field, values, state):
+        ' Store the rendered values, using the state returned by :meth:`get` '
+        if state is None or not values or self.conn is None:
+            return
+        fingerprints = state[1]
+        name = field.name
+        with self.lock, self.conn:
+            c = self.conn.cursor()
+            self._delete_invalidated(c)
+            c.executemany(
+                'INSERT OR REPLACE INTO composite_values(name, book, fingerprint, val) VALUES (?, ?, ?, ?)',
+                ((name, book_id, fingerprints[book_id], val) for book_id, val in values.items() if book_id in fingerprints))
+
+    def invalidate(self, book_ids):
+        # This is called for every write to the library, so the stored values
+        # are only deleted the next time values are stored. Until then get()
+        # returns them only if the fields they depend on are unchanged.
+        if self._conn is None or not book_ids:
+            return
+        with self.lock:
+            self.invalidated.update(book_ids)
+
+    def _delete_invalidated(self, cursor):
+        if self.invalidated:
+            cursor.executemany('DELETE FROM composite_values WHERE book=?', ((book_id,) for book_id in self.invalidated))
+            self.invalidated = set()
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                try:
+                    with self._conn:
+                        self._delete_invalidated(self._conn.cursor())
+                except apsw.Error:
+                    pass
+                self._conn.close()
+                self._conn = None
@@ -235,6 +235,10 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
 class CompositeField(OneToOneField):
 
     is_composite = True
+    RENDER_BATCH_SIZE = 1000
+    # An instance of calibre.db.composite_values.CompositeValues used to
+    # persist rendered values, set by the Cache
+    value_store = None
     SIZE_SUFFIX_MAP = {suffix:i for i, suffix in enumerate(('', 'K', 'M', 'G', 'T', 'P', 'E'))}
 
     def __init__(self, name, table, bools_are_tristate, get_template_functions):
@@ -324,6 +328,8 @@ def clear_caches(self, book_ids=None):
             else:
                 for book_id in book_ids:
                     self._render_cache.pop(book_id, None)
+        if book_ids is not None and self.value_store is not None:
+            self.value_store.invalidate(book_ids)
 
     def get_value_with_cache(self, book_id, get_metadata):
         with self._lock:
@@ -333,6 +339,41 @@ def get_value_with_cache(self, book_id, get_metadata):
             return self.__render_composite(book_id, mi, mi.formatter, mi.template_cache)
         return ans
 
+    def render_for_books(self, book_ids, get_metadata):
+        ''' Render this column for all the books in book_ids that are not
+        already in the render cache. The values of the fields the template
+        refers to are read for many books at once, which is much faster than
+        reading them separately for every book. Must be called with the
+        database read lock held. '''
+        from calibre.db.lazy import prefetch_field_values
+        from calibre.utils.formatter import TemplateFormatter
+        with self._lock:
+            book_ids = [book_id for book_id in book_ids if book_id not in self._render_cache]
+        if len(book_ids) < 2:
+            return
+        store_state = None
+        if self.value_store is not None:
+            stored, store_state = self.value_store.get(self, book_ids)
+            if stored:
+                with self._lock:
+                    for book_id, val in stored.items():
+                        self._render_cache.setdefault(book_id, val)
+                book_ids = [book_id for book_id in book_ids if book_id not in stored]
+        template = self.metadata['display']['composite_template']
+        fields = TemplateFormatter().referenced_fields(template, self.get_template_functions())
+        rendered = {}
+        for i in range(0, len(book_ids), self.RENDER_BATCH_SIZE):
+            batch = book_ids[i:i+self.RENDER_BATCH_SIZE]
+            mis = [get_metadata(book_id) for book_id in batch]
+            prefetch_field_values(mis, fields)
+            for book_id, mi in zip(batch, mis):
+                with self._lock:
+                    done = book_id in self._render_cache
+                if not done:
+                    rendered[book_id] = self.__render_composite(book_id, mi, mi.formatter, mi.template_cache)
+        if store_state is not None:
+            self.value_store.set(self, rendered, store_state)
+
     def sort_keys_for_books(self, get_metadata, lang_map):
         gv = self.get_value_with_cache
         sk = self._sort_key
@@ -343,6 +384,7 @@ def sort_keys_for_books(self, get_metadata, lang_map):
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         val_map = defaultdict(set)
         splitter = self.splitter
+        self.render_for_books(candidates, get_metadata)
         for book_id in candidates:
             vals = self.get_value_with_cache(book_id, get_metadata)
             vals = (vv.strip() for vv in vals.split(splitter)) if splitter else (vals,)
@@ -361,6 +403,7 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
     def iter_counts(self, candidates, get_metadata=None):
         val_map = defaultdict(set)
         splitter = self.splitter
+        self.render_for_books(candidates, get_metadata)
         for book_id in candidates:
             vals = self.get_value_with_cache(book_id, get_metadata)
             if splitter:
@@ -376,6 +419,7 @@ def get_composite_categories(self, tag_class, book_rating_map, book_ids,
                                  is_multiple, get_metadata):
         ans = []
         id_map = defaultdict(set)
+        self.render_for_books(book_ids, get_metadata)
         for book_id in book_ids:
             val = self.get_value_with_cache(book_id, get_metadata)
             vals = [x.strip() for x in val.split(is_multiple)] if is_multiple else [val]
@@ -394,6 +438,7 @@ def get_composite_categories(self, tag_class, book_rating_map, book_ids,
     def get_books_for_val(self, value, get_metadata, book_ids):
         is_multiple = self.table.metadata['is_multiple'].get('cache_to_list', None)
         ans = set()
+        self.render_for_books(book_ids, get_metadata)
         for book_id in book_ids:
             val = self.get_value_with_cache(book_id, get_metadata)
             vals = {x.strip() for x in val.split(is_multiple)} if is_multiple else [val]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2024, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A persistent index of the hashes of the contents of the format files in a
+library, used to find books that already contain a byte-identical copy of a
+file that is being added.
+
+Every hash is stored along with the size and modification time of the file
+it was computed from and is only used if the file still has the same size and
+modification time, so a stale hash is never returned, even if the library is
+changed by some other program. Identical files have the same size, so only
+formats that have the same size as the file being looked up ever need to be
+hashed, see Cache.find_books_with_identical_files().
+'''
+
+import hashlib
+import os
+import weakref
+from threading import Lock
+
+import apsw
+
+from calibre.constants import cache_dir
+
+
+def hash_stream(stream, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=32)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        h.update(chunk)
+    return h.hexdigest()
+
+
+class FormatHashes:
+
+    def __init__(self, db, path=None):
+        self.dbref = weakref.ref(db)
+        self.path = path
+        self.lock = Lock()
+        self._conn = None
+        self.failed = False
+
+    @property
+    def conn(self):
+        if self._conn is None and not self.failed:
+            try:
+                path = self.path or os.path.join(cache_dir(), 'format-hashes', self.dbref().library_id + '.sqlite')
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                conn = apsw.Connection(path)
+                conn.setbusytimeout(5000)
+                with conn:
+                    conn.cursor().execute('''
+                    CREATE TABLE IF NOT EXISTS format_hashes(
+                        book INTEGER NOT NULL, fmt TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL, hash TEXT NOT NULL,
+                        PRIMARY KEY(book, fmt));
+                    ''')
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                self.failed = True
+            else:
+                self._conn = conn
+        return self._conn
+
+    def get(self, book_id, fmt, size, mtime):
+        ' Return the stored hash of the format if the file has not changed since it was computed, otherwise None '
+        conn = self.conn
+        if conn is None:
+            return None
+        with self.lock:
+            for h, in conn.cursor().execute(
+                    'SELECT hash FROM format_hashes WHERE book=? AND fmt=? AND size=? AND mtime=?', (book_id, fmt, size, mtime)):
+                return h
+
+    def set(self, book_id, fmt, size, mtime, h):
+        conn = self.conn
+        if conn is None:
+            return
+        with self.lock, conn:
+            conn.cursor().execute(
+                'INSERT OR REPLACE INTO format_hashes(book, fmt, size, mtime, hash) VALUES (?, ?, ?, ?, ?)', (book_id, fmt, size, mtime, h))
+
+    def invalidate(self, book_ids):
+        if self._conn is None or not book_ids:
+            return
+        with self.lock, self._conn:
+            self._conn.cursor().executemany('DELETE FROM format_hashes WHERE book=?', ((book_id,) for book_id in book_ids))
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2024, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Compressed storage of the text extracted from books for full text search.
+
+The text is stored in books_text_store.searchable_text as a BLOB whose first
+byte identifies the codec, followed by the compressed UTF-8 text. Plain TEXT
+is returned unchanged. The books_text_view view decompresses the text on the
+fly with the calibre_fts_text() SQL function, so that the FTS tables, which
+use books_text_view as their external content table, can still produce
+snippets and highlights.
+'''
+
+import zlib
+
+ZLIB_CODEC = 1
+COMPRESSION_LEVEL = 6
+
+
+def compress_text(text):
+    if not text:
+        return ''
+    return bytes((ZLIB_CODEC,)) + zlib.compress(text.encode('utf-8'), COMPRESSION_LEVEL)
+
+
+def decompress_text(data):
+    if not isinstance(data, bytes):
+        return data
+    if not data:
+        return ''
+    if data[0] != ZLIB_CODEC:
+        raise ValueError(f'Unknown compression codec for full text search data: {data[0]}')
+    return zlib.decompress(memoryview(data)[1:]).decode('utf-8')
+
+
+def register_functions(conn):
+    conn.createscalarfunction('calibre_fts_text', decompress_text, 1, deterministic=True)
@@ -5,16 +5,21 @@
 import apsw
 import builtins
 import hashlib
+import json
 import os
 import sys
 from contextlib import suppress
-from threading import Lock
-from itertools import count
+from heapq import merge
+from operator import itemgetter
+from pathlib import Path
+from queue import Queue
+from threading import Event, Lock, Thread
 
 from calibre.db import FTSQueryError
 from calibre.db.annotations import unicode_normalize
 from calibre.utils.date import EPOCH, utcnow
 
+from .compression import compress_text, register_functions
 from .pool import Pool
 from .schema_upgrade import SchemaUpgrade
 
@@ -26,11 +31,19 @@ def print(*args, **kwargs):
 
 class FTS:
 
+    # Searches are split into this many ranges of rows, searched in parallel
+    # on separate read only connections, when there are at least
+    # MIN_ROWS_TO_SHARD indexed texts
+    NUM_SEARCH_SHARDS = min(4, os.cpu_count() or 1)
+    MIN_ROWS_TO_SHARD = 5000
+
     def __init__(self, dbref):
         self.dbref = dbref
         self.pool = Pool(dbref)
         self.init_lock = Lock()
-        self.temp_table_counter = count()
+        self.read_connections = []
+        self.read_connections_lock = Lock()
+        self.read_connections_closed = False
 
     def initialize(self, conn):
         needs_dirty = False
@@ -38,12 +51,13 @@ def initialize(self, conn):
             if conn.fts_dbpath is None:
                 main_db_path = os.path.abspath(conn.db_filename('main'))
                 dbpath = os.path.join(os.path.dirname(main_db_path), 'full-text-search.db')
+                register_functions(conn)
                 conn.execute("ATTACH DATABASE ? AS fts_db", (dbpath,))
                 SchemaUpgrade(conn)
                 conn.execute('UPDATE fts_db.dirtied_formats SET in_progress=FALSE WHERE in_progress=TRUE')
                 num_dirty = conn.get('''SELECT COUNT(*) from fts_db.dirtied_formats''')[0][0]
                 if not num_dirty:
-                    num_indexed = conn.get('''SELECT COUNT(*) from fts_db.books_text''')[0][0]
+                    num_indexed = conn.get('''SELECT COUNT(*) from fts_db.books_text_store''')[0][0]
                     if not num_indexed:
                         needs_dirty = True
                 conn.fts_dbpath = dbpath
@@ -93,9 +107,9 @@ def dirty_book(self, book_id, *fmts):
     def unindex(self, book_id, fmt=None):
         conn = self.get_connection()
         if fmt is None:
-            conn.execute('DELETE FROM books_text WHERE book=?', (book_id,))
+            conn.execute('DELETE FROM books_text_store WHERE book=?', (book_id,))
         else:
-            conn.execute('DELETE FROM books_text WHERE book=? AND format=?', (book_id, fmt.upper()))
+            conn.execute('DELETE FROM books_text_store WHERE book=? AND format=?', (book_id, fmt.upper()))
 
     def add_text(self, book_id, fmt, text, text_hash='', fmt_size=0, fmt_hash='', err_msg=''):
         conn = self.get_connection()
@@ -103,16 +117,16 @@ def add_text(self, book_id, fmt, text, text_hash='', fmt_size=0, fmt_hash='', er
         fmt = fmt.upper()
         if err_msg:
             conn.execute(
-                'INSERT OR REPLACE INTO fts_db.books_text '
+                'INSERT OR REPLACE INTO fts_db.books_text_store '
                 '(book, timestamp, format, format_size, format_hash, err_msg) VALUES '
                 '(?, ?, ?, ?, ?, ?)', (
                     book_id, ts, fmt, fmt_size, fmt_hash, err_msg))
         elif text:
             conn.execute(
-                'INSERT OR REPLACE INTO fts_db.books_text '
+                'INSERT OR REPLACE INTO fts_db.books_text_store '
                 '(book, timestamp, format, format_size, format_hash, searchable_text, text_size, text_hash) VALUES '
                 '(?, ?, ?, ?, ?, ?, ?, ?)', (
-                    book_id, ts, fmt, fmt_size, fmt_hash, text, len(text), text_hash))
+                    book_id, ts, fmt, fmt_size, fmt_hash, compress_text(text), len(text), text_hash))
         else:
             conn.execute('DELETE FROM fts_db.dirtied_formats WHERE book=? AND format=?', (book_id, fmt))
 
@@ -127,7 +141,7 @@ def commit_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg=''):
         text_hash = ''
         if text:
             text_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
-            for x in conn.get('SELECT id FROM fts_db.books_text WHERE book=? AND format=? AND text_hash=?', (book_id, fmt, text_hash)):
+            for x in conn.get('SELECT id FROM fts_db.books_text_store WHERE book=? AND format=? AND text_hash=?', (book_id, fmt, text_hash)):
                 text = ''
                 break
         self.add_text(book_id, fmt, text, text_hash, fmt_size, fmt_hash, err_msg)
@@ -135,7 +149,7 @@ def commit_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg=''):
     def queue_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
         conn = self.get_connection()
         fmt = fmt.upper()
-        for x in conn.get('SELECT id FROM fts_db.books_text WHERE book=? AND format=? AND format_size=? AND format_hash=?', (
+        for x in conn.get('SELECT id FROM fts_db.books_text_store WHERE book=? AND format=? AND format_size=? AND format_hash=?', (
                 book_id, fmt, fmt_size, fmt_hash)):
             break
         else:
@@ -154,9 +168,9 @@ def search(self,
         if restrict_to_book_ids is not None and not restrict_to_book_ids:
             return
         fts_engine_query = unicode_normalize(fts_engine_query)
-        fts_table = 'books_fts' + ('_stemmed' if use_stemming else '')
+        fts_table = 'books_text_fts' + ('_stemmed' if use_stemming else '')
         if return_text:
-            text = 'books_text.searchable_text'
+            text = 'books_text_view.searchable_text'
             if highlight_start is not None and highlight_end is not None:
                 if snippet_size is not None:
                     text = f'''snippet("{fts_table}", 0, '{highlight_start}', '{highlight_end}', '…', {max(1, min(snippet_size, 64))})'''
@@ -165,24 +179,26 @@ def search(self,
             text = ', ' + text
         else:
             text = ''
-        query = 'SELECT {0}.id, {0}.book, {0}.format {1} FROM {0} '.format('books_text', text)
-        query += f' JOIN {fts_table} ON fts_db.books_text.id = {fts_table}.rowid'
+        query = 'SELECT {0}.id, {0}.book, {0}.format {1}, {2}.rank FROM {0} '.format('books_text_view', text, fts_table)
+        query += f' JOIN {fts_table} ON fts_db.books_text_view.id = {fts_table}.rowid'
         query += ' WHERE '
         data = []
         conn = self.get_connection()
-        temp_table_name = ''
         if restrict_to_book_ids:
-            temp_table_name = f'fts_restrict_search_{next(self.temp_table_counter)}'
-            conn.execute(f'CREATE TABLE temp.{temp_table_name}(x INTEGER)')
-            conn.executemany(f'INSERT INTO temp.{temp_table_name} VALUES (?)', tuple((x,) for x in restrict_to_book_ids))
-            query += f' fts_db.books_text.book IN temp.{temp_table_name} AND '
+            # Pass the book ids as a single JSON array, which is much faster
+            # than creating and filling a temporary table for every search
+            query += ' fts_db.books_text_view.book IN (SELECT value FROM json_each(?)) AND '
+            data.append(json.dumps(tuple(restrict_to_book_ids)))
         query += f' "{fts_table}" MATCH ?'
         data.append(fts_engine_query)
-        query += f' ORDER BY {fts_table}.rank '
-        if temp_table_name:
-            query += f'; DROP TABLE temp.{temp_table_name}'
+        shards = self.search_shards(conn, restrict_to_book_ids)
+        if shards:
+            query += f' AND {fts_table}.rowid BETWEEN ? AND ?'
+            records = self.search_shards_in_parallel(conn.fts_dbpath, query + f' ORDER BY {fts_table}.rank', data, shards)
+        else:
+            records = conn.execute(query + f' ORDER BY {fts_table}.rank', tuple(data))
         try:
-            for record in conn.execute(query, tuple(data)):
+            for record in records:
                 result = {
                     'id': record[0],
                     'book_id': record[1],
@@ -196,6 +212,98 @@ def search(self,
                     break
         except apsw.SQLError as e:
             raise FTSQueryError(fts_engine_query, query, e) from e
+        finally:
+            if shards:
+                records.close()
+
+    def search_shards(self, conn, restrict_to_book_ids):
+        ''' Return the ranges of row ids to search in parallel or None if the
+        search should be done in a single query. '''
+        if self.NUM_SEARCH_SHARDS < 2 or (restrict_to_book_ids and len(restrict_to_book_ids) < self.MIN_ROWS_TO_SHARD):
+            return None
+        lo, hi = conn.get('SELECT MIN(id), MAX(id) FROM fts_db.books_text_store')[0]
+        if lo is None or hi - lo < self.MIN_ROWS_TO_SHARD:
+            return None
+        step = (hi - lo) // self.NUM_SEARCH_SHARDS + 1
+        return tuple((start, start + step - 1) for start in range(lo, hi + 1, step))
+
+    def search_shards_in_parallel(self, dbpath, query, data, shards):
+        '''
+        Run query for each range of row ids in a separate thread on its own
+        connection, yielding the records of all ranges merged in order of rank.
+        The rank of a record does not depend on the range it is in, since all
+        ranges are searched in the same FTS table.
+        '''
+        abort = Event()
+        queues = [Queue() for shard in shards]
+
+        def run(q, lo, hi):
+            try:
+                conn = self.get_read_connection(dbpath)
+            except Exception as e:
+                q.put(e)
+                q.put(None)
+                return
+            try:
+                for record in conn.execute(query, tuple(data) + (lo, hi)):
+                    if abort.is_set():
+                        break
+                    q.put(record)
+            except Exception as e:
+                q.put(e)
+            finally:
+                self.release_read_connection(conn)
+                q.put(None)
+
+        def records(q):
+            while True:
+                x = q.get()
+                if x is None:
+                    break
+                if isinstance(x, Exception):
+                    raise x
+                yield x
+
+        threads = [Thread(name='FTSSearchShard', daemon=True, target=run, args=(q, lo, hi)) for q, (lo, hi) in zip(queues, shards)]
+        for t in threads:
+            t.start()
+        try:
+            yield from merge(*map(records, queues), key=itemgetter(-1))
+        finally:
+            abort.set()
+            # Wait for the connections to be released, so that none are in
+            # use once the search is done and the database can be closed
+            for t in threads:
+                t.join()
+
+    def get_read_connection(self, dbpath):
+        with self.read_connections_lock:
+            for i, conn in enumerate(self.read_connections):
+                if conn.fts_dbpath == dbpath:
+                    return self.read_connections.pop(i)
+        from calibre.db.backend import Connection
+        conn = Connection(':memory:', flags=apsw.SQLITE_OPEN_READWRITE | apsw.SQLITE_OPEN_CREATE | apsw.SQLITE_OPEN_URI)
+        register_functions(conn)
+        conn.execute('ATTACH DATABASE ? AS fts_db', (Path(dbpath).as_uri() + '?mode=ro',))
+        conn.fts_dbpath = dbpath
+        return conn
+
+    def release_read_connection(self, conn):
+        with self.read_connections_lock:
+            if not self.read_connections_closed:
+                self.read_connections.append(conn)
+                return
+        conn.close()
+
+    def close_read_connections(self):
+        with self.read_connections_lock:
+            conns, self.read_connections = self.read_connections, []
+        for conn in conns:
+            with suppress(Exception):
+                conn.close()
 
     def shutdown(self):
         self.pool.shutdown()
+        with self.read_connections_lock:
+            self.read_connections_closed = True
+        self.close_read_connections()
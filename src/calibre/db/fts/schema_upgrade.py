@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # License: GPL v3 Copyright: 2022, Kovid Goyal <kovid at kovidgoyal.net>
 
+from calibre.db.fts.compression import compress_text
 from calibre.utils.resources import get_path as P
 
 
@@ -21,6 +22,7 @@ def __init__(self, conn):
                 print(f'Upgrading FTS database to version {uv+1}...')
                 meth()
                 self.user_version = uv + 1
+            self.move_uncompressed_text()
             fts_triggers = P('fts_triggers.sql', data=True, allow_user_override=False).decode('utf-8')
             conn.execute(fts_triggers)
         except (Exception, BaseException):
@@ -30,6 +32,99 @@ def __init__(self, conn):
             conn.execute('COMMIT')
         self.conn = None
 
+    def upgrade_version_1(self):
+        '''
+        Store the extracted text compressed, in books_text_store, indexed by
+        the books_text_fts tables, whose content table is the books_text_view
+        view that decompresses it. The books_text and books_fts tables are
+        left in place, empty, so that older versions of calibre, which do not
+        know how to decompress the text, can still use this database.
+        '''
+        self.conn.execute('''
+            CREATE TABLE fts_db.books_text_store ( id INTEGER PRIMARY KEY,
+                book INTEGER NOT NULL,
+                timestamp REAL NOT NULL,
+                format TEXT NOT NULL COLLATE NOCASE,
+                format_hash TEXT NOT NULL COLLATE NOCASE,
+                format_size INTEGER NOT NULL DEFAULT 0,
+                searchable_text TEXT NOT NULL DEFAULT '',
+                text_size INTEGER NOT NULL DEFAULT 0,
+                text_hash TEXT NOT NULL COLLATE NOCASE DEFAULT '',
+                err_msg TEXT DEFAULT '',
+                UNIQUE(book, format)
+            );
+
+            -- searchable_text is stored compressed, see calibre/db/fts/compression.py
+            CREATE VIEW fts_db.books_text_view AS SELECT
+                id, book, timestamp, format, format_hash, format_size, calibre_fts_text(searchable_text) AS searchable_text, text_size, text_hash, err_msg
+                FROM books_text_store;
+
+            CREATE VIRTUAL TABLE fts_db.books_text_fts USING fts5(
+                searchable_text, content = 'books_text_view', content_rowid = 'id', tokenize = 'calibre remove_diacritics 2');
+            CREATE VIRTUAL TABLE fts_db.books_text_fts_stemmed USING fts5(
+                searchable_text, content = 'books_text_view', content_rowid = 'id', tokenize = 'porter calibre remove_diacritics 2');
+
+            CREATE TRIGGER fts_db.books_text_store_insert_trg AFTER INSERT ON fts_db.books_text_store
+            BEGIN
+                INSERT INTO books_text_fts(rowid, searchable_text) VALUES (NEW.id, calibre_fts_text(NEW.searchable_text));
+                INSERT INTO books_text_fts_stemmed(rowid, searchable_text) VALUES (NEW.id, calibre_fts_text(NEW.searchable_text));
+                DELETE FROM dirtied_formats WHERE book=NEW.book AND format=NEW.format;
+            END;
+
+            CREATE TRIGGER fts_db.books_text_store_delete_trg AFTER DELETE ON fts_db.books_text_store
+            BEGIN
+                INSERT INTO books_text_fts(books_text_fts, rowid, searchable_text) VALUES('delete', OLD.id, calibre_fts_text(OLD.searchable_text));
+                INSERT INTO books_text_fts_stemmed(books_text_fts_stemmed, rowid, searchable_text) VALUES(
+                    'delete', OLD.id, calibre_fts_text(OLD.searchable_text));
+            END;
+
+            CREATE TRIGGER fts_db.books_text_store_update_trg AFTER UPDATE ON fts_db.books_text_store
+            BEGIN
+                INSERT INTO books_text_fts(books_text_fts, rowid, searchable_text) VALUES('delete', OLD.id, calibre_fts_text(OLD.searchable_text));
+                INSERT INTO books_text_fts(rowid, searchable_text) VALUES (NEW.id, calibre_fts_text(NEW.searchable_text));
+                INSERT INTO books_text_fts_stemmed(books_text_fts_stemmed, rowid, searchable_text) VALUES(
+                    'delete', OLD.id, calibre_fts_text(OLD.searchable_text));
+                INSERT INTO books_text_fts_stemmed(rowid, searchable_text) VALUES (NEW.id, calibre_fts_text(NEW.searchable_text));
+                DELETE FROM dirtied_formats WHERE book=NEW.book AND format=NEW.format;
+            END;
+        ''')
+
+    def move_uncompressed_text(self):
+        '''
+        Move the text in books_text, stored by older versions of calibre, to
+        books_text_store, compressing it. Older versions only write to
+        books_text, so this is needed after the upgrade and whenever an older
+        version has been used with this library since.
+        '''
+        conn = self.conn
+        ids = [r[0] for r in conn.execute('SELECT id FROM fts_db.books_text')]
+        if not ids:
+            return
+        cols = 'book, timestamp, format, format_hash, format_size, searchable_text, text_size, text_hash, err_msg'
+        batch_size = 64
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i+batch_size]
+            rows = tuple(conn.execute(
+                'SELECT {} FROM fts_db.books_text WHERE id IN ({})'.format(cols, ','.join('?' * len(batch))), batch))
+            conn.executemany(
+                'INSERT OR REPLACE INTO fts_db.books_text_store ({}) VALUES ({})'.format(cols, ','.join('?' * 9)),
+                (r[:5] + (compress_text(r[5]),) + r[6:] for r in rows))
+        # Empty books_text and its FTS tables without running the triggers
+        # that remove every row from the FTS tables one by one
+        fts_sqlite = P('fts_sqlite.sql', data=True, allow_user_override=False).decode('utf-8')
+        start = fts_sqlite.index('CREATE TRIGGER')
+        conn.execute('''
+            DROP TRIGGER IF EXISTS fts_db.books_fts_insert_trg;
+            DROP TRIGGER IF EXISTS fts_db.books_fts_delete_trg;
+            DROP TRIGGER IF EXISTS fts_db.books_fts_update_trg;
+            DELETE FROM fts_db.books_text;
+            INSERT INTO fts_db.books_fts(books_fts) VALUES('delete-all');
+            INSERT INTO fts_db.books_fts_stemmed(books_fts_stemmed) VALUES('delete-all');
+        ''')
+        conn.execute(fts_sqlite[start:fts_sqlite.index('PRAGMA', start)])
+        # Older versions do not remove the text of deleted books from books_text_store
+        conn.execute('DELETE FROM fts_db.books_text_store WHERE book NOT IN (SELECT id FROM main.books)')
+
     @property
     def user_version(self):
         return self.conn.get('PRAGMA fts_db.user_version', all=False) or 0
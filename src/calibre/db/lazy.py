@@ -292,28 +292,37 @@ def user_categories_getter(proxy_metadata):
         return ret
 
 
+# Fields whose values are read with field_for(), mapped to the database field
+# name (which is also the key used in the cache), the default value and the
+# postprocessing function. See prefetch_field_values()
+db_fields = {
+    'title': ('title', _('Unknown'), None),
+    'title_sort': ('sort', _('Unknown'), None),
+    'authors': ('authors', (_('Unknown'),), list),
+    'author_sort': ('author_sort', _('Unknown'), None),
+    'uuid': ('uuid', 'dummy', None),
+    'book_size': ('size', 0, None),
+    'ondevice_col': ('ondevice', '', None),
+    'languages': ('languages', None, list),
+    'tags': ('tags', (_('Unknown'),), list),
+}
+for field in ('comments', 'publisher', 'identifiers', 'series', 'rating'):
+    db_fields[field] = (field, None, None)
+
 getters = {
-    'title':simple_getter('title', _('Unknown')),
-    'title_sort':simple_getter('sort', _('Unknown')),
-    'authors':pp_getter('authors', list, (_('Unknown'),)),
-    'author_sort':simple_getter('author_sort', _('Unknown')),
-    'uuid':simple_getter('uuid', 'dummy'),
-    'book_size':simple_getter('size', 0),
-    'ondevice_col':simple_getter('ondevice', ''),
-    'languages':pp_getter('languages', list),
+    field: (simple_getter(name, default_value) if postprocess is None else pp_getter(name, postprocess, default_value))
+    for field, (name, default_value, postprocess) in db_fields.items()
+}
+getters.update({
     'language':item_getter('languages', default_value=NULL_VALUES['language']),
     'db_approx_formats': approx_fmts_getter,
     'has_cover': has_cover_getter,
-    'tags':pp_getter('tags', list, (_('Unknown'),)),
     'series_index':series_index_getter(),
     'application_id':lambda x, book_id, y: book_id,
     'id':lambda x, book_id, y: book_id,
     'virtual_libraries':virtual_libraries_getter,
     'link_maps': link_maps_getter,
-}
-
-for field in ('comments', 'publisher', 'identifiers', 'series', 'rating'):
-    getters[field] = simple_getter(field)
+})
 
 for field in ('author_sort_map',):
     getters[field] = adata_getter(field)
@@ -326,6 +335,43 @@ def user_categories_getter(proxy_metadata):
 
 for field in ('formats', 'format_metadata'):
     getters[field] = fmt_getter(field)
+
+
+def prefetch_field_values(proxies, fields):
+    '''
+    Read the values of the specified fields for all the ProxyMetadata objects
+    in proxies at once, rather than one book at a time as they are accessed.
+    Fields that cannot be read in bulk are ignored and will be read on demand
+    as usual. Must be called with the database read lock held.
+    '''
+    if not proxies:
+        return
+    db = ga(proxies[0], '_db')()
+    fm = db.field_metadata
+    book_ids = tuple(ga(mi, '_book_id') for mi in proxies)
+    caches = tuple(ga(mi, '_cache') for mi in proxies)
+    for field in fields:
+        if field not in fm:
+            field = fm.search_term_to_field_key(field)
+        spec = db_fields.get(field)
+        if spec is None:
+            if field == 'series_index':
+                spec = field, 1.0, None
+            elif field in db.fields and fm.get(field, {}).get('is_custom'):
+                if field.endswith('_index') and fm[field]['datatype'] == 'float':
+                    spec = field, 1.0, None
+                else:
+                    spec = field, None, fmt_custom
+        if spec is None:
+            continue
+        name, default_value, postprocess = spec
+        if name not in db.fields or db.fields[name].is_composite:
+            continue
+        vals = db._all_field_for(name, book_ids, default_value=default_value)
+        for book_id, cache in zip(book_ids, caches):
+            if name not in cache:
+                val = vals[book_id]
+                cache[name] = val if postprocess is None else postprocess(val)
 # }}}
 
 
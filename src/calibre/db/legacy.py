@@ -383,9 +383,10 @@ def import_book_directory_multiple(self, dirpath, callback=None, added_ids=None,
     def import_book_directory(self, dirpath, callback=None, added_ids=None, compiled_rules=()):
         return import_book_directory(self, dirpath, callback=callback, added_ids=added_ids, compiled_rules=compiled_rules)
 
-    def recursive_import(self, root, single_book_per_directory=True, callback=None, added_ids=None, compiled_rules=()):
+    def recursive_import(self, root, single_book_per_directory=True, callback=None, added_ids=None, compiled_rules=(), max_workers=0):
         return recursive_import(
-            self, root, single_book_per_directory=single_book_per_directory, callback=callback, added_ids=added_ids, compiled_rules=compiled_rules)
+            self, root, single_book_per_directory=single_book_per_directory, callback=callback, added_ids=added_ids,
+            compiled_rules=compiled_rules, max_workers=max_workers)
 
     def add_catalog(self, path, title):
         book_id, new_book_added = add_catalog(self.new_api, path, title, dbapi=self)
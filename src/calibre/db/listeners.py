@@ -52,6 +52,9 @@ def __init__(self):
         self.queue = Queue()
         self.activated = False
         self.library_id = ''
+        # Called in the thread generating the event, before any queued
+        # listeners, for use by internal caches that must never be stale
+        self.synchronous_listeners = []
 
     def add_listener(self, callback):
         # note that we intentionally leak dead weakrefs. To not do so would
@@ -75,6 +78,8 @@ def __contains__(self, callback):
         return ref in self.refs
 
     def __call__(self, event_name, *args):
+        for listener in self.synchronous_listeners:
+            listener(event_name, args)
         if self.activated:
             self.queue.put((event_name, self.library_id, args))
 
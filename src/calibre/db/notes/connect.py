@@ -7,9 +7,11 @@
 import shutil
 import time
 import xxhash
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
 from itertools import count, repeat
-from collections import defaultdict
+from collections import defaultdict, deque
+from threading import get_ident
 from typing import Optional
 
 from calibre import sanitize_file_name
@@ -34,12 +36,23 @@ class cmt(str):
 SEP = b'\0\x1c\0'
 DOC_NAME = 'doc.html'
 METADATA_EXT = '.metadata'
+TEMP_EXT = '.tmp'
 
 
 def hash_data(data: bytes) -> str:
     return 'xxh64:' + xxhash.xxh3_64_hexdigest(data)
 
 
+def hash_stream(f) -> str:
+    h = xxhash.xxh3_64()
+    while True:
+        chunk = f.read(1024 * 1024)
+        if not chunk:
+            break
+        h.update(chunk)
+    return 'xxh64:' + h.hexdigest()
+
+
 def hash_key(key: str) -> str:
     return xxhash.xxh3_64_hexdigest(key.encode('utf-8'))
 
@@ -57,9 +70,27 @@ def remove_with_retry(x, is_dir=False):
             f(x)
 
 
+def parallel_map(func, items, max_workers=8, window=32):
+    '''
+    Yield func(item) for every item, in order, running func in a pool of
+    threads. At most window results are computed ahead of the consumer, so
+    memory use stays bounded no matter how many items there are.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 class Notes:
 
     max_retired_items = 256
+    max_io_threads = 8
+    max_export_read_ahead_size = 1024 * 1024
 
     def __init__(self, backend):
         self.temp_table_counter = count()
@@ -194,12 +225,10 @@ def unretire(self, conn, field_name, item_id, item_value) -> int:
             except Exception:
                 return note_id
             marked_up_text, searchable_text = a.decode('utf-8'), b.decode('utf-8')
-        resources = set()
-        for x in os.listdir(srcdir):
-            if x.startswith('res-'):
-                rname = x.split('-', 1)[1]
-                with open(os.path.join(srcdir, x), 'rb') as rsrc:
-                    resources.add(self.add_resource(conn, rsrc, rname, update_name=False))
+        # The retired resources are links to or copies of stored resources,
+        # which are never modified in place, so they can be linked back
+        resources = set(self.add_resources(conn, (
+            (os.path.join(srcdir, x), x.split('-', 1)[1]) for x in os.listdir(srcdir) if x.startswith('res-')), update_name=False, link=True))
         note_id = self.set_note(conn, field_name, item_id, item_value, marked_up_text, resources, searchable_text, add_item_value_to_searchable_text=False)
         if note_id > -1:
             remove_with_retry(srcdir, is_dir=True)
@@ -311,35 +340,71 @@ def key(path):
             for path in items[:extra]:
                 remove_with_retry(path, is_dir=True)
 
-    def add_resource(self, conn, path_or_stream_or_data, name, update_name=True, mtime=None):
-        if isinstance(path_or_stream_or_data, bytes):
-            data = path_or_stream_or_data
-        elif isinstance(path_or_stream_or_data, str):
-            with open(path_or_stream_or_data, 'rb') as f:
-                data = f.read()
+    def store_resource(self, path_or_stream_or_data, mtime=None, link=False) -> str:
+        '''
+        Store the resource in the content addressed resource store, without
+        adding it to the database, and return its hash. Can be called from
+        multiple threads at once. Stored files are only ever replaced
+        atomically, never modified in place, so they can be shared with hard
+        links. When link is True and a path is specified, the resource is hard
+        linked to the file at path if possible, only use it for files that are
+        never modified in place either, such as the resources of a library.
+        '''
+        if link and isinstance(path_or_stream_or_data, str):
+            src_path, data = make_long_path_useable(path_or_stream_or_data), None
+            with open(src_path, 'rb') as f:
+                resource_hash = hash_stream(f)
+                size = os.stat(f.fileno()).st_size
         else:
-            data = path_or_stream_or_data.read()
-        resource_hash = hash_data(data)
-        path = self.path_for_resource(resource_hash)
-        path = make_long_path_useable(path)
-        exists = False
+            if isinstance(path_or_stream_or_data, bytes):
+                data = path_or_stream_or_data
+            elif isinstance(path_or_stream_or_data, str):
+                with open(path_or_stream_or_data, 'rb') as f:
+                    data = f.read()
+            else:
+                data = path_or_stream_or_data.read()
+            resource_hash, size = hash_data(data), len(data)
+        path = make_long_path_useable(self.path_for_resource(resource_hash))
         try:
             s = os.stat(path, follow_symlinks=False)
         except OSError:
             pass
         else:
-            exists = s.st_size == len(data)
-        if not exists:
-            try:
-                f = open(path, 'wb')
-            except FileNotFoundError:
-                os.makedirs(os.path.dirname(path), exist_ok=True)
-                f = open(path, 'wb')
-            with f:
-                f.write(data)
-            if mtime is not None:
-                os.utime(f.name, (mtime, mtime))
+            if s.st_size == size:
+                return resource_hash
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tpath = f'{path}-{os.getpid()}-{get_ident()}{TEMP_EXT}'
+        try:
+            if data is None:
+                copyfile_using_links(src_path, tpath, dest_is_dir=False)
+            else:
+                with open(tpath, 'wb') as f:
+                    f.write(data)
+                if mtime is not None:
+                    os.utime(tpath, (mtime, mtime))
+            os.replace(tpath, path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(tpath)
+            raise
+        return resource_hash
 
+    def write_resource_name(self, path, name):
+        # Replace the metadata file rather than writing to it, as it may be a
+        # hard link shared with another library, for example after a restore
+        path += METADATA_EXT
+        tpath = f'{path}-{os.getpid()}-{get_ident()}{TEMP_EXT}'
+        try:
+            with open(tpath, 'w') as fn:
+                fn.write(json.dumps({'name':name}))
+            os.replace(tpath, path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(tpath)
+            raise
+
+    def name_resource(self, conn, resource_hash, name, update_name=True):
+        path = make_long_path_useable(self.path_for_resource(resource_hash))
         name = sanitize_file_name(name)
         base_name, ext = os.path.splitext(name)
         c = 0
@@ -348,8 +413,7 @@ def add_resource(self, conn, path_or_stream_or_data, name, update_name=True, mti
                 while True:
                     try:
                         conn.execute('UPDATE notes_db.resources SET name=? WHERE hash=?', (name, resource_hash))
-                        with open(path + METADATA_EXT, 'w') as fn:
-                            fn.write(json.dumps({'name':name}))
+                        self.write_resource_name(path, name)
                         break
                     except apsw.ConstraintError:
                         c += 1
@@ -359,14 +423,59 @@ def add_resource(self, conn, path_or_stream_or_data, name, update_name=True, mti
             while True:
                 try:
                     conn.get('INSERT INTO notes_db.resources (hash,name) VALUES (?,?)', (resource_hash, name), all=False)
-                    with open(path + METADATA_EXT, 'w') as fn:
-                        fn.write(json.dumps({'name':name}))
+                    self.write_resource_name(path, name)
                     break
                 except apsw.ConstraintError:
                     c += 1
                     name = f'{base_name}-{c}{ext}'
+
+    def add_resource(self, conn, path_or_stream_or_data, name, update_name=True, mtime=None):
+        resource_hash = self.store_resource(path_or_stream_or_data, mtime)
+        self.name_resource(conn, resource_hash, name, update_name)
         return resource_hash
 
+    def add_resources(self, conn, items, update_name=True, link=False):
+        '''
+        Add many resources at once, items is an iterable of (path_or_stream_or_data, name)
+        pairs. The resources are hashed and stored in parallel. Returns the list of
+        resource hashes.
+        '''
+        items = tuple(items)
+        hashes = list(parallel_map(lambda item: self.store_resource(item[0], link=link), items, max_workers=self.max_io_threads))
+        with conn:
+            for resource_hash, (_, name) in zip(hashes, items):
+                self.name_resource(conn, resource_hash, name, update_name)
+        return hashes
+
+    def resources_to_verify(self, conn, after='', limit=256):
+        '''
+        Return the hashes of at most limit stored resources, in order, starting
+        after the resource hash after. Lets very large resource stores be
+        verified a batch at a time, in the background.
+        '''
+        return tuple(r[0] for r in conn.execute(
+            'SELECT hash FROM notes_db.resources WHERE hash > ? ORDER BY hash LIMIT ?', (after, limit)))
+
+    def bad_resources(self, hashes, conn=None):
+        '''
+        Return the hashes of the resources whose files are missing or
+        corrupted. Hashing the files does not use the database, so this can be
+        called without holding the database lock. If conn is specified,
+        resources that are no longer in the database are ignored.
+        '''
+        if conn is not None and hashes:
+            existing = {r[0] for r in conn.execute(
+                'SELECT hash FROM notes_db.resources WHERE hash IN ({})'.format(','.join(repeat('?', len(hashes)))), tuple(hashes))}
+            hashes = [h for h in hashes if h in existing]
+
+        def is_ok(resource_hash):
+            try:
+                with open(make_long_path_useable(self.path_for_resource(resource_hash)), 'rb') as f:
+                    return hash_stream(f) == resource_hash
+            except OSError:
+                return False
+        return [h for h, ok in zip(hashes, parallel_map(is_ok, hashes, max_workers=self.max_io_threads)) if not ok]
+
     def get_resource_data(self, conn, resource_hash) -> Optional[dict]:
         ans = None
         for (name,) in conn.execute('SELECT name FROM notes_db.resources WHERE hash=?', (resource_hash,)):
@@ -449,31 +558,49 @@ def search(self,
 
     def export_non_db_data(self, zf):
         import zipfile
-        def add_dir(which):
-            for dirpath, _, filenames in os.walk(make_long_path_useable(which)):
-                for f in filenames:
-                    path = os.path.join(dirpath, f)
-                    with open(path, 'rb') as src:
-                        zi = zipfile.ZipInfo.from_file(path, arcname=os.path.relpath(path, self.notes_dir))
-                        with zf.open(zi, 'w') as dest:
-                            shutil.copyfileobj(src, dest)
-        add_dir(self.backup_dir)
-        add_dir(self.resources_dir)
+
+        def read(path):
+            zi = zipfile.ZipInfo.from_file(path, arcname=os.path.relpath(path, self.notes_dir))
+            if zi.file_size > self.max_export_read_ahead_size:
+                return path, zi, None
+            with open(path, 'rb') as src:
+                return path, zi, src.read()
+
+        def paths():
+            for which in (self.backup_dir, self.resources_dir):
+                for dirpath, _, filenames in os.walk(make_long_path_useable(which)):
+                    for f in filenames:
+                        if not f.endswith(TEMP_EXT):
+                            yield os.path.join(dirpath, f)
+
+        # Small files are read in parallel, while the archive, which is a
+        # single stream, is written serially. Large files are copied into the
+        # archive in chunks so they are never read into memory whole.
+        for path, zi, data in parallel_map(read, paths(), max_workers=self.max_io_threads):
+            if data is None:
+                with open(path, 'rb') as src, zf.open(zi, 'w') as dest:
+                    shutil.copyfileobj(src, dest)
+            else:
+                zf.writestr(zi, data)
 
     def vacuum(self, conn):
         conn.execute('VACUUM notes_db')
 
     def restore(self, conn, tables, report_progress):
-        resources = {}
         errors = []
+
+        def read_name(name_path):
+            with suppress(OSError), open(make_long_path_useable(name_path)) as n:
+                return json.loads(n.read())['name']
+            return 'unnamed'
+
+        resource_files = []
         for subdir in os.listdir(make_long_path_useable(self.resources_dir)):
             for rf in os.listdir(make_long_path_useable(os.path.join(self.resources_dir, subdir))):
-                if not rf.endswith(METADATA_EXT):
-                    name_path = os.path.join(self.resources_dir, subdir, rf + METADATA_EXT)
-                    name = 'unnamed'
-                    with suppress(OSError), open(make_long_path_useable(name_path)) as n:
-                        name = json.loads(n.read())['name']
-                    resources[rf.replace('-', ':', 1)] = name
+                if not rf.endswith(METADATA_EXT) and not rf.endswith(TEMP_EXT):
+                    resource_files.append((rf.replace('-', ':', 1), os.path.join(self.resources_dir, subdir, rf + METADATA_EXT)))
+        resources = dict(zip((x[0] for x in resource_files), parallel_map(
+            read_name, (x[1] for x in resource_files), max_workers=self.max_io_threads)))
         items = {}
         for f in os.listdir(make_long_path_useable(self.backup_dir)):
             if f in self.allowed_fields:
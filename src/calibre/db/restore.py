@@ -19,10 +19,12 @@
 from calibre.constants import filesystem_encoding, iswindows
 from calibre.db.backend import DB, DBPrefs
 from calibre.db.constants import METADATA_FILE_NAME, TRASH_DIR_NAME, NOTES_DIR_NAME, NOTES_DB_NAME
+from calibre.db.notes.connect import METADATA_EXT
 from calibre.db.cache import Cache
 from calibre.ebooks.metadata.opf2 import OPF
 from calibre.ptempfile import TemporaryDirectory
 from calibre.utils.date import utcfromtimestamp
+from calibre.utils.filenames import copytree_using_links
 
 NON_EBOOK_EXTENSIONS = frozenset((
     'jpg', 'jpeg', 'gif', 'png', 'bmp',
@@ -296,7 +298,22 @@ def restore_books(self):
         notes_dest = os.path.join(self.library_path, NOTES_DIR_NAME)
         if os.path.exists(notes_dest):  # created by load_preferences()
             shutil.rmtree(notes_dest)
-        shutil.copytree(os.path.join(self.src_library_path, NOTES_DIR_NAME), notes_dest)
+        src_notes = os.path.join(self.src_library_path, NOTES_DIR_NAME)
+        shutil.copytree(src_notes, notes_dest, ignore=lambda d, names: ('resources',) if d == src_notes else ())
+        # Notes resources are never modified in place so they can be shared
+        # with hard links instead of being copied. Their metadata files are
+        # rewritten when a resource is renamed, so those are copied.
+        if os.path.isdir(os.path.join(src_notes, 'resources')):
+            copytree_using_links(os.path.join(src_notes, 'resources'), notes_dest)
+            for dirpath, dirnames, filenames in os.walk(os.path.join(notes_dest, 'resources')):
+                for fname in filenames:
+                    if fname.endswith(METADATA_EXT):
+                        path = os.path.join(dirpath, fname)
+                        with open(path, 'rb') as f:
+                            raw = f.read()
+                        os.remove(path)
+                        with open(path, 'wb') as f:
+                            f.write(raw)
         with suppress(FileNotFoundError):
             os.remove(os.path.join(notes_dest, NOTES_DB_NAME))
         db = Restorer(self.library_path)
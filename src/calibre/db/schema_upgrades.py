@@ -820,3 +820,10 @@ def upgrade_version_25(self):
         alters.append("ALTER TABLE languages ADD COLUMN link TEXT NOT NULL DEFAULT '';")
         alters.append("ALTER TABLE ratings ADD COLUMN link TEXT NOT NULL DEFAULT '';")
         self.db.execute('\n'.join(alters))
+
+    def upgrade_version_26(self):
+        'Index annotations by timestamp for paging through them'
+        self.db.execute('''
+        DROP INDEX IF EXISTS annot_timestamp_idx;
+        CREATE INDEX annot_timestamp_idx ON annotations (timestamp);
+        ''')
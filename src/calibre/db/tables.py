@@ -626,10 +626,31 @@ def read_maps(self, db):
                 sm[book][fmt] = sz
 
         self.book_col_map = {k:tuple(sorted(v)) for k, v in iteritems(bcm)}
+        self.size_index = None
+
+    def formats_with_size(self, size):
+        ' Return the (book_id, fmt) pairs of all formats of the specified size '
+        if self.size_index is None:
+            self.size_index = defaultdict(set)
+            for book_id, sizes in iteritems(self.size_map):
+                for fmt, sz in iteritems(sizes):
+                    self.size_index[sz].add((book_id, fmt))
+        return frozenset(self.size_index.get(size, ()))
+
+    def unindex_sizes(self, book_id, fmts=None):
+        if self.size_index is not None:
+            for fmt, sz in iteritems(self.size_map.get(book_id, {})):
+                if fmts is None or fmt in fmts:
+                    q = self.size_index.get(sz)
+                    if q is not None:
+                        q.discard((book_id, fmt))
+                        if not q:
+                            del self.size_index[sz]
 
     def remove_books(self, book_ids, db):
         clean = ManyToManyTable.remove_books(self, book_ids, db)
         for book_id in book_ids:
+            self.unindex_sizes(book_id)
             self.fname_map.pop(book_id, None)
             self.size_map.pop(book_id, None)
         return clean
@@ -642,6 +663,7 @@ def set_fname(self, book_id, fmt, fname, db):
     def remove_formats(self, formats_map, db):
         for book_id, fmts in iteritems(formats_map):
             self.book_col_map[book_id] = [fmt for fmt in self.book_col_map.get(book_id, []) if fmt not in fmts]
+            self.unindex_sizes(book_id, fmts)
             for m in (self.fname_map, self.size_map):
                 m[book_id] = {k:v for k, v in iteritems(m[book_id]) if k not in fmts}
             for fmt in fmts:
@@ -681,7 +703,10 @@ def update_fmt(self, book_id, fmt, fname, size, db):
             self.col_book_map[fmt] = {book_id}
 
         self.fname_map[book_id][fmt] = fname
+        self.unindex_sizes(book_id, (fmt,))
         self.size_map[book_id][fmt] = size
+        if self.size_index is not None:
+            self.size_index[size].add((book_id, fmt))
         db.execute('INSERT OR REPLACE INTO data (book,format,uncompressed_size,name) VALUES (?,?,?,?)',
                         (book_id, fmt, size, fname))
         return max(itervalues(self.size_map[book_id]))
@@ -217,6 +217,49 @@ def test_add_books(self):  # {{{
         self.assertEqual(cache.format(book_id, 'FMT2'), FMT2)
     # }}}
 
+    def test_recursive_import(self):  # {{{
+        'Test adding books from folders with metadata read in worker processes'
+        from calibre.db.adding import recursive_import
+        root = self.mkdtemp()
+        for i, folder in enumerate(('one', 'two', 'two/three')):
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+            with open(os.path.join(root, folder, f'book {i}.txt'), 'wb') as f:
+                f.write(b'some text %d' % i)
+        for max_workers in (0, 2):
+            db = self.init_legacy(self.cloned_library)
+            cache = db.new_api
+            before = cache.all_book_ids()
+            added_ids = set()
+            duplicates = recursive_import(db, root, added_ids=added_ids, max_workers=max_workers)
+            self.assertFalse(duplicates)
+            self.assertEqual(added_ids, cache.all_book_ids() - before)
+            self.assertEqual({cache.field_for('title', book_id) for book_id in added_ids}, {'book 0', 'book 1', 'book 2'})
+            self.assertEqual(recursive_import(db, root, add_duplicates=True, max_workers=max_workers), [])
+            duplicates = recursive_import(db, root, add_duplicates=False, max_workers=max_workers)
+            self.assertEqual(len(duplicates), 3)
+            db.close()
+    # }}}
+
+    def test_read_metadata_in_workers(self):  # {{{
+        'Test reading metadata from groups of files in worker processes'
+        from calibre.db.adding import read_metadata_in_workers
+        from calibre.ebooks.metadata.worker import read_metadata
+        root = self.mkdtemp()
+        groups = []
+        for i in range(3):
+            path = os.path.join(root, f'book {i}.txt')
+            with open(path, 'wb') as f:
+                f.write(b'some text %d' % i)
+            groups.append([path])
+        paths, opf, has_cover, duplicate_info, file_hashes = read_metadata(groups[0], 0, self.mkdtemp())
+        self.assertEqual(paths, groups[0])
+        self.assertFalse(file_hashes)
+        results = list(read_metadata_in_workers(iter(groups), self.mkdtemp(), max_workers=2))
+        self.assertEqual([paths for paths, mi, tb in results], groups)
+        self.assertEqual([tb for paths, mi, tb in results], [None] * 3)
+        self.assertEqual([mi.title for paths, mi, tb in results], ['book 0', 'book 1', 'book 2'])
+    # }}}
+
     def test_remove_books(self):  # {{{
         'Test removal of books'
         cl = self.cloned_library
@@ -347,6 +390,28 @@ def test_original_fmt(self):  # {{{
         ae(set(fmts), set(db.formats(1, verify_formats=False)))
     # }}}
 
+    def test_map_format(self):  # {{{
+        ' Test read-only memory mapped access to formats '
+        from calibre.db.errors import NoSuchFormat
+        ae = self.assertEqual
+        db = self.init_cache()
+        raw = db.format(1, 'FMT1')
+        with db.map_format(1, 'FMT1') as lease:
+            ae(raw, lease.data[:])
+            ae(raw[:3], lease.stream.read(3))
+            # Replacing or modifying a leased format must not change the data seen through the lease
+            db.add_format(1, 'FMT1', BytesIO(b'replaced'), run_hooks=False)
+            db.backend.apply_to_format(1, db.field_for('path', 1), db.fields['formats'].format_fname(1, 'FMT1'), 'FMT1', lambda f: f.write(b'R'))
+            ae(raw, lease.data[:])
+            ae(b'Replaced', db.format(1, 'FMT1'))
+        self.assertFalse(db.backend.format_leases)
+        ae(b'', lease.data)
+        db.add_format(1, 'FMT1', BytesIO(b'in place'), run_hooks=False)
+        ae(b'in place', db.format(1, 'FMT1'))
+        self.assertRaises(NoSuchFormat, db.map_format, 1, 'XXX')
+        self.assertFalse([x for x in os.listdir(os.path.dirname(db.format_abspath(1, 'FMT1'))) if x.endswith('.tmp')])
+    # }}}
+
     def test_format_orphan(self):  # {{{
         ' Test that adding formats does not create orphans if the file name algorithm changes '
         cache = self.init_cache()
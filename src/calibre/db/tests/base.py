@@ -30,6 +30,7 @@ class BaseTest(unittest.TestCase):
     def setUp(self):
         from calibre.utils.recycle_bin import nuke_recycle
         nuke_recycle()
+        self.use_temp_cache_dir()
         self.library_path = self.mkdtemp()
         self.create_db(self.library_path)
 
@@ -44,6 +45,7 @@ def tearDown(self):
             gc.collect(), gc.collect()
             time.sleep(2)
             shutil.rmtree(self.library_path)
+        self.restore_cache_dir()
 
     def create_db(self, library_path):
         from calibre.library.database2 import LibraryDatabase2
@@ -61,6 +63,18 @@ def create_db(self, library_path):
         db.conn.close()
         return dest
 
+    def use_temp_cache_dir(self):
+        # Keep the on disk caches of the test libraries out of the calibre
+        # cache folder
+        from calibre.constants import cache_dir
+        self.original_cache_dir = cache_dir()
+        cache_dir.ans = self.mkdtemp()
+
+    def restore_cache_dir(self):
+        from calibre.constants import cache_dir
+        tdir, cache_dir.ans = cache_dir.ans, self.original_cache_dir
+        rmtree(tdir)
+
     def init_cache(self, library_path=None):
         from calibre.db.backend import DB
         from calibre.db.cache import Cache
@@ -243,7 +243,11 @@ def test_fname_change(self):
 
     def test_export_import(self):
         from calibre.db.cache import import_library
-        from calibre.utils.exim import Exporter, Importer
+        from threading import Event
+
+        from calibre.utils.exim import (
+            Exporter, ImportJournal, Importer, export_can_be_resumed, import_can_be_resumed,
+        )
         cache = self.init_cache()
         bookdir = os.path.dirname(cache.format_abspath(1, '__COVER_INTERNAL__'))
         with open(os.path.join(bookdir, 'exf'), 'w') as f:
@@ -253,13 +257,15 @@ def test_export_import(self):
             f.write('recurse')
         self.assertEqual({ef.relpath for ef in cache.list_extra_files(1, pattern='sub/**/*')}, {'sub/recurse'})
         self.assertEqual({ef.relpath for ef in cache.list_extra_files(1)}, {'exf', 'sub/recurse'})
-        for part_size in (1 << 30, 100, 1):
+        for part_size, num_threads in ((1 << 30, 4), (100, 1), (100, 4), (1, 4)):
             with TemporaryDirectory('export_lib') as tdir, TemporaryDirectory('import_lib') as idir:
                 exporter = Exporter(tdir, part_size=part_size)
-                cache.export_library('l', exporter)
+                cache.export_library('l', exporter, num_threads=num_threads)
                 exporter.commit()
+                self.assertFalse(os.path.exists(exporter.journal_path))
                 importer = Importer(tdir)
-                ic = import_library('l', importer, idir)
+                ic = import_library('l', importer, idir, num_threads=num_threads)
+                self.assertFalse(os.path.exists(os.path.join(idir, ImportJournal.NAME)))
                 self.assertEqual(cache.all_book_ids(), ic.all_book_ids())
                 for book_id in cache.all_book_ids():
                     self.assertEqual(cache.cover(book_id), ic.cover(book_id), 'Covers not identical for book: %d' % book_id)
@@ -269,6 +275,43 @@ def test_export_import(self):
                 bookdir = os.path.dirname(ic.format_abspath(1, '__COVER_INTERNAL__'))
                 self.assertEqual('exf', read(os.path.join(bookdir, 'exf')))
                 self.assertEqual('recurse', read(os.path.join(bookdir, 'sub', 'recurse')))
+        # Resume interrupted exports and imports
+        with TemporaryDirectory('export_lib') as tdir, TemporaryDirectory('import_lib') as idir:
+            exporter = Exporter(tdir, part_size=100)
+            cache.export_library('l', exporter)
+            exporter.journal.close()
+            del exporter
+            self.assertTrue(export_can_be_resumed(tdir))
+            exporter = Exporter(tdir, part_size=100, resume=True)
+            self.assertTrue(exporter.file_metadata)
+            cache.export_library('l', exporter)
+            exporter.commit()
+            self.assertFalse(export_can_be_resumed(tdir))
+            parts = sorted(os.listdir(tdir))
+            self.assertRaises(ValueError, Exporter, tdir, resume=True)
+            self.assertEqual(parts, sorted(os.listdir(tdir)))
+            importer = Importer(tdir)
+            abort = Event()
+            abort.set()
+            self.assertIsNone(import_library('l', importer, idir, abort=abort))
+            self.assertTrue(import_can_be_resumed(idir))
+            with ImportJournal(idir, resume=True) as j:
+                self.assertNotIn('databases', j)
+            ic = import_library('l', importer, idir)
+            j = ImportJournal(idir)
+            j.add('databases'), j.add(1)
+            j.f.write('2')
+            j.close()
+            j = ImportJournal(idir, resume=True)
+            self.assertIn('databases', j), self.assertIn(1, j), self.assertNotIn(2, j)
+            j.remove()
+            ic.close()
+            ic = import_library('l', importer, idir, resume=True)
+            for book_id in cache.all_book_ids():
+                self.assertEqual(cache.cover(book_id), ic.cover(book_id))
+                for fmt in cache.formats(book_id):
+                    self.assertEqual(cache.format(book_id, fmt), ic.format(book_id, fmt))
+            self.assertFalse(importer.corrupted_files)
         r1 = cache.add_notes_resource(b'res1', 'res.jpg', mtime=time.time()-113)
         r2 = cache.add_notes_resource(b'res2', 'res.jpg', mtime=time.time()-1115)
         cache.set_notes_for('authors', 2, 'some notes', resource_hashes=(r1, r2))
@@ -295,6 +338,68 @@ def test_export_import(self):
             self.assertEqual(a, b)
             self.assertLess(abs(at-bt), 2)
 
+    def test_cli_export(self):
+        from types import SimpleNamespace
+
+        from calibre.db.cli.main import get_parser, module_for_cmd
+        cache = self.init_cache()
+        m = module_for_cmd('export')
+        dbctx = SimpleNamespace(is_remote=False, run=lambda name, *args: module_for_cmd(name).implementation(cache, None, *args))
+        # Books with the same title and authors must not overwrite each other
+        cache.set_field('title', {1: 'Same', 2: 'Same', 3: 'Other'})
+        cache.set_field('authors', {1: ('A',), 2: ('A',), 3: ('A',)})
+        bookdir = os.path.dirname(cache.format_abspath(1, '__COVER_INTERNAL__'))
+        os.mkdir(os.path.join(bookdir, 'data'))
+        with open(os.path.join(bookdir, 'data', 'exf'), 'w') as f:
+            f.write('exf')
+        names = {1: 'Same', 2: 'Same (1)', 3: 'Other'}
+        for io_threads in (2, 4):
+            with TemporaryDirectory('export_cli') as tdir:
+                opts, args = m.option_parser(get_parser, ()).parse_args([
+                    '--all', '--to-dir', tdir, '--template', '{title}', '--dont-update-metadata',
+                    '--io-threads', str(io_threads)])
+                self.assertEqual(m.main(opts, args, dbctx), 0)
+                files = set(os.listdir(tdir))
+                for book_id, name in names.items():
+                    base = os.path.join(tdir, name)
+                    self.assertIn(name + '.opf', files)
+                    for fmt in cache.formats(book_id):
+                        self.assertEqual(read(f'{base}.{fmt.lower()}', 'rb'), cache.format(book_id, fmt))
+                    cdata = cache.cover(book_id)
+                    if cdata:
+                        self.assertEqual(read(base + '.jpg', 'rb'), cdata)
+                    else:
+                        self.assertNotIn(name + '.jpg', files)
+                self.assertEqual('exf', read(os.path.join(tdir, 'data', 'exf')))
+
+        # Metadata embedded in the exported files by worker processes
+        from contextlib import redirect_stderr
+        from io import StringIO
+
+        from calibre.ebooks.metadata.book.base import Metadata
+        from calibre.ebooks.metadata.meta import get_metadata
+        from calibre.ebooks.oeb.polish.create import create_book
+        for book_id in (1, 2):
+            path = os.path.join(self.library_path, 'book%d.epub' % book_id)
+            create_book(Metadata('Old title', ['Old author']), path)
+            with open(path, 'rb') as f:
+                cache.add_format(book_id, 'EPUB', f)
+        cache.add_format(3, 'EPUB', BytesIO(b'not an epub'))
+        with TemporaryDirectory('export_cli') as tdir:
+            opts, args = m.option_parser(get_parser, ()).parse_args([
+                '--all', '--to-dir', tdir, '--template', '{title}', '--formats', 'epub',
+                '--io-threads', '2', '--metadata-workers', '2'])
+            stderr = StringIO()
+            with redirect_stderr(stderr):
+                self.assertEqual(m.main(opts, args, dbctx), 0)
+            for book_id in (1, 2):
+                raw = read(os.path.join(tdir, names[book_id] + '.epub'), 'rb')
+                self.assertNotEqual(raw, cache.format(book_id, 'EPUB'))
+                mi = get_metadata(BytesIO(raw), 'epub')
+                self.assertEqual((mi.title, mi.authors), ('Same', ['A']))
+            self.assertEqual(get_metadata(BytesIO(cache.format(1, 'EPUB')), 'epub').title, 'Old title')
+            self.assertIn('Failed to set metadata for the epub format of Other', stderr.getvalue())
+
     def test_find_books_in_directory(self):
         from calibre.db.adding import find_books_in_directory, compile_rule
         def strip(files):
@@ -60,7 +60,7 @@ def wait_for_fts_to_finish(self, fts, timeout=10):
                 fts.pool.supervisor_thread.join(0.01)
 
     def text_records(self, fts):
-        return fts.get_connection().get_dict('SELECT * FROM fts_db.books_text')
+        return fts.get_connection().get_dict('SELECT * FROM fts_db.books_text_view')
 
     def make_txtz(self, txt, **extra):
         buf = BytesIO()
@@ -88,6 +88,8 @@ def check(**kw):
             q(tr[0], **kw)
 
         check(id=1, book=1, format='TXT', searchable_text='a test text')
+        # check the text is stored compressed
+        self.ae(fts.get_connection().get('SELECT typeof(searchable_text) FROM fts_db.books_text_store', all=False), 'blob')
         # check re-adding does not rescan
         cache.add_format(1, 'TXT', BytesIO(b'a test text'))
         self.wait_for_fts_to_finish(fts)
@@ -158,6 +160,42 @@ def test_fts_search(self):
         self.ae({x['id'] for x in cache.fts_search('help')}, {2})
         cache.close()
 
+    def test_fts_sharded_search(self):
+        import apsw
+        cache = self.new_library()
+        fts = cache.enable_fts()
+        self.wait_for_fts_to_finish(fts)
+        for book_id, word in ((1, 'one'), (2, 'two'), (3, 'three')):
+            cache.add_format(book_id, 'TXT', BytesIO(f'some common text in book {word}'.encode()))
+        self.wait_for_fts_to_finish(fts)
+
+        def search(query, **kw):
+            return {(x['book_id'], x['text']) for x in cache.fts_search(query, highlight_start='[', highlight_end=']', **kw)}
+
+        fts.NUM_SEARCH_SHARDS = 1
+        expected = search('common')
+        self.ae(len(expected), 3)
+        self.assertIsNone(fts.search_shards(fts.get_connection(), None))
+        fts.NUM_SEARCH_SHARDS, fts.MIN_ROWS_TO_SHARD = 3, 2
+        self.ae(len(fts.search_shards(fts.get_connection(), None)), 3)
+        self.assertIsNone(fts.search_shards(fts.get_connection(), (1,)))
+        self.ae(search('common'), expected)
+        self.ae(search('two'), {(2, 'some common text in book [two]')})
+        self.ae({x[0] for x in search('common', restrict_to_book_ids=(1, 3))}, {1, 3})
+        # The connections used for the ranges are released once the search
+        # is done and cannot write to the database
+        conns = list(fts.read_connections)
+        self.assertTrue(conns)
+        for conn in conns:
+            self.assertRaises(apsw.ReadOnlyError, conn.execute, 'DELETE FROM fts_db.dirtied_formats')
+        fts = cache.reindex_fts()
+        for conn in conns:
+            self.assertRaises(apsw.ConnectionClosedError, conn.execute, 'SELECT 1')
+        self.wait_for_fts_to_finish(fts)
+        fts.NUM_SEARCH_SHARDS, fts.MIN_ROWS_TO_SHARD = 3, 2
+        self.ae(search('common'), expected)
+        cache.close()
+
     def test_fts_triggers(self):
         cache = self.init_cache()
         # the cache fts jobs will clear dirtied flag so disable it
@@ -192,6 +230,53 @@ def test_fts_triggers(self):
         cache.reindex_fts_book(2)
         self.ae(fts.all_currently_dirty(), [(2, 'ADDED')])
 
+    def test_fts_upgrade(self):
+        from calibre.db.backend import Connection
+        from calibre.utils.resources import get_path as P
+        dbpath = os.path.join(self.library_path, 'full-text-search.db')
+
+        def old_calibre():
+            # A connection like the ones used by older versions of calibre,
+            # which cannot decompress the stored text
+            conn = Connection(os.path.join(self.library_path, 'metadata.db'))
+            conn.execute('ATTACH DATABASE ? AS fts_db', (dbpath,))
+            return conn
+
+        def add_text_with_old_calibre(book_id, text):
+            conn = old_calibre()
+            conn.execute(
+                'INSERT OR REPLACE INTO fts_db.books_text (book, timestamp, format, format_hash, format_size, searchable_text, text_size) VALUES'
+                " (?, 0, 'FMT1', '', 0, ?, ?)", (book_id, text, len(text)))
+            ans = conn.get('SELECT books_text.book FROM books_text JOIN books_fts ON books_text.id = books_fts.rowid WHERE books_fts MATCH ?', (
+                text.split()[0],))
+            conn.close()
+            return ans
+
+        def open_library():
+            cache = self.init_cache()
+            cache.queue_next_fts_job = lambda *a: None
+            fts = cache.enable_fts(start_pool=False)
+            conn = fts.get_connection()
+            self.ae(conn.get('PRAGMA fts_db.user_version', all=False), 2)
+            self.ae(conn.get('SELECT COUNT(*) FROM fts_db.books_text', all=False), 0)
+            return cache, conn
+
+        conn = old_calibre()
+        conn.execute(P('fts_sqlite.sql', data=True, allow_user_override=False).decode('utf-8'))
+        conn.close()
+        self.ae(add_text_with_old_calibre(1, 'some old text'), [(1,)])
+        cache, conn = open_library()
+        self.ae(conn.get('SELECT book, typeof(searchable_text) FROM fts_db.books_text_store'), [(1, 'blob')])
+        self.ae([(x['book_id'], x['text']) for x in cache.fts_search('old', highlight_start='[', highlight_end=']')], [(1, 'some [old] text')])
+        cache.close()
+
+        # The upgraded database can still be used by older versions
+        self.ae(add_text_with_old_calibre(2, 'newer text'), [(2,)])
+        cache, conn = open_library()
+        self.ae(conn.get('SELECT book, typeof(searchable_text) FROM fts_db.books_text_store ORDER BY book'), [(1, 'blob'), (2, 'blob')])
+        self.ae({x['book_id'] for x in cache.fts_search('text')}, {1, 2})
+        cache.close()
+
     def test_fts_to_text(self):
         from calibre.ebooks.oeb.polish.parsing import parse
         html = '''
@@ -193,6 +193,37 @@ def ids_for_search(x, restrict_to_fields=()):
     self.ae(ids_for_search(' AND '.join(an.split()), ('authors',)), {('authors', authors[0])})
 
 
+def test_resource_store(self: 'NotesTest'):
+    cache, notes = self.create_notes_db()
+    with tempfile.TemporaryDirectory() as tdir:
+        items = []
+        for i in range(20):
+            path = os.path.join(tdir, f'r{i}.jpg')
+            with open(path, 'wb') as f:
+                f.write(f'resource{i % 10}'.encode())
+            items.append((path, f'r{i % 10}.jpg'))
+        hashes = notes.add_resources(cache.backend.conn, items, link=True)
+        self.ae(hashes, [cache.add_notes_resource(f'resource{i % 10}'.encode(), f'r{i % 10}.jpg') for i in range(20)])
+        for i, h in enumerate(hashes[:10]):
+            self.ae(cache.get_notes_resource(h)['data'], f'resource{i}'.encode())
+            self.ae(cache.get_notes_resource(h)['name'], f'r{i}.jpg')
+    self.ae(cache.verify_notes_resources(), ([], None))
+    bad = sorted(hashes[:10])[3]
+    with open(notes.path_for_resource(bad), 'wb') as f:
+        f.write(b'bad')
+    found, after = [], ''
+    while after is not None:
+        b, after = cache.verify_notes_resources(after, limit=3)
+        found.extend(b)
+    self.ae(found, [bad])
+    # A corrupted resource is replaced, not modified in place, when it is added again
+    os.link(notes.path_for_resource(bad), os.path.join(notes.notes_dir, 'link'))
+    cache.add_notes_resource(f'resource{hashes.index(bad)}'.encode(), 'x.jpg')
+    self.ae(cache.verify_notes_resources(), ([], None))
+    with open(os.path.join(notes.notes_dir, 'link'), 'rb') as f:
+        self.ae(f.read(), b'bad')
+
+
 class NotesTest(BaseTest):
 
     ae = BaseTest.assertEqual
@@ -206,3 +237,4 @@ def test_notes(self):
         test_fts(self)
         test_cache_api(self)
         test_notes_api(self)
+        test_resource_store(self)
@@ -771,11 +771,80 @@ def test_composites(self):  # {{{
         self.assertEqual(cache.search('#ccf:FMT1'), {1, 2})
         cache.remove_formats({1:('FMT1',)})
         self.assertEqual('FMT2', cache.field_for('#ccf', 1))
+
+        # Test rendering many books at once
+        from calibre.utils.formatter import TemplateFormatter
+        tf = TemplateFormatter()
+        self.assertEqual(tf.referenced_fields('{title} - {#Tags:|[|]}'), {'title', '#tags'})
+        self.assertEqual(tf.referenced_fields(
+            'program: $title & field("authors") & $$#float & raw_field(field("x")) & uppercase($tags)'), {'title', 'authors', '#float', 'tags', 'x'})
+        self.assertEqual(tf.referenced_fields('program: unknown_function()'), set())
+        book_ids = cache.all_book_ids()
+        for field in ('#ccp', '#ccm', '#number', '#ccdate'):
+            f = cache.fields[field]
+            f.clear_caches()
+            expected = {book_id:cache.field_for(field, book_id) for book_id in book_ids}
+            f.clear_caches()
+            with cache.safe_read_lock:
+                f.render_for_books(book_ids, cache._get_proxy_metadata)
+            self.assertEqual(f._render_cache, expected)
+    # }}}
+
+    def test_persistent_composite_values(self):  # {{{
+        ' Test the on disk cache of composite column values '
+        cache = self.init_cache()
+        cache.create_custom_column('cct', 'CCT', 'composite', False, display={'composite_template': '{title} - {#tags}'})
+        cache.create_custom_column('ccu', 'CCU', 'composite', False, display={'composite_template': "{:'approximate_formats()'}"})
+        path = os.path.join(self.library_path, 'composite-values.sqlite')
+
+        def open_cache():
+            cache = self.init_cache()
+            cache.composite_values.path = path
+            return cache
+
+        cache = open_cache()
+        store = cache.composite_values
+        book_ids = cache.all_book_ids()
+        self.assertIsNone(store.dependencies(cache.fields['#ccu']))
+        from calibre.utils.formatter import TemplateFormatter
+        # eval() can use fields that are not referenced by the template itself
+        self.assertIsNone(TemplateFormatter().template_dependencies("program: eval(strcat('$', 'title'))"))
+        self.assertEqual(store.dependencies(cache.fields['#cct']), ('#tags', 'title'))
+        expected = cache.multisort([('#cct', True)])
+        values = {book_id:cache.field_for('#cct', book_id) for book_id in book_ids}
+        cache.close()
+
+        cache = open_cache()
+        f = cache.fields['#cct']
+        with cache.safe_read_lock:
+            stored, state = cache.composite_values.get(f, book_ids)
+        self.assertEqual(stored, values)
+        self.assertEqual(cache.multisort([('#cct', True)]), expected)
+        cache.set_field('title', {1: 'changed'})
+        # Deleting the stored values of changed books is deferred
+        self.assertIn(1, cache.composite_values.invalidated)
+        self.assertTrue(cache.field_for('#cct', 1).startswith('changed'))
+        store = cache.composite_values
+        cache.close()
+        self.assertFalse(store.invalidated)
+
+        # Changes made without going through this cache are detected
+        cache = self.init_cache()
+        cache.set_field('#tags', {2: 'x'})
+        cache.close()
+        cache = open_cache()
+        with cache.safe_read_lock:
+            stored, state = cache.composite_values.get(cache.fields['#cct'], book_ids)
+        self.assertNotIn(1, stored)
+        self.assertNotIn(2, stored)
+        self.assertTrue(cache.field_for('#cct', 2).endswith('- x'))
+        cache.close()
     # }}}
 
     def test_find_identical_books(self):  # {{{
         ' Test find_identical_books '
         from calibre.ebooks.metadata.book.base import Metadata
+        from calibre.db.format_hashes import hash_stream
         from calibre.db.utils import find_identical_books
         # 'find_identical_books': [(,), (Metadata('unknown'),), (Metadata('xxxx'),)],
         cache = self.init_cache(self.library_path)
@@ -793,6 +862,51 @@ def test_find_identical_books(self):  # {{{
         ):
             self.assertEqual(books, cache.find_identical_books(mi))
             self.assertEqual(books, find_identical_books(mi, data))
+
+        # The title index follows changes to the library
+        cache.set_field('title', {2: 'Changed title'})
+        self.assertEqual(set(), cache.find_identical_books(Metadata('title one', ['author one'])))
+        self.assertEqual({2}, cache.find_identical_books(Metadata('the changed Title', ['author one'])))
+        book_id = cache.create_book_entry(Metadata('Changed title', ['Author One', 'X']))
+        cache.update_data_for_find_identical_books(book_id, data)
+        for mi, books in (
+                (Metadata('changed title', ['author one']), {book_id}),
+                (Metadata('changed title', ['author one', 'x']), {book_id}),
+                (Metadata('changed title', ['author two']), set()),
+        ):
+            self.assertEqual(books, find_identical_books(mi, data))
+        self.assertEqual({2, book_id}, cache.find_identical_books(Metadata('changed title', ['author one'])))
+        self.assertEqual({book_id}, cache.find_identical_books(Metadata('changed title', ['author one']), book_ids=(1, book_id)))
+        cache.set_field('title', {book_id: 'Retitled'})
+        cache.update_data_for_find_identical_books(book_id, data)
+        self.assertEqual(set(), find_identical_books(Metadata('changed title', ['author one', 'x']), data))
+        self.assertEqual({book_id}, find_identical_books(Metadata('retitled', ['author one']), data))
+        cache.remove_books((book_id,))
+        self.assertEqual({2}, cache.find_identical_books(Metadata('changed title', ['author one'])))
+        mi = Metadata('changed title', ['author one'])
+        mi.authors = []
+        self.assertEqual(set(), cache.find_identical_books(mi))
+        self.assertEqual(set(), find_identical_books(mi, data))
+        cache.clear_caches(book_ids={2})
+        self.assertIn(2, cache.fuzzy_title_dirtied)
+        cache.reload_from_db()
+        self.assertIsNone(cache.fuzzy_title_index_cache)
+        self.assertEqual({2}, cache.find_identical_books(Metadata('changed title', ['author one'])))
+
+        # Byte identical files
+        raw = cache.format(1, 'FMT1')
+        self.assertEqual({1}, cache.find_books_with_identical_files([BytesIO(raw)]))
+        self.assertEqual({1}, cache.find_books_with_identical_file_hashes([(len(raw), hash_stream(BytesIO(raw))), (0, '')]))
+        self.assertIsNotNone(cache.format_hashes.get(1, 'FMT1', len(raw), cache.format_metadata(1, 'FMT1')['mtime'].timestamp()))
+        self.assertEqual(set(), cache.find_books_with_identical_files([BytesIO(raw + b'x'), BytesIO(raw[:-1] + b'x')]))
+        cache.add_format(2, 'FMTX', BytesIO(raw), run_hooks=False)
+        self.assertEqual({1, 2}, cache.find_books_with_identical_files([BytesIO(raw)]))
+        cache.add_format(1, 'FMT1', BytesIO(raw[:-1] + b'x'), run_hooks=False)
+        self.assertEqual({2}, cache.find_books_with_identical_files([BytesIO(raw)]))
+        cache.remove_formats({2: ('FMTX',)})
+        self.assertEqual(set(), cache.find_books_with_identical_files([BytesIO(raw)]))
+        cache.close()
+        self.assertIsNone(cache.format_hashes._conn)
     # }}}
 
     def test_last_read_positions(self):  # {{{
@@ -959,3 +1073,40 @@ def evaluate(book, ctx):
         unload_user_template_functions('aaaaa')
         self.assertEqual(set(v.split(',')), {'Tag One', 'News', 'Tag Two', 'one argument'})
     # }}}
+
+    def test_compiled_templates(self):  # {{{
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        from calibre.utils.formatter import _program_cache
+        formatter = SafeFormat()
+        db = self.init_legacy(self.library_path)
+        mi = db.get_metadata(1)
+
+        # Compiled programs are used when there is no break reporter, they
+        # must give the same results as the interpreter
+        for template in (
+            'program: if $series_index ==# 1 then "one" elif $title then "title" else "no" fi',
+            'program: for t in $tags: if t == "News" then break fi rof; t',
+            'program: switch($title, "^T", "m1", "zz", "m2", "none") & strcat("a", "b")',
+            'program: x = 2 * 3 + -1; y = x / 2; x & "," & y',
+            'program: first_non_empty("", $#float, "b") && !("" || "")',
+            'program: contains($title, "title", "c1", "c2")',
+            'program: def f(a): return a & "!" fed; f($$title)',
+            'program: uppercase($title) inlist "b," & uppercase($title)',
+            'program: 1 <# "a"',
+        ):
+            compiled = formatter.safe_format(template, {}, 'TEMPLATE ERROR', mi)
+            self.assertIn((template[len('program:'):], id(formatter.funcs)), _program_cache)
+            interpreted = formatter.safe_format(template, {}, 'TEMPLATE ERROR', mi, break_reporter=lambda *a: None)
+            self.assertEqual(compiled, interpreted, template)
+
+        # Cached programs are invalidated when the template functions change
+        from calibre.utils.formatter_functions import load_user_template_functions, unload_user_template_functions
+        template = 'program: my_func()'
+        self.assertIn('TEMPLATE ERROR', formatter.safe_format(template, {}, 'TEMPLATE ERROR', mi))
+        load_user_template_functions('aaaaa', [['my_func', '', 0, 'program: "called"']], None)
+        try:
+            self.assertEqual(formatter.safe_format(template, {}, 'TEMPLATE ERROR', mi), 'called')
+        finally:
+            unload_user_template_functions('aaaaa')
+        self.assertIn('TEMPLATE ERROR', formatter.safe_format(template, {}, 'TEMPLATE ERROR', mi))
+    # }}}
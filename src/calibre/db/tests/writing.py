@@ -5,6 +5,7 @@
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import json
 import os
 from collections import namedtuple
 from functools import partial
@@ -411,6 +412,11 @@ def read_all_extra_files(book_id=1):
         doc += f'2 <img src="{RESOURCE_URL_SCHEME}://{h2.replace(":", "/",1)}">'
         cache.set_notes_for('authors', authors[1], doc, resource_hashes=(h1,h2))
         notes_before = {cache.get_item_name('authors', aid): cache.export_note('authors', aid) for aid in authors}
+        # Keep a link to a resource metadata file of the old library, to
+        # check that it is not shared with the restored library
+        from calibre.db.notes.connect import METADATA_EXT
+        shared_metadata = os.path.join(self.library_path, 'r1.metadata')
+        os.link(cache.backend.notes.path_for_resource(h1) + METADATA_EXT, shared_metadata)
         cache.close()
         from calibre.db.restore import Restore
         restorer = Restore(cl)
@@ -425,6 +431,10 @@ def read_all_extra_files(book_id=1):
         authors = sorted(cache.all_field_ids('authors'))
         notes_after = {cache.get_item_name('authors', aid): cache.export_note('authors', aid) for aid in authors}
         ae(notes_before, notes_after)
+        cache.add_notes_resource(b'resource1', 'renamed.jpg')
+        ae(cache.get_notes_resource(h1)['name'], 'renamed.jpg')
+        with open(shared_metadata) as f:
+            ae(json.loads(f.read()), {'name': 'r1.jpg'})
     # }}}
 
     def test_set_cover(self):  # {{{
@@ -707,6 +717,45 @@ def test_invalidate():
         test_invalidate()
     # }}}
 
+    def test_device_match_index(self):  # {{{
+        ' Test that the device match index is incrementally updated on writes '
+        cache = self.init_cache()
+        idx = cache.device_match_index()
+
+        def test_invalidate():
+            self.assertIs(idx, cache.device_match_index())
+            self.assertEqual(idx.entries, self.init_cache().device_match_index().entries)
+
+        self.assertEqual(idx.book_for_uuid(cache.field_for('uuid', 2)), 2)
+        self.assertEqual(idx.match_title('title one!')['authors'], {'authorone': {2}})
+        cache.set_field('title', {1:'Title One', 3:'yy'})
+        test_invalidate()
+        self.assertEqual(idx.match_title('Title One')['db_ids'], {1, 2})
+        self.assertIsNone(idx.match_title('Unknown'))
+        cache.set_field('uuid', {1:'xxx'})
+        test_invalidate()
+        self.assertEqual(idx.book_for_uuid('xxx'), 1)
+        cache.rename_items('authors', {cache.get_item_id('authors', 'Author One'):'meow'})
+        test_invalidate()
+        cache.set_sort_for_authors({cache.get_item_id('authors', 'meow'):'woof'})
+        test_invalidate()
+        cache.remove_books((2,))
+        test_invalidate()
+        self.assertEqual(idx.match_title('Title One')['db_ids'], {1})
+        cache.create_book_entry(Metadata('Title One', ['Author One']))
+        test_invalidate()
+        self.assertEqual(len(idx.match_title('Title One')['db_ids']), 2)
+
+        # Changes made by other processes
+        cache.backend.execute('UPDATE books SET title="External" WHERE id=1')
+        cache.reload_from_db()
+        idx = cache.device_match_index()
+        self.assertEqual(idx.match_title('External')['db_ids'], {1})
+        self.assertEqual(len(idx.match_title('Title One')['db_ids']), 1)
+        self.assertIsNot(idx, cache.device_match_index(reset=True))
+        self.assertEqual(cache.device_match_index().entries, idx.entries)
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         ' Test roundtripping the db through SQL '
         import warnings
@@ -898,6 +947,50 @@ def map_as_list(amap):
         amap = cache.annotations_map_for_book(1, 'moo')
         self.assertEqual([x[0] for x in annot_list], map_as_list(amap))
 
+        # Test incremental merging
+        ids = {x['annotation']['seq']: x['id'] for x in cache.all_annotations()}
+        stale = dict(annot_list[1][0], notes='stale', timestamp=EPOCH.isoformat())
+        new = a(type='highlight', highlighted_text='text4', uuid='4', seq=4)[0]
+        last_read = a(type='last-read', pos='/2', pos_type='epubcfi', seq=5)[0]
+        self.assertTrue(cache.merge_annotations_for_book(1, 'moo', [stale, new, last_read]))
+        self.assertEqual([x[0] for x in annot_list] + [new], map_as_list(cache.annotations_map_for_book(1, 'moo')))
+        self.assertFalse(cache.merge_annotations_for_book(1, 'moo', [stale, new]))
+        updated = a(type='highlight', highlighted_text='text2', uuid='2', seq=3, notes='updated notes')[0]
+        self.assertTrue(cache.merge_annotations_for_book(1, 'moo', [updated]))
+        self.assertEqual([annot_list[0][0], updated, new], map_as_list(cache.annotations_map_for_book(1, 'moo')))
+        self.assertEqual(ids[3], {x['annotation']['seq']: x['id'] for x in cache.all_annotations()}[3])
+        self.assertEqual([ids[3]], [x['id'] for x in cache.search_annotations('"updated"')])
+
+        # Test paging
+        cache.set_annotations_for_book(2, 'moo', [
+            a(type='highlight', highlighted_text=f'text {i}', uuid=f'b2-{i}', seq=i) for i in range(23)])
+
+        def pages(func, *args, **kw):
+            ans, after = [], None
+            while True:
+                page, after = func(*args, after=after, page_size=5, **kw)
+                self.assertLessEqual(len(page), 5)
+                ans.extend(x['id'] for x in page)
+                if after is None:
+                    return ans
+
+        self.assertEqual([x['id'] for x in cache.all_annotations()], pages(cache.annotations_page))
+        self.assertEqual(
+            [x['id'] for x in cache.all_annotations(restrict_to_book_ids={2})], pages(cache.annotations_page, restrict_to_book_ids={2}))
+        self.assertEqual(23, len(pages(cache.annotations_page, restrict_to_book_ids={2})))
+        self.assertEqual([x['id'] for x in cache.search_annotations('"text"')], pages(cache.search_annotations_page, '"text"'))
+        self.assertEqual(23, len(pages(cache.search_annotations_page, '"text"')))
+        self.assertFalse(pages(cache.search_annotations_page, '"text"', restrict_to_book_ids={1}))
+
+        # Test ignoring removed annotations
+        cache.set_annotations_for_book(3, 'moo', [
+            a(type='highlight', highlighted_text='kept', uuid='b3-1', seq=1),
+            a(type='highlight', highlighted_text='not removed', uuid='b3-2', seq=2, removed=False),
+            a(type='highlight', uuid='b3-3', seq=3, removed=True),
+        ])
+        self.assertEqual(3, len(cache.all_annotations(restrict_to_book_ids={3})))
+        self.assertEqual([1, 2], sorted(x['annotation']['seq'] for x in cache.all_annotations(restrict_to_book_ids={3}, ignore_removed=True)))
+
     # }}}
 
     def test_changed_events(self):  # {{{
@@ -1034,3 +1127,31 @@ def test_link_maps(self):
 
 
     # }}}
+
+    def test_embed_metadata(self):  # {{{
+        from calibre.ebooks.metadata.meta import get_metadata
+        from calibre.ebooks.oeb.polish.create import create_book
+        cache = self.init_cache()
+        for book_id in (1, 2, 3):
+            path = os.path.join(self.library_path, 'book%d.epub' % book_id)
+            create_book(Metadata('Old title', ['Old author']), path)
+            with open(path, 'rb') as f:
+                cache.add_format(book_id, 'EPUB', f)
+        cache.set_field('title', {1: 'New one', 2: 'New two', 3: 'New three'})
+        progress, errors = [], []
+        # Update the files in parallel in worker processes
+        cache.embed_metadata((1, 2, 3), only_fmts={'epub'}, max_workers=2,
+                             report_error=lambda *a: errors.append(a), report_progress=lambda i, total, mi: progress.append(mi.id))
+        self.assertFalse(errors)
+        # Books without covers are skipped, but still reported
+        self.assertEqual(sorted(progress), [1, 2, 3])
+        for book_id in (1, 2, 3):
+            path = cache.format_abspath(book_id, 'EPUB')
+            with open(path, 'rb') as f:
+                mi = get_metadata(f, 'epub')
+            self.assertEqual(mi.title, 'Old title' if book_id == 3 else cache.field_for('title', book_id))
+            self.assertEqual(cache.format_metadata(book_id, 'EPUB')['size'], os.path.getsize(path))
+            self.assertEqual(cache.field_for('size', book_id), max(cache.format_metadata(book_id, fmt)['size'] for fmt in cache.formats(book_id)))
+        # Files in other formats are not changed
+        self.assertEqual(cache.format(1, 'FMT1'), b'book1fmt1')
+    # }}}
@@ -69,26 +69,19 @@ def fuzzy_title(title):
 
 
 def find_identical_books(mi, data):
-    author_map, aid_map, title_map, lang_map = data
-    found_books = None
+    author_map, aid_map, title_map, lang_map, fuzzy_title_map = data
+    if not mi.authors:
+        return set()
+    # Start with the books that have the same title, usually very few
+    found_books = set(fuzzy_title_map.get(fuzzy_title(mi.title or ''), ()))
     for a in mi.authors:
+        if not found_books:
+            return set()
         author_ids = author_map.get(icu_lower(str(a)))
         if author_ids is None:
             return set()
-        books_by_author = {book_id for aid in author_ids for book_id in aid_map.get(aid, ())}
-        if found_books is None:
-            found_books = books_by_author
-        else:
-            found_books &= books_by_author
-        if not found_books:
-            return set()
-
-    ans = set()
-    titleq = fuzzy_title(mi.title)
-    for book_id in found_books:
-        title = title_map.get(book_id, '')
-        if fuzzy_title(title) == titleq:
-            ans.add(book_id)
+        found_books = {book_id for book_id in found_books if any(book_id in aid_map.get(aid, ()) for aid in author_ids)}
+    ans = found_books
 
     langq = tuple(filter(lambda x: x and x != 'und', map(canonicalize_lang, mi.languages or ())))
     if not langq:
@@ -101,6 +94,154 @@ def lang_matches(book_id):
     return {book_id for book_id in ans if lang_matches(book_id)}
 
 
+class DeviceMatchIndex:
+
+    '''
+    An index of the title, authors, author sort and uuid of every book in the
+    library, used to match books on a device to books in the library. It is
+    maintained incrementally by :meth:`calibre.db.cache.Cache.device_match_index`.
+    '''
+
+    clean_pat = re.compile(r'(?u)\W|[_]')
+
+    @classmethod
+    def clean_string(cls, x):
+        try:
+            x = x.lower() if x else ''
+        except Exception:
+            x = ''
+        return cls.clean_pat.sub('', x)
+
+    def __init__(self):
+        self.entries = {}
+        self.title_map = {}
+        self.uuid_map = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, book_id, title, authors, author_sort, uuid):
+        self.remove(book_id)
+        title, authors, author_sort = map(self.clean_string, (title, authors, author_sort))
+        self.entries[book_id] = title, authors, author_sort, uuid
+        d = self.title_map.get(title)
+        if d is None:
+            d = self.title_map[title] = {'authors': {}, 'author_sort': {}, 'db_ids': set()}
+        d['db_ids'].add(book_id)
+        if authors:
+            d['authors'].setdefault(authors, set()).add(book_id)
+        if author_sort:
+            d['author_sort'].setdefault(author_sort, set()).add(book_id)
+        if uuid:
+            self.uuid_map[uuid] = book_id
+
+    def remove(self, book_id):
+        e = self.entries.pop(book_id, None)
+        if e is None:
+            return
+        title, authors, author_sort, uuid = e
+        if uuid and self.uuid_map.get(uuid) == book_id:
+            del self.uuid_map[uuid]
+        d = self.title_map[title]
+        d['db_ids'].discard(book_id)
+        for key, val in (('authors', authors), ('author_sort', author_sort)):
+            ids = d[key].get(val)
+            if ids is not None:
+                ids.discard(book_id)
+                if not ids:
+                    del d[key][val]
+        if not d['db_ids']:
+            del self.title_map[title]
+
+    def book_for_uuid(self, uuid):
+        return self.uuid_map.get(uuid)
+
+    def match_title(self, title):
+        '''
+        Return None if no book in the library has the specified title, otherwise
+        a dict with the keys ``db_ids``, the set of book ids with that title, and
+        ``authors`` and ``author_sort``, mapping cleaned authors strings to the
+        set of book ids with that title and those authors.
+        '''
+        return self.title_map.get(self.clean_string(title))
+
+
+class FuzzyTitleIndex:
+
+    '''
+    An index of the fuzzy titles of the books in the library, used to find
+    duplicates of books that are being added. It is maintained incrementally
+    by :meth:`calibre.db.cache.Cache.fuzzy_title_index`.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+        self.title_map = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, book_id, title):
+        self.remove(book_id)
+        title = self.entries[book_id] = fuzzy_title(title or '')
+        self.title_map.setdefault(title, set()).add(book_id)
+
+    def remove(self, book_id):
+        title = self.entries.pop(book_id, None)
+        if title is None:
+            return
+        ids = self.title_map[title]
+        ids.discard(book_id)
+        if not ids:
+            del self.title_map[title]
+
+    def books_with_title(self, title):
+        ' The ids of the books whose fuzzy title is the same as that of title '
+        return frozenset(self.title_map.get(fuzzy_title(title or ''), ()))
+
+    def copy_of_map(self):
+        return {title: set(ids) for title, ids in self.title_map.items()}
+
+
+def embed_metadata_in_files(data, common_data=None):
+    # This is called from a worker process by Cache.embed_metadata(). It must
+    # not open the database or change any files in the library. Each format
+    # file is copied to a temporary file and the metadata is updated in the
+    # copy. Returns a map of format to new file size and a list of errors.
+    from io import BytesIO
+
+    from calibre.customize.ui import apply_null_metadata
+    from calibre.ebooks.metadata.meta import set_metadata
+    from calibre.ebooks.metadata.opf2 import OPF, pretty_print
+    from calibre.utils.date import parse_date
+    mi = OPF(BytesIO(data['opf']), try_to_guess_cover=False, populate_spine=False).to_book_metadata()
+    with suppress(Exception):
+        mi.last_modified = parse_date(data['last_modified'])
+    mi.cover, mi.cover_data = None, (None, None)
+    if data.get('cover'):
+        with open(data['cover'], 'rb') as f:
+            cdata = f.read()
+        if cdata:
+            mi.cover_data = ('jpeg', cdata)
+    sizes, errors = {}, []
+
+    def report_error(mi, fmt, tb):
+        errors.append((fmt, tb))
+
+    for fmt, path, tpath in data['fmts']:
+        try:
+            shutil.copyfile(path, tpath)
+            with open(tpath, 'r+b') as stream:
+                with apply_null_metadata, pretty_print:
+                    set_metadata(stream, mi, stream_type=fmt, report_error=report_error)
+                stream.seek(0, os.SEEK_END)
+                sizes[fmt] = stream.tell()
+        except Exception:
+            import traceback
+            errors.append((fmt, traceback.format_exc()))
+    return sizes, errors
+
+
 Entry = namedtuple('Entry', 'path size timestamp thumbnail_size')
 
 
@@ -90,6 +90,7 @@ def option_parser():
             ' be asked for the export folder and the libraries to export. You can also specify them'
             ' as command line arguments to skip the questions.'
             ' Use absolute paths for the export folder and libraries.'
+            ' If the export folder contains an interrupted export, it is resumed.'
             ' The special keyword "all" can be used to export all libraries. Examples:\n\n'
             '  calibre-debug --export-all-calibre-data  # for interactive use\n'
             '  calibre-debug --export-all-calibre-data /path/to/empty/export/folder /path/to/library/folder1 /path/to/library2\n'
@@ -16,7 +16,7 @@
 import threading
 import time
 import traceback
-from collections import defaultdict
+from collections import defaultdict, deque
 from errno import EAGAIN, EINTR
 from functools import wraps
 from threading import Thread
@@ -693,8 +693,10 @@ def _receive_from_client(self, print_debug_info=True):
             raise
         raise ControlError(desc='Device responded with incorrect information')
 
-    # Write a file to the device as a series of binary strings.
-    def _put_file(self, infile, lpath, book_metadata, this_book, total_books):
+    # Write a file to the device as a series of binary strings. If pipelined
+    # is True, the device acknowledges the book only after receiving all of
+    # it, and the acknowledgement must be read with _receive_book_ack()
+    def _put_file(self, infile, lpath, book_metadata, this_book, total_books, pipelined=False):
         close_ = False
         if not hasattr(infile, 'read'):
             infile, close_ = open(infile, 'rb'), True
@@ -703,16 +705,18 @@ def _put_file(self, infile, lpath, book_metadata, this_book, total_books):
         book_metadata.size = length
         infile.seek(0)
 
+        wants_ok = self.can_send_ok_to_sendbook and not pipelined
         opcode, result = self._call_client('SEND_BOOK', {'lpath': lpath, 'length': length,
                                'metadata': book_metadata, 'thisBook': this_book,
                                'totalBooks': total_books,
                                'willStreamBooks': True,
                                'willStreamBinary' : True,
-                               'wantsSendOkToSendbook' : self.can_send_ok_to_sendbook,
+                               'wantsSendOkToSendbook' : wants_ok,
+                               'wantsBookAcknowledgement': pipelined,
                                'canSupportLpathChanges': True},
                           print_debug_info=False,
-                          wait_for_response=self.can_send_ok_to_sendbook)
-        if self.can_send_ok_to_sendbook:
+                          wait_for_response=wants_ok)
+        if wants_ok:
             if opcode == 'ERROR':
                 raise UserFeedback(msg='Sending book %s to device failed' % lpath,
                                    details=result.get('message', ''),
@@ -720,7 +724,8 @@ def _put_file(self, infile, lpath, book_metadata, this_book, total_books):
                 return
             lpath = result.get('lpath', lpath)
             book_metadata.lpath = lpath
-        self._set_known_metadata(book_metadata)
+        if not pipelined:
+            self._set_known_metadata(book_metadata)
         pos = 0
         failed = False
         with infile:
@@ -736,6 +741,19 @@ def _put_file(self, infile, lpath, book_metadata, this_book, total_books):
             infile.close()
         return (-1, None) if failed else (length, lpath)
 
+    def _receive_book_ack(self, book_metadata, lpath):
+        # Read the acknowledgement for a book sent with pipelined=True. The
+        # device acknowledges books in the order they were sent.
+        opcode, result = self._receive_from_client(print_debug_info=False)
+        if opcode == 'ERROR':
+            raise UserFeedback(msg='Sending book %s to device failed' % lpath,
+                               details=result.get('message', ''),
+                               level=UserFeedback.ERROR)
+        lpath = result.get('lpath', lpath)
+        book_metadata.lpath = lpath
+        self._set_known_metadata(book_metadata)
+        return lpath
+
     def _metadata_in_cache(self, uuid, ext_or_lpath, lastmod):
         from calibre.utils.date import now, parse_date
         try:
@@ -1062,7 +1080,8 @@ def open(self, connected_device, library_uuid):
                     'lastModifiedFormat': tweaks['gui_last_modified_display_format'],
                     'calibre_version': numeric_version,
                     'canSupportUpdateBooks': True,
-                    'canSupportLpathChanges': True})
+                    'canSupportLpathChanges': True,
+                    'canSupportPipelinedBooks': True})
             if opcode != 'OK':
                 # Something wrong with the return. Close the socket
                 # and continue.
@@ -1106,6 +1125,10 @@ def open(self, connected_device, library_uuid):
             self._debug('Cache uses lpaths', self.client_cache_uses_lpaths)
             self.can_send_ok_to_sendbook = result.get('canSendOkToSendbook', False)
             self._debug('Can send OK to sendbook', self.can_send_ok_to_sendbook)
+            # Clients that acknowledge each book after receiving it, instead of
+            # before, allow several books to be in flight at once
+            self.max_books_in_flight = max(1, result.get('maxBooksInFlight', 1))
+            self._debug('Max books in flight', self.max_books_in_flight)
             self.can_accept_library_info = result.get('canAcceptLibraryInfo', False)
             self._debug('Can accept library info', self.can_accept_library_info)
             self.will_ask_for_update_books = result.get('willAskForUpdateBooks', False)
@@ -1486,6 +1509,14 @@ def upload_books(self, files, names, on_card=None, end_session=True,
         paths = []
         names = iter(names)
         metadata = iter(metadata)
+        # Books sent but not yet acknowledged by the device, when pipelining
+        in_flight = deque()
+        pipelined = self.max_books_in_flight > 1
+
+        def receive_ack():
+            book, lpath, length = in_flight.popleft()
+            paths.append((self._receive_book_ack(book, lpath), length))
+            self.report_progress(len(paths) / float(len(files)), _('Transferring books to device...'))
 
         for i, infile in enumerate(files):
             mdata, fname = next(metadata), next(names)
@@ -1494,13 +1525,20 @@ def upload_books(self, files, names, on_card=None, end_session=True,
             if not hasattr(infile, 'read'):
                 infile = USBMS.normalize_path(infile)
             book = SDBook(self.PREFIX, lpath, other=mdata)
-            length, lpath = self._put_file(infile, lpath, book, i, len(files))
+            length, lpath = self._put_file(infile, lpath, book, i, len(files), pipelined=pipelined)
             if length < 0:
                 raise ControlError(desc='Sending book %s to device failed' % lpath)
-            paths.append((lpath, length))
             # No need to deal with covers. The client will get the thumbnails
             # in the mi structure
-            self.report_progress((i + 1) / float(len(files)), _('Transferring books to device...'))
+            if pipelined:
+                in_flight.append((book, lpath, length))
+                while len(in_flight) >= self.max_books_in_flight:
+                    receive_ack()
+            else:
+                paths.append((lpath, length))
+                self.report_progress((i + 1) / float(len(files)), _('Transferring books to device...'))
+        while in_flight:
+            receive_ack()
 
         self.report_progress(1.0, _('Transferring books to device...'))
         self._debug('finished uploading %d books' % (len(files)))
@@ -1877,6 +1915,7 @@ def _startup_on_demand(self):
             self.debug_time = time.time()
             self.debug_start_time = time.time()
             self.max_book_packet_len = 0
+            self.max_books_in_flight = 1
             self.noop_counter = 0
             self.connection_attempts = {}
             self.client_wants_uuid_file_names = False
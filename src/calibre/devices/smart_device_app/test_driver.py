@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2024, Kovid Goyal <kovid at kovidgoyal.net>
+
+
+import json
+import socket
+import unittest
+from collections import defaultdict
+from io import BytesIO
+from threading import Thread
+from types import SimpleNamespace
+
+from calibre.devices.smart_device_app.driver import SMART_DEVICE_APP
+from calibre.ebooks.metadata.book.base import Metadata
+from calibre.ebooks.metadata.book.json_codec import JsonCodec
+
+
+class FakeClient(Thread):
+
+    ''' A minimal wireless device app, that receives books over one end of a
+    socket pair and acknowledges them in the way the client advertised. '''
+
+    def __init__(self, sock, pipelined, renamed=None):
+        Thread.__init__(self, name='FakeSmartDeviceClient', daemon=True)
+        self.sock, self.pipelined = sock, pipelined
+        self.renamed = renamed or {}
+        self.books = {}
+        self.max_pending_acks = 0
+        self.buf = b''
+        self.error = None
+
+    def read(self, n):
+        while len(self.buf) < n:
+            x = self.sock.recv(1 << 16)
+            if not x:
+                raise EOFError('Connection closed')
+            self.buf += x
+        ans, self.buf = self.buf[:n], self.buf[n:]
+        return ans
+
+    def read_message(self):
+        prefix = b''
+        while True:
+            c = self.read(1)
+            if c == b'[':
+                break
+            prefix += c
+        return json.loads(b'[' + self.read(int(prefix) - 1))
+
+    def send(self, opcode, payload):
+        s = json.dumps([SMART_DEVICE_APP.opcodes[opcode], payload]).encode('utf-8')
+        self.sock.sendall(b'%d' % len(s) + s)
+
+    def run(self):
+        try:
+            self.receive_books()
+        except Exception as e:
+            self.error = e
+
+    def receive_books(self):
+        pending_acks = []
+        while True:
+            opcode, args = self.read_message()
+            self.assertions(opcode, args)
+            lpath = self.renamed.get(args['lpath'], args['lpath'])
+            if args['wantsSendOkToSendbook']:
+                self.send('OK', {'lpath': lpath})
+            self.books[lpath] = self.read(args['length'])
+            if args['wantsBookAcknowledgement']:
+                pending_acks.append(lpath)
+                self.max_pending_acks = max(self.max_pending_acks, len(pending_acks))
+                # Acknowledge books in batches, as a real client reading ahead would
+                if len(pending_acks) >= 3 or args['thisBook'] == args['totalBooks'] - 1:
+                    for lpath in pending_acks:
+                        self.send('OK', {'lpath': lpath})
+                    del pending_acks[:]
+            if args['thisBook'] == args['totalBooks'] - 1:
+                break
+
+    def assertions(self, opcode, args):
+        if opcode != SMART_DEVICE_APP.opcodes['SEND_BOOK']:
+            raise ValueError(f'Unexpected opcode: {opcode}')
+        if args['wantsBookAcknowledgement'] != self.pipelined:
+            raise ValueError('Book acknowledgement requested for non-pipelined client')
+        if self.pipelined and args['wantsSendOkToSendbook']:
+            raise ValueError('OK to sendbook requested from pipelined client')
+
+
+class TestUploadBooks(unittest.TestCase):
+
+    def setUp(self):
+        self.device_socket, self.client_socket = socket.socketpair()
+        for s in (self.device_socket, self.client_socket):
+            s.settimeout(10)
+
+    def tearDown(self):
+        self.device_socket.close()
+        self.client_socket.close()
+
+    def create_driver(self, max_books_in_flight):
+        d = SMART_DEVICE_APP(None)
+        ec = [False] * 20
+        ec[d.OPT_IGNORE_FREESPACE] = True
+        opts = SimpleNamespace(extra_customization=ec, use_subdirs=False, save_template='{title}')
+        d.settings = lambda: opts
+        d.save_template = lambda: opts.save_template
+        d.report_progress = lambda *a: None
+        d._debug = lambda *a: None
+        d.device_socket = self.device_socket
+        d.json_codec = JsonCodec()
+        d.known_metadata = {}
+        d.device_book_cache = defaultdict(dict)
+        d.max_book_packet_len = 4096
+        d.max_books_in_flight = max_books_in_flight
+        d.noop_counter = 0
+        d.can_send_ok_to_sendbook = True
+        d.client_cache_uses_lpaths = True
+        d.client_wants_uuid_file_names = False
+        d.exts_path_lengths = {}
+        return d
+
+    def upload(self, max_books_in_flight, num_books=7):
+        pipelined = max_books_in_flight > 1
+        d = self.create_driver(max_books_in_flight)
+        client = FakeClient(self.client_socket, pipelined, renamed={'book 1.epub': 'renamed 1.epub'})
+        client.start()
+        files, names, metadata = [], [], []
+        for i in range(num_books):
+            # Larger than a packet, so that books span several packets
+            files.append(BytesIO(b'%d' % i * (5000 + i)))
+            names.append(f'book {i}.epub')
+            metadata.append(Metadata(f'book {i}', ['Author']))
+        paths = d.upload_books(files, names, metadata=metadata)
+        client.join(10)
+        self.assertFalse(client.is_alive())
+        self.assertIsNone(client.error)
+        expected = [(f'book {i}.epub', 5000 + i) for i in range(num_books)]
+        expected[1] = ('renamed 1.epub', 5001)
+        self.assertEqual(paths, expected)
+        for i, (lpath, length) in enumerate(expected):
+            self.assertEqual(client.books[lpath], b'%d' % i * length)
+            self.assertEqual(d.known_metadata[lpath].title, f'book {i}')
+            self.assertEqual(d.known_metadata[lpath].lpath, lpath)
+        self.assertNotIn('book 1.epub', d.known_metadata)
+        return client
+
+    def test_upload_books_pipelined(self):
+        client = self.upload(3)
+        self.assertEqual(client.max_pending_acks, 3)
+
+    def test_upload_books_unpipelined(self):
+        client = self.upload(1)
+        self.assertEqual(client.max_pending_acks, 0)
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestUploadBooks)
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(find_tests())
@@ -10,6 +10,7 @@
 
 import os, time, json, shutil
 from itertools import cycle
+from threading import Thread
 
 from calibre.constants import numeric_version, ismacos
 from calibre import prints, isbytestring, fsync
@@ -19,6 +20,7 @@
 from calibre.devices.usbms.books import BookList, Book
 from calibre.ebooks.metadata.book.json_codec import JsonCodec
 from polyglot.builtins import itervalues, string_or_bytes
+from polyglot.queue import Empty, Queue
 
 
 def debug_print(*args, **kw):
@@ -97,6 +99,10 @@ class USBMS(CLI, Device):
 
     SCAN_FROM_ROOT = False
 
+    # The maximum number of threads used to read metadata from book files
+    # that are not present in the metadata cache
+    METADATA_READ_THREADS = 4
+
     def _update_driveinfo_record(self, dinfo, prefix, location_code, name=None):
         from calibre.utils.date import now, isoformat
         import uuid
@@ -236,6 +242,7 @@ def books(self, oncard=None, end_session=True):
             bl_cache[b.lpath] = idx
 
         all_formats = self.formats_to_scan_for()
+        new_lpaths, seen_new_lpaths = [], set()
 
         def update_booklist(filename, path, prefix):
             changed = False
@@ -254,10 +261,11 @@ def update_booklist(filename, path, prefix):
                         if self.update_metadata_item(bl[idx]):
                             # print 'update_metadata_item returned true'
                             changed = True
-                    else:
-                        if bl.add_book(self.book_from_path(prefix, lpath),
-                                              replace_metadata=False):
-                            changed = True
+                    elif lpath not in seen_new_lpaths:
+                        # Metadata for new books is read in parallel once the
+                        # scan of the filesystem is complete
+                        seen_new_lpaths.add(lpath)
+                        new_lpaths.append(lpath)
                 except:  # Probably a filename encoding error
                     import traceback
                     traceback.print_exc()
@@ -297,6 +305,15 @@ def update_booklist(filename, path, prefix):
                     if changed:
                         need_sync = True
 
+        if new_lpaths:
+            debug_print('USBMS: reading metadata for %d books not in the cache' % len(new_lpaths))
+            for i, book in enumerate(self.books_from_paths(prefix, new_lpaths)):
+                self.report_progress((i+1) / float(len(new_lpaths)), _('Reading metadata from books on device...'))
+                # The new books are known not to be in the booklist already, so
+                # skip the linear duplicates check in add_book()
+                if book is not None and bl.add_book_extended(book, replace_metadata=False, check_for_duplicates=False):
+                    need_sync = True
+
         # Remove books that are no longer in the filesystem. Cache contains
         # indices into the booklist if book not in filesystem, None otherwise
         # Do the operation in reverse order so indices remain valid
@@ -319,6 +336,49 @@ def update_booklist(filename, path, prefix):
         debug_print('USBMS: Finished fetching list of books from device. oncard=', oncard)
         return bl
 
+    def books_from_paths(self, prefix, lpaths):
+        '''
+        Create book objects for the files at lpaths, reading their metadata
+        using up to :attr:`METADATA_READ_THREADS` threads. The books are
+        yielded in the same order as lpaths, with None for any file that
+        could not be read.
+        '''
+        def safe_book_from_path(lpath):
+            try:
+                return self.book_from_path(prefix, lpath)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+        num_threads = min(len(lpaths), self.METADATA_READ_THREADS)
+        if num_threads < 2:
+            for lpath in lpaths:
+                yield safe_book_from_path(lpath)
+            return
+
+        jobs, results = Queue(), Queue()
+        for i, lpath in enumerate(lpaths):
+            jobs.put((i, lpath))
+
+        def run():
+            while True:
+                try:
+                    i, lpath = jobs.get_nowait()
+                except Empty:
+                    break
+                results.put((i, safe_book_from_path(lpath)))
+
+        for i in range(num_threads):
+            Thread(target=run, name='USBMSReadMetadata-%d' % i, daemon=True).start()
+        # Yield results in order, buffering any that arrive early
+        pending, next_idx = {}, 0
+        while next_idx < len(lpaths):
+            i, book = results.get()
+            pending[i] = book
+            while next_idx in pending:
+                yield pending.pop(next_idx)
+                next_idx += 1
+
     def upload_books(self, files, names, on_card=None, end_session=True,
                      metadata=None):
         debug_print('USBMS: uploading %d books'%(len(files)))
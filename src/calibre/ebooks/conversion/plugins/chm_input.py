@@ -100,7 +100,7 @@ def do_node(parent, div):
 
     def _create_oebbook_html(self, htmlpath, basedir, opts, log, mi):
         # use HTMLInput plugin to generate book
-        from calibre.customize.builtins import HTMLInput
+        from calibre.ebooks.conversion.plugins.html_input import HTMLInput
         opts.breadth_first = True
         opts.max_levels = 30
         opts.correct_case_mismatches = True
@@ -211,6 +211,23 @@ class Source(Plugin):
     #: to this source.
     ignore_ssl_errors = False
 
+    #: If True, responses to GET requests made with :attr:`browser` are
+    #: stored in a persistent cache shared by all sources. Fresh responses
+    #: are served from the cache and stale ones are revalidated using their
+    #: ETag or Last-Modified headers. Set to False if the responses from this
+    #: source must never be reused.
+    cache_http_responses = True
+
+    #: The maximum average number of requests per second made to this source
+    #: with :attr:`browser` while downloading metadata for many books at once,
+    #: shared by all the books being processed. Downloading metadata for a
+    #: single book is not rate limited.
+    #: Up to :attr:`request_burst` requests can be made in quick succession
+    #: before the limit applies. The rate is reduced automatically while the
+    #: source responds with HTTP 429 or 503 errors. None means no limit.
+    requests_per_second = 2
+    request_burst = 5
+
     #: Cached cover URLs can sometimes be unreliable (i.e. the download could
     #: fail or the returned image could be bogus). If that is often the case
     #: with this source, set to False
@@ -243,6 +260,7 @@ def __init__(self, *args, **kwargs):
         self.cache_lock = threading.RLock()
         self._config_obj = None
         self._browser = None
+        self._rate_limiter = None
         self.prefs.defaults['ignore_fields'] = []
         for opt in self.options:
             self.prefs.defaults[opt.name] = opt.default
@@ -291,7 +309,17 @@ def browser(self):
             self._browser = browser(user_agent=self.user_agent, verify_ssl_certificates=not self.ignore_ssl_errors)
             if self.supports_gzip_transfer_encoding:
                 self._browser.set_handle_gzip(True)
-        return self._browser.clone_browser()
+        ans = self._browser.clone_browser()
+        if self.cache_http_responses and not self.running_a_test:
+            from calibre.ebooks.metadata.sources.http_cache import CachingHandler
+            ans.add_handler(CachingHandler())
+        if self.requests_per_second and not self.running_a_test:
+            from calibre.ebooks.metadata.sources.rate_limit import RateLimitHandler, TokenBucket
+            with self.cache_lock:
+                if self._rate_limiter is None:
+                    self._rate_limiter = TokenBucket(self.requests_per_second, self.request_burst)
+            ans.add_handler(RateLimitHandler(self._rate_limiter))
+        return ans
 
     # }}}
 
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2024, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A persistent, on disk, cache of HTTP responses shared by all metadata source
+plugins. Only responses that the server explicitly marks as cacheable, with
+Cache-Control max-age or Expires, are stored and responses that are private or
+set cookies are never stored. Fresh responses are served from the cache, stale
+responses are revalidated with conditional requests using their ETag or
+Last-Modified headers.
+'''
+
+import hashlib
+import os
+import re
+import time
+from email.utils import parsedate_to_datetime
+from functools import partial
+from threading import Lock
+
+from mechanize import BaseHandler
+
+from calibre.constants import cache_dir
+from calibre.utils.serialize import msgpack_dumps, msgpack_loads
+
+MAX_SIZE = 256 * 1024 * 1024
+max_age_pat = re.compile(r'max-age\s*=\s*(\d+)', re.I)
+
+
+def header_value(headers, name):
+    name = name.lower()
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return ''
+
+
+def request_header(request, name):
+    return request.get_header(name.capitalize(), '')
+
+
+def parse_http_date(val):
+    try:
+        return parsedate_to_datetime(val).timestamp()
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def freshness_lifetime(headers):
+    ''' Return the number of seconds the response is fresh for or None if the
+    server did not explicitly allow it to be stored in a shared cache '''
+    cc = header_value(headers, 'Cache-Control').lower()
+    directives = {x.partition('=')[0].strip() for x in cc.split(',')}
+    if directives & {'no-store', 'private'} or header_value(headers, 'Set-Cookie') or header_value(headers, 'Vary').strip() == '*':
+        return None
+    m = max_age_pat.search(cc)
+    if m is not None:
+        ttl = int(m.group(1))
+    else:
+        expires = header_value(headers, 'Expires')
+        if not expires:
+            return None
+        expires = parse_http_date(expires)
+        # An invalid Expires header means the response is already stale
+        date = parse_http_date(header_value(headers, 'Date')) or time.time()
+        ttl = 0 if expires is None else max(0, int(expires - date))
+    return 0 if 'no-cache' in directives else ttl
+
+
+def vary_headers(headers):
+    return sorted({x.strip().lower() for x in header_value(headers, 'Vary').split(',') if x.strip()})
+
+
+class ResponseCache:
+
+    def __init__(self, path=None, max_size=MAX_SIZE):
+        self.path = path or os.path.join(cache_dir(), 'metadata-sources-http')
+        self.max_size = max_size
+        self.lock = Lock()
+        self.hits = self.revalidated = self.misses = self.stores = 0
+        os.makedirs(self.path, exist_ok=True)
+        self.prune()
+
+    def path_for(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url, request_headers=None):
+        try:
+            with open(self.path_for(url), 'rb') as f:
+                entry = msgpack_loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        # The stored response can only be used for requests that have the
+        # same values for the request headers listed in its Vary header
+        vary = entry.get('vary') or {}
+        if vary and (request_headers is None or any(request_headers(k) != v for k, v in vary.items())):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored'] < entry['ttl']
+
+    def put(self, url, code, msg, headers, body, request_headers=None):
+        path = self.path_for(url)
+        ttl = freshness_lifetime(headers)
+        if ttl is None or (ttl == 0 and not (header_value(headers, 'ETag') or header_value(headers, 'Last-Modified'))):
+            # Not cacheable, remove any previously stored response so that it
+            # is not revalidated and served again
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+        vary = {}
+        if request_headers is not None:
+            vary = {k: request_headers(k) for k in vary_headers(headers)}
+        entry = {'url': url, 'code': code, 'msg': msg, 'headers': headers, 'body': body, 'stored': time.time(), 'ttl': ttl, 'vary': vary}
+        tpath = f'{path}.{os.getpid()}.{id(entry)}.tmp'
+        try:
+            with open(tpath, 'wb') as f:
+                f.write(msgpack_dumps(entry))
+            os.replace(tpath, path)
+        except OSError:
+            return
+        with self.lock:
+            self.stores += 1
+            prune = self.stores % 100 == 0
+        if prune:
+            self.prune()
+
+    def refresh(self, entry, headers):
+        # The server said the cached response is still valid, update the
+        # validators and freshness lifetime from the new headers
+        merged = {k.lower(): (k, v) for k, v in entry['headers']}
+        for k, v in headers:
+            if k.lower() in ('etag', 'last-modified', 'cache-control', 'expires', 'date'):
+                merged[k.lower()] = (k, v)
+        vary = entry.get('vary') or {}
+        self.put(entry['url'], entry['code'], entry['msg'], list(merged.values()), entry['body'], lambda k: vary.get(k, ''))
+
+    def prune(self):
+        # Remove the least recently stored responses once the cache grows
+        # larger than max_size
+        try:
+            items = []
+            for x in os.scandir(self.path):
+                st = x.stat()
+                items.append((st.st_mtime, st.st_size, x.path))
+        except OSError:
+            return
+        total = sum(x[1] for x in items)
+        if total <= self.max_size:
+            return
+        items.sort()
+        for mtime, size, path in items:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= 0.8 * self.max_size:
+                break
+
+    def record(self, which):
+        with self.lock:
+            setattr(self, which, getattr(self, which) + 1)
+
+    @property
+    def hit_rate(self):
+        with self.lock:
+            total = self.hits + self.revalidated + self.misses
+            return (self.hits + self.revalidated) / total if total else 0
+
+    def stats_summary(self):
+        with self.lock:
+            hits, revalidated, misses = self.hits, self.revalidated, self.misses
+        return 'HTTP cache: {} hits, {} revalidated, {} misses ({:.0%} hit rate)'.format(
+            hits, revalidated, misses, self.hit_rate)
+
+
+_response_cache, _response_cache_lock = None, Lock()
+
+
+def response_cache():
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
+
+
+def make_cached_response(entry):
+    from mechanize._response import make_response
+    headers = entry['headers']
+    body = entry['body']
+    if header_value(headers, 'Content-Encoding').lower() in ('gzip', 'x-gzip') and not body.startswith(b'\x1f\x8b'):
+        # The body was stored after it was decompressed
+        headers = [(k, v) for k, v in headers if k.lower() not in ('content-encoding', 'content-length')]
+    return make_response(body, headers, entry['url'], entry['code'], entry['msg'])
+
+
+class CachingHandler(BaseHandler):
+
+    # Run after the other processors have seen the response, but before
+    # HTTPErrorProcessor turns 304 responses into errors
+    handler_order = 900
+
+    def __init__(self, cache=None):
+        self.cache = cache or response_cache()
+
+    def is_cacheable(self, request):
+        # Responses to requests with credentials or cookies may be specific to
+        # a user, so they are never cached
+        return request.get_method() == 'GET' and not request.has_header('Authorization') and not request.has_header('Cookie')
+
+    def default_open(self, request):
+        if not self.is_cacheable(request):
+            return None
+        entry = getattr(request, 'calibre_cache_entry', None)
+        if entry is not None and self.cache.is_fresh(entry):
+            request.calibre_cache_hit = True
+            self.cache.record('hits')
+            return make_cached_response(entry)
+
+    def http_request(self, request):
+        if self.is_cacheable(request):
+            entry = self.cache.get(request.get_full_url(), partial(request_header, request))
+            request.calibre_cache_entry = entry
+            if entry is not None and not self.cache.is_fresh(entry):
+                etag = header_value(entry['headers'], 'ETag')
+                lm = header_value(entry['headers'], 'Last-Modified')
+                if etag:
+                    request.add_unredirected_header('If-None-Match', etag)
+                if lm:
+                    request.add_unredirected_header('If-Modified-Since', lm)
+        return request
+
+    def http_response(self, request, response):
+        if not self.is_cacheable(request) or getattr(request, 'calibre_cache_hit', False):
+            return response
+        entry = getattr(request, 'calibre_cache_entry', None)
+        headers = list(response.info().items())
+        if response.code == 304 and entry is not None:
+            self.cache.record('revalidated')
+            self.cache.refresh(entry, headers)
+            return make_cached_response(entry)
+        self.cache.record('misses')
+        if response.code != 200:
+            return response
+        from mechanize._response import make_response
+        body = response.read()
+        self.cache.put(request.get_full_url(), response.code, response.msg, headers, body, partial(request_header, request))
+        return make_response(body, headers, response.geturl(), response.code, response.msg)
+
+    https_request = http_request
+    https_response = http_response
+
+
+def find_tests():
+    import shutil
+    import tempfile
+    import unittest
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from threading import Thread
+
+    from mechanize import Request
+
+    headers_for_path = {
+        '/a': {'Cache-Control': 'public, max-age=3600'},
+        '/b': {'Cache-Control': 'max-age=0', 'ETag': '"v1"'},
+        '/expires': {'Expires': 'Thu, 01 Jan 2099 00:00:00 GMT'},
+        '/expired': {'Expires': '0'},
+        '/vary': {'Cache-Control': 'max-age=3600', 'Vary': 'Accept-Language'},
+        '/default': {'ETag': '"v2"'},
+        '/nostore': {'Cache-Control': 'no-store, max-age=3600'},
+        '/private': {'Cache-Control': 'private, max-age=3600'},
+        '/cookie': {'Cache-Control': 'max-age=3600', 'Set-Cookie': 'x=1'},
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+
+        requests = []
+
+        def do_GET(self):
+            self.requests.append(self.path)
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = ('response for ' + self.path).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in headers_for_path[self.path].items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *a):
+            pass
+
+    class TestResponseCache(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+            self.server = HTTPServer(('localhost', 0), Handler)
+            Thread(target=self.server.serve_forever, daemon=True).start()
+            self.base = 'http://localhost:%d' % self.server.server_address[1]
+            del Handler.requests[:]
+
+        def tearDown(self):
+            self.server.shutdown()
+            self.server.server_close()
+            shutil.rmtree(self.tdir)
+
+        def test_response_cache(self):
+            from calibre import browser
+            cache = ResponseCache(self.tdir)
+            br = browser()
+            br.add_handler(CachingHandler(cache))
+
+            def get(path, **headers):
+                return br.open_novisit(Request(self.base + path, headers=headers)).read()
+
+            def ae(path, num_of_requests, **headers):
+                del Handler.requests[:]
+                self.assertEqual(get(path, **headers), b'response for ' + path.encode('ascii'))
+                self.assertEqual(get(path, **headers), b'response for ' + path.encode('ascii'))
+                self.assertEqual(Handler.requests, [path] * num_of_requests, path)
+
+            ae('/a', 1)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            ae('/b', 2)
+            self.assertEqual(cache.revalidated, 1)
+            ae('/expires', 1)
+            ae('/expired', 2)
+            ae('/vary', 1, **{'Accept-Language': 'en'})
+            del Handler.requests[:]
+            get('/vary', **{'Accept-Language': 'fr'})
+            self.assertEqual(Handler.requests, ['/vary'])
+            # Responses without explicit freshness information, private
+            # responses and responses that set cookies are not stored
+            for path in ('/default', '/nostore', '/private', '/cookie'):
+                ae(path, 2)
+            self.assertIn('hit rate', cache.stats_summary())
+            cache.max_size = 0
+            cache.prune()
+            self.assertFalse(os.listdir(self.tdir))
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestResponseCache)
+
+
+if __name__ == '__main__':
+    from calibre.utils.run_tests import run_tests
+    run_tests(find_tests)
@@ -494,6 +494,8 @@ def get_results():
 
     log('The identify phase took %.2f seconds'%(time.time() - start_time))
     log('The longest time (%f) was taken by:'%longest, lp)
+    from calibre.ebooks.metadata.sources.http_cache import response_cache
+    log(response_cache().stats_summary())
     log('Merging results from different sources')
     start_time = time.time()
     results = merge_identify_results(results, log)
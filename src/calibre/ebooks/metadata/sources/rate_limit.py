@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2024, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Per source rate limiting for the requests made by metadata source plugins,
+so that many books can be processed at once without overloading a source.
+'''
+
+import time
+from threading import Lock
+
+from mechanize import BaseHandler
+
+# Rate limits only apply while metadata is downloaded for many books at once,
+# see calibre.ebooks.metadata.sources.worker.main(). Downloading metadata for a
+# single book makes few requests, which must not be slowed down.
+rate_limits_enabled = False
+
+
+def enable_rate_limits(enabled=True):
+    global rate_limits_enabled
+    rate_limits_enabled = enabled
+
+
+class TokenBucket:
+
+    '''
+    Allow an average of rate events per second, with bursts of up to burst
+    events. The rate is reduced with :meth:`backoff` when the source is
+    overloaded and gradually restored with :meth:`recover`.
+    '''
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.clock, self.sleep = clock, sleep
+        self.last = clock()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def backoff(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class RateLimitHandler(BaseHandler):
+
+    # Run after CachingHandler so that responses served from the cache do not
+    # count against the limit
+    handler_order = 950
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def default_open(self, request):
+        if rate_limits_enabled:
+            self.bucket.acquire()
+        return None
+
+    def http_response(self, request, response):
+        if not rate_limits_enabled or getattr(request, 'calibre_cache_hit', False):
+            # Responses from the cache say nothing about the load on the source
+            return response
+        if response.code in (429, 503):
+            self.bucket.backoff()
+        else:
+            self.bucket.recover()
+        return response
+
+    https_response = http_response
+
+
+def find_tests():
+    import unittest
+
+    class TestTokenBucket(unittest.TestCase):
+
+        def test_token_bucket(self):
+            now = [0.]
+
+            def sleep(x):
+                now[0] += x
+
+            b = TokenBucket(2, burst=3, clock=lambda: now[0], sleep=sleep)
+            for i in range(3):
+                b.acquire()
+            self.assertEqual(now[0], 0)
+            b.acquire()
+            self.assertAlmostEqual(now[0], 0.5)
+            b.backoff()
+            self.assertEqual(b.rate, 1)
+            b.acquire()
+            self.assertAlmostEqual(now[0], 1.5)
+            for i in range(20):
+                b.recover()
+            self.assertEqual(b.rate, 2)
+            for i in range(10):
+                b.backoff()
+            self.assertEqual(b.rate, 2 / 16)
+
+        def test_rate_limit_handler(self):
+            from types import SimpleNamespace
+
+            class Bucket:
+
+                def __init__(self):
+                    self.calls = []
+
+                def __getattr__(self, name):
+                    return lambda: self.calls.append(name)
+
+            b = Bucket()
+            h = RateLimitHandler(b)
+
+            def request(hit=False):
+                rq = SimpleNamespace()
+                if hit:
+                    rq.calibre_cache_hit = True
+                return rq
+
+            ok, busy = SimpleNamespace(code=200), SimpleNamespace(code=429)
+            # Not rate limited unless enabled
+            h.default_open(request()), h.http_response(request(), busy)
+            self.assertEqual(b.calls, [])
+            enable_rate_limits()
+            try:
+                h.default_open(request()), h.http_response(request(), busy)
+                h.default_open(request()), h.http_response(request(), ok)
+                h.http_response(request(hit=True), ok)
+            finally:
+                enable_rate_limits(False)
+            self.assertEqual(b.calls, ['acquire', 'backoff', 'acquire', 'recover'])
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestTokenBucket)
+
+
+if __name__ == '__main__':
+    from calibre.utils.run_tests import run_tests
+    run_tests(find_tests)
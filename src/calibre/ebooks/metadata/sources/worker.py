@@ -13,6 +13,7 @@
 from calibre.ebooks.metadata.sources.base import dump_caches, load_caches
 from calibre.ebooks.metadata.sources.covers import download_cover, run_download
 from calibre.ebooks.metadata.sources.identify import identify, msprefs
+from calibre.ebooks.metadata.sources.rate_limit import enable_rate_limits
 from calibre.ebooks.metadata.sources.update import patch_plugins
 from calibre.utils.date import as_utc
 from calibre.utils.logging import GUILog
@@ -61,53 +62,91 @@ def wrapper(*a, **k):
     return wrapper
 
 
+# The number of books whose metadata is downloaded at the same time. The
+# load on each source is kept in check by its rate limit, see
+# Source.requests_per_second
+BOOKS_IN_FLIGHT = 4
+
+
+def download_one(book_id, opf, do_identify, covers, ensure_fields, tdir):
+    # Returns (metadata_failed, cover_failed, anything_succeeded)
+    failed = failed_cover = False
+    succeeded = False
+    log = GUILog()
+    mi = OPF(BytesIO(opf), basedir=tdir,
+            populate_spine=False).to_book_metadata()
+    title, authors, identifiers = mi.title, mi.authors, mi.identifiers
+    cdata = None
+
+    if do_identify:
+        results = []
+        try:
+            results = identify(log, Event(), title=title, authors=authors,
+                identifiers=identifiers)
+        except:
+            pass
+        if results:
+            succeeded = True
+            mi = merge_result(mi, results[0], ensure_fields=ensure_fields)
+            identifiers = mi.identifiers
+            if not mi.is_null('rating'):
+                # set_metadata expects a rating out of 10
+                mi.rating *= 2
+            with open(os.path.join(tdir, '%d.mi'%book_id), 'wb') as f:
+                f.write(metadata_to_opf(mi, default_lang='und'))
+        else:
+            log.error('Failed to download metadata for', title)
+            failed = True
+
+    if covers:
+        cdata = download_cover(log, title=title, authors=authors,
+                identifiers=identifiers)
+        if cdata is None:
+            failed_cover = True
+        else:
+            with open(os.path.join(tdir, '%d.cover'%book_id), 'wb') as f:
+                f.write(cdata[-1])
+            succeeded = True
+
+    with open(os.path.join(tdir, '%d.log'%book_id), 'wb') as f:
+        f.write(log.plain_text.encode('utf-8'))
+    return failed, failed_cover, succeeded
+
+
 @shutdown_webengine_workers
 def main(do_identify, covers, metadata, ensure_fields, tdir):
     failed_ids = set()
     failed_covers = set()
     all_failed = True
-    log = GUILog()
     patch_plugins()
+    enable_rate_limits()
+    jobs, results = Queue(), Queue()
+    for x in iteritems(metadata):
+        jobs.put(x)
 
-    for book_id, mi in iteritems(metadata):
-        mi = OPF(BytesIO(mi), basedir=tdir,
-                populate_spine=False).to_book_metadata()
-        title, authors, identifiers = mi.title, mi.authors, mi.identifiers
-        cdata = None
-        log.clear()
-
-        if do_identify:
-            results = []
+    def run():
+        while True:
+            try:
+                book_id, opf = jobs.get_nowait()
+            except Empty:
+                break
             try:
-                results = identify(log, Event(), title=title, authors=authors,
-                    identifiers=identifiers)
-            except:
-                pass
-            if results:
-                all_failed = False
-                mi = merge_result(mi, results[0], ensure_fields=ensure_fields)
-                identifiers = mi.identifiers
-                if not mi.is_null('rating'):
-                    # set_metadata expects a rating out of 10
-                    mi.rating *= 2
-                with open(os.path.join(tdir, '%d.mi'%book_id), 'wb') as f:
-                    f.write(metadata_to_opf(mi, default_lang='und'))
-            else:
-                log.error('Failed to download metadata for', title)
-                failed_ids.add(book_id)
-
-        if covers:
-            cdata = download_cover(log, title=title, authors=authors,
-                    identifiers=identifiers)
-            if cdata is None:
-                failed_covers.add(book_id)
-            else:
-                with open(os.path.join(tdir, '%d.cover'%book_id), 'wb') as f:
-                    f.write(cdata[-1])
-                all_failed = False
-
-        with open(os.path.join(tdir, '%d.log'%book_id), 'wb') as f:
-            f.write(log.plain_text.encode('utf-8'))
+                results.put((book_id, download_one(book_id, opf, do_identify, covers, ensure_fields, tdir)))
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                results.put((book_id, (do_identify, covers, False)))
+
+    for i in range(min(BOOKS_IN_FLIGHT, len(metadata))):
+        Thread(target=run, name='DownloadMetadata-%d' % i, daemon=True).start()
+    for i in range(len(metadata)):
+        book_id, (failed, failed_cover, succeeded) = results.get()
+        if failed:
+            failed_ids.add(book_id)
+        if failed_cover:
+            failed_covers.add(book_id)
+        if succeeded:
+            all_failed = False
 
     return failed_ids, failed_covers, all_failed
 
@@ -76,10 +76,25 @@ def has_book(mi, data_for_has_book):
     return mi.title and icu_lower(mi.title.strip()) in data_for_has_book
 
 
-def read_metadata(paths, group_id, tdir, common_data=None):
+def hash_files(paths):
+    from calibre.db.format_hashes import hash_stream
+    ans = []
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                ans.append((os.fstat(f.fileno()).st_size, hash_stream(f)))
+        except OSError:
+            continue
+    return ans
+
+
+def read_metadata(paths, group_id, tdir, find_identical_files=False, common_data=None):
     paths = run_import_plugins(paths, group_id, tdir)
     mi, opf, has_cover = serialize_metadata_for(paths, tdir, group_id)
     duplicate_info = None
     if isinstance(common_data, (set, frozenset)):
         duplicate_info = has_book(mi, common_data)
-    return paths, opf, has_cover, duplicate_info
+    # The files are hashed here rather than in the GUI, where reading large
+    # files would block the event loop
+    file_hashes = hash_files(paths) if find_identical_files else ()
+    return paths, opf, has_cover, duplicate_info, file_hashes
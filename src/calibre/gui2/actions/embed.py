@@ -5,14 +5,48 @@
 __copyright__ = '2014, Kovid Goyal <kovid at kovidgoyal.net>'
 
 from functools import partial
+from threading import Thread
+
 from qt.core import QProgressDialog, Qt, QTimer
 
 from calibre import force_unicode
-from calibre.gui2 import gprefs
+from calibre.gui2 import Aborted, error_dialog, gprefs
 from calibre.gui2.actions import InterfaceActionWithLibraryDrop
 from calibre.utils.localization import ngettext
 
 
+class Worker(Thread):
+
+    # Embed metadata into all the books with a single call, so that the
+    # database can update the files in parallel
+
+    def __init__(self, db, book_ids, only_fmts):
+        Thread.__init__(self, name='EmbedMetadata', daemon=True)
+        self.db, self.book_ids, self.only_fmts = db, book_ids, only_fmts
+        self.num_done = 0
+        self.errors = []
+        self.was_canceled = False
+        self.error = None
+
+    def report_progress(self, num_done, total, mi):
+        self.num_done = num_done
+        if self.was_canceled:
+            raise Aborted()
+
+    def report_error(self, mi, fmt, tb):
+        mi.book_id = mi.id
+        self.errors.append((mi, fmt, tb))
+
+    def run(self):
+        try:
+            self.db.embed_metadata(self.book_ids, only_fmts=self.only_fmts, report_error=self.report_error, report_progress=self.report_progress)
+        except Aborted:
+            pass
+        except Exception:
+            import traceback
+            self.error = traceback.format_exc()
+
+
 class EmbedAction(InterfaceActionWithLibraryDrop):
 
     name = 'Embed Metadata'
@@ -36,7 +70,8 @@ def genesis(self):
                 triggered=self.embed_selected_formats)
         self.qaction.setMenu(self.embed_menu)
         self.pd_timer = t = QTimer()
-        t.timeout.connect(self.do_one)
+        t.setInterval(100)
+        t.timeout.connect(self.check_progress)
 
     def embed(self):
         rb = self.gui.iactions['Remove Books']
@@ -60,54 +95,48 @@ def do_embed(self, book_ids, only_fmts=None):
         pd = QProgressDialog(_('Embedding updated metadata into book files...'), _('&Stop'), 0, len(book_ids), self.gui)
         pd.setWindowTitle(_('Embedding metadata...'))
         pd.setWindowModality(Qt.WindowModality.WindowModal)
-        errors = []
-        self.job_data = (0, tuple(book_ids), pd, only_fmts, errors)
+        worker = Worker(self.gui.current_db.new_api, tuple(book_ids), only_fmts)
+        self.job_data = (worker, pd)
+        worker.start()
         self.pd_timer.start()
 
-    def do_one(self):
+    def check_progress(self):
         try:
-            i, book_ids, pd, only_fmts, errors = self.job_data
+            worker, pd = self.job_data
         except (TypeError, AttributeError):
             return
-        if i >= len(book_ids) or pd.wasCanceled():
-            pd.setValue(pd.maximum())
-            pd.hide()
-            self.pd_timer.stop()
-            self.job_data = None
-            self.gui.library_view.model().refresh_ids(book_ids)
-            if i > 0:
-                self.gui.status_bar.show_message(ngettext(
-                    'Embedded metadata in one book', 'Embedded metadata in {} books', i).format(i), 5000)
-            if errors:
-                det_msg = '\n\n'.join([_('The {0} format of {1}:\n\n{2}\n').format(
-                    (fmt or '').upper(), force_unicode(mi.title), force_unicode(tb)) for mi, fmt, tb in errors])
-                from calibre.gui2.dialogs.message_box import MessageBox
-                title, msg = _('Failed for some files'), _(
-                    'Failed to embed metadata into some book files. Click "Show details" for details.')
-                d = MessageBox(MessageBox.WARNING, _('WARNING:')+ ' ' + title, msg, det_msg, parent=self.gui, show_copy_button=True)
-                tc = d.toggle_checkbox
-                tc.setVisible(True), tc.setText(_('Show the &failed books in the main book list'))
-                tc.setChecked(gprefs.get('show-embed-failed-books', False))
-                d.resize_needed.emit()
-                d.exec()
-                gprefs['show-embed-failed-books'] = tc.isChecked()
-                if tc.isChecked():
-                    failed_ids = {mi.book_id for mi, fmt, tb in errors}
-                    db = self.gui.current_db
-                    db.data.set_marked_ids(failed_ids)
-                    self.gui.search.set_search_string('marked:true')
+        if pd.wasCanceled():
+            worker.was_canceled = True
+        if worker.is_alive():
+            pd.setValue(worker.num_done)
             return
-        pd.setValue(i)
-        db = self.gui.current_db.new_api
-        book_id = book_ids[i]
-
-        def report_error(mi, fmt, tb):
-            mi.book_id = book_id
-            errors.append((mi, fmt, tb))
-        try:
-            db.embed_metadata((book_id,), only_fmts=only_fmts, report_error=report_error)
-        except Exception:
-            import traceback
-            mi = db.get_metadata(book_id)
-            report_error(mi, '', traceback.format_exc())
-        self.job_data = (i + 1, book_ids, pd, only_fmts, errors)
+        pd.setValue(pd.maximum())
+        pd.hide()
+        self.pd_timer.stop()
+        self.job_data = None
+        book_ids, errors, i = worker.book_ids, worker.errors, worker.num_done
+        self.gui.library_view.model().refresh_ids(book_ids)
+        if i > 0:
+            self.gui.status_bar.show_message(ngettext(
+                'Embedded metadata in one book', 'Embedded metadata in {} books', i).format(i), 5000)
+        if worker.error is not None:
+            error_dialog(self.gui, _('Failed to embed metadata'), _(
+                'Failed to embed metadata into book files. Click "Show details" for details.'), det_msg=worker.error, show=True)
+        if errors:
+            det_msg = '\n\n'.join([_('The {0} format of {1}:\n\n{2}\n').format(
+                (fmt or '').upper(), force_unicode(mi.title), force_unicode(tb)) for mi, fmt, tb in errors])
+            from calibre.gui2.dialogs.message_box import MessageBox
+            title, msg = _('Failed for some files'), _(
+                'Failed to embed metadata into some book files. Click "Show details" for details.')
+            d = MessageBox(MessageBox.WARNING, _('WARNING:')+ ' ' + title, msg, det_msg, parent=self.gui, show_copy_button=True)
+            tc = d.toggle_checkbox
+            tc.setVisible(True), tc.setText(_('Show the &failed books in the main book list'))
+            tc.setChecked(gprefs.get('show-embed-failed-books', False))
+            d.resize_needed.emit()
+            d.exec()
+            gprefs['show-embed-failed-books'] = tc.isChecked()
+            if tc.isChecked():
+                failed_ids = {mi.book_id for mi, fmt, tb in errors}
+                db = self.gui.current_db
+                db.data.set_marked_ids(failed_ids)
+                self.gui.search.set_search_string('marked:true')
@@ -297,7 +297,7 @@ def do_one_group(self):
             return
         try:
             self.pool(group_id, 'calibre.ebooks.metadata.worker', 'read_metadata',
-                      self.file_groups[group_id], group_id, self.tdir)
+                      self.file_groups[group_id], group_id, self.tdir, bool(self.db is not None and self.add_formats_to_existing))
         except Failure as err:
             error_dialog(self.pd, _('Cannot add books'), _(
             'Failed to add any books, click "Show details" for more information.'),
@@ -365,8 +365,9 @@ def process_result(self, group_id, result):
             paths = self.file_groups[group_id]
             has_cover = False
             duplicate_info = set() if self.add_formats_to_existing else False
+            file_hashes = ()
         else:
-            paths, opf, has_cover, duplicate_info = result.value
+            paths, opf, has_cover, duplicate_info, file_hashes = result.value
             try:
                 mi = OPF(BytesIO(opf), basedir=self.tdir, populate_spine=False, try_to_guess_cover=False).to_book_metadata()
                 mi.read_metadata_failed = False
@@ -402,7 +403,7 @@ def process_result(self, group_id, result):
             return
 
         if self.add_formats_to_existing:
-            identical_book_ids = find_identical_books(mi, self.find_identical_books_data)
+            identical_book_ids = find_identical_books(mi, self.find_identical_books_data) | self.db.find_books_with_identical_file_hashes(file_hashes)
             if identical_book_ids:
                 try:
                     self.merge_books(mi, cover_path, paths, identical_book_ids)
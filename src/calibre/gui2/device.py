@@ -5,7 +5,6 @@
 
 # Imports {{{
 import os
-import re
 import sys
 import time
 import traceback
@@ -1788,7 +1787,7 @@ def book_on_device(self, id, reset=False):
             return
 
         if not self.device_manager.is_device_connected or \
-                        not hasattr(self, 'db_book_uuid_cache'):
+                        not hasattr(self, 'device_match_index'):
             return loc
 
         if self.book_db_id_cache is None:
@@ -1844,15 +1843,6 @@ def set_books_in_library(self, booklists, reset=False, add_as_step_to_job=None,
         except:
             return False
 
-        string_pat = re.compile(r'(?u)\W|[_]')
-
-        def clean_string(x):
-            try:
-                x = x.lower() if x else ''
-            except Exception:
-                x = ''
-            return string_pat.sub('', x)
-
         update_metadata = (
            device_prefs['manage_device_metadata'] == 'on_connect' or force_send)
 
@@ -1863,31 +1853,12 @@ def clean_string(x):
                 get_covers = True
                 desired_thumbnail_height = self.device_manager.device.THUMBNAIL_HEIGHT
 
-        # Force a reset if the caches are not initialized
-        if reset or not hasattr(self, 'db_book_title_cache'):
-            # Build a cache (map) of the library, so the search isn't On**2
-            db_book_title_cache = {}
-            db_book_uuid_cache = {}
-
-            for id_ in db.data.iterallids():
-                title = clean_string(db.title(id_, index_is_id=True))
-                if title not in db_book_title_cache:
-                    db_book_title_cache[title] = \
-                                {'authors':{}, 'author_sort':{}, 'db_ids':{}}
-                # If there are multiple books in the library with the same title
-                # and author, then remember the last one. That is OK, because as
-                # we can't tell the difference between the books, one is as good
-                # as another.
-                authors = clean_string(db.authors(id_, index_is_id=True))
-                if authors:
-                    db_book_title_cache[title]['authors'][authors] = id_
-                if db.author_sort(id_, index_is_id=True):
-                    aus = clean_string(db.author_sort(id_, index_is_id=True))
-                    db_book_title_cache[title]['author_sort'][aus] = id_
-                db_book_title_cache[title]['db_ids'][id_] = id_
-                db_book_uuid_cache[db.uuid(id_, index_is_id=True)] = id_
-            self.db_book_title_cache = db_book_title_cache
-            self.db_book_uuid_cache = db_book_uuid_cache
+        # The index is maintained incrementally by the database, so getting it
+        # costs time proportional to the number of books changed since the
+        # last call, not to the size of the library. reset here only refers
+        # to the ondevice state of the books, the index is discarded by the
+        # database itself when the library is reloaded or its caches cleared.
+        self.device_match_index = match_index = db.new_api.device_match_index()
 
         book_ids_to_refresh = set()
         book_formats_to_send = []
@@ -1966,8 +1937,8 @@ def updateq(id_, book):
                             flags=QEventLoop.ProcessEventsFlag.ExcludeUserInputEvents|QEventLoop.ProcessEventsFlag.ExcludeSocketNotifiers)
                     current_book_count += 1
                     book.in_library = None
-                    if getattr(book, 'uuid', None) in self.db_book_uuid_cache:
-                        id_ = db_book_uuid_cache[book.uuid]
+                    id_ = match_index.book_for_uuid(getattr(book, 'uuid', None))
+                    if id_ is not None:
                         if updateq(id_, book):
                             update_book(id_, book)
                         book.in_library = 'UUID'
@@ -1975,8 +1946,7 @@ def updateq(id_, book):
                         book.application_id = id_
                         continue
                     # No UUID exact match. Try metadata matching.
-                    book_title = clean_string(book.title)
-                    d = self.db_book_title_cache.get(book_title, None)
+                    d = match_index.match_title(book.title)
                     if d is not None:
                         # At this point we know that the title matches. The book
                         # will match if any of the db_id, author, or author_sort
@@ -2002,14 +1972,17 @@ def updateq(id_, book):
                         if book.authors:
                             # Compare against both author and author sort, because
                             # either can appear as the author
-                            book_authors = clean_string(authors_to_string(book.authors))
+                            # If there are multiple books in the library with
+                            # the same title and author, use any one of them, as
+                            # we can't tell the difference between the books.
+                            book_authors = match_index.clean_string(authors_to_string(book.authors))
                             if book_authors in d['authors']:
-                                id_ = d['authors'][book_authors]
+                                id_ = max(d['authors'][book_authors])
                                 update_book(id_, book)
                                 book.in_library = 'AUTHOR'
                                 book.application_id = id_
                             elif book_authors in d['author_sort']:
-                                id_ = d['author_sort'][book_authors]
+                                id_ = max(d['author_sort'][book_authors])
                                 update_book(id_, book)
                                 book.in_library = 'AUTH_SORT'
                                 book.application_id = id_
@@ -18,7 +18,9 @@
 from calibre.gui2 import choose_dir, error_dialog, question_dialog
 from calibre.gui2.widgets2 import Dialog
 from calibre.startup import connect_lambda
-from calibre.utils.exim import Importer, all_known_libraries, export, import_data
+from calibre.utils.exim import (
+    Importer, all_known_libraries, export, export_can_be_resumed, import_can_be_resumed, import_data,
+)
 from calibre.utils.icu import numeric_sort_key
 
 
@@ -297,6 +299,7 @@ def validate_import(self):
             return False
         else:
             blanks = []
+            self.import_resume = False
             for w in self.imported_lib_widgets:
                 newloc = w.path
                 if not newloc:
@@ -311,8 +314,14 @@ def validate_import(self):
                     error_dialog(self, _('Not a folder'), _('%s is not a folder')%newloc, show=True)
                     return False
                 if os.listdir(newloc):
-                    error_dialog(self, _('Folder not empty'), _('%s is not an empty folder')%newloc, show=True)
-                    return False
+                    if not import_can_be_resumed(newloc):
+                        error_dialog(self, _('Folder not empty'), _('%s is not an empty folder')%newloc, show=True)
+                        return False
+                    if not self.import_resume:
+                        if not question_dialog(self, _('Resume import?'), _(
+                            'The folder {} contains an interrupted import. Do you want to resume it?').format(newloc)):
+                            return False
+                        self.import_resume = True
             if blanks:
                 if len(blanks) == len(self.imported_lib_widgets):
                     error_dialog(self, _('No libraries selected'), _(
@@ -344,7 +353,13 @@ def validate_export(self):
         path = choose_dir(self, 'export-calibre-dir', _('Choose a folder to export to'))
         if not path:
             return False
-        if os.listdir(path):
+        self.export_resume = False
+        if export_can_be_resumed(path):
+            if not question_dialog(self, _('Resume export?'), _(
+                'The folder {} contains an interrupted export. Do you want to resume it?').format(path)):
+                return False
+            self.export_resume = True
+        elif os.listdir(path):
             error_dialog(self, _('Export folder not empty'), _(
                 'The folder you choose to export the data to must be empty.'), show=True)
             return False
@@ -360,7 +375,8 @@ def run_export_action(self):
             db = gui.current_db
             dbmap[db.library_path] = db.new_api
         return RunAction(_('Exporting all calibre data...'), _(
-            'Failed to export data.'), partial(export, self.export_dir, library_paths=library_paths, dbmap=dbmap),
+            'Failed to export data.'), partial(
+                export, self.export_dir, library_paths=library_paths, dbmap=dbmap, resume=self.export_resume),
                       parent=self).exec() == QDialog.DialogCode.Accepted
 
     def run_import_action(self):
@@ -369,7 +385,7 @@ def run_import_action(self):
             if w.path:
                 library_path_map[w.lpath] = w.path
         return RunAction(_('Importing all calibre data...'), _(
-            'Failed to import data.'), partial(import_data, self.importer, library_path_map), parent=self).exec() == QDialog.DialogCode.Accepted
+            'Failed to import data.'), partial(import_data, self.importer, library_path_map, resume=self.import_resume), parent=self).exec() == QDialog.DialogCode.Accepted
 
     def accept(self):
         if not self.validate():
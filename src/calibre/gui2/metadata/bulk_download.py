@@ -217,7 +217,9 @@ def run(self):
 
 def download(all_ids, tf, db, do_identify, covers, ensure_fields,
         log=None, abort=None, notifications=None):
-    batch_size = 10
+    # Each worker process downloads several books at a time, see
+    # BOOKS_IN_FLIGHT in the worker module
+    batch_size = 40
     batches = split_jobs(all_ids, batch_size=batch_size)
     tdir = PersistentTemporaryDirectory('_metadata_bulk')
     heartbeat = HeartBeat(tdir)
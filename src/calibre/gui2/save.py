@@ -22,7 +22,8 @@
 from calibre.gui2 import error_dialog, gprefs, open_local_file, warning_dialog
 from calibre.gui2.dialogs.progress import ProgressDialog
 from calibre.library.save_to_disk import (
-    find_plugboard, get_path_components, plugboard_save_to_disk_value, sanitize_args,
+    ensure_unique_components, find_plugboard, get_path_components,
+    plugboard_save_to_disk_value, sanitize_args,
 )
 from calibre.ptempfile import PersistentTemporaryDirectory, SpooledTemporaryFile
 from calibre.utils.filenames import make_long_path_useable
@@ -33,22 +34,6 @@
 BookId = namedtuple('BookId', 'title authors')
 
 
-def ensure_unique_components(data):  # {{{
-    cmap = defaultdict(set)
-    bid_map = {}
-    for book_id, (mi, components, fmts) in iteritems(data):
-        cmap[tuple(components)].add(book_id)
-        bid_map[book_id] = components
-
-    for book_ids in itervalues(cmap):
-        if len(book_ids) > 1:
-            for i, book_id in enumerate(sorted(book_ids)[1:]):
-                suffix = ' (%d)' % (i + 1)
-                components = bid_map[book_id]
-                components[-1] = components[-1] + suffix
-# }}}
-
-
 class SpooledFile(SpooledTemporaryFile):  # {{{
 
     def __init__(self, file_obj, max_size=50*1024*1024):
@@ -341,7 +326,9 @@ def do_one_update(self):
 
     def updating_metadata_finished(self):
         if DEBUG:
-            prints('Saved %d books in %.1f seconds' % (len(self.all_book_ids), time.time() - self.start_time))
+            elapsed = time.time() - self.start_time
+            prints('Saved %d books in %.1f seconds (%.1f books per second)' % (
+                len(self.all_book_ids), elapsed, len(self.all_book_ids) / max(elapsed, 0.001)))
         self.pd.close()
         self.pd.deleteLater()
         self.report()
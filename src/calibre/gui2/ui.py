@@ -325,6 +325,7 @@ def initialize(self, library_path, db, actions, show_gui=True):
 
         # ###################### Start spare job server ########################
         QTimer.singleShot(1000, self.create_spare_pool)
+        QTimer.singleShot(5000, self.watch_font_folders)
 
         # ###################### Location Manager ########################
         self.location_manager.location_selected.connect(self.location_selected)
@@ -549,6 +550,10 @@ def create_spare_pool(self, *args):
             num = min(detect_ncpus(), config['worker_limit']//2)
             self._spare_pool = Pool(max_workers=num, name='GUIPool')
 
+    def watch_font_folders(self):
+        from calibre.utils.fonts.scanner import watch_font_folders
+        watch_font_folders()
+
     def spare_pool(self):
         ans, self._spare_pool = self._spare_pool, None
         QTimer.singleShot(1000, self.create_spare_pool)
@@ -138,6 +138,15 @@ class EPUB_MOBI(CatalogPlugin):
                           help=_("Custom field containing note text to insert in Description header.\n"
                           "Default: '%default'\n"
                           "Applies to: AZW3, EPUB, MOBI output formats")),
+                   Option('--incremental',
+                          default=False,
+                          dest='incremental',
+                          action='store_true',
+                          help=_("Reuse the Descriptions and Genres files of books that have not changed since the "
+                          "previous catalog generated with this option, instead of generating them again. "
+                          "Useful for regularly regenerating catalogs of large libraries.\n"
+                          "Default: '%default'\n"
+                          "Applies to: AZW3, EPUB, MOBI output formats")),
                    Option('--merge-comments-rule',
                           default='::',
                           dest='merge_comments_rule',
@@ -385,7 +394,7 @@ def run(self, path_to_output, opts, db, notification=DummyReporter()):
             if key in ['catalog_title', 'author_clip', 'connected_kindle', 'creator',
                        'cross_reference_authors', 'description_clip', 'exclude_book_marker',
                        'exclude_genre', 'exclude_tags', 'exclusion_rules', 'fmt',
-                       'genre_source_field', 'header_note_source_field', 'merge_comments_rule',
+                       'genre_source_field', 'header_note_source_field', 'incremental', 'merge_comments_rule',
                        'output_profile', 'prefix_rules', 'preset', 'read_book_marker',
                        'search_text', 'sort_by', 'sort_descriptions_by_author', 'sync',
                        'thumb_width', 'use_existing_cover', 'wishlist_tag']:
@@ -2,6 +2,8 @@
 # License: GPLv3 Copyright: 2010, Greg Riker
 
 import datetime
+import hashlib
+import json
 import os
 import platform
 import re
@@ -17,7 +19,7 @@
     as_unicode, force_unicode, isbytestring, prepare_string_for_xml, replace_entities,
     strftime, xml_replace_entities,
 )
-from calibre.constants import cache_dir, ismacos
+from calibre.constants import __version__, cache_dir, ismacos
 from calibre.customize.conversion import DummyReporter
 from calibre.customize.ui import output_profiles
 from calibre.ebooks.BeautifulSoup import BeautifulSoup, NavigableString, prettify
@@ -57,6 +59,16 @@ def makeelement(tag_name, parent, **attrs):
     return ans
 
 
+def scale_thumbnail(src, dest, width, height):
+    # Run in worker processes by CatalogBuilder.scale_thumbnails()
+    from calibre.utils.img import scale_image
+    with open(src, 'rb') as f:
+        data = f.read()
+    thumb_data = scale_image(data, width=width, height=height)[-1]
+    with open(dest, 'wb') as f:
+        f.write(thumb_data)
+
+
 class Formatter(TemplateFormatter):
 
     def get_value(self, key, args, kwargs):
@@ -89,6 +101,8 @@ class CatalogBuilder:
     '''
 
     DEBUG = False
+    # Below this many covers to scale, worker processes are not worth starting
+    PARALLEL_THUMBNAILS_THRESHOLD = 16
 
     # A single number creates 'Last x days' only.
     # Multiple numbers create 'Last x days', 'x to y days ago' ...
@@ -194,6 +208,7 @@ def __init__(self, db, _opts, plugin,
         self.prefix_rules = self.get_prefix_rules()
         self.progress_int = 0.0
         self.progress_string = ''
+        self.section_cache = None
         self.thumb_height = 0
         self.thumb_width = 0
         self.thumbs = None
@@ -207,6 +222,7 @@ def __init__(self, db, _opts, plugin,
         self.calculate_thumbnail_dimensions()
         self.confirm_thumbs_archive()
         self.load_section_templates()
+        self.load_section_cache()
         if init_resources:
             self.copy_catalog_resources()
 
@@ -358,6 +374,30 @@ def build_sources(self):
         if self.opts.generate_descriptions:
             self.generate_ncx_descriptions(_("Descriptions"))
         self.write_ncx()
+        self.save_section_cache()
+
+    def cached_section_file(self, fname, key):
+        """ Reuse a file generated by a previous incremental build.
+
+        Args:
+         fname (str): name of the file in content_dir
+         key (str): digest of everything the contents of the file depend on
+
+        Return:
+         (bool, extra): whether the cached file was copied to content_dir and
+          the extra data stored with it by store_section_file()
+        """
+        if self.section_cache is None:
+            return False, None
+        entry = self.section_cache['index'].get(fname)
+        if entry is None or entry[0] != key:
+            return False, None
+        try:
+            shutil.copyfile(os.path.join(self.section_cache['path'], fname), os.path.join(self.content_dir, fname))
+        except OSError:
+            return False, None
+        self.section_cache['used'][fname] = entry
+        return True, entry[1]
 
     def calculate_thumbnail_dimensions(self):
         """ Calculate thumb dimensions based on device DPI.
@@ -2168,12 +2208,25 @@ def generate_html_by_genres(self):
                     else:
                         books_by_current_author += 1
 
-                # Write the genre book list as an article
-                outfile = f"{self.content_dir}/Genre_{genre}.html"
-                titles_spanned = self.generate_html_by_genre(genre,
-                                                             True if index == 0 else False,
-                                                             genre_tag_set[genre],
-                                                             outfile)
+                # Write the genre book list as an article, unless it is
+                # unchanged since the previous incremental build
+                fname = "Genre_%s.html" % genre
+                outfile = f"{self.content_dir}/{fname}"
+                titles_spanned = None
+                if self.section_cache is not None:
+                    last_modified = self.section_cache['last_modified']
+                    key = self.section_file_key(fname, index == 0, genre_tag_set[genre],
+                                                [last_modified.get(int(book['id'])) for book in genre_tag_set[genre]])
+                    found, titles_spanned = self.cached_section_file(fname, key)
+                    if found:
+                        titles_spanned = [tuple(x) for x in titles_spanned]
+                if titles_spanned is None:
+                    titles_spanned = self.generate_html_by_genre(genre,
+                                                                 True if index == 0 else False,
+                                                                 genre_tag_set[genre],
+                                                                 outfile)
+                    if self.section_cache is not None:
+                        self.store_section_file(fname, key, titles_spanned)
 
                 tag_file = "content/Genre_%s.html" % genre
                 master_genre_list.append({
@@ -2848,12 +2901,22 @@ def generate_html_descriptions(self):
                                             title_num, len(self.books_by_title)),
                                             float(title_num * 100 / len(self.books_by_title)) / 100)
 
+            fname = "book_%d.html" % int(title['id'])
+            if self.section_cache is not None:
+                key = self.section_file_key(
+                    fname, title, title['id'] in (self.bookmarked_books or ()),
+                    self.section_cache['last_modified'].get(int(title['id'])))
+                if self.cached_section_file(fname, key)[0]:
+                    continue
+
             # Generate the header from user-customizable template
             soup = self.generate_html_description_header(title)
 
             # Write the book entry to content_dir
-            with open("%s/book_%d.html" % (self.content_dir, int(title['id'])), 'wb') as outfile:
+            with open(os.path.join(self.content_dir, fname), 'wb') as outfile:
                 outfile.write(prettify(soup).encode('utf-8'))
+            if self.section_cache is not None:
+                self.store_section_file(fname, key)
 
     def generate_html_empty_header(self, title):
         """ Return a boilerplate HTML header.
@@ -3928,6 +3991,8 @@ def generate_thumbnails(self):
 
         Generate or retrieve a thumbnail for each cover. If nonexistent or faulty
         cover data, substitute default cover. Checks for updated default cover.
+        The thumbs archive is read and updated only once, thumbs not already in
+        the archive are scaled in parallel by worker processes.
         At completion, writes self.opts.thumb_width to archive.
 
         Inputs:
@@ -3940,57 +4005,62 @@ def generate_thumbnails(self):
         self.update_progress_full_step(_("Thumbnails"))
         thumbs = ['thumbnail_default.jpg']
         image_dir = "%s/images" % self.catalog_path
-        for (i, title) in enumerate(self.books_by_title):
-            # Update status
-            self.update_progress_micro_step("%s %d of %d" %
-                (_("Thumbnail"), i, len(self.books_by_title)),
-                 i / float(len(self.books_by_title)))
+        total = len(self.books_by_title)
+        failed, to_scale = [], []
 
-            thumb_file = 'thumbnail_%d.jpg' % int(title['id'])
-            thumb_generated = True
-            valid_cover = True
-            try:
-                self.generate_thumbnail(title, image_dir, thumb_file)
-                thumbs.append("thumbnail_%d.jpg" % int(title['id']))
-            except:
-                if 'cover' in title and os.path.exists(title['cover']):
-                    valid_cover = False
-                    self.opts.log.warn(" *** Invalid cover file for '%s'***" %
-                                            (title['title']))
-                    if not self.error:
-                        self.error.append('Invalid cover files')
-                    self.error.append("Warning: invalid cover file for '%s', default cover substituted.\n" % (title['title']))
-
-                thumb_generated = False
-
-            if not thumb_generated:
-                self.opts.log.warn("     using default cover for '%s' (%d)" % (title['title'], title['id']))
-                # Confirm thumb exists, default is current
-                default_thumb_fp = os.path.join(image_dir, "thumbnail_default.jpg")
-                cover = os.path.join(self.catalog_path, "DefaultCover.png")
-                title['cover'] = cover
-
-                if not os.path.exists(cover):
-                    shutil.copyfile(I('default_cover.png'), cover)
-
-                if os.path.isfile(default_thumb_fp):
-                    # Check to see if default cover is newer than thumbnail
-                    # os.path.getmtime() = modified time
-                    # os.path.ctime() = creation time
-                    cover_timestamp = os.path.getmtime(cover)
-                    thumb_timestamp = os.path.getmtime(default_thumb_fp)
-                    if thumb_timestamp < cover_timestamp:
-                        if self.DEBUG and self.opts.verbose:
-                            self.opts.log.warn("updating thumbnail_default for %s" % title['title'])
-                        self.generate_thumbnail(title, image_dir,
-                                            "thumbnail_default.jpg" if valid_cover else thumb_file)
+        try:
+            zf = ZipFile(self.thumbs_path, mode='r', allowZip64=True)
+        except Exception:
+            # occurs under windows if the file is opened by another process
+            zf = None
+        try:
+            cached = set(zf.namelist()) if zf is not None else set()
+            for (i, title) in enumerate(self.books_by_title):
+                self.update_progress_micro_step("%s %d of %d" %
+                    (_("Thumbnail"), i, total), 0.5 * i / float(total))
+                thumb_file = 'thumbnail_%d.jpg' % int(title['id'])
+                try:
+                    with open(title['cover'], 'rb') as f:
+                        cover_crc = hex(zlib.crc32(f.read()))
+                except Exception:
+                    failed.append(title)
+                    continue
+                uuid = title.get('uuid')
+                name = uuid + cover_crc if uuid and zf is not None else None
+                if name is not None and name in cached:
+                    # uuid found in cache with matching crc
+                    with open(os.path.join(image_dir, thumb_file), 'wb') as f:
+                        f.write(zf.read(name))
+                    thumbs.append(thumb_file)
                 else:
-                    if self.DEBUG and self.opts.verbose:
-                        self.opts.log.warn("     generating new thumbnail_default.jpg")
-                    self.generate_thumbnail(title, image_dir,
-                                            "thumbnail_default.jpg" if valid_cover else thumb_file)
-                # Clear the book's cover property
-                title['cover'] = None
+                    to_scale.append((title, thumb_file, name))
+        finally:
+            if zf is not None:
+                zf.close()
+
+        for title, thumb_file, name, err in self.scale_thumbnails(to_scale, image_dir, 0.5):
+            if err is None:
+                thumbs.append(thumb_file)
+            else:
+                failed.append(title)
+
+        # Save the new thumbs to the archive, opening it only once
+        new_thumbs = [(name, thumb_file) for title, thumb_file, name in to_scale
+                      if name is not None and thumb_file in thumbs]
+        if new_thumbs:
+            try:
+                with ZipFile(self.thumbs_path, mode='a', allowZip64=True) as zfw:
+                    for name, thumb_file in new_thumbs:
+                        with open(os.path.join(image_dir, thumb_file), 'rb') as f:
+                            zfw.writestr(name, f.read())
+            except Exception:
+                # occurs under windows if the file is opened by another process
+                pass
+
+        failed = {id(title) for title in failed}
+        for title in self.books_by_title:
+            if id(title) in failed:
+                self.use_default_thumbnail(title, image_dir)
 
         # Write thumb_width to the file, validating cache contents
         # Allows detection of aborted catalog builds
@@ -4125,6 +4195,42 @@ def letter_or_symbol(self, char):
         else:
             return char
 
+    def load_section_cache(self):
+        """ Load the index of files generated by the previous incremental build.
+
+        In incremental mode, the files for Descriptions and Genres are cached
+        per library and reused if none of the books in them changed, as
+        determined by their last_modified timestamps and metadata, and the
+        catalog settings are unchanged.
+
+        Inputs:
+         opts.incremental (bool): incremental mode requested
+
+        Results:
+         section_cache (dict): cache location, index and key of the settings
+        """
+        if not getattr(self.opts, 'incremental', False):
+            return
+        path = os.path.join(self.cache_dir, 'sections', self.db.library_id)
+        try:
+            with open(os.path.join(path, 'index.json'), 'rb') as f:
+                index = json.loads(f.read())
+        except (OSError, ValueError):
+            index = {}
+        ignored = ('connected_device', 'creator', 'creator_sort_as', 'incremental', 'log', 'start_time')
+        settings = sorted((k, repr(v)) for k, v in vars(self.opts).items() if k not in ignored and (
+            v is None or isinstance(v, (str, bytes, int, float, list, tuple, dict))))
+        resources = [P(x, data=True) for x in (
+            'catalog/template.xhtml', 'catalog/stylesheet.css', 'catalog/section_list_templates.conf')]
+        ids = tuple(int(book['id']) for book in self.books_to_catalog)
+        self.section_cache = {
+            'path': path, 'index': index, 'used': {},
+            'settings': repr((__version__, get_lang(), settings, resources, sorted((self.genre_tags_dict or {}).items()))),
+            'last_modified': {k: str(v) for k, v in self.db.new_api.all_field_for('last_modified', ids).items()},
+        }
+        if self.opts.verbose:
+            self.opts.log.info("  incremental build, %d cached files in '%s'" % (len(index), path))
+
     def load_section_templates(self):
         """ Add section templates to local namespace.
 
@@ -4314,6 +4420,101 @@ def relist_multiple_authors(self, books_by_author):
 
         return books_by_author
 
+    def save_section_cache(self):
+        """ Save the index of files generated by this incremental build.
+
+        Files not used by this build are removed from the cache.
+        """
+        if self.section_cache is None:
+            return
+        path, used = self.section_cache['path'], self.section_cache['used']
+        try:
+            for fname in os.listdir(path):
+                if fname not in used and fname != 'index.json':
+                    os.remove(os.path.join(path, fname))
+            with open(os.path.join(path, 'index.json'), 'wb') as f:
+                f.write(json.dumps(used).encode('utf-8'))
+        except OSError as err:
+            self.opts.log.warning("  failed to update the catalog cache at '%s': %s" % (path, as_unicode(err)))
+
+    def scale_thumbnails(self, to_scale, image_dir, progress_start):
+        """ Scale covers to thumbnails, in worker processes for many covers.
+
+        Args:
+         to_scale (list): [(title, thumb_file, archive_name), ...]
+         image_dir (str): directory to write thumbs to
+         progress_start (float): fraction of the step already completed
+
+        Yields:
+         (title, thumb_file, archive_name, error) in the order of to_scale
+        """
+        if len(to_scale) < self.PARALLEL_THUMBNAILS_THRESHOLD:
+            for title, thumb_file, name in to_scale:
+                try:
+                    scale_thumbnail(title['cover'], os.path.join(image_dir, thumb_file), self.thumb_width, self.thumb_height)
+                except Exception as e:
+                    yield title, thumb_file, name, as_unicode(e)
+                else:
+                    yield title, thumb_file, name, None
+            return
+
+        from calibre.utils.ipc.pool import Failure, Pool
+        from polyglot.queue import Empty
+        pool = Pool(name='CatalogThumbnails')
+        try:
+            for i, (title, thumb_file, name) in enumerate(to_scale):
+                pool(i, 'calibre.library.catalogs.epub_mobi_builder', 'scale_thumbnail',
+                     title['cover'], os.path.join(image_dir, thumb_file), self.thumb_width, self.thumb_height)
+            results = {}
+            for i, (title, thumb_file, name) in enumerate(to_scale):
+                while i not in results:
+                    if pool.failed:
+                        raise Failure(pool.terminal_failure)
+                    try:
+                        wr = pool.results.get(timeout=0.1)
+                    except Empty:
+                        continue
+                    if wr.is_terminal_failure:
+                        raise Failure(pool.terminal_failure)
+                    results[wr.id] = wr.result.err
+                self.update_progress_micro_step("%s %d of %d" %
+                    (_("Thumbnail"), i, len(to_scale)),
+                    progress_start + (1 - progress_start) * i / float(len(to_scale)))
+                yield title, thumb_file, name, results.pop(i)
+        finally:
+            pool.shutdown()
+
+    def section_file_key(self, *data):
+        """ Return the cache key for a generated file.
+
+        Args:
+         data: everything the contents of the file depend on, apart from the
+          catalog settings
+
+        Return:
+         (str): digest of data and the catalog settings
+        """
+        h = hashlib.sha1(self.section_cache['settings'].encode('utf-8'))
+        h.update(repr(data).encode('utf-8'))
+        return h.hexdigest()
+
+    def store_section_file(self, fname, key, extra=None):
+        """ Save a newly generated file for use by later incremental builds.
+
+        Args:
+         fname (str): name of the file in content_dir
+         key (str): digest from section_file_key()
+         extra (JSON serializable): data to return from cached_section_file()
+        """
+        if self.section_cache is None:
+            return
+        try:
+            os.makedirs(self.section_cache['path'], exist_ok=True)
+            shutil.copyfile(os.path.join(self.content_dir, fname), os.path.join(self.section_cache['path'], fname))
+        except OSError:
+            return
+        self.section_cache['used'][fname] = [key, extra]
+
     def update_progress_full_step(self, description):
         """ Update calibre's job status UI.
 
@@ -4363,6 +4564,54 @@ def update_progress_micro_step(self, description, micro_step_pct):
         self.progress_int = coarse_progress + fine_progress
         self.reporter(self.progress_int, self.progress_string)
 
+    def use_default_thumbnail(self, title, image_dir):
+        """ Substitute the default cover for a book with a missing or invalid cover.
+
+        Args:
+         title (dict): book metadata
+         image_dir (str): directory to write thumb data to
+
+        Output:
+         (file): thumbnail_default.jpg written to /images, if absent or outdated
+        """
+        thumb_file = 'thumbnail_%d.jpg' % int(title['id'])
+        valid_cover = True
+        if 'cover' in title and title['cover'] and os.path.exists(title['cover']):
+            valid_cover = False
+            self.opts.log.warn(" *** Invalid cover file for '%s'***" %
+                                    (title['title']))
+            if not self.error:
+                self.error.append('Invalid cover files')
+            self.error.append("Warning: invalid cover file for '%s', default cover substituted.\n" % (title['title']))
+
+        self.opts.log.warn("     using default cover for '%s' (%d)" % (title['title'], title['id']))
+        # Confirm thumb exists, default is current
+        default_thumb_fp = os.path.join(image_dir, "thumbnail_default.jpg")
+        cover = os.path.join(self.catalog_path, "DefaultCover.png")
+        title['cover'] = cover
+
+        if not os.path.exists(cover):
+            shutil.copyfile(I('default_cover.png'), cover)
+
+        if os.path.isfile(default_thumb_fp):
+            # Check to see if default cover is newer than thumbnail
+            # os.path.getmtime() = modified time
+            # os.path.ctime() = creation time
+            cover_timestamp = os.path.getmtime(cover)
+            thumb_timestamp = os.path.getmtime(default_thumb_fp)
+            if thumb_timestamp < cover_timestamp:
+                if self.DEBUG and self.opts.verbose:
+                    self.opts.log.warn("updating thumbnail_default for %s" % title['title'])
+                self.generate_thumbnail(title, image_dir,
+                                    "thumbnail_default.jpg" if valid_cover else thumb_file)
+        else:
+            if self.DEBUG and self.opts.verbose:
+                self.opts.log.warn("     generating new thumbnail_default.jpg")
+            self.generate_thumbnail(title, image_dir,
+                                    "thumbnail_default.jpg" if valid_cover else thumb_file)
+        # Clear the book's cover property
+        title['cover'] = None
+
     def write_ncx(self):
         """ Write accumulated ncx_soup to file.
 
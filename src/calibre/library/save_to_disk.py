@@ -8,6 +8,7 @@
 import os
 import re
 import traceback
+from collections import defaultdict
 
 from calibre import prints, sanitize_file_name, strftime
 from calibre.constants import DEBUG, iswindows, preferred_encoding
@@ -296,6 +297,24 @@ def get_path_components(opts, mi, book_id, path_length):
     return components
 
 
+def ensure_unique_components(data):
+    ''' Make the path components of books that would be saved to the same
+    location unique by adding a numeric suffix. data must be a mapping of book
+    id to a tuple of the form (mi, components, formats). '''
+    cmap = defaultdict(set)
+    bid_map = {}
+    for book_id, (mi, components, fmts) in data.items():
+        cmap[tuple(components)].add(book_id)
+        bid_map[book_id] = components
+
+    for book_ids in cmap.values():
+        if len(book_ids) > 1:
+            for i, book_id in enumerate(sorted(book_ids)[1:]):
+                suffix = ' (%d)' % (i + 1)
+                components = bid_map[book_id]
+                components[-1] = components[-1] + suffix
+
+
 def update_metadata(mi, fmt, stream, plugboards, cdata, error_report=None, plugboard_cache=None):
     from calibre.ebooks.metadata.meta import set_metadata
     if error_report is not None:
@@ -324,7 +343,13 @@ def report_error(mi, fmt, tb):
 
 
 def do_save_book_to_disk(db, book_id, mi, plugboards,
-        formats, root, opts, length, extra_files=()):
+        formats, root, opts, length, extra_files=(), components=None, metadata_updater=None):
+    '''
+    Save the specified book. If components is not None it is used as the
+    precomputed path components for the book. If metadata_updater is not None,
+    instead of embedding metadata in the saved files, it is called with the
+    arguments: (book_id, mi, cdata, paths of saved format files).
+    '''
     originals = mi.cover, mi.pubdate, mi.timestamp
     formats_written = False
     try:
@@ -333,7 +358,8 @@ def do_save_book_to_disk(db, book_id, mi, plugboards,
         if mi.timestamp:
             mi.timestamp = as_local_time(mi.timestamp)
 
-        components = get_path_components(opts, mi, book_id, length)
+        if components is None:
+            components = get_path_components(opts, mi, book_id, length)
         base_path = os.path.join(root, *components)
         base_name = os.path.basename(base_path)
         dirpath = os.path.dirname(base_path)
@@ -365,6 +391,7 @@ def do_save_book_to_disk(db, book_id, mi, plugboards,
     if not formats:
         return not formats_written, book_id, mi.title
 
+    fmt_paths = []
     for fmt in formats:
         fmt_path = base_path+'.'+str(fmt)
         try:
@@ -373,8 +400,13 @@ def do_save_book_to_disk(db, book_id, mi, plugboards,
         except NoSuchFormat:
             continue
         if opts.update_metadata:
-            with open(make_long_path_useable(fmt_path), 'r+b') as stream:
-                update_metadata(mi, fmt, stream, plugboards, cdata)
+            if metadata_updater is None:
+                with open(make_long_path_useable(fmt_path), 'r+b') as stream:
+                    update_metadata(mi, fmt, stream, plugboards, cdata)
+            else:
+                fmt_paths.append(fmt_path)
+    if fmt_paths:
+        metadata_updater(book_id, mi, cdata, fmt_paths)
 
     return not formats_written, book_id, mi.title
 
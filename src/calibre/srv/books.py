@@ -14,7 +14,7 @@
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
 from calibre.ebooks.metadata import authors_to_string
-from calibre.srv.errors import BookNotFound, HTTPNotFound
+from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound, HTTPUnprocessableEntity
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json
 from calibre.srv.render_book import RENDER_VERSION
@@ -280,6 +280,41 @@ def update_annotations(ctx, rd, library_id, book_id, fmt):
     return b''
 
 
+@endpoint('/book-annotations-page/{library_id}', postprocess=json)
+def annotations_page(ctx, rd, library_id):
+    '''
+    Get a page of the annotations of the current user, newest first, or if the
+    query parameter is specified, the best matches for that full text search.
+    The optional type and num parameters restrict the annotation type and the
+    number of annotations per page. To get the next page pass the value of next
+    from the current page as the after parameter, next is null on the last page.
+    '''
+    db = get_db(ctx, rd, library_id)
+    user = rd.username or '*'
+    try:
+        num = max(1, min(int(rd.query.get('num', 100)), 1000))
+        after = rd.query.get('after')
+        if after:
+            rank, annot_id = jsonlib.loads(after)
+            after = float(rank), int(annot_id)
+    except Exception:
+        raise HTTPBadRequest('Invalid after or num parameter')
+    kw = {
+        'after': after or None, 'page_size': num, 'restrict_to_user': ('web', user), 'annotation_type': rd.query.get('type') or None,
+        'ignore_removed': True, 'restrict_to_book_ids': ctx.allowed_book_ids(rd, db),
+    }
+    query = rd.query.get('query')
+    from calibre.db import FTSQueryError
+    try:
+        if query:
+            annotations, after = db.search_annotations_page(query, **kw)
+        else:
+            annotations, after = db.annotations_page(**kw)
+    except FTSQueryError as e:
+        raise HTTPUnprocessableEntity(str(e))
+    return {'annotations': annotations, 'next': after}
+
+
 mathjax_lock = Lock()
 mathjax_manifest = None
 
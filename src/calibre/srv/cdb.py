@@ -9,7 +9,7 @@
 from io import BytesIO
 
 from calibre import as_unicode, sanitize_file_name
-from calibre.db.cli import module_for_cmd
+from calibre.db.cli import expire_staged_uploads, module_for_cmd, staged_upload_path
 from calibre.ebooks.metadata.meta import get_metadata
 from calibre.srv.changes import books_added, books_deleted, metadata
 from calibre.srv.errors import HTTPBadRequest, HTTPForbidden, HTTPNotFound
@@ -25,33 +25,41 @@
 receive_data_methods = {'GET', 'POST'}
 
 
-@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache')
-def cdb_run(ctx, rd, which, version):
-    try:
-        m = module_for_cmd(which)
-    except ImportError:
-        raise HTTPNotFound(f'No module named: {which}')
-    if not getattr(m, 'readonly', False):
-        ctx.check_for_write_access(rd)
-    if getattr(m, 'version', 0) != int(version):
-        raise HTTPNotFound(('The module {} is not available in version: {}.'
-                           'Make sure the version of calibre used for the'
-                            ' server and calibredb match').format(which, version))
-    db = get_library_data(ctx, rd, strict_library_id=True)[0]
-    if ctx.restriction_for(rd, db):
-        raise HTTPForbidden('Cannot use the command-line db interface with a user who has per library restrictions')
+def read_cdb_args(rd):
     raw = rd.read()
     ct = rd.inheaders.get('Content-Type', all=True)
     ct = {x.lower().partition(';')[0] for x in ct}
     try:
         if MSGPACK_MIME in ct:
-            args = msgpack_loads(raw)
+            return msgpack_loads(raw)
         elif 'application/json' in ct:
-            args = json_loads(raw)
+            return json_loads(raw)
         else:
             raise HTTPBadRequest('Only JSON or msgpack requests are supported')
+    except HTTPBadRequest:
+        raise
     except Exception:
         raise HTTPBadRequest('args are not valid encoded data')
+
+
+def cdb_module(ctx, rd, which, version):
+    try:
+        m = module_for_cmd(which)
+    except ImportError:
+        raise HTTPNotFound(f'No module named: {which}')
+    if not hasattr(m, 'implementation'):
+        # Commands such as batch that are run entirely by calibredb
+        raise HTTPNotFound(f'The command {which} cannot be run by the server')
+    if not getattr(m, 'readonly', False):
+        ctx.check_for_write_access(rd)
+    if getattr(m, 'version', 0) != int(version):
+        raise HTTPNotFound(('The module {} is not available in version: {}.'
+                           'Make sure the version of calibre used for the'
+                            ' server and calibredb match').format(which, version))
+    return m
+
+
+def run_cdb_command(ctx, db, m, args):
     if getattr(m, 'needs_srv_ctx', False):
         args = [ctx] + list(args)
     try:
@@ -65,6 +73,42 @@ def cdb_run(ctx, rd, which, version):
     return {'result': result}
 
 
+@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache')
+def cdb_run(ctx, rd, which, version):
+    m = cdb_module(ctx, rd, which, version)
+    db = get_library_data(ctx, rd, strict_library_id=True)[0]
+    if ctx.restriction_for(rd, db):
+        raise HTTPForbidden('Cannot use the command-line db interface with a user who has per library restrictions')
+    args = read_cdb_args(rd)
+    return run_cdb_command(ctx, db, m, args)
+
+
+@endpoint('/cdb/batch', postprocess=msgpack_or_json, methods={'POST'}, cache_control='no-cache')
+def cdb_batch(ctx, rd):
+    '''
+    Run many calibredb commands with a single request. The body of the request
+    must be a list of (command, version, args) entries. The result is a list
+    with one entry per command, of the same form as the result of /cdb/cmd.
+    Commands are run in order and a failing command, including one that does
+    not exist, does not stop the commands after it.
+    '''
+    db = get_library_data(ctx, rd, strict_library_id=True)[0]
+    if ctx.restriction_for(rd, db):
+        raise HTTPForbidden('Cannot use the command-line db interface with a user who has per library restrictions')
+    # Check all the commands before running any of them, so that a batch that
+    # needs write access fails as a whole for read-only users
+    commands = []
+    try:
+        for which, version, args in read_cdb_args(rd):
+            try:
+                commands.append((cdb_module(ctx, rd, which, version), args, None))
+            except HTTPNotFound as err:
+                commands.append((None, args, {'err': as_unicode(err), 'tb': ''}))
+    except (TypeError, ValueError):
+        raise HTTPBadRequest('Invalid list of commands')
+    return {'results': [err or run_cdb_command(ctx, db, m, args) for m, args, err in commands]}
+
+
 @endpoint('/cdb/add-book/{job_id}/{add_duplicates}/{filename}/{library_id=None}',
           needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache')
 def cdb_add_book(ctx, rd, job_id, add_duplicates, filename, library_id):
@@ -113,6 +157,30 @@ def cdb_add_book(ctx, rd, job_id, add_duplicates, filename, library_id):
     return ans
 
 
+@endpoint('/cdb/upload/{request_id}/{key}/{library_id=None}',
+          needs_db_write=True, postprocess=json, methods={'POST'}, cache_control='no-cache')
+def cdb_upload(ctx, rd, request_id, key, library_id):
+    '''
+    Store the file in the body of the request for use by later calibredb
+    commands with the same request_id. This allows calibredb to stream large
+    files to the server instead of embedding them in the command arguments.
+    '''
+    db = get_db(ctx, rd, library_id)
+    if ctx.restriction_for(rd, db):
+        raise HTTPForbidden('Cannot use the command-line db interface with a user who has per library restrictions')
+    try:
+        path = staged_upload_path(request_id, key)
+    except ValueError as err:
+        raise HTTPBadRequest(str(err))
+    expire_staged_uploads()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rd.request_body_file.seek(0)
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(rd.request_body_file, f)
+        size = f.tell()
+    return {'size': size}
+
+
 @endpoint('/cdb/delete-books/{book_ids}/{library_id=None}',
           needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache')
 def cdb_delete_book(ctx, rd, book_ids, library_id):
@@ -241,5 +241,7 @@ def main(args=sys.argv):
     # Needed for dynamic cover generation, which uses Qt for drawing
     from calibre.gui2 import ensure_app, load_builtin_fonts
     ensure_app(), load_builtin_fonts()
+    from calibre.utils.fonts.scanner import watch_font_folders
+    watch_font_folders()
     with HandleInterrupt(server.stop):
         server.serve_forever()
@@ -9,12 +9,17 @@
 import zlib
 from functools import partial
 from io import BytesIO
+from types import SimpleNamespace
 
+from calibre.db.cli import remove_staged_uploads, staged_upload_path, upload_key
+from calibre.db.cli.main import DBCtx
 from calibre.ebooks.metadata.meta import get_metadata
+from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.tests.base import LibraryBaseTest
 from calibre.utils.localization import _
+from calibre.utils.serialize import MSGPACK_MIME, msgpack_dumps, msgpack_loads
 from polyglot.binary import as_base64_bytes
-from polyglot.http_client import FORBIDDEN, NOT_FOUND, OK
+from polyglot.http_client import BAD_REQUEST, FORBIDDEN, NOT_FOUND, OK
 from polyglot.urllib import quote, urlencode
 
 
@@ -193,4 +198,66 @@ def d(book_ids, username='12', status=OK):
             ae(q, content)
             d((1,), username='ro', status=FORBIDDEN)
             d((1, data['book_id']))
+
+            # Files streamed to the server and then added in a batch by calibredb
+            rid, upath = 'testrequest', os.path.abspath('upload test.txt')
+            r, data = make_request(conn, f'/cdb/upload/{rid}/{upload_key(upath)}', username='12', password='test',
+                                   prefix='', method='POST', data=content)
+            ae(r.status, OK)
+            ae(data, {'size': len(content)})
+            r, data = make_request(conn, f'/cdb/upload/{rid}/a.b', username='12', password='test', prefix='', method='POST', data=content)
+            ae(r.status, BAD_REQUEST)
+            args = ['books', [[[upath, None], 'upload test.txt', 'txt', True, 'Uploaded', None, None, None, None, 1.0,
+                               None, None, None, 'disabled', rid]]]
+            r, data = make_request(conn, '/cdb/cmd/add/1', headers={'Content-Type': MSGPACK_MIME, 'Accept': MSGPACK_MIME},
+                                   username='12', password='test', prefix='', method='POST', data=msgpack_dumps(args))
+            ae(r.status, OK)
+            (added_ids, updated_ids, duplicates, title), = msgpack_loads(data)['result']
+            ae(title, 'Uploaded')
+            r, q = make_request(conn, '/get/txt/{}'.format(next(iter(added_ids))), username='12', password='test', prefix='')
+            ae(q, content)
+            # Used files are removed from the staging area
+            self.assertFalse(os.path.exists(staged_upload_path(rid, upload_key(upath))))
+            self.assertRaises(ValueError, staged_upload_path, '../x', upload_key(upath))
+
+            # Streaming files to the server with the calibredb client
+            host, port = server.address
+            dbctx = DBCtx(SimpleNamespace(library_path=f'http://{host}:{port}', timeout=10, username='12', password='test'), None)
+            with TemporaryDirectory('cdb-upload') as tdir:
+                paths = []
+                for i in range(5):
+                    paths.append(os.path.join(tdir, f'{i}.txt'))
+                    with open(paths[-1], 'wb') as f:
+                        f.write(b'%d' % i * 100000)
+                rid = 'clientrequest'
+                dbctx.upload(rid, paths, num_threads=3)
+                for i, path in enumerate(paths):
+                    with open(staged_upload_path(rid, upload_key(path)), 'rb') as f:
+                        ae(f.read(), b'%d' % i * 100000)
+                self.assertRaises(ValueError, dbctx.upload, '../x', paths)
+                # Files not used by the command are removed, even if it fails
+                args = ['format_group', [[os.path.join(tdir, 'missing.txt'), None], [paths[0], None]], True, 'disabled', rid, None]
+                r, data = make_request(conn, '/cdb/cmd/add/1', headers={'Content-Type': MSGPACK_MIME, 'Accept': MSGPACK_MIME},
+                                       username='12', password='test', prefix='', method='POST', data=msgpack_dumps(args))
+                ae(r.status, OK)
+                self.assertIn('err', msgpack_loads(data))
+                self.assertFalse(os.path.exists(staged_upload_path(rid, upload_key(paths[0]))))
+                self.assertTrue(os.path.exists(staged_upload_path(rid, upload_key(paths[1]))))
+                remove_staged_uploads(rid, [upload_key(p) for p in paths])
+                self.assertFalse(os.path.exists(os.path.dirname(staged_upload_path(rid, upload_key(paths[2])))))
+
+            # Many calibredb commands in a single request
+            commands = [('saved_searches', 0, ('add', 'x', 'title:x')), ('batch', 0, ()), ('nonexistent', 0, ()),
+                        ('saved_searches', 0, ('list',))]
+            r, data = make_request(conn, '/cdb/batch', headers={'Content-Type': MSGPACK_MIME, 'Accept': MSGPACK_MIME},
+                                   username='12', password='test', prefix='', method='POST', data=msgpack_dumps(commands))
+            ae(r.status, OK)
+            results = msgpack_loads(data)['results']
+            ae(len(results), 4)
+            # Commands that the server cannot run fail without failing the batch
+            self.assertIn('err', results[1]), self.assertIn('err', results[2])
+            ae(results[3], {'result': {'x': 'title:x'}})
+            r, data = make_request(conn, '/cdb/batch', headers={'Content-Type': MSGPACK_MIME}, username='ro', password='test',
+                                   prefix='', method='POST', data=msgpack_dumps(commands))
+            ae(r.status, FORBIDDEN)
     # }}}
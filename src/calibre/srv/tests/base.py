@@ -56,6 +56,7 @@ class LibraryBaseTest(BaseTest):
     def setUp(self):
         from calibre.utils.recycle_bin import nuke_recycle
         nuke_recycle()
+        self.use_temp_cache_dir()
         self.library_path = self.mkdtemp()
         self.create_db(self.library_path)
 
@@ -70,12 +71,23 @@ def tearDown(self):
             gc.collect(), gc.collect()
             time.sleep(2)
             shutil.rmtree(self.library_path)
+        self.restore_cache_dir()
 
     def mkdtemp(self):
         ans = tempfile.mkdtemp(prefix='db_test_')
         atexit.register(rmtree, ans)
         return ans
 
+    def use_temp_cache_dir(self):
+        from calibre.constants import cache_dir
+        self.original_cache_dir = cache_dir()
+        cache_dir.ans = self.mkdtemp()
+
+    def restore_cache_dir(self):
+        from calibre.constants import cache_dir
+        tdir, cache_dir.ans = cache_dir.ans, self.original_cache_dir
+        rmtree(tdir)
+
     def create_db(self, library_path):
         from calibre.db.cache import Cache
         from calibre.db.legacy import create_backend
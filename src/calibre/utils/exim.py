@@ -13,6 +13,7 @@
 import time
 import uuid
 from collections import Counter
+from threading import Lock
 
 from calibre import prints
 from calibre.constants import config_dir, filesystem_encoding, iswindows
@@ -41,32 +42,35 @@ class FileDest:
 
     def __init__(self, key, exporter, mtime=None):
         self.exporter, self.key = exporter, key
+        self.writer = exporter.acquire_writer()
+        self.writer.ensure_space(0)
         self.hasher = hashlib.sha1()
-        self.start_pos = exporter.f.tell()
+        self.start_pos = self.writer.f.tell()
         self._discard = False
-        self.mtime = None
+        self.mtime = mtime
 
     def discard(self):
         self._discard = True
 
     def ensure_space(self, size):
         if size > 0:
-            self.exporter.ensure_space(size)
-            self.start_pos = self.exporter.f.tell()
+            self.writer.ensure_space(size)
+            self.start_pos = self.writer.f.tell()
 
     def write(self, data):
         self.hasher.update(data)
-        self.exporter.f.write(data)
+        self.writer.f.write(data)
 
     def flush(self):
         pass
 
     def close(self):
         if not self._discard:
-            size = self.exporter.f.tell() - self.start_pos
+            size = self.writer.f.tell() - self.start_pos
             digest = str(self.hasher.hexdigest())
-            self.exporter.file_metadata[self.key] = (len(self.exporter.parts), self.start_pos, size, digest, self.mtime)
-        del self.exporter, self.hasher
+            self.writer.add_file(self.key, (self.writer.part_num, self.start_pos, size, digest, self.mtime))
+        self.exporter.release_writer(self.writer)
+        del self.exporter, self.hasher, self.writer
 
     def __enter__(self):
         return self
@@ -75,67 +79,191 @@ def __exit__(self, *args):
         self.close()
 
 
+class PartWriter:
+
+    '''
+    Writes files into a series of parts. Every thread exporting files uses
+    its own writer, so files are written in parallel to different parts.
+    '''
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.f = None
+        self.part_num = 0
+        self.files = {}
+
+    def open_part(self, num):
+        self.part_num = num
+        self.f = open(self.exporter.part_path(num), 'wb')
+
+    def ensure_space(self, size):
+        if self.f is not None:
+            pos = self.f.tell()
+            if pos == 0 or size + pos < self.exporter.part_size:
+                return
+            self.commit()
+        self.open_part(self.exporter.allocate_part_num())
+
+    def add_file(self, key, mdata):
+        self.files[key] = mdata
+        with self.exporter.lock:
+            self.exporter.file_metadata[key] = mdata
+
+    def commit(self, is_last=False):
+        if self.f is None:
+            return
+        self.f.write(struct.pack(Exporter.TAIL_FMT, self.part_num, Exporter.VERSION, is_last))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.f = None
+        self.exporter.part_committed(self.part_num, self.files)
+        self.files = {}
+
+
 class Exporter:
 
+    '''
+    Export files into parts of approximately part_size bytes. Every completed
+    part is recorded in a journal, so that if the export is interrupted it can
+    be resumed, with resume=True, without exporting the files in the
+    completed parts again. Resuming discards any incomplete parts, and fails
+    if there is no journal, see :func:`export_can_be_resumed`.
+    '''
+
     VERSION = 0
     TAIL_FMT = b'!II?'  # part_num, version, is_last
     MDATA_SZ_FMT = b'!Q'
     EXT = '.calibre-data'
+    JOURNAL_NAME = 'export-journal.json'
 
-    def __init__(self, path_to_export_dir, part_size=(1 << 30)):
+    def __init__(self, path_to_export_dir, part_size=(1 << 30), resume=False):
         self.part_size = part_size
         self.base = os.path.abspath(path_to_export_dir)
-        self.parts = []
-        self.new_part()
+        self.lock = Lock()
+        self.used_part_nums = set()
+        self.idle_writers = []
+        self.committed = False
         self.file_metadata = {}
         self.metadata = {'file_metadata': self.file_metadata}
+        self.journal_path = os.path.join(self.base, self.JOURNAL_NAME)
+        entries = self.read_journal() if resume else ()
+        if entries is None:
+            # Without the journal, all the parts would be discarded as incomplete
+            raise ValueError(f'Cannot resume the export as there is no export journal in: {self.base}')
+        if resume:
+            # Remove parts that were incomplete when the export was interrupted
+            for name in os.listdir(self.base):
+                if name.endswith(self.EXT) and name not in {os.path.basename(self.part_path(num)) for num, files in entries}:
+                    os.remove(os.path.join(self.base, name))
+        self.journal = open(self.journal_path, 'w', encoding='utf-8')
+        for num, files in entries:
+            self.part_committed(num, files)
+
+    def read_journal(self):
+        tail_size = struct.calcsize(self.TAIL_FMT)
+        try:
+            with open(self.journal_path, encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return
+        entries = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # The export was interrupted while writing this entry
+            num = entry['part']
+            try:
+                with open(self.part_path(num), 'rb') as f:
+                    f.seek(-tail_size, os.SEEK_END)
+                    if struct.unpack(self.TAIL_FMT, f.read())[0] != num:
+                        continue
+            except (OSError, struct.error):
+                continue
+            self.used_part_nums.add(num)
+            self.file_metadata.update(entry['files'])
+            entries.append((num, entry['files']))
+        return entries
+
+    def part_path(self, num):
+        return os.path.join(self.base, f'part-{num:04d}{self.EXT}')
+
+    def allocate_part_num(self):
+        with self.lock:
+            num = 1
+            while num in self.used_part_nums:
+                num += 1
+            self.used_part_nums.add(num)
+            return num
+
+    def part_committed(self, num, files):
+        with self.lock:
+            self.journal.write(json.dumps({'part': num, 'files': files}, ensure_ascii=False) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def acquire_writer(self):
+        with self.lock:
+            if self.committed:
+                raise RuntimeError('This exporter has already been committed, cannot add to it')
+            return self.idle_writers.pop() if self.idle_writers else PartWriter(self)
+
+    def release_writer(self, writer):
+        with self.lock:
+            self.idle_writers.append(writer)
+
+    def has_file(self, key, mtime, size=None):
+        '''
+        Return True if the file with the specified key was exported by a
+        previous run of a resumed export and has not changed since.
+        '''
+        mdata = self.file_metadata.get(key)
+        return mdata is not None and mtime is not None and mdata[4] == mtime and (size is None or mdata[2] == size)
 
     def set_metadata(self, key, val):
         if key in self.metadata:
             raise KeyError('The metadata already contains the key: %s' % key)
         self.metadata[key] = val
 
-    @property
-    def f(self):
-        return self.parts[-1]
-
-    def new_part(self):
-        self.parts.append(open(os.path.join(
-            self.base, f'part-{len(self.parts) + 1:04d}{self.EXT}'), 'wb'))
-
-    def commit_part(self, is_last=False):
-        self.f.write(struct.pack(self.TAIL_FMT, len(self.parts), self.VERSION, is_last))
-        self.f.close()
-        self.parts[-1] = self.f.name
-
-    def ensure_space(self, size):
-        try:
-            if size + self.f.tell() < self.part_size:
-                return
-        except AttributeError:
-            raise RuntimeError('This exporter has already been committed, cannot add to it')
-        self.commit_part()
-        self.new_part()
-
     def commit(self):
+        with self.lock:
+            self.committed = True
+            writers, self.idle_writers = self.idle_writers, []
+        for w in writers:
+            w.commit()
         raw = json.dumps(self.metadata, ensure_ascii=False)
         if not isinstance(raw, bytes):
             raw = raw.encode('utf-8')
-        self.ensure_space(len(raw))
-        self.f.write(raw)
-        self.f.write(struct.pack(self.MDATA_SZ_FMT, len(raw)))
-        self.commit_part(is_last=True)
+        last = max(self.used_part_nums, default=0) + 1
+        # Parts that were incomplete when a resumed export was interrupted
+        # and were not needed again leave gaps in the part numbers
+        for num in sorted(set(range(1, last)) - self.used_part_nums):
+            w = PartWriter(self)
+            w.open_part(num)
+            w.commit()
+        w = PartWriter(self)
+        w.open_part(last)
+        w.f.write(raw)
+        w.f.write(struct.pack(self.MDATA_SZ_FMT, len(raw)))
+        w.commit(is_last=True)
+        self.journal.close()
+        os.remove(self.journal_path)
 
     def add_file(self, fileobj, key):
         fileobj.seek(0, os.SEEK_END)
         size = fileobj.tell()
         fileobj.seek(0)
-        self.ensure_space(size)
-        pos = self.f.tell()
-        digest = send_file(fileobj, self.f)
-        size = self.f.tell() - pos
-        mtime = os.fstat(fileobj.fileno()).st_mtime
-        self.file_metadata[key] = (len(self.parts), pos, size, digest, mtime)
+        writer = self.acquire_writer()
+        try:
+            writer.ensure_space(size)
+            pos = writer.f.tell()
+            digest = send_file(fileobj, writer.f)
+            size = writer.f.tell() - pos
+            mtime = os.fstat(fileobj.fileno()).st_mtime
+            writer.add_file(key, (writer.part_num, pos, size, digest, mtime))
+        finally:
+            self.release_writer(writer)
 
     def start_file(self, key, mtime=None):
         return FileDest(key, self, mtime=mtime)
@@ -178,14 +306,19 @@ def all_known_libraries():
     return added
 
 
-def export(destdir, library_paths=None, dbmap=None, progress1=None, progress2=None, abort=None):
+def export_can_be_resumed(destdir):
+    ' Return True if destdir contains an interrupted export that can be resumed '
+    return os.path.exists(os.path.join(destdir, Exporter.JOURNAL_NAME))
+
+
+def export(destdir, library_paths=None, dbmap=None, progress1=None, progress2=None, abort=None, num_threads=4, resume=False):
     from calibre.db.backend import DB
     from calibre.db.cache import Cache
     if library_paths is None:
         library_paths = all_known_libraries()
     dbmap = dbmap or {}
     dbmap = {os.path.normcase(os.path.abspath(k)):v for k, v in iteritems(dbmap)}
-    exporter = Exporter(destdir)
+    exporter = Exporter(destdir, resume=resume)
     exporter.metadata['libraries'] = libraries = {}
     total = len(library_paths) + 1
     for i, (lpath, count) in enumerate(iteritems(library_paths)):
@@ -201,7 +334,7 @@ def export(destdir, library_paths=None, dbmap=None, progress1=None, progress2=No
             closedb = True
         else:
             db = db.new_api
-        db.export_library(key, exporter, progress=progress2, abort=abort)
+        db.export_library(key, exporter, progress=progress2, abort=abort, num_threads=num_threads)
         if closedb:
             db.close()
         libraries[key] = count
@@ -218,6 +351,59 @@ def export(destdir, library_paths=None, dbmap=None, progress1=None, progress2=No
 # Import {{{
 
 
+class ImportJournal:
+
+    '''
+    A record of the steps of an import that have been completed, so that an
+    interrupted import can be resumed.
+    '''
+
+    NAME = '.calibre-import-journal'
+
+    def __init__(self, library_path, resume=False):
+        self.path = os.path.join(library_path, self.NAME)
+        self.done = set()
+        if resume:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    # The last line is incomplete if the import was
+                    # interrupted while writing it
+                    self.done = set(filter(None, f.read().split('\n')[:-1]))
+            except FileNotFoundError:
+                pass
+        self.f = open(self.path, 'w', encoding='utf-8')
+        for step in self.done:
+            self.f.write(step + '\n')
+        self.f.flush()
+
+    def __contains__(self, step):
+        return str(step) in self.done
+
+    def add(self, step):
+        step = str(step)
+        self.done.add(step)
+        self.f.write(step + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+def import_can_be_resumed(library_path):
+    ' Return True if library_path contains an interrupted import that can be resumed '
+    return os.path.exists(os.path.join(library_path, ImportJournal.NAME))
+
+
 class FileSource:
 
     def __init__(self, f, size, digest, description, mtime, importer):
@@ -342,7 +528,7 @@ def export_config(self, base_dir, library_usage_stats):
         gprefs['library_usage_stats'] = dict(library_usage_stats)
 
 
-def import_data(importer, library_path_map, config_location=None, progress1=None, progress2=None, abort=None):
+def import_data(importer, library_path_map, config_location=None, progress1=None, progress2=None, abort=None, num_threads=4, resume=False):
     from calibre.db.cache import import_library
     config_location = config_location or config_dir
     config_location = os.path.abspath(os.path.realpath(config_location))
@@ -362,7 +548,7 @@ def import_data(importer, library_path_map, config_location=None, progress1=None
                 raise
         if not os.path.isdir(dest):
             raise ValueError('%s is not a directory' % dest)
-        import_library(library_key, importer, dest, progress=progress2, abort=abort).close()
+        import_library(library_key, importer, dest, progress=progress2, abort=abort, num_threads=num_threads, resume=resume).close()
         stats_key = os.path.abspath(dest).replace(os.sep, '/')
         library_usage_stats[stats_key] = importer.metadata['libraries'].get(library_key, 1)
     if progress1 is not None:
@@ -427,7 +613,10 @@ def run_exporter(export_dir=None, args=None, check_known_libraries=True):
         export_dir = args[0]
         if not os.path.exists(export_dir):
             os.makedirs(export_dir)
-        if os.listdir(export_dir):
+        resume = export_can_be_resumed(export_dir)
+        if resume:
+            print('Resuming the interrupted export in:', export_dir)
+        elif os.listdir(export_dir):
             raise SystemExit('%s is not empty' % export_dir)
         all_libraries = {os.path.normcase(os.path.abspath(path)):lus for path, lus in iteritems(all_known_libraries())}
         if 'all' in args[1:]:
@@ -438,7 +627,7 @@ def run_exporter(export_dir=None, args=None, check_known_libraries=True):
             raise SystemExit('Unknown library: ' + tuple(libraries - set(all_libraries))[0])
         libraries = {p: all_libraries[p] for p in libraries}
         print('Exporting libraries:', ', '.join(sorted(libraries)), 'to:', export_dir)
-        export(export_dir, progress1=cli_report, progress2=cli_report, library_paths=libraries)
+        export(export_dir, progress1=cli_report, progress2=cli_report, library_paths=libraries, resume=resume)
         return
 
     export_dir = export_dir or input_unicode(
@@ -447,14 +636,16 @@ def run_exporter(export_dir=None, args=None, check_known_libraries=True):
         os.makedirs(export_dir)
     if not os.path.isdir(export_dir):
         raise SystemExit('%s is not a folder' % export_dir)
-    if os.listdir(export_dir):
+    resume = export_can_be_resumed(export_dir) and input_unicode(
+        'The folder contains an interrupted export, resume it [y/n]: ').strip().lower() == 'y'
+    if not resume and os.listdir(export_dir):
         raise SystemExit('%s is not empty' % export_dir)
     library_paths = {}
     for lpath, lus in iteritems(all_known_libraries()):
         if input_unicode('Export the library %s [y/n]: ' % lpath).strip().lower() == 'y':
             library_paths[lpath] = lus
     if library_paths:
-        export(export_dir, progress1=cli_report, progress2=cli_report, library_paths=library_paths)
+        export(export_dir, progress1=cli_report, progress2=cli_report, library_paths=library_paths, resume=resume)
     else:
         raise SystemExit('No libraries selected for export')
 
@@ -473,13 +664,55 @@ def run_importer():
         os.makedirs(import_dir)
     if not os.path.isdir(import_dir):
         raise SystemExit('%s is not a folder' % import_dir)
-    if os.listdir(import_dir):
+    library_path_map = {k:os.path.join(import_dir, os.path.basename(k)) for k in importer.metadata['libraries']}
+    resume = any(map(import_can_be_resumed, library_path_map.values())) and input_unicode(
+        'The folder contains an interrupted import, resume it [y/n]: ').strip().lower() == 'y'
+    if not resume and os.listdir(import_dir):
         raise SystemExit('%s is not empty' % import_dir)
-    import_data(importer, {
-        k:os.path.join(import_dir, os.path.basename(k)) for k in importer.metadata['libraries']}, progress1=cli_report, progress2=cli_report)
+    import_data(importer, library_path_map, progress1=cli_report, progress2=cli_report, resume=resume)
 
 # }}}
 
 
+def benchmark(num_books=200, format_size=1 << 20, thread_counts=(1, 4)):  # {{{
+    '''
+    Time the export and import of a synthetic library with num_books books,
+    each with one format of format_size bytes, using different numbers of
+    threads. Run it with::
+
+        calibre-debug -c "from calibre.utils.exim import benchmark; benchmark()"
+    '''
+    from io import BytesIO
+
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache, import_library
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.ptempfile import TemporaryDirectory
+    with TemporaryDirectory('exim-benchmark') as base:
+        lpath = os.path.join(base, 'library')
+        os.mkdir(lpath)
+        db = Cache(DB(lpath, load_user_formatter_functions=False))
+        db.init()
+        for i in range(num_books):
+            book_id = db.create_book_entry(Metadata(f'Book {i}', [f'Author {i % 17}']))
+            db.add_format(book_id, 'EPUB', BytesIO(os.urandom(format_size)), run_hooks=False)
+        total = num_books * format_size / (1 << 20)
+        for num_threads in thread_counts:
+            edir, idir = os.path.join(base, f'export-{num_threads}'), os.path.join(base, f'import-{num_threads}')
+            os.mkdir(edir), os.mkdir(idir)
+            st = time.monotonic()
+            exporter = Exporter(edir)
+            db.export_library('l', exporter, num_threads=num_threads)
+            exporter.commit()
+            et = time.monotonic() - st
+            st = time.monotonic()
+            import_library('l', Importer(edir), idir, num_threads=num_threads).close()
+            it = time.monotonic() - st
+            prints(f'{num_threads} threads: export: {et:.2f}s ({total/et:.1f} MB/s) import: {it:.2f}s ({total/it:.1f} MB/s)')
+            shutil.rmtree(edir), shutil.rmtree(idir)
+        db.close()
+# }}}
+
+
 if __name__ == '__main__':
     export(sys.argv[-1], progress1=print, progress2=print)
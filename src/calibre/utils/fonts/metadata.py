@@ -91,6 +91,28 @@ def to_dict(self):
         return ans
 
 
+def read_metadata_for_files(paths):
+    '''
+    Read the metadata of the specified font files, used by the font scanner in
+    worker processes. Returns a list of (metadata, error) in the order of
+    paths, the metadata is an empty dict for unsupported fonts.
+    '''
+    ans = []
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                fm = FontMetadata(f)
+        except UnsupportedFont:
+            ans.append(({}, None))
+        except Exception as e:
+            ans.append((None, str(e)))
+        else:
+            data = fm.to_dict()
+            data['path'] = path
+            ans.append((data, None))
+    return ans
+
+
 if __name__ == '__main__':
     import sys
     with open(sys.argv[-1], 'rb') as f:
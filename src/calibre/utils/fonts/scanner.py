@@ -5,17 +5,20 @@
 __copyright__ = '2012, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import mmap
 import os
 from collections import defaultdict
-from threading import Thread
+from threading import RLock, Thread
 
 from calibre import as_unicode, prints, walk
 from calibre.constants import (
-    DEBUG, config_dir, filesystem_encoding, ismacos, iswindows, isworker,
+    DEBUG, cache_dir, config_dir, filesystem_encoding, islinux, ismacos, iswindows,
+    isworker,
 )
 from calibre.utils.fonts.metadata import FontMetadata, UnsupportedFont
 from calibre.utils.icu import lower as icu_lower, sort_key
 from calibre.utils.resources import get_path as P
+from calibre.utils.serialize import msgpack_dumps, msgpack_loads
 from polyglot.builtins import itervalues
 
 
@@ -197,7 +200,11 @@ def build_families(cached_fonts, folders, family_attr='font-family'):
 
 class FontScanner(Thread):
 
-    CACHE_VERSION = 2
+    CACHE_VERSION = 3
+    # Metadata is read in worker processes when at least this many font
+    # files are new or changed
+    PARALLEL_READ_THRESHOLD = 64
+    PARALLEL_READ_BATCH_SIZE = 128
 
     def __init__(self, folders=[], allowed_extensions={'ttf', 'otf'}):
         super().__init__(daemon=True)
@@ -207,6 +214,8 @@ def __init__(self, folders=[], allowed_extensions={'ttf', 'otf'}):
                 self.folders]
         self.font_families = ()
         self.allowed_extensions = allowed_extensions
+        self.scan_lock = RLock()
+        self.watcher = None
 
     # API {{{
     def find_font_families(self):
@@ -301,82 +310,185 @@ def filter_faces(font):
         return None, None
     # }}}
 
+    @property
+    def index_path(self):
+        return os.path.join(cache_dir(), 'fonts', 'scanner-index.msgpack')
+
     def reload_cache(self):
-        if not hasattr(self, 'cache'):
-            from calibre.utils.config import JSONConfig
-            self.cache = JSONConfig('fonts/scanner_cache')
-        else:
-            self.cache.refresh()
-        if self.cache.get('version', None) != self.CACHE_VERSION:
-            self.cache.clear()
-        self.cached_fonts = self.cache.get('fonts', {})
+        # The index is a single msgpack file, so that worker processes can
+        # load it without scanning. It is deserialized in full, the mmap only
+        # avoids an extra copy of the raw bytes while doing so.
+        self.cached_fonts = {}
+        try:
+            with open(self.index_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                index = msgpack_loads(m)
+        except Exception:
+            return
+        if isinstance(index, dict) and index.get('version') == self.CACHE_VERSION:
+            self.cached_fonts = index.get('fonts', {})
 
     def run(self):
         self.do_scan()
 
-    def do_scan(self):
-        self.reload_cache()
-
-        if isworker:
-            # Dont scan font files in worker processes, use whatever is
-            # cached. Font files typically dont change frequently enough to
-            # justify a rescan in a worker process.
-            self.build_families()
-            return
+    def is_font_file(self, path):
+        return path.rpartition('.')[-1].lower() in self.allowed_extensions and os.path.isfile(path)
 
-        cached_fonts = self.cached_fonts.copy()
-        self.cached_fonts.clear()
-        for folder in self.folders:
-            if not os.path.isdir(folder):
-                continue
-            try:
-                files = tuple(walk(folder))
-            except OSError as e:
-                if DEBUG:
-                    prints('Failed to walk font folder:', folder,
-                            as_unicode(e))
-                continue
-            for candidate in files:
-                if (candidate.rpartition('.')[-1].lower() not in self.allowed_extensions or not os.path.isfile(candidate)):
-                    continue
-                candidate = os.path.normcase(os.path.abspath(candidate))
-                try:
-                    s = os.stat(candidate)
-                except OSError:
-                    continue
-                fileid = f'{candidate}||{s.st_size}:{s.st_mtime}'
-                if fileid in cached_fonts:
-                    # Use previously cached metadata, since the file size and
-                    # last modified timestamp have not changed.
-                    self.cached_fonts[fileid] = cached_fonts[fileid]
+    def do_scan(self):
+        with self.scan_lock:
+            self.reload_cache()
+
+            if isworker:
+                # Dont scan font files in worker processes, use whatever is
+                # cached. Font files typically dont change frequently enough to
+                # justify a rescan in a worker process.
+                self.build_families()
+                return
+
+            cached_fonts = self.cached_fonts.copy()
+            self.cached_fonts.clear()
+            unknown = []
+            for folder in self.folders:
+                if not os.path.isdir(folder):
                     continue
                 try:
-                    self.read_font_metadata(candidate, fileid)
-                except Exception as e:
+                    files = tuple(walk(folder))
+                except OSError as e:
                     if DEBUG:
-                        prints('Failed to read metadata from font file:',
-                                candidate, as_unicode(e))
+                        prints('Failed to walk font folder:', folder,
+                                as_unicode(e))
                     continue
+                for candidate in files:
+                    if not self.is_font_file(candidate):
+                        continue
+                    candidate = os.path.normcase(os.path.abspath(candidate))
+                    try:
+                        s = os.stat(candidate)
+                    except OSError:
+                        continue
+                    fileid = f'{candidate}||{s.st_size}:{s.st_mtime}'
+                    if fileid in cached_fonts:
+                        # Use previously cached metadata, since the file size and
+                        # last modified timestamp have not changed.
+                        self.cached_fonts[fileid] = cached_fonts[fileid]
+                    else:
+                        unknown.append((candidate, fileid))
+            self.read_fonts_metadata(unknown)
+
+            if frozenset(cached_fonts) != frozenset(self.cached_fonts):
+                # Write out the cache only if some font files have changed
+                self.write_cache()
 
-        if frozenset(cached_fonts) != frozenset(self.cached_fonts):
-            # Write out the cache only if some font files have changed
-            self.write_cache()
+            self.build_families()
 
-        self.build_families()
+    def update_paths(self, paths):
+        '''
+        Update the cached fonts for only the specified files and folders, which
+        have been created, changed or deleted. A path of None means that
+        anything could have changed and does a full scan.
+        '''
+        if None in paths:
+            return self.do_scan()
+        with self.scan_lock:
+            before = frozenset(self.cached_fonts)
+            paths = {os.path.normcase(os.path.abspath(path)) for path in paths}
+            prefixes = tuple(path + os.sep for path in paths)
+            for fileid in tuple(self.cached_fonts):
+                fpath = fileid.rpartition('||')[0]
+                if fpath in paths or fpath.startswith(prefixes):
+                    del self.cached_fonts[fileid]
+            unknown = []
+            for path in paths:
+                files = walk(path) if os.path.isdir(path) else (path,)
+                for candidate in files:
+                    if not self.is_font_file(candidate):
+                        continue
+                    candidate = os.path.normcase(os.path.abspath(candidate))
+                    try:
+                        s = os.stat(candidate)
+                    except OSError:
+                        continue
+                    fileid = f'{candidate}||{s.st_size}:{s.st_mtime}'
+                    if fileid not in self.cached_fonts:
+                        unknown.append((candidate, fileid))
+            self.read_fonts_metadata(unknown)
+            if before != frozenset(self.cached_fonts):
+                self.write_cache()
+                self.build_families()
+
+    def watch_for_changes(self):
+        if self.watcher is None and islinux and not isworker:
+            self.watcher = FontWatcher(self)
+            self.watcher.start()
 
     def build_families(self):
         self.font_family_map, self.font_families = build_families(self.cached_fonts, self.folders)
 
     def write_cache(self):
-        # writing to the cache is atomic thanks to JSONConfig
-        with self.cache:
-            self.cache['version'] = self.CACHE_VERSION
-            self.cache['fonts'] = self.cached_fonts
+        # Write to a temporary file and rename it, so that the index is
+        # replaced atomically for other processes
+        from calibre.utils.filenames import atomic_rename
+        path = self.index_path
+        tpath = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tpath, 'wb') as f:
+                f.write(msgpack_dumps({'version': self.CACHE_VERSION, 'fonts': self.cached_fonts}))
+            atomic_rename(tpath, path)
+        except OSError as e:
+            if DEBUG:
+                prints('Failed to write font scanner index:', path, as_unicode(e))
 
     def force_rescan(self):
         self.cached_fonts = {}
         self.write_cache()
 
+    def read_fonts_metadata(self, candidates):
+        ''' Read metadata for the list of (path, fileid) candidates, in worker
+        processes if there are many of them. '''
+        if len(candidates) < self.PARALLEL_READ_THRESHOLD:
+            return self.read_fonts_metadata_in_process(candidates)
+        from calibre.utils.ipc.pool import Pool
+        from polyglot.queue import Empty
+        pool = Pool(name='FontScanner')
+        batches = {}
+        try:
+            for i in range(0, len(candidates), self.PARALLEL_READ_BATCH_SIZE):
+                batch = batches[i] = candidates[i:i+self.PARALLEL_READ_BATCH_SIZE]
+                pool(i, 'calibre.utils.fonts.metadata', 'read_metadata_for_files', [path for path, fileid in batch])
+            while batches and not pool.failed:
+                try:
+                    wr = pool.results.get(timeout=0.1)
+                except Empty:
+                    continue
+                if wr.is_terminal_failure:
+                    break
+                batch = batches.pop(wr.id)
+                if wr.result.err is not None:
+                    if DEBUG:
+                        prints('Failed to read metadata from font files:', wr.result.err)
+                    continue
+                for (path, fileid), (data, err) in zip(batch, wr.result.value):
+                    if data is not None:
+                        self.cached_fonts[fileid] = data
+                    elif DEBUG:
+                        prints('Failed to read metadata from font file:', path, err)
+        finally:
+            pool.shutdown()
+        if batches:
+            # The worker pool failed, read the remaining fonts in this process
+            if DEBUG:
+                prints('Font metadata worker pool failed:', pool.terminal_failure)
+            self.read_fonts_metadata_in_process([c for batch in batches.values() for c in batch])
+
+    def read_fonts_metadata_in_process(self, candidates):
+        for path, fileid in candidates:
+            try:
+                self.read_font_metadata(path, fileid)
+            except Exception as e:
+                if DEBUG:
+                    prints('Failed to read metadata from font file:',
+                            path, as_unicode(e))
+
     def read_font_metadata(self, path, fileid):
         with open(path, 'rb') as f:
             try:
@@ -405,6 +517,63 @@ def dump_fonts(self):
             prints()
 
 
+class FontWatcher(Thread):
+
+    ''' Keep the font index up to date as fonts are installed or removed,
+    using inotify, so that other processes can use it without scanning. '''
+
+    # Wait for this many seconds after a change for further changes, as fonts
+    # are usually installed many at a time
+    SETTLE_TIME = 1
+
+    def __init__(self, scanner):
+        super().__init__(daemon=True, name='FontWatcher')
+        self.scanner = scanner
+
+    def run(self):
+        import select
+
+        from calibre.utils.inotify import INotifyTreeWatcher
+        watchers = {}
+        for folder in self.scanner.folders:
+            if not os.path.isdir(folder):
+                continue
+            try:
+                w = INotifyTreeWatcher(folder)
+            except Exception as e:
+                # Too many folders to watch or no inotify support
+                if DEBUG:
+                    prints('Cannot watch font folder:', folder, as_unicode(e))
+                continue
+            watchers[w._inotify_fd] = folder, w
+        while watchers:
+            modified = set()
+            timeout = None
+            while True:
+                r = select.select(list(watchers), [], [], timeout)[0]
+                if not r:
+                    break
+                for fd in r:
+                    folder, w = watchers[fd]
+                    try:
+                        changed = w()
+                    except Exception:
+                        # The folder itself was moved or deleted
+                        del watchers[fd]
+                        w.close()
+                        modified.add(None)
+                        continue
+                    # Map paths back to the folder, which may be a symlink
+                    modified |= {None if p is None else folder + p[len(w.basedir):] for p in changed}
+                timeout = self.SETTLE_TIME
+            try:
+                self.scanner.update_paths(modified)
+            except Exception:
+                if DEBUG:
+                    import traceback
+                    traceback.print_exc()
+
+
 font_scanner = FontScanner()
 font_scanner.start()
 
@@ -415,5 +584,111 @@ def force_rescan():
     font_scanner.run()
 
 
+def watch_font_folders():
+    ''' Keep the font index up to date while this process is running. Only
+    long running processes, such as the GUI and the server, should call this,
+    as it uses a thread and inotify watches for every font folder. '''
+    font_scanner.watch_for_changes()
+
+
+def find_tests():
+    import shutil
+    import tempfile
+    import unittest
+
+    class Scanner(FontScanner):
+
+        def __init__(self, tdir):
+            super().__init__()
+            self.folders = [os.path.normcase(os.path.abspath(os.path.join(tdir, 'fonts')))]
+            self.tdir = tdir
+            self.num_writes = 0
+
+        @property
+        def index_path(self):
+            return os.path.join(self.tdir, 'index.msgpack')
+
+        def write_cache(self):
+            self.num_writes += 1
+            return super().write_cache()
+
+    class TestFontIndex(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+            self.font_dir = os.path.join(self.tdir, 'fonts')
+            os.mkdir(self.font_dir)
+            self.font_path = os.path.join(self.font_dir, 'symbols.otf')
+            shutil.copy2(P('fonts/calibreSymbols.otf'), self.font_path)
+
+        def tearDown(self):
+            shutil.rmtree(self.tdir)
+
+        def paths(self, s):
+            return sorted(os.path.basename(f['path']) for f in s.cached_fonts.values() if f)
+
+        def test_font_index(self):
+            s = Scanner(self.tdir)
+            s.do_scan()
+            self.assertEqual(self.paths(s), ['symbols.otf'])
+            self.assertEqual(s.num_writes, 1)
+            self.assertTrue(s.font_families)
+            # A new scanner uses the index and does not rewrite it
+            t = Scanner(self.tdir)
+            t.reload_cache()
+            self.assertEqual(set(t.cached_fonts), set(s.cached_fonts))
+            self.assertEqual(self.paths(t), ['symbols.otf'])
+            t.do_scan()
+            self.assertEqual(t.num_writes, 0)
+            self.assertEqual(t.font_families, s.font_families)
+            # An index from a different version of the scanner is ignored
+            with open(t.index_path, 'wb') as f:
+                f.write(msgpack_dumps({'version': t.CACHE_VERSION - 1, 'fonts': s.cached_fonts}))
+            t.reload_cache()
+            self.assertEqual(t.cached_fonts, {})
+            # So is a corrupted index
+            with open(t.index_path, 'wb') as f:
+                f.write(b'\xc1')
+            t.reload_cache()
+            self.assertEqual(t.cached_fonts, {})
+
+        def test_font_index_invalidation(self):
+            s = Scanner(self.tdir)
+            s.do_scan()
+            old_ids = set(s.cached_fonts)
+            # A changed font file is read again
+            st = os.stat(self.font_path)
+            os.utime(self.font_path, (st.st_atime, st.st_mtime + 10))
+            t = Scanner(self.tdir)
+            t.do_scan()
+            self.assertEqual(t.num_writes, 1)
+            self.assertEqual(self.paths(t), ['symbols.otf'])
+            self.assertFalse(old_ids & set(t.cached_fonts))
+            t.reload_cache()
+            self.assertFalse(old_ids & set(t.cached_fonts))
+            # New and deleted font files
+            shutil.copy2(self.font_path, os.path.join(self.font_dir, 'copy.otf'))
+            t.update_paths({os.path.join(self.font_dir, 'copy.otf')})
+            self.assertEqual(self.paths(t), ['copy.otf', 'symbols.otf'])
+            os.remove(self.font_path)
+            t.update_paths({self.font_path})
+            self.assertEqual(self.paths(t), ['copy.otf'])
+            # Changes to other files do not rewrite the index
+            num_writes = t.num_writes
+            with open(os.path.join(self.font_dir, 'readme.txt'), 'w') as f:
+                f.write('xxx')
+            t.update_paths({self.font_dir})
+            self.assertEqual(t.num_writes, num_writes)
+            # Deleting a folder removes all the fonts in it
+            shutil.rmtree(self.font_dir)
+            t.update_paths({self.font_dir})
+            self.assertEqual(self.paths(t), [])
+            u = Scanner(self.tdir)
+            u.reload_cache()
+            self.assertEqual(u.cached_fonts, {})
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestFontIndex)
+
+
 if __name__ == '__main__':
     font_scanner.dump_fonts()
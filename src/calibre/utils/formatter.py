@@ -15,6 +15,7 @@
 from functools import partial
 from math import modf
 from sys import exc_info
+from threading import Lock
 
 from calibre import prints
 from calibre.constants import DEBUG
@@ -988,6 +989,8 @@ def program(self, funcs, parent, prog, val, is_call=False, args=None,
             if is_call:
                 # prog is an instance of the function definition class
                 ret =  self.do_node_stored_template_call(StoredTemplateCallNode(1, prog.name, prog, None), args=args)
+            elif self.break_reporter is None and getattr(prog, 'compiled', None) is not None:
+                ret = prog.compiled(self)
             else:
                 ret = self.expression_list(prog)
         except ReturnExecuted as e:
@@ -1584,6 +1587,476 @@ def expr(self, prog):
                        prog.line_number)
 
 
+class _ProgramTree(list):
+    # A parsed template program along with its compiled form. See _Compiler
+    compiled = None
+
+
+class _Compiler:
+    '''
+    Compile the parse tree of a template program into nested closures, each
+    of which takes the :class:`_Interpreter` running the program as its only
+    argument. The closures have the same semantics as the corresponding
+    do_node_* methods of the interpreter, except that they never call the
+    break reporter, so compiled programs are only used when there is no break
+    reporter. Nodes that have no compiled form are evaluated by the
+    interpreter.
+    '''
+
+    def compile_program(self, prog):
+        return self.expression_list(prog)
+
+    def expression_list(self, prog):
+        exprs = tuple(self.expr(p) for p in prog)
+
+        def expression_list(ip):
+            val = ''
+            try:
+                for expr in exprs:
+                    val = expr(ip)
+            except (BreakExecuted, ContinueExecuted) as e:
+                e.set_value(val)
+                raise e
+            return val
+        return expression_list
+
+    def expr(self, prog):
+        if isinstance(prog, list):
+            return self.expression_list(prog)
+        compiler = self.NODE_COMPILERS.get(prog.node_type)
+        f = None if compiler is None else compiler(self, prog)
+        if f is None:
+            def interpreted(ip):
+                return ip.expr(prog)
+            return interpreted
+        line_number = prog.line_number
+
+        def expr(ip):
+            try:
+                return f(ip)
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                if (DEBUG):
+                    traceback.print_exc()
+                ip.error(_("Internal error evaluating an expression: '{0}'").format(str(e)), line_number)
+        return expr
+
+    def do_node_if(self, prog):
+        condition = self.expr(prog.condition)
+        then_part = self.expression_list(prog.then_part)
+        else_part = self.expression_list(prog.else_part) if prog.else_part else None
+
+        def f(ip):
+            if condition(ip):
+                return then_part(ip)
+            elif else_part is not None:
+                return else_part(ip)
+            return ''
+        return f
+
+    def do_node_rvalue(self, prog):
+        name, line_number = prog.name, prog.line_number
+
+        def f(ip):
+            try:
+                return ip.locals[name]
+            except:
+                ip.error(_("Unknown identifier '{0}'").format(name), line_number)
+        return f
+
+    def do_node_func(self, prog):
+        args = tuple(self.expr(arg) for arg in prog.expression_list)
+        id_ = prog.name.strip()
+
+        def f(ip):
+            vals = [arg(ip) for arg in args]
+            return ip.funcs[id_].eval_(ip.parent, ip.parent_kwargs, ip.parent_book, ip.locals, *vals)
+        return f
+
+    def do_node_constant(self, prog):
+        value = prog.value
+
+        def f(ip):
+            return value
+        return f
+
+    def do_node_field(self, prog):
+        expression, line_number = self.expr(prog.expression), prog.line_number
+
+        def f(ip):
+            try:
+                name = expression(ip)
+                try:
+                    return ip.parent.get_value(name, [], ip.parent_kwargs)
+                except StopException:
+                    raise
+                except:
+                    ip.error(_("Unknown field '{0}'").format(name), line_number)
+            except (StopException, ValueError):
+                raise
+            except:
+                ip.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return f
+
+    def do_node_raw_field(self, prog):
+        expression, line_number = self.expr(prog.expression), prog.line_number
+        default = None if prog.default is None else self.expr(prog.default)
+
+        def f(ip):
+            try:
+                name = field_metadata.search_term_to_field_key(expression(ip))
+                res = getattr(ip.parent_book, name, None)
+                if res is None and default is not None:
+                    return default(ip)
+                if res is not None and isinstance(res, list):
+                    fm = ip.parent_book.metadata_for_field(name)
+                    if fm is None:
+                        return ', '.join(res)
+                    return fm['is_multiple']['list_to_ui'].join(res)
+                return str(res)
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return f
+
+    def do_node_assign(self, prog):
+        left, right = prog.left, self.expr(prog.right)
+
+        def f(ip):
+            ip.locals[left] = t = right(ip)
+            return t
+        return f
+
+    def do_node_first_non_empty(self, prog):
+        exprs = tuple(self.expr(e) for e in prog.expression_list)
+
+        def f(ip):
+            for expr in exprs:
+                v = expr(ip)
+                if v:
+                    return v
+            return ''
+        return f
+
+    def do_node_switch(self, prog):
+        exprs = tuple(self.expr(e) for e in prog.expression_list)
+        value, default = exprs[0], exprs[-1]
+        cases = tuple((exprs[i], exprs[i+1]) for i in range(1, len(exprs)-1, 2))
+
+        def f(ip):
+            val = value(ip)
+            for pattern, result in cases:
+                if re.search(pattern(ip), val, flags=re.I):
+                    return result(ip)
+            return default(ip)
+        return f
+
+    def do_node_switch_if(self, prog):
+        exprs = tuple(self.expr(e) for e in prog.expression_list)
+        cases = tuple((exprs[i], exprs[i+1]) for i in range(0, len(exprs)-1, 2))
+        default = exprs[-1]
+
+        def f(ip):
+            for test, result in cases:
+                if test(ip):
+                    return result(ip)
+            return default(ip)
+        return f
+
+    def do_node_strcat(self, prog):
+        exprs = tuple(self.expr(e) for e in prog.expression_list)
+
+        def f(ip):
+            return ''.join([expr(ip) for expr in exprs])
+        return f
+
+    def do_node_break(self, prog):
+        def f(ip):
+            raise BreakExecuted()
+        return f
+
+    def do_node_continue(self, prog):
+        def f(ip):
+            raise ContinueExecuted()
+        return f
+
+    def do_node_return(self, prog):
+        expr = self.expr(prog.expr)
+
+        def f(ip):
+            e = ReturnExecuted()
+            e.set_value(expr(ip))
+            raise e
+        return f
+
+    def do_node_contains(self, prog):
+        value, test = self.expr(prog.value_expression), self.expr(prog.test_expression)
+        match, not_match = self.expr(prog.match_expression), self.expr(prog.not_match_expression)
+
+        def f(ip):
+            v = value(ip)
+            if re.search(test(ip), v, flags=re.I):
+                return match(ip)
+            return not_match(ip)
+        return f
+
+    def do_node_string_infix(self, prog):
+        op = _Interpreter.INFIX_STRING_COMPARE_OPS.get(prog.operator)
+        if op is None:
+            return None
+        left, right, line_number = self.expr(prog.left), self.expr(prog.right), prog.line_number
+        error = _("Error during string comparison: operator '{0}'").format(prog.operator)
+
+        def f(ip):
+            try:
+                return '1' if op(left(ip), right(ip)) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.error(error, line_number)
+        return f
+
+    def do_node_numeric_infix(self, prog):
+        op = _Interpreter.INFIX_NUMERIC_COMPARE_OPS.get(prog.operator)
+        if op is None:
+            return None
+        left, right, line_number = self.expr(prog.left), self.expr(prog.right), prog.line_number
+        error = _("Value used in comparison is not a number: operator '{0}'").format(prog.operator)
+
+        def f(ip):
+            try:
+                return '1' if op(ip.float_deal_with_none(left(ip)), ip.float_deal_with_none(right(ip))) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.error(error, line_number)
+        return f
+
+    def do_node_logop(self, prog):
+        if prog.operator not in ('and', 'or'):
+            return None
+        is_and = prog.operator == 'and'
+        left, right, line_number = self.expr(prog.left), self.expr(prog.right), prog.line_number
+        error = _("Error during operator evaluation: operator '{0}'").format(prog.operator)
+
+        def f(ip):
+            try:
+                if is_and:
+                    return '1' if (left(ip) and right(ip)) else ''
+                return '1' if (left(ip) or right(ip)) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.error(error, line_number)
+        return f
+
+    def do_node_logop_unary(self, prog):
+        if prog.operator != 'not':
+            return None
+        expr = self.expr(prog.expr)
+
+        def f(ip):
+            return '' if expr(ip) else '1'
+        return f
+
+    def do_node_binary_arithop(self, prog):
+        op = _Interpreter.ARITHMETIC_BINARY_OPS.get(prog.operator)
+        if op is None:
+            return None
+        left, right, line_number = self.expr(prog.left), self.expr(prog.right), prog.line_number
+        error = _("Error during operator evaluation: operator '{0}'").format(prog.operator)
+
+        def f(ip):
+            try:
+                answer = op(ip.float_deal_with_none(left(ip)), ip.float_deal_with_none(right(ip)))
+                return str(answer if modf(answer)[0] != 0 else int(answer))
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.error(error, line_number)
+        return f
+
+    def do_node_unary_arithop(self, prog):
+        op = _Interpreter.ARITHMETIC_UNARY_OPS.get(prog.operator)
+        if op is None:
+            return None
+        expr, line_number = self.expr(prog.expr), prog.line_number
+        error = _("Error during operator evaluation: operator '{0}'").format(prog.operator)
+
+        def f(ip):
+            try:
+                answer = op(float(expr(ip)))
+                return str(answer if modf(answer)[0] != 0 else int(answer))
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.error(error, line_number)
+        return f
+
+    def do_node_stringops(self, prog):
+        left, right, line_number = self.expr(prog.left), self.expr(prog.right), prog.line_number
+        error = _("Error during operator evaluation: operator '{0}'").format(prog.operator)
+
+        def f(ip):
+            try:
+                return left(ip) + right(ip)
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.error(error, line_number)
+        return f
+
+    # Nodes that are not listed here, such as for loops and calls to stored
+    # templates and local functions, are evaluated by the interpreter
+    NODE_COMPILERS = {
+        Node.NODE_IF:               do_node_if,
+        Node.NODE_ASSIGN:           do_node_assign,
+        Node.NODE_CONSTANT:         do_node_constant,
+        Node.NODE_RVALUE:           do_node_rvalue,
+        Node.NODE_FUNC:             do_node_func,
+        Node.NODE_FIELD:            do_node_field,
+        Node.NODE_RAW_FIELD:        do_node_raw_field,
+        Node.NODE_COMPARE_STRING:   do_node_string_infix,
+        Node.NODE_COMPARE_NUMERIC:  do_node_numeric_infix,
+        Node.NODE_FIRST_NON_EMPTY:  do_node_first_non_empty,
+        Node.NODE_SWITCH:           do_node_switch,
+        Node.NODE_SWITCH_IF:        do_node_switch_if,
+        Node.NODE_CONTAINS:         do_node_contains,
+        Node.NODE_BINARY_LOGOP:     do_node_logop,
+        Node.NODE_UNARY_LOGOP:      do_node_logop_unary,
+        Node.NODE_BINARY_ARITHOP:   do_node_binary_arithop,
+        Node.NODE_UNARY_ARITHOP:    do_node_unary_arithop,
+        Node.NODE_BREAK:            do_node_break,
+        Node.NODE_CONTINUE:         do_node_continue,
+        Node.NODE_RETURN:           do_node_return,
+        Node.NODE_STRCAT:           do_node_strcat,
+        Node.NODE_BINARY_STRINGOP:  do_node_stringops,
+    }
+
+
+# Builtin template functions whose results depend only on their arguments
+# (and the interface language). See _DependencyFinder
+PURE_FUNCTIONS = frozenset((
+    'add', 'and', 'assign', 'capitalize', 'ceiling', 'character', 'cmp', 'contains', 'count',
+    'date_arithmetic', 'days_between', 'divide', 'finish_formatting',
+    'first_matching_cmp', 'first_non_empty', 'floor', 'format_date', 'format_number',
+    'fractional_part', 'human_readable', 'identifier_in_list', 'ifempty', 'in_list',
+    'language_codes', 'language_strings', 'list_count', 'list_count_matching',
+    'list_difference', 'list_equals', 'list_intersection', 'list_item', 'list_join',
+    'list_re', 'list_re_group', 'list_remove_duplicates', 'list_sort', 'list_split',
+    'list_union', 'lowercase', 'mod', 'multiply', 'not', 'or', 'print', 'range',
+    'rating_to_stars', 're', 're_group', 'round', 'select', 'shorten', 'str_in_list',
+    'strcat', 'strcat_max', 'strcmp', 'strcmpcase', 'strlen', 'sublist', 'subitems',
+    'substr', 'subtract', 'switch', 'switch_if', 'test', 'titlecase', 'to_hex',
+    'transliterate', 'uppercase',
+))
+
+
+class _DependencyFinder:
+
+    # Find the fields a template refers to by examining its parse tree. If
+    # anything other than those fields can affect the result of the template,
+    # for example template functions that read book data, stored templates or
+    # fields whose names are computed when the template runs, complete is set
+    # to False.
+
+    def __init__(self, formatter, funcs):
+        self.formatter, self.funcs = formatter, funcs
+        self.builtins = formatter_functions().get_builtins_and_aliases()
+        self.fields = set()
+        self.complete = True
+
+    def template(self, fmt):
+        if fmt.startswith('python:'):
+            self.complete = False
+        elif fmt.startswith('program:'):
+            self.program(fmt[8:])
+        else:
+            self.single_function_mode(fmt)
+        return self
+
+    def program(self, text):
+        try:
+            tree = self.formatter.gpm_parser.program(self.formatter, self.funcs, self.formatter.lex_scanner.scan(text))
+        except Exception:
+            self.complete = False
+        else:
+            self.walk(tree)
+
+    def single_function_mode(self, fmt):
+        # Mirrors the handling of format specs in TemplateFormatter.format_field()
+        try:
+            parts = tuple(self.formatter.parse(fmt))
+        except ValueError:
+            self.complete = False
+            return
+        for literal, name, spec, conversion in parts:
+            if name:
+                self.fields.add(name.lower())
+            if not spec:
+                continue
+            spec = self.formatter._explode_format_string(spec)[0]
+            if not spec:
+                continue
+            p = 0 if spec.startswith("'") else spec.find(":'")
+            if p > 0:
+                p += 1
+            if p >= 0 and spec[-1] == "'":
+                self.program(spec[p+1:-1])
+            else:
+                p = spec.find('(')
+                if p >= 0 and spec[-1] == ')':
+                    self.function(spec[spec[0:p].find(':')+1:p].strip())
+
+    def function(self, name):
+        if name not in PURE_FUNCTIONS or self.funcs.get(name) is not self.builtins.get(name):
+            self.complete = False
+
+    def constant(self, expr):
+        if isinstance(expr, list) and len(expr) == 1:
+            expr = expr[0]
+        if getattr(expr, 'node_type', None) == Node.NODE_CONSTANT:
+            return expr.value
+
+    def walk(self, node):
+        if isinstance(node, list):
+            for x in node:
+                self.walk(x)
+            return
+        if not isinstance(node, Node):
+            return
+        nt = node.node_type
+        if nt in (Node.NODE_FIELD, Node.NODE_RAW_FIELD):
+            name = self.constant(node.expression)
+            if name is None:
+                self.complete = False
+            else:
+                self.fields.add(name.lower())
+        elif nt == Node.NODE_FUNC:
+            self.function(node.name.strip())
+        elif nt == Node.NODE_CALL_STORED_TEMPLATE:
+            self.complete = False
+        elif nt == Node.NODE_FOR:
+            # The list expression can be the name of a field
+            name = self.constant(node.list_field_expr)
+            if name is None:
+                self.complete = False
+            elif name.isidentifier() or name.startswith('#'):
+                self.fields.add(name.lower())
+        for val in vars(node).values():
+            if isinstance(val, (list, Node)):
+                self.walk(val)
+
+
+# Parsed and compiled template programs shared by all formatters, keyed by
+# program text and function set. See TemplateFormatter._parse_program()
+_program_cache = OrderedDict()
+_program_cache_lock = Lock()
+_PROGRAM_CACHE_SIZE = 1024
+
+
 class TemplateFormatter(string.Formatter):
     '''
     Provides a format function that substitutes '' for any missing value
@@ -1677,17 +2150,58 @@ def _explode_format_string(self, fmt):
             (r'\s',                      lambda x,t: _Parser.LEX_NEWLINE if t == '\n' else None),  # noqa
         ], flags=re.DOTALL)
 
+    def _parse_program(self, prog):
+        # Parsing depends on the set of available functions, so cached programs
+        # are keyed on it and discarded when functions are added or removed
+        key = prog, id(self.funcs)
+        version = formatter_functions().version
+        with _program_cache_lock:
+            entry = _program_cache.get(key)
+            if entry is not None and entry[0] is self.funcs and entry[1] == version:
+                _program_cache.move_to_end(key)
+                return entry[2]
+        tree = _ProgramTree(self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog)))
+        tree.compiled = _Compiler().compile_program(tree)
+        with _program_cache_lock:
+            _program_cache[key] = self.funcs, version, tree
+            while len(_program_cache) > _PROGRAM_CACHE_SIZE:
+                _program_cache.popitem(last=False)
+        return tree
+
     def _eval_program(self, val, prog, column_name, global_vars, break_reporter):
         if column_name is not None and self.template_cache is not None:
             tree = self.template_cache.get(column_name, None)
             if not tree:
-                tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
+                tree = self._parse_program(prog)
                 self.template_cache[column_name] = tree
         else:
-            tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
+            tree = self._parse_program(prog)
         return self.gpm_interpreter.program(self.funcs, self, tree, val,
                                 global_vars=global_vars, break_reporter=break_reporter)
 
+    def referenced_fields(self, fmt, template_functions=None):
+        '''
+        Return the set of names of the fields that the template fmt refers to,
+        found by parsing the template without evaluating it. Fields used by
+        template functions, stored templates or with names computed when the
+        template is run are not found, so the result is suitable for
+        prefetching field values but not as a complete list of dependencies.
+        See :meth:`template_dependencies` for that.
+        '''
+        funcs = template_functions or formatter_functions().get_functions()
+        return _DependencyFinder(self, funcs).template(fmt).fields
+
+    def template_dependencies(self, fmt, template_functions=None):
+        '''
+        Return the set of names of the fields whose values determine the
+        result of the template fmt, or None if the result can also depend on
+        other things, such as template functions that read data that is not
+        passed to them as arguments or the current time.
+        '''
+        funcs = template_functions or formatter_functions().get_functions()
+        finder = _DependencyFinder(self, funcs).template(fmt)
+        return finder.fields if finder.complete else None
+
     def _eval_sfm_call(self, template_name, args, global_vars):
         func = self.funcs[template_name]
         compiled_text = func.cached_compiled_text
@@ -53,6 +53,9 @@ def __init__(self):
         self._builtins = {}
         self._functions = {}
         self._functions_from_library = {}
+        # Incremented whenever the set of functions changes, used to
+        # invalidate cached template programs
+        self.version = 0
 
     def register_builtin(self, func_class):
         if not isinstance(func_class, FormatterFunction):
@@ -65,6 +68,7 @@ def register_builtin(self, func_class):
         self._functions[name] = func_class
         for a in func_class.aliases:
             self._functions[a] = func_class
+        self.version += 1
 
     def _register_function(self, func_class, replace=False):
         if not isinstance(func_class, FormatterFunction):
@@ -74,6 +78,7 @@ def _register_function(self, func_class, replace=False):
         if not replace and name in self._functions:
             raise ValueError('Name %s already used'%name)
         self._functions[name] = func_class
+        self.version += 1
 
     def register_functions(self, library_uuid, funcs):
         self._functions_from_library[library_uuid] = funcs
@@ -105,6 +110,7 @@ def unregister_functions(self, library_uuid):
             for cls in self._functions_from_library[library_uuid]:
                 self._functions.pop(cls.name, None)
             self._functions_from_library.pop(library_uuid)
+            self.version += 1
             self._register_functions()
 
     def get_builtins(self):
@@ -127,6 +133,7 @@ def reset_to_builtins(self):
             self._functions[n] = c
             for a in c.aliases:
                 self._functions[a] = c
+        self.version += 1
 
 
 _ff = FormatterFunctions()
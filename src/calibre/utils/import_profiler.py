@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2024, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Record the tree of modules imported by a calibre process, with the time taken
+to import each of them. Enabled by setting the CALIBRE_PROFILE_IMPORTS
+environment variable, which works for every calibre entry point, including
+the frozen builds that ignore the PYTHONPROFILEIMPORTTIME variable. If the
+value of the variable is a path, the report is written to that file,
+otherwise it is printed to stderr when the process exits.
+'''
+
+import atexit
+import os
+import sys
+import threading
+from time import perf_counter
+
+
+class ImportNode:
+
+    __slots__ = ('name', 'cumulative', 'children')
+
+    def __init__(self, name):
+        self.name = name
+        self.cumulative = 0.
+        self.children = []
+
+    @property
+    def self_time(self):
+        return self.cumulative - sum(c.cumulative for c in self.children)
+
+
+class TimedLoader:
+
+    def __init__(self, loader, profiler, name):
+        self.loader, self.profiler, self.name = loader, profiler, name
+        self.create_time = 0.
+
+    def __getattr__(self, attr):
+        return getattr(self.loader, attr)
+
+    def create_module(self, spec):
+        st = perf_counter()
+        try:
+            return self.loader.create_module(spec)
+        finally:
+            self.create_time = perf_counter() - st
+
+    def exec_module(self, module):
+        node = ImportNode(self.name)
+        stack = self.profiler.stack
+        stack[-1].children.append(node)
+        stack.append(node)
+        st = perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            node.cumulative = perf_counter() - st + self.create_time
+            stack.pop()
+
+
+class ImportProfiler:
+
+    def __init__(self):
+        self.root = ImportNode('')
+        self.local = threading.local()
+        self.start = perf_counter()
+
+    @property
+    def stack(self):
+        ans = getattr(self.local, 'stack', None)
+        if ans is None:
+            ans = self.local.stack = [self.root]
+        return ans
+
+    def find_spec(self, fullname, path, target=None):
+        if getattr(self.local, 'finding', False):
+            return None
+        self.local.finding = True
+        try:
+            for finder in sys.meta_path:
+                if finder is not self and hasattr(finder, 'find_spec'):
+                    spec = finder.find_spec(fullname, path, target)
+                    if spec is not None:
+                        break
+            else:
+                return None
+        finally:
+            self.local.finding = False
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = TimedLoader(spec.loader, self, fullname)
+        return spec
+
+    def report(self, min_time=0.0001):
+        lines = ['Import times in milliseconds: cumulative, self, module']
+
+        def render(node, depth):
+            for child in node.children:
+                if child.cumulative >= min_time:
+                    lines.append('{:9.1f} {:8.1f} {}{}'.format(
+                        child.cumulative * 1000, child.self_time * 1000, '  ' * depth, child.name))
+                    render(child, depth + 1)
+
+        def count(node):
+            return len(node.children) + sum(count(c) for c in node.children)
+
+        render(self.root, 0)
+        lines.append('{} modules imported in {:.1f} ms, {:.1f} ms after the profiler was installed'.format(
+            count(self.root), sum(c.cumulative for c in self.root.children) * 1000, (perf_counter() - self.start) * 1000))
+        return '\n'.join(lines)
+
+
+def write_report(profiler, output):
+    report = profiler.report()
+    if output and output != '1':
+        with open(output, 'w') as f:
+            print(report, file=f)
+    else:
+        print(report, file=sys.stderr)
+
+
+def install_import_profiler(output=None):
+    profiler = ImportProfiler()
+    sys.meta_path.insert(0, profiler)
+    atexit.register(write_report, profiler, output)
+    return profiler
+
+
+def benchmark_startup(code='import calibre.customize.ui', repeat=5):
+    '''
+    Run code in fresh calibre processes and print the fastest time taken and
+    the number of modules imported, for comparing the start up cost of
+    commands before and after a change. For example::
+
+        calibre-debug -c "from calibre.utils.import_profiler import *; benchmark_startup()"
+    '''
+    import subprocess
+    import tempfile
+    from calibre.debug import run_calibre_debug
+    times = []
+    with tempfile.TemporaryDirectory() as tdir:
+        output = os.path.join(tdir, 'report.txt')
+        env = dict(os.environ, CALIBRE_PROFILE_IMPORTS=output)
+        for i in range(repeat):
+            p = run_calibre_debug('-c', code, env=env, stdout=subprocess.DEVNULL)
+            if p.wait() != 0:
+                raise SystemExit(f'Running {code!r} failed')
+            with open(output) as f:
+                summary = f.read().splitlines()[-1]
+            times.append(float(summary.split()[4]))
+    print(f'{code}: {min(times):.1f} ms (fastest of {repeat} runs)', summary.split()[0], 'modules imported')
@@ -274,8 +274,20 @@ def ok(x):
         a(find_tests())
         from calibre.ebooks.metadata.author_mapper import find_tests
         a(find_tests())
+        from calibre.ebooks.metadata.sources.http_cache import find_tests
+        a(find_tests())
+        from calibre.ebooks.metadata.sources.rate_limit import find_tests
+        a(find_tests())
         from calibre.utils.shared_file import find_tests
         a(find_tests())
+        from calibre.devices.smart_device_app.test_driver import find_tests
+        a(find_tests())
+        from calibre.utils.zipfile import find_tests
+        a(find_tests())
+        from calibre.customize.zipplugin import find_tests
+        a(find_tests())
+        from calibre.customize.ui import find_tests
+        a(find_tests())
         from calibre.utils.test_lock import find_tests
         a(find_tests())
         from calibre.utils.search_query_parser_test import find_tests
@@ -284,6 +296,8 @@ def ok(x):
         a(find_tests())
         from calibre.utils.shm import find_tests
         a(find_tests())
+        from calibre.utils.fonts.scanner import find_tests
+        a(find_tests())
         from calibre.library.comments import find_tests
         a(find_tests())
         from calibre.ebooks.compression.palmdoc import find_tests
@@ -11,10 +11,10 @@
 import struct
 import sys
 import time
-from contextlib import closing
+from contextlib import closing, suppress
 
 from calibre import sanitize_file_name
-from calibre.constants import filesystem_encoding
+from calibre.constants import filesystem_encoding, iswindows
 from calibre.ebooks.chardet import detect
 from calibre.ptempfile import SpooledTemporaryFile
 from polyglot.builtins import string_or_bytes, as_bytes
@@ -1472,12 +1472,219 @@ def close(self):
         self.fp = None
 
 
+# Zip files larger than this have the files replaced by safe_replace() written
+# in place, instead of being re-created
+IN_PLACE_MIN_SIZE = 4 * 1024 * 1024
+# If all the files that are to be replaced are within this many bytes of the
+# central directory, everything after the first of them is re-written,
+# otherwise the new files are appended, leaving the old ones unused
+TAIL_REWRITE_MAX_SIZE = 1024 * 1024
+# The zip file is re-created, compacting it, once more than this fraction of
+# it would be unused
+MAX_UNUSED_FRACTION = 0.25
+JOURNAL_SUFFIX = '.calibre-zip-journal'
+JOURNAL_MAGIC = b'CALIBRE-ZIP-JOURNAL-1\0'
+JOURNAL_HEADER = '<QQL'
+
+
+def zip_journal_path(zipstream):
+    name = getattr(zipstream, 'name', None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return os.path.abspath(name) + JOURNAL_SUFFIX
+
+
+class ZipUpdateJournal:
+
+    '''
+    Before a zip file is changed, the bytes from the offset at which the
+    changes start to the end of the file are saved next to it. If the update
+    is interrupted, for example by a crash, :func:`recover_interrupted_update`
+    uses them to restore the zip file to its previous state. Streams that do
+    not correspond to a file on disk are not journalled.
+    '''
+
+    def __init__(self, zipstream):
+        self.stream = zipstream
+        self.path = zip_journal_path(zipstream)
+
+    def begin(self, offset):
+        if self.path is None:
+            return
+        self.stream.seek(0, os.SEEK_END)
+        size = self.stream.tell() - offset
+        self.stream.seek(offset)
+        crc = 0
+        with open(self.path, 'wb') as f:
+            f.write(JOURNAL_MAGIC + struct.pack(JOURNAL_HEADER, offset, size, 0))
+            while True:
+                chunk = self.stream.read(1024 * 1024)
+                if not chunk:
+                    break
+                crc = crc32(chunk, crc)
+                f.write(chunk)
+            # The checksum is written last so that a partially written
+            # journal is never used
+            f.seek(len(JOURNAL_MAGIC))
+            f.write(struct.pack(JOURNAL_HEADER, offset, size, crc & 0xffffffff))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def commit(self):
+        self.stream.flush()
+        if self.path is None:
+            return
+        os.fsync(self.stream.fileno())
+        os.remove(self.path)
+
+
+def recover_interrupted_update(zipstream):
+    '''
+    Undo an update of the zip file that was interrupted, if any. Returns True
+    if the zip file was restored.
+    '''
+    path = zip_journal_path(zipstream)
+    if path is None or not os.path.exists(path):
+        return False
+    restored = False
+    hsz = len(JOURNAL_MAGIC) + struct.calcsize(JOURNAL_HEADER)
+    with open(path, 'rb') as f:
+        header = f.read(hsz)
+        if len(header) == hsz and header.startswith(JOURNAL_MAGIC):
+            offset, size, crc = struct.unpack(JOURNAL_HEADER, header[len(JOURNAL_MAGIC):])
+            actual = 0
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                actual = crc32(chunk, actual)
+            if f.tell() - hsz == size and actual & 0xffffffff == crc:
+                f.seek(hsz)
+                zipstream.seek(offset)
+                shutil.copyfileobj(f, zipstream)
+                zipstream.truncate()
+                zipstream.flush()
+                os.fsync(zipstream.fileno())
+                restored = True
+    os.remove(path)
+    return restored
+
+
+def in_place_update_offset(z, size, names):
+    '''
+    Return the offset from which the zip file has to be re-written to replace
+    the specified files, or None if the zip file should be re-created instead.
+    '''
+    infos = z.infolist()
+    if (size < IN_PLACE_MIN_SIZE or z.start_dir > ZIP64_LIMIT or len(z.NameToInfo) != len(infos) or
+            any(i.flag_bits & 0x1 for i in infos)):
+        return None
+    try:
+        z._calculate_file_offsets()
+    except Exception:
+        return None
+    ordered = sorted(infos, key=lambda i: i.header_offset)
+    changed = [i for i in ordered if i.filename in names]
+    first = changed[0].header_offset if changed else z.start_dir
+    if z.start_dir - first <= TAIL_REWRITE_MAX_SIZE:
+        return first
+    if changed[0] is ordered[0]:
+        # The first file, such as the mimetype file in an EPUB, must stay first
+        return None
+    used = sum(i.file_offset - i.header_offset + i.compress_size + (12 if i.flag_bits & 0x08 else 0)
+               for i in ordered if i.filename not in names)
+    if z.start_dir - ordered[0].header_offset - used > MAX_UNUSED_FRACTION * size:
+        return None
+    return z.start_dir
+
+
+def replace_in_place(z, offset, replacements, add_missing):
+    # Files after offset are re-written in their original order, with the
+    # replaced files in their old positions, the replacements for files
+    # before offset are appended after them, leaving the old data unused.
+    tail = sorted((i for i in z.infolist() if i.header_offset >= offset), key=lambda i: i.header_offset)
+    tail = [(i, None if i.filename in replacements else z.read_raw(i)) for i in tail]
+    moved = [i for i in z.infolist() if i.header_offset < offset and i.filename in replacements]
+    z.filelist = [i for i in z.filelist if i.header_offset < offset and i.filename not in replacements]
+    found = set()
+    z.mode = 'a'
+    z.fp.seek(offset)
+    for obj, raw in tail:
+        if raw is None:
+            z.writestr(obj, replacements[obj.filename])
+            found.add(obj.filename)
+        else:
+            z.writestr(obj, raw, raw_bytes=True)
+    for obj in moved:
+        z.writestr(obj, replacements[obj.filename])
+        found.add(obj.filename)
+    if add_missing:
+        for name in sorted(set(replacements) - found):
+            z.writestr(name, replacements[name])
+    z._didModify = True
+    z.close()
+
+
+def recreate_zip(z, dest, replacements, add_missing):
+    names = frozenset(replacements)
+    found = set()
+    ztemp = ZipFile(dest, 'w')
+    for obj in z.infolist():
+        if isinstance(obj.filename, str):
+            obj.flag_bits |= 0x16  # Set isUTF-8 bit
+        if obj.filename in names:
+            ztemp.writestr(obj, replacements[obj.filename])
+            found.add(obj.filename)
+        else:
+            ztemp.writestr(obj, z.read_raw(obj), raw_bytes=True)
+    if add_missing:
+        for name in names - found:
+            ztemp.writestr(name, replacements[name])
+    ztemp.close()
+
+
+def recreate_zip_by_rename(z, zipstream, replacements, add_missing):
+    '''
+    Re-create the zip file as a new file next to it and rename that over it.
+    The rename is atomic, so unlike copying the new zip file into the stream,
+    this needs no journal. The stream is then made to refer to the new file.
+    Returns False, without changing anything, if the stream is not a file on
+    disk or if the file cannot be renamed while it is open, as on Windows.
+    '''
+    name = getattr(zipstream, 'name', None)
+    if iswindows or not isinstance(name, str) or not os.path.isfile(name):
+        return False
+    path = os.path.abspath(name)
+    tpath = path + '.calibre-zip-tmp'
+    try:
+        with open(tpath, 'w+b') as f:
+            recreate_zip(z, f, replacements, add_missing)
+            z.close()
+            f.flush()
+            os.fsync(f.fileno())
+            shutil.copymode(path, tpath)
+            os.replace(tpath, path)
+            zipstream.flush()
+            os.dup2(f.fileno(), zipstream.fileno())
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tpath)
+        raise
+    zipstream.seek(0)
+    return True
+
+
 def safe_replace(zipstream, name, datastream, extra_replacements={},
         add_missing=False):
     '''
-    Replace a file in a zip file in a safe manner. This proceeds by extracting
-    and re-creating the zipfile. This is necessary because :method:`ZipFile.replace`
-    sometimes created corrupted zip files.
+    Replace a file in a zip file in a safe manner. For small zip files, this
+    proceeds by extracting and re-creating the zipfile. This is necessary
+    because :method:`ZipFile.replace` sometimes created corrupted zip files.
+    In large zip files only the files after the first replaced file, or just
+    the new files and the central directory are written, see
+    :func:`in_place_update_offset`. The part of the zip file that is changed
+    is saved in a journal first, so that an interrupted update can be undone.
+    Zip files that are re-created are renamed over the original file, when
+    possible, see :func:`recreate_zip_by_rename`.
 
 
     :param zipstream:  Stream from a zip file
@@ -1490,38 +1697,34 @@ def safe_replace(zipstream, name, datastream, extra_replacements={},
                         are not created.
 
     '''
+    recover_interrupted_update(zipstream)
     z = ZipFile(zipstream, 'r')
     replacements = {name:datastream}
     replacements.update(extra_replacements)
-    names = frozenset(replacements.keys())
-    found = set()
-
-    def rbytes(name):
-        r = replacements[name]
+    for k, r in tuple(replacements.items()):
         if not isinstance(r, bytes):
-            r = r.read()
-        return r
+            replacements[k] = r.read()
+    journal = ZipUpdateJournal(zipstream)
+    zipstream.seek(0, os.SEEK_END)
+    offset = in_place_update_offset(z, zipstream.tell(), frozenset(replacements))
+    if offset is not None:
+        journal.begin(offset)
+        replace_in_place(z, offset, replacements, add_missing)
+        zipstream.truncate()
+        journal.commit()
+        return
 
+    if recreate_zip_by_rename(z, zipstream, replacements, add_missing):
+        return
     with SpooledTemporaryFile(max_size=100*1024*1024) as temp:
-        ztemp = ZipFile(temp, 'w')
-        for obj in z.infolist():
-            if isinstance(obj.filename, str):
-                obj.flag_bits |= 0x16  # Set isUTF-8 bit
-            if obj.filename in names:
-                ztemp.writestr(obj, rbytes(obj.filename))
-                found.add(obj.filename)
-            else:
-                ztemp.writestr(obj, z.read_raw(obj), raw_bytes=True)
-        if add_missing:
-            for name in names - found:
-                ztemp.writestr(name, rbytes(name))
-        ztemp.close()
+        recreate_zip(z, temp, replacements, add_missing)
         z.close()
+        journal.begin(0)
         temp.seek(0)
         zipstream.seek(0)
         zipstream.truncate()
         shutil.copyfileobj(temp, zipstream)
-        zipstream.flush()
+        journal.commit()
 
 
 class PyZipFile(ZipFile):
@@ -1629,6 +1832,139 @@ def extractall(source, dest):
         zf.extractall(dest)
 
 
+def find_tests():
+    import random
+    import tempfile
+    import unittest
+    import zipfile as pyzipfile
+    from unittest.mock import patch
+
+    def random_data(rng, size):
+        if rng.random() < 0.5:
+            return rng.getrandbits(8 * size).to_bytes(size, 'little') if size else b''
+        return b''.join(rng.choice((b'abc', b'<p>', b'xyz ', b'\n')) for i in range(size // 3))
+
+    class TestSafeReplace(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.tdir)
+
+        def create(self, rng, path):
+            files = {'mimetype': b'application/epub+zip'}
+            for i in range(rng.randint(1, 12)):
+                files[f'dir{rng.randint(0, 3)}/file-{i}é.html'] = random_data(rng, rng.randint(0, 30000))
+            with pyzipfile.ZipFile(path, 'w') as zf:
+                for name, data in files.items():
+                    zf.writestr(name, data, compress_type=rng.choice((pyzipfile.ZIP_STORED, pyzipfile.ZIP_DEFLATED)))
+            return files
+
+        def check(self, path, files):
+            with pyzipfile.ZipFile(path) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(zf.namelist()[0], 'mimetype')
+                self.assertEqual(sorted(zf.namelist()), sorted(files))
+                for name, data in files.items():
+                    self.assertEqual(zf.read(name), data, name)
+                self.assertEqual(min(zf.infolist(), key=lambda i: i.header_offset).filename, 'mimetype')
+
+        def test_safe_replace_fuzz(self):
+            rng = random.Random(42)
+            path = os.path.join(self.tdir, 'test.zip')
+            for i in range(150):
+                files = self.create(rng, path)
+                limits = {
+                    'IN_PLACE_MIN_SIZE': rng.choice((0, 0, 1 << 30)),
+                    'TAIL_REWRITE_MAX_SIZE': rng.choice((0, 20000, 1 << 30)),
+                    'MAX_UNUSED_FRACTION': rng.choice((0, 1, 100)),
+                }
+                with patch.multiple(sys.modules[__name__], **limits):
+                    for r in range(rng.randint(1, 4)):
+                        existing = sorted(set(files) - {'mimetype'})
+                        names = rng.sample(existing, rng.randint(0, min(2, len(existing))))
+                        add_missing = rng.random() < 0.5
+                        if rng.random() < 0.5:
+                            names.append(f'new-{r}.xml')
+                        if not names:
+                            continue
+                        replacements = {n: io.BytesIO(random_data(rng, rng.randint(0, 20000))) for n in names}
+                        expected = dict(files)
+                        for n, data in replacements.items():
+                            if n in files or add_missing:
+                                expected[n] = data.getvalue()
+                        with open(path, 'r+b') as f:
+                            safe_replace(f, names[0], replacements[names[0]], extra_replacements=replacements, add_missing=add_missing)
+                        self.assertFalse(os.path.exists(path + JOURNAL_SUFFIX))
+                        self.check(path, expected)
+                        files = expected
+
+        def test_safe_replace_in_place(self):
+            rng = random.Random(7)
+            path = os.path.join(self.tdir, 'test.zip')
+            files = self.create(rng, path)
+            with pyzipfile.ZipFile(path) as zf:
+                last = max(zf.infolist(), key=lambda i: i.header_offset)
+            with open(path, 'rb') as f:
+                before = f.read()
+            with patch.multiple(sys.modules[__name__], IN_PLACE_MIN_SIZE=0), open(path, 'r+b') as f:
+                safe_replace(f, last.filename, b'changed')
+                f.seek(0)
+                after = f.read()
+            offset = last.header_offset
+            files[last.filename] = b'changed'
+            self.check(path, files)
+            self.assertEqual(before[:offset], after[:offset])
+
+        @unittest.skipIf(iswindows, 'Open files cannot be renamed over on Windows')
+        def test_safe_replace_recreate(self):
+            rng = random.Random(3)
+            path = os.path.join(self.tdir, 'test.zip')
+            files = self.create(rng, path)
+            os.chmod(path, 0o640)
+            name = sorted(set(files) - {'mimetype'})[0]
+            # A zip file that is re-created is renamed over the original,
+            # without a journal, and the stream then refers to the new file
+            with patch.object(ZipUpdateJournal, 'begin', side_effect=AssertionError('Journal used')), open(path, 'r+b') as f:
+                safe_replace(f, name, b'changed')
+                f.seek(0)
+                after = f.read()
+            files[name] = b'changed'
+            self.check(path, files)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), after)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o640)
+            self.assertEqual(os.listdir(self.tdir), ['test.zip'])
+
+        def test_journal_recovery(self):
+            rng = random.Random(13)
+            path = os.path.join(self.tdir, 'test.zip')
+            files = self.create(rng, path)
+            with open(path, 'rb') as f:
+                before = f.read()
+            with open(path, 'r+b') as f:
+                ZipUpdateJournal(f).begin(len(before) // 2)
+                f.seek(len(before) // 2)
+                f.write(b'garbage' * 1000)
+                f.truncate()
+            with open(path, 'r+b') as f:
+                self.assertTrue(recover_interrupted_update(f))
+            self.assertFalse(os.path.exists(path + JOURNAL_SUFFIX))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), before)
+            self.check(path, files)
+            # An incomplete journal is discarded
+            with open(path + JOURNAL_SUFFIX, 'wb') as f:
+                f.write(JOURNAL_MAGIC + b'\0' * 5)
+            with open(path, 'r+b') as f:
+                self.assertFalse(recover_interrupted_update(f))
+            self.assertFalse(os.path.exists(path + JOURNAL_SUFFIX))
+            self.check(path, files)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestSafeReplace)
+
+
 def main(args=None):
     import textwrap
     USAGE=textwrap.dedent("""\